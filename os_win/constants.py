@@ -25,11 +25,27 @@ HYPERV_VM_STATE_REBOOT = 10
 HYPERV_VM_STATE_PAUSED = 32768
 HYPERV_VM_STATE_SUSPENDED = 32769
 
+# Msvm_ComputerSystem caption of the VMs, as opposed to the host.
+VM_CAPTION = 'Virtual Machine'
+
 
 WMI_JOB_STATUS_STARTED = 4096
 WMI_JOB_STATE_RUNNING = 4
 WMI_JOB_STATE_COMPLETED = 7
 
+# Hyper-V WMI method return values, also used as job error codes.
+WMI_JOB_ERROR_FAILED = 32768
+WMI_JOB_ERROR_ACCESS_DENIED = 32769
+WMI_JOB_ERROR_NOT_SUPPORTED = 32770
+WMI_JOB_ERROR_TIMEOUT = 32772
+WMI_JOB_ERROR_INVALID_PARAMETER = 32773
+WMI_JOB_ERROR_SYSTEM_IN_USE = 32774
+WMI_JOB_ERROR_INVALID_STATE = 32775
+WMI_JOB_ERROR_INCORRECT_DATA_TYPE = 32776
+WMI_JOB_ERROR_SYSTEM_NOT_AVAILABLE = 32777
+WMI_JOB_ERROR_OUT_OF_MEMORY = 32778
+
+VM_SUMMARY_ELEMENT_NAME = 1
 VM_SUMMARY_NUM_PROCS = 4
 VM_SUMMARY_ENABLED_STATE = 100
 VM_SUMMARY_MEMORY_USAGE = 103
@@ -53,6 +53,25 @@ class HyperVVMNotFoundException(HyperVException):
     msg_fmt = _("VM not found: %(vm_name)s")
 
 
+class WMIJobTimeoutException(HyperVException):
+    msg_fmt = _("WMI job %(job_path)s did not finish in %(timeout)s "
+                "seconds.")
+
+
+class WMIJobFailed(HyperVException):
+    msg_fmt = _("WMI job failed with status %(job_state)s. "
+                "Error details: %(error_summ_desc)s - %(error_desc)s - "
+                "Error code: %(error_code)s")
+
+    def __init__(self, message=None, job_state=None, error_code=None,
+                 error_summ_desc=None, error_desc=None):
+        self.error_code = error_code
+        self.job_state = job_state
+        super(WMIJobFailed, self).__init__(
+            message=message, job_state=job_state, error_code=error_code,
+            error_summ_desc=error_summ_desc, error_desc=error_desc)
+
+
 class SMBException(OSWinException):
     pass
 
@@ -0,0 +1,28 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Benchmarks of the VMUtils, JobUtils and NetworkUtils hot paths.
+
+The benchmarks run against the fake WMI provider, so they do not require
+a Hyper-V host. WMI round trips, wall time and memory allocations are
+measured for each scenario, the results being saved as JSON. Round trip
+regressions are detected by comparing the results with a saved baseline:
+
+    python -m os_win.tests.benchmarks --scale small \\
+        --compare os_win/tests/benchmarks/baselines/small.json
+
+The baselines are updated using --output.
+"""
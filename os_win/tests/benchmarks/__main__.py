@@ -0,0 +1,85 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from __future__ import print_function
+
+import argparse
+import sys
+
+from os_win.tests.benchmarks import base
+from os_win.tests.benchmarks import scenarios
+from os_win.tests import fake_wmi
+
+
+def _get_parser():
+    parser = argparse.ArgumentParser(
+        prog='python -m os_win.tests.benchmarks',
+        description='Benchmarks the os-win hot paths against the fake WMI '
+                    'provider.')
+    parser.add_argument('--scale', choices=sorted(scenarios.SCALES),
+                        default='small')
+    parser.add_argument('--filter', default='',
+                        help='Only run the scenarios containing this string.')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Simulated latency of each WMI call, in '
+                             'seconds.')
+    parser.add_argument('--output', help='Saves the results to this file.')
+    parser.add_argument('--compare', help='Compares the results with this '
+                                          'baseline file.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='Accepted wall time and allocation increase '
+                             'ratio, when comparing.')
+    return parser
+
+
+def main(argv=None):
+    args = _get_parser().parse_args(argv)
+
+    latency = None
+    if args.latency:
+        latency = dict((category, args.latency)
+                       for category in (fake_wmi.QUERY, fake_wmi.ENUMERATION,
+                                        fake_wmi.ASSOCIATORS, fake_wmi.METHOD,
+                                        fake_wmi.GET_OBJECT))
+
+    results = {}
+    for scenario in scenarios.get_scenarios(args.scale):
+        if args.filter not in scenario.key:
+            continue
+        result = base.run_scenario(scenario, latency)
+        results[scenario.key] = result
+        print('%(key)s: round_trips=%(round_trips)s '
+              'cold_round_trips=%(cold_round_trips)s '
+              'wall_time=%(wall_time).6fs '
+              'allocated_bytes=%(allocated_bytes)s' % dict(result,
+                                                           key=scenario.key))
+
+    if args.output:
+        base.save_results(results, args.output)
+
+    if args.compare:
+        regressions, warnings = base.compare_results(
+            results, base.load_results(args.compare), args.tolerance)
+        for warning in warnings:
+            print('WARNING: %s' % warning)
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
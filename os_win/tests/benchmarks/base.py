@@ -0,0 +1,157 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import collections
+import json
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Not available on Python 2.
+    tracemalloc = None
+
+from os_win.tests import fake_wmi
+
+# The round trip averages are rounded, avoiding float noise.
+_ROUND_TRIPS_PRECISION = 2
+
+
+class Scenario(object):
+    """Benchmarked operation, along with its parameters.
+
+    :param name: the scenario name, typically the benchmarked method.
+    :param setup: callable receiving the fake WMI provider and the
+                  parameters, which populates the provider and returns the
+                  benchmarked operation. The operation receives the
+                  iteration number.
+    :param params: dict of parameters, e.g. the VM count.
+    :param iterations: the number of measured operations.
+    :param provider_kwargs: additional FakeWMIProvider arguments.
+    """
+
+    def __init__(self, name, setup, params, iterations=5,
+                 provider_kwargs=None):
+        self.name = name
+        self.setup = setup
+        self.params = params
+        self.iterations = iterations
+        self.provider_kwargs = provider_kwargs or {}
+
+    @property
+    def key(self):
+        return '%s[%s]' % (self.name, ','.join(
+            '%s=%s' % (param, self.params[param])
+            for param in sorted(self.params)))
+
+
+def run_scenario(scenario, latency=None):
+    """Runs the scenario against a new fake WMI provider.
+
+    The first operation warms up the caches (e.g. the WMI connections), its
+    round trips being reported separately as cold_round_trips. The other
+    values are averaged per operation.
+    """
+    provider = fake_wmi.FakeWMIProvider(latency=latency,
+                                        **scenario.provider_kwargs)
+    fake_wmi_module = fake_wmi.FakeWMIModule(provider)
+    with fake_wmi_module.patch():
+        operation = scenario.setup(provider, **scenario.params)
+
+        provider.call_counts.clear()
+        operation(0)
+        cold_round_trips = sum(provider.call_counts.values())
+
+        provider.call_counts.clear()
+        start = time.time()
+        for iteration in range(1, scenario.iterations + 1):
+            operation(iteration)
+        wall_time = (time.time() - start) / scenario.iterations
+
+        calls = collections.Counter()
+        for (category, class_name, name), count in (
+                provider.call_counts.items()):
+            calls[category] += count
+
+        allocated_bytes = None
+        if tracemalloc:
+            tracemalloc.start()
+            try:
+                operation(scenario.iterations + 1)
+                allocated_bytes = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+
+    return {
+        'round_trips': round(float(sum(calls.values())) / scenario.iterations,
+                             _ROUND_TRIPS_PRECISION),
+        'cold_round_trips': cold_round_trips,
+        'calls': dict((category, round(float(count) / scenario.iterations,
+                                       _ROUND_TRIPS_PRECISION))
+                      for category, count in calls.items()),
+        'wall_time': wall_time,
+        'allocated_bytes': allocated_bytes,
+    }
+
+
+def run_scenarios(scenarios, latency=None):
+    """Returns a dict mapping the scenario keys to the results."""
+    return collections.OrderedDict(
+        (scenario.key, run_scenario(scenario, latency))
+        for scenario in scenarios)
+
+
+def save_results(results, path):
+    with open(path, 'w') as f:
+        json.dump({'results': results}, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare_results(results, baseline, tolerance=0.5):
+    """Compares the results with a baseline.
+
+    Any round trip increase is a regression. Wall time and allocations
+    depend on the environment, only increases exceeding the given ratio
+    being reported, as warnings.
+
+    :returns: a (regressions, warnings) tuple of message lists.
+    """
+    regressions = []
+    warnings = []
+    for key, result in results.items():
+        expected = baseline.get(key)
+        if expected is None:
+            warnings.append('%s: missing from the baseline.' % key)
+            continue
+
+        for metric in ('round_trips', 'cold_round_trips'):
+            if result[metric] > expected[metric]:
+                regressions.append(
+                    '%s: %s increased from %s to %s.' % (
+                        key, metric, expected[metric], result[metric]))
+
+        for metric in ('wall_time', 'allocated_bytes'):
+            if result[metric] is None or not expected.get(metric):
+                continue
+            if result[metric] > expected[metric] * (1 + tolerance):
+                warnings.append(
+                    '%s: %s increased from %s to %s.' % (
+                        key, metric, expected[metric], result[metric]))
+    return regressions, warnings
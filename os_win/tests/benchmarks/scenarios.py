@@ -0,0 +1,187 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from os_win import constants
+from os_win.tests.benchmarks import base
+from os_win.utils.compute import vmutils
+from os_win.utils import jobutils
+from os_win.utils.network import networkutils
+
+_VM_NAME_FORMAT = 'instance-%05d'
+_ITERATIONS = 5
+
+# Scenario parameters, per scale.
+SCALES = {
+    'small': {'vm_count': [10],
+              'disk_count': [4],
+              'acl_count': [10],
+              'job_duration': [0]},
+    'large': {'vm_count': [100, 1000],
+              'disk_count': [8, 32],
+              'acl_count': [100, 1000],
+              'job_duration': [0, 0.3]},
+}
+
+
+class SecurityGroupRule(object):
+    """Minimal security group rule, as passed by the networking agents."""
+
+    def __init__(self, **properties):
+        self._properties = properties
+        for name, value in properties.items():
+            setattr(self, name, value)
+
+    def to_dict(self):
+        return dict(self._properties)
+
+    def __eq__(self, other):
+        return all(getattr(other, name, None) == value
+                   for name, value in self._properties.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def _get_rule(index, weight=None):
+    properties = {'Direction': networkutils.NetworkUtils._ACL_DIR_IN,
+                  'Action': networkutils.NetworkUtils._ACL_ACTION_ALLOW,
+                  'LocalPort': '80',
+                  'Protocol': 'tcp',
+                  'RemoteIPAddress': '10.%d.%d.%d/32' % (
+                      index // 65536, index // 256 % 256, index % 256)}
+    if weight is not None:
+        properties['Weight'] = weight
+    return properties
+
+
+def _get_vm_name(vm_count):
+    # Targets a VM from the middle of the list.
+    return _VM_NAME_FORMAT % (vm_count // 2)
+
+
+def create_vm(provider, vm_count):
+    provider.populate(vm_count, disks_per_vm=0, nics_per_vm=0)
+    vm_utils = vmutils.VMUtils()
+
+    def operation(iteration):
+        vm_utils.create_vm('bench-vm-%05d' % iteration, 1024, 2, False, 1.0,
+                           constants.VM_GEN_2, 'C:\\Instances',
+                           ['bench-notes'])
+    return operation
+
+
+def attach_drive(provider, vm_count, disk_count):
+    provider.populate(vm_count, disks_per_vm=disk_count, nics_per_vm=0)
+    vm_utils = vmutils.VMUtils()
+    vm_name = _get_vm_name(vm_count)
+    controller_path = vm_utils.get_vm_scsi_controller(vm_name)
+
+    def operation(iteration):
+        vm_utils.attach_drive(vm_name, 'C:\\Images\\bench-%s.vhdx' % iteration,
+                              controller_path, disk_count + iteration,
+                              constants.DISK)
+    return operation
+
+
+def attach_volume_to_controller(provider, vm_count, disk_count):
+    provider.populate(vm_count, disks_per_vm=disk_count, nics_per_vm=0)
+    vm_utils = vmutils.VMUtils()
+    vm_name = _get_vm_name(vm_count)
+    controller_path = vm_utils.get_vm_scsi_controller(vm_name)
+    mounted_disk_paths = [provider.add_mounted_disk(drive_number).path_()
+                          for drive_number in range(_ITERATIONS + 2)]
+
+    def operation(iteration):
+        vm_utils.attach_volume_to_controller(
+            vm_name, controller_path, disk_count + iteration,
+            mounted_disk_paths[iteration], serial='serial-%s' % iteration)
+    return operation
+
+
+def get_vm_summary_info(provider, vm_count):
+    provider.populate(vm_count, disks_per_vm=0, nics_per_vm=0,
+                      state=constants.HYPERV_VM_STATE_ENABLED)
+    vm_utils = vmutils.VMUtils()
+
+    def operation(iteration):
+        vm_utils.get_vm_summary_info(_VM_NAME_FORMAT % (iteration % vm_count))
+    return operation
+
+
+def get_active_instances(provider, vm_count):
+    provider.populate(vm_count // 2, disks_per_vm=0, nics_per_vm=0,
+                      state=constants.HYPERV_VM_STATE_ENABLED)
+    provider.populate(vm_count - vm_count // 2, disks_per_vm=0,
+                      nics_per_vm=0, name_format='stopped-%05d')
+    vm_utils = vmutils.VMUtils()
+
+    def operation(iteration):
+        vm_utils.get_active_instances()
+    return operation
+
+
+def _bind_security_rules(provider, acl_count, rule_count=10):
+    vm = provider.add_vm('bench-vm')
+    max_weight = networkutils.NetworkUtilsR2._MAX_WEIGHT
+    port = provider.add_port_allocation(
+        vm, 'bench-port',
+        acls=[_get_rule(index, weight=max_weight - 1 - index)
+              for index in range(acl_count)])
+    net_utils = networkutils.NetworkUtilsR2()
+
+    def operation(iteration):
+        first_index = acl_count + iteration * rule_count
+        sg_rules = [SecurityGroupRule(**_get_rule(index))
+                    for index in range(first_index, first_index + rule_count)]
+        net_utils._bind_security_rules(port, sg_rules)
+    return operation
+
+
+def _wait_for_job(provider, job_duration):
+    job_utils = jobutils.JobUtils()
+
+    def operation(iteration):
+        job_utils._wait_for_job(provider.add_job(job_duration))
+    return operation
+
+
+def get_scenarios(scale='small'):
+    params = SCALES[scale]
+    scenarios = []
+    for vm_count in params['vm_count']:
+        scenarios.append(base.Scenario('create_vm', create_vm,
+                                       {'vm_count': vm_count}, _ITERATIONS))
+        for disk_count in params['disk_count']:
+            disk_params = {'vm_count': vm_count, 'disk_count': disk_count}
+            scenarios.append(base.Scenario(
+                'attach_drive', attach_drive, disk_params, _ITERATIONS))
+            scenarios.append(base.Scenario(
+                'attach_volume_to_controller', attach_volume_to_controller,
+                disk_params, _ITERATIONS))
+        scenarios.append(base.Scenario(
+            'get_vm_summary_info', get_vm_summary_info,
+            {'vm_count': vm_count}, _ITERATIONS))
+        scenarios.append(base.Scenario(
+            'get_active_instances', get_active_instances,
+            {'vm_count': vm_count}, _ITERATIONS))
+    for acl_count in params['acl_count']:
+        scenarios.append(base.Scenario(
+            '_bind_security_rules', _bind_security_rules,
+            {'acl_count': acl_count}, _ITERATIONS))
+    for job_duration in params['job_duration']:
+        scenarios.append(base.Scenario(
+            '_wait_for_job', _wait_for_job,
+            {'job_duration': job_duration}, _ITERATIONS))
+    return scenarios
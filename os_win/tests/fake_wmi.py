@@ -0,0 +1,1304 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-memory simulator of the Hyper-V WMI object model.
+
+FakeWMIModule replaces the wmi module used by the utils classes, serving
+the requests from stateful FakeWMIProvider objects, one per host. The
+providers hold the instances of the root/virtualization/v2 namespace
+(VMs, setting data, resources, services and jobs) and implement the
+Msvm_VirtualSystemManagementService methods, the VM state changes and the
+migration service, so the utils classes can be exercised and benchmarked
+without a Hyper-V host:
+
+    fake_wmi_module = fake_wmi.FakeWMIModule(
+        fake_wmi.FakeWMIProvider(latency={fake_wmi.QUERY: 0.005}))
+    fake_wmi_module.provider.populate(1000)
+    with fake_wmi_module.patch():
+        vmutils.VMUtils().list_instances()
+
+Like the real WMI objects, the returned objects are snapshots. Changes
+have to be passed back through the management service methods in order
+to be persisted.
+
+WMI event subscriptions are not supported, so the job states are polled
+while patching, the event based features falling back to queries.
+"""
+
+import collections
+import contextlib
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+
+import mock
+from six.moves import builtins
+
+from os_win import constants
+from os_win.utils import baseutils
+from os_win.utils.compute import vminventory
+from os_win.utils.compute import vmpowerstate
+from os_win.utils.compute import vmutils
+from os_win.utils import jobutils
+
+V2_NAMESPACE = 'root/virtualization/v2'
+CIMV2_NAMESPACE = 'root/cimv2'
+
+# Latency injection categories.
+CONNECT = 'connect'
+QUERY = 'query'
+ENUMERATION = 'enumeration'
+ASSOCIATORS = 'associators'
+METHOD = 'method'
+GET_OBJECT = 'get_object'
+
+COMPUTER_SYSTEM = 'Msvm_ComputerSystem'
+PLANNED_COMPUTER_SYSTEM = 'Msvm_PlannedComputerSystem'
+VSSD = 'Msvm_VirtualSystemSettingData'
+RASD = 'Msvm_ResourceAllocationSettingData'
+SASD = 'Msvm_StorageAllocationSettingData'
+PROCESSOR_SETTING_DATA = 'Msvm_ProcessorSettingData'
+MEMORY_SETTING_DATA = 'Msvm_MemorySettingData'
+SYNTH_ETH_PORT_SETTING_DATA = 'Msvm_SyntheticEthernetPortSettingData'
+PORT_ALLOC_SETTING_DATA = 'Msvm_EthernetPortAllocationSettingData'
+SHUTDOWN_COMPONENT = 'Msvm_ShutdownComponent'
+DISK_DRIVE = 'Msvm_DiskDrive'
+CONCRETE_JOB = 'Msvm_ConcreteJob'
+SUMMARY_INFORMATION = 'Msvm_SummaryInformation'
+VIRTUAL_SYSTEM_MANAGEMENT_SERVICE = 'Msvm_VirtualSystemManagementService'
+MIGRATION_SERVICE = 'Msvm_VirtualSystemMigrationService'
+MIGRATION_SERVICE_SETTING_DATA = (
+    'Msvm_VirtualSystemMigrationServiceSettingData')
+MIGRATION_SETTING_DATA = 'Msvm_VirtualSystemMigrationSettingData'
+VIRTUAL_ETHERNET_SWITCH = 'Msvm_VirtualEthernetSwitch'
+PORT_ACL_SETTING_DATA = 'Msvm_EthernetSwitchPortAclSettingData'
+PORT_EXT_ACL_SETTING_DATA = 'Msvm_EthernetSwitchPortExtendedAclSettingData'
+ETHERNET_SWITCH_PORT = 'Msvm_EthernetSwitchPort'
+
+SETTINGS_DEFINE_STATE = 'Msvm_SettingsDefineState'
+SETTING_DATA_COMPONENT = 'Msvm_VirtualSystemSettingDataComponent'
+ELEMENT_SETTING_DATA = 'Msvm_ElementSettingData'
+AFFECTED_JOB_ELEMENT = 'Msvm_AffectedJobElement'
+SYSTEM_DEVICE = 'Msvm_SystemDevice'
+
+VM_CAPTION = constants.VM_CAPTION
+VIRTUAL_SYSTEM_TYPE_REALIZED = 'Microsoft:Hyper-V:System:Realized'
+
+PHYS_DISK_RES_SUB_TYPE = 'Microsoft:Hyper-V:Physical Disk Drive'
+DISK_DRIVE_RES_SUB_TYPE = 'Microsoft:Hyper-V:Synthetic Disk Drive'
+DVD_DRIVE_RES_SUB_TYPE = 'Microsoft:Hyper-V:Synthetic DVD Drive'
+HARD_DISK_RES_SUB_TYPE = 'Microsoft:Hyper-V:Virtual Hard Disk'
+DVD_DISK_RES_SUB_TYPE = 'Microsoft:Hyper-V:Virtual CD/DVD Disk'
+IDE_CTRL_RES_SUB_TYPE = 'Microsoft:Hyper-V:Emulated IDE Controller'
+SCSI_CTRL_RES_SUB_TYPE = 'Microsoft:Hyper-V:Synthetic SCSI Controller'
+SERIAL_PORT_RES_SUB_TYPE = 'Microsoft:Hyper-V:Serial Port'
+SYNTH_ETH_PORT_RES_SUB_TYPE = 'Microsoft:Hyper-V:Synthetic Ethernet Port'
+ETH_CONNECTION_RES_SUB_TYPE = 'Microsoft:Hyper-V:Ethernet Connection'
+
+_MIGRATION_TYPE_STAGED = 32770
+_MIGRATION_TYPE_VIRTUAL_SYSTEM_AND_STORAGE = 32771
+
+_KILL_JOB_STATE_CHANGE_REQUEST = 5
+_STATE_CHANGE_INVALID_STATE = 32775
+
+_LOGICAL_DEVICE_KEYS = ('CreationClassName', 'DeviceID',
+                        'SystemCreationClassName', 'SystemName')
+_SERVICE_KEYS = ('CreationClassName', 'Name', 'SystemCreationClassName',
+                 'SystemName')
+_CLASS_KEYS = {
+    COMPUTER_SYSTEM: ('CreationClassName', 'Name'),
+    PLANNED_COMPUTER_SYSTEM: ('CreationClassName', 'Name'),
+    VIRTUAL_ETHERNET_SWITCH: ('CreationClassName', 'Name'),
+    SHUTDOWN_COMPONENT: _LOGICAL_DEVICE_KEYS,
+    DISK_DRIVE: _LOGICAL_DEVICE_KEYS,
+    ETHERNET_SWITCH_PORT: _LOGICAL_DEVICE_KEYS,
+    VIRTUAL_SYSTEM_MANAGEMENT_SERVICE: _SERVICE_KEYS,
+    MIGRATION_SERVICE: _SERVICE_KEYS,
+    SUMMARY_INFORMATION: (),
+}
+_DEFAULT_KEYS = ('InstanceID', )
+
+# Resource setting data default instances, as (class, subtype, type).
+_DEFAULT_RESOURCES = [
+    (RASD, PHYS_DISK_RES_SUB_TYPE, 17),
+    (RASD, DISK_DRIVE_RES_SUB_TYPE, 17),
+    (RASD, DVD_DRIVE_RES_SUB_TYPE, 16),
+    (RASD, IDE_CTRL_RES_SUB_TYPE, 5),
+    (RASD, SCSI_CTRL_RES_SUB_TYPE, 6),
+    (RASD, SERIAL_PORT_RES_SUB_TYPE, 21),
+    (SASD, HARD_DISK_RES_SUB_TYPE, 31),
+    (SASD, DVD_DISK_RES_SUB_TYPE, 31),
+    (SYNTH_ETH_PORT_SETTING_DATA, SYNTH_ETH_PORT_RES_SUB_TYPE, 10),
+    (PORT_ALLOC_SETTING_DATA, ETH_CONNECTION_RES_SUB_TYPE, 33),
+]
+# Feature setting data default instances.
+_DEFAULT_FEATURES = [PORT_ACL_SETTING_DATA, PORT_EXT_ACL_SETTING_DATA]
+
+_EMBEDDED_INSTANCE_PREFIX = 'FAKEWMI:'
+
+
+class FakeCOMError(object):
+    def __init__(self, hresult):
+        self.hresult = hresult
+
+
+class FakeWMIError(Exception):
+    """Replaces wmi.x_wmi, carrying a com_error having a hresult."""
+
+    def __init__(self, info='', hresult=None):
+        super(FakeWMIError, self).__init__(info)
+        self.info = info
+        self.message = info
+        self.com_error = FakeCOMError(hresult)
+
+
+class FakeWMITimedOut(FakeWMIError):
+    pass
+
+
+class FakeWMIPath(object):
+    def __init__(self, class_name, rel_path, path):
+        self.Class = class_name
+        self.RelPath = rel_path
+        self.Path = path
+
+
+def _normalize_path(path):
+    """Returns the lookup key of an object path, ignoring the host.
+
+    Separator runs are collapsed, so that the paths match regardless of
+    the key values being escaped or not.
+    """
+    path = re.sub(r'[\\/]+', '/', path).lower()
+    if path.startswith('/'):
+        path = path[1:].split('/', 1)[-1]
+    return path
+
+
+def _to_embedded_instance(class_name, properties):
+    return _EMBEDDED_INSTANCE_PREFIX + json.dumps(
+        {'class': class_name, 'properties': properties})
+
+
+def _from_embedded_instance(text):
+    if not text or not text.startswith(_EMBEDDED_INSTANCE_PREFIX):
+        raise FakeWMIError('Invalid embedded instance: %s' % text)
+    data = json.loads(text[len(_EMBEDDED_INSTANCE_PREFIX):])
+    return data['class'], data['properties']
+
+
+class _Instance(object):
+    """Stored WMI instance, never handed out directly."""
+
+    def __init__(self, namespace, class_name, properties, key_names, path):
+        self.namespace = namespace
+        self.class_name = class_name
+        self.properties = properties
+        self.key_names = key_names
+        self.path = path
+        # List of (association_class, instance) tuples.
+        self.links = []
+
+
+class FakeWMIObject(object):
+    """Snapshot of a WMI instance, mimicking wmi._wmi_object.
+
+    Reading properties that are not set returns None, as it happens for
+    the null WMI properties. Methods are dispatched to the provider, based
+    on the object path.
+    """
+
+    def __init__(self, provider, class_name, properties, path=''):
+        object.__setattr__(self, '_provider', provider)
+        object.__setattr__(self, '_class_name', class_name)
+        object.__setattr__(self, '_properties', properties)
+        object.__setattr__(self, '_path', path)
+
+    def __getattr__(self, name):
+        method = self._provider._get_method(self._class_name, name)
+        if method:
+            return lambda *args, **kwargs: self._provider._call_method(
+                self, name, method, *args, **kwargs)
+        if name in self._properties:
+            return self._properties[name]
+        if name[:1].isupper():
+            return None
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._properties[name] = value
+
+    def __eq__(self, other):
+        return (isinstance(other, FakeWMIObject) and
+                bool(self._path) and self._path == other._path)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._path) if self._path else id(self)
+
+    def __repr__(self):
+        return '<FakeWMIObject: %s>' % (self._path or self._class_name)
+
+    @property
+    def ole_object(self):
+        return self
+
+    def path_(self):
+        return self._path
+
+    def path(self):
+        rel_path = self._path.split(':', 1)[-1] if self._path else ''
+        return FakeWMIPath(self._class_name, rel_path, self._path)
+
+    def associators(self, wmi_association_class='', wmi_result_class=''):
+        return self._provider._get_associators(
+            self, wmi_association_class, wmi_result_class)
+
+    def GetText_(self, text_format=1):
+        return _to_embedded_instance(self._class_name,
+                                     dict(self._properties))
+
+    def set(self, **properties):
+        self._properties.update(properties)
+
+    def Clone_(self):
+        return FakeWMIObject(self._provider, self._class_name,
+                             dict(self._properties))
+
+
+class FakeWMIClass(object):
+    """Mimics wmi._wmi_class, e.g. conn.Msvm_ComputerSystem."""
+
+    def __init__(self, provider, namespace, class_name):
+        self._provider = provider
+        self._namespace = namespace
+        self._class_name = class_name
+
+    def __call__(self, fields=None, **where):
+        return self._provider._enumerate(self._namespace, self._class_name,
+                                         fields, where)
+
+    def new(self, **properties):
+        return FakeWMIObject(self._provider, self._class_name,
+                             dict(properties))
+
+    def watch_for(self, *args, **kwargs):
+        raise FakeWMIError('Event subscriptions are not supported.')
+
+
+class FakeWMINamespace(object):
+    """Mimics wmi._wmi_namespace, the object returned by wmi.WMI."""
+
+    def __init__(self, provider, namespace):
+        self._provider = provider
+        self._namespace = namespace
+
+    def query(self, wql, **kwargs):
+        return self._provider._query(self._namespace, wql)
+
+    def watch_for(self, *args, **kwargs):
+        raise FakeWMIError('Event subscriptions are not supported.')
+
+    def _raw_query(self, wql):
+        return iter(self._provider._query(self._namespace, wql))
+
+    def __getattr__(self, name):
+        if not name[:1].isupper():
+            raise AttributeError(name)
+        return FakeWMIClass(self._provider, self._namespace, name)
+
+
+class _WQLParser(object):
+    """Parses the WQL subset used by os-win.
+
+    Supported conditions: =, !=, <>, <, >, <=, >=, LIKE, IS [NOT] NULL,
+    combined with AND, OR, NOT and parentheses.
+    """
+
+    _QUERY_REGEX = re.compile(
+        r'^\s*SELECT\s+(?P<props>.+?)\s+FROM\s+(?P<class>\w+)'
+        r'(?:\s+WHERE\s+(?P<where>.+?))?\s*$', re.IGNORECASE | re.DOTALL)
+    _TOKEN_REGEX = re.compile(
+        r"\s*(?:(?P<string>'(?:[^']|'')*'|\"(?:[^\"\\]|\\.)*\")|"
+        r"(?P<op><>|!=|<=|>=|=|<|>)|(?P<paren>[()])|"
+        r"(?P<word>[\w.:-]+))")
+
+    def parse(self, wql):
+        match = self._QUERY_REGEX.match(wql)
+        if not match:
+            raise FakeWMIError('Unsupported query: %s' % wql)
+        props = [prop.strip() for prop in match.group('props').split(',')]
+        if props == ['*']:
+            props = None
+        predicate = None
+        if match.group('where'):
+            self._tokens = self._tokenize(match.group('where'))
+            self._pos = 0
+            predicate = self._parse_or()
+            if self._pos != len(self._tokens):
+                raise FakeWMIError('Unsupported query: %s' % wql)
+        return props, match.group('class'), predicate
+
+    def _tokenize(self, text):
+        tokens = []
+        pos = 0
+        text = text.rstrip()
+        while pos < len(text):
+            match = self._TOKEN_REGEX.match(text, pos)
+            if not match or match.end() == pos:
+                raise FakeWMIError('Unsupported WQL: %s' % text)
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            pos = match.end()
+        return tokens
+
+    def _peek(self):
+        if self._pos < len(self._tokens):
+            return self._tokens[self._pos]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        self._pos += 1
+        return token
+
+    def _peek_keyword(self, keyword):
+        kind, value = self._peek()
+        return kind == 'word' and value.upper() == keyword
+
+    def _parse_or(self):
+        operands = [self._parse_and()]
+        while self._peek_keyword('OR'):
+            self._next()
+            operands.append(self._parse_and())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda obj: any(operand(obj) for operand in operands)
+
+    def _parse_and(self):
+        operands = [self._parse_not()]
+        while self._peek_keyword('AND'):
+            self._next()
+            operands.append(self._parse_not())
+        if len(operands) == 1:
+            return operands[0]
+        return lambda obj: all(operand(obj) for operand in operands)
+
+    def _parse_not(self):
+        if self._peek_keyword('NOT'):
+            self._next()
+            operand = self._parse_not()
+            return lambda obj: not operand(obj)
+        if self._peek() == ('paren', '('):
+            self._next()
+            predicate = self._parse_or()
+            if self._next() != ('paren', ')'):
+                raise FakeWMIError('Unbalanced parentheses.')
+            return predicate
+        return self._parse_condition()
+
+    def _parse_condition(self):
+        kind, prop = self._next()
+        if kind != 'word':
+            raise FakeWMIError('Expected a property name, got: %s' % prop)
+        kind, operator = self._next()
+        if kind == 'word' and operator.upper() == 'IS':
+            negate = self._peek_keyword('NOT')
+            if negate:
+                self._next()
+            self._next()  # NULL
+            return lambda obj: (_get_value(obj, prop) is None) != negate
+        if kind == 'word' and operator.upper() == 'LIKE':
+            regex = _like_to_regex(self._parse_value())
+            return lambda obj: bool(regex.match(
+                str(_get_value(obj, prop) or '')))
+        if kind != 'op':
+            raise FakeWMIError('Unsupported operator: %s' % operator)
+        value = self._parse_value()
+        return lambda obj: _compare(_get_value(obj, prop), operator, value)
+
+    def _parse_value(self):
+        kind, token = self._next()
+        if kind == 'string':
+            if token[0] == "'":
+                return _unescape(token[1:-1].replace("''", "'"))
+            return _unescape(token[1:-1])
+        if kind == 'word':
+            if token.upper() in ('TRUE', 'FALSE'):
+                return token.upper() == 'TRUE'
+            if token.upper() == 'NULL':
+                return None
+            try:
+                return int(token)
+            except ValueError:
+                return token
+        raise FakeWMIError('Expected a value, got: %s' % token)
+
+
+def _unescape(value):
+    # Escaped backslashes and quotes. Other backslashes are kept as they
+    # are, which is how Hyper-V handles the unescaped object paths.
+    return re.sub(r'\\([\\\'"])', r'\1', value)
+
+
+def _like_to_regex(pattern):
+    regex = ''
+    for char in pattern:
+        if char == '%':
+            regex += '.*'
+        elif char == '_':
+            regex += '.'
+        else:
+            regex += re.escape(char)
+    return re.compile(regex + '$', re.IGNORECASE | re.DOTALL)
+
+
+def _get_value(instance, prop):
+    if prop.upper() == '__PATH':
+        return instance.path
+    if prop.upper() == '__CLASS':
+        return instance.class_name
+    return instance.properties.get(prop)
+
+
+def _compare(actual, operator, expected):
+    if actual is None or expected is None:
+        return (operator in ('!=', '<>')) == (actual is not expected)
+    if isinstance(actual, bool) or isinstance(expected, bool):
+        actual, expected = bool(actual), bool(expected)
+    elif isinstance(expected, int) and not isinstance(actual, int):
+        try:
+            actual = int(actual)
+        except (TypeError, ValueError):
+            actual, expected = str(actual).lower(), str(expected).lower()
+    elif not isinstance(expected, int):
+        # String comparisons are case insensitive.
+        actual, expected = str(actual).lower(), str(expected).lower()
+        if actual.startswith(('\\', '/')):
+            actual, expected = (_normalize_path(actual),
+                                _normalize_path(expected))
+
+    if operator == '=':
+        return actual == expected
+    if operator in ('!=', '<>'):
+        return actual != expected
+    if operator == '<':
+        return actual < expected
+    if operator == '>':
+        return actual > expected
+    if operator == '<=':
+        return actual <= expected
+    return actual >= expected
+
+
+class FakeWMIProvider(object):
+    """Stateful in-memory model of a Hyper-V host's WMI namespaces.
+
+    :param host_name: the host name, used in the object paths.
+    :param latency: simulated latency of the WMI calls. Either a dict
+                    mapping call categories (CONNECT, QUERY, ENUMERATION,
+                    ASSOCIATORS, METHOD, GET_OBJECT) to seconds, or a
+                    callable receiving the category, the class name and
+                    the call name, returning the latency in seconds.
+    :param job_duration: seconds it takes for the jobs started by the
+                         methods to complete. If None, the methods complete
+                         synchronously, without returning jobs.
+
+    The calls are counted in call_counts, keyed by (category, class name,
+    call name) tuples.
+    """
+
+    _METHODS = {
+        COMPUTER_SYSTEM: {
+            'RequestStateChange': '_request_state_change'},
+        SHUTDOWN_COMPONENT: {
+            'InitiateShutdown': '_initiate_shutdown'},
+        CONCRETE_JOB: {
+            'RequestStateChange': '_request_job_state_change'},
+        VIRTUAL_SYSTEM_MANAGEMENT_SERVICE: {
+            'DefineSystem': '_define_system',
+            'DestroySystem': '_destroy_system',
+            'ModifySystemSettings': '_modify_system_settings',
+            'AddResourceSettings': '_add_resource_settings',
+            'ModifyResourceSettings': '_modify_resource_settings',
+            'RemoveResourceSettings': '_remove_resource_settings',
+            'AddFeatureSettings': '_add_feature_settings',
+            'RemoveFeatureSettings': '_remove_resource_settings',
+            'GetSummaryInformation': '_get_summary_information'},
+        MIGRATION_SERVICE: {
+            'MigrateVirtualSystemToHost': '_migrate_virtual_system'},
+    }
+
+    _VM_STATE_CHANGES = {
+        constants.HYPERV_VM_STATE_REBOOT: constants.HYPERV_VM_STATE_ENABLED,
+        # Reset
+        11: constants.HYPERV_VM_STATE_ENABLED,
+    }
+
+    def __init__(self, host_name='FAKEHOST', latency=None, job_duration=None):
+        self.host_name = host_name
+        self.latency = latency or {}
+        self.job_duration = job_duration
+        self.call_counts = collections.Counter()
+        self.module = None
+
+        self._lock = threading.RLock()
+        self._counter = itertools.count(1)
+        self._parser_lock = threading.Lock()
+        self._parsed_queries = {}
+        # Maps namespaces to dicts mapping class names to instance lists.
+        self._classes = collections.defaultdict(
+            lambda: collections.defaultdict(list))
+        # Maps the normalized object paths to instances.
+        self._paths = {}
+        self._add_host_objects()
+
+    # Simulation helpers.
+
+    def _simulate_call(self, category, class_name, name):
+        self.call_counts[(category, class_name, name)] += 1
+        if callable(self.latency):
+            delay = self.latency(category, class_name, name)
+        else:
+            delay = self.latency.get(category)
+        if delay:
+            time.sleep(delay)
+
+    def _get_path(self, namespace, class_name, properties, key_names):
+        if not key_names:
+            return ''
+        keys = ','.join(
+            '%s="%s"' % (key, str(properties.get(key)).replace('\\', '\\\\'))
+            for key in key_names)
+        return '\\\\%s\\%s:%s.%s' % (self.host_name,
+                                     namespace.replace('/', '\\'),
+                                     class_name, keys)
+
+    def _snapshot(self, instance, properties=None):
+        """Returns a FakeWMIObject, optionally selecting some properties.
+
+        The object path is available only if the key properties are
+        selected, as it happens for the WMI projected queries.
+        """
+        if instance.class_name == CONCRETE_JOB:
+            self._update_job_state(instance)
+        if properties is None:
+            return FakeWMIObject(self, instance.class_name,
+                                 dict(instance.properties), instance.path)
+
+        selected = dict((prop, instance.properties.get(prop))
+                        for prop in properties)
+        has_keys = all(key in selected for key in instance.key_names)
+        return FakeWMIObject(self, instance.class_name, selected,
+                             instance.path if has_keys else '')
+
+    def _get_instance(self, path, required=True):
+        instance = self._paths.get(_normalize_path(path)) if path else None
+        if not instance and required:
+            raise FakeWMIError('Object not found: %s' % path,
+                               hresult=-2147217406)
+        return instance
+
+    def _get_instance_by_id(self, class_name, instance_id):
+        for instance in self._classes[V2_NAMESPACE][class_name]:
+            if instance.properties.get('InstanceID') == instance_id:
+                return instance
+        raise FakeWMIError('Instance not found: %s' % instance_id)
+
+    def _get_method(self, class_name, name):
+        return self._METHODS.get(class_name, {}).get(name)
+
+    def _call_method(self, obj, name, method, *args, **kwargs):
+        self._simulate_call(METHOD, obj._class_name, name)
+        with self._lock:
+            instance = self._get_instance(obj.path_())
+            return getattr(self, method)(instance, *args, **kwargs)
+
+    # Namespace operations.
+
+    def connect(self, namespace):
+        self._simulate_call(CONNECT, None, namespace)
+        return FakeWMINamespace(self, namespace.replace('\\', '/').strip(
+            '/').lower())
+
+    def get_object(self, namespace_path):
+        self._simulate_call(GET_OBJECT, None, 'Get')
+        with self._lock:
+            return self._snapshot(self._get_instance(namespace_path))
+
+    def _parse_query(self, wql):
+        parsed = self._parsed_queries.get(wql)
+        if parsed is None:
+            with self._parser_lock:
+                parsed = _WQLParser().parse(wql)
+            self._parsed_queries[wql] = parsed
+        return parsed
+
+    def _query(self, namespace, wql):
+        props, class_name, predicate = self._parse_query(wql)
+        self._simulate_call(QUERY, class_name, 'query')
+        with self._lock:
+            return [self._snapshot(instance, props)
+                    for instance in self._classes[namespace][class_name]
+                    if not predicate or predicate(instance)]
+
+    def _enumerate(self, namespace, class_name, fields, where):
+        self._simulate_call(ENUMERATION, class_name, class_name)
+        with self._lock:
+            return [self._snapshot(instance, fields or None)
+                    for instance in self._classes[namespace][class_name]
+                    if all(_compare(instance.properties.get(prop), '=',
+                                    value)
+                           for prop, value in where.items())]
+
+    def _get_associators(self, obj, association_class, result_class):
+        self._simulate_call(ASSOCIATORS, obj._class_name,
+                            result_class or association_class)
+        with self._lock:
+            instance = self._get_instance(obj.path_())
+            return [self._snapshot(other)
+                    for (assoc_class, other) in instance.links
+                    if (not association_class or
+                        assoc_class == association_class) and
+                    (not result_class or other.class_name == result_class)]
+
+    # Model building.
+
+    def add_object(self, class_name, namespace=V2_NAMESPACE, key_names=None,
+                   **properties):
+        """Adds an instance, returning a snapshot of it."""
+        with self._lock:
+            return self._snapshot(self._add_instance(
+                class_name, properties, namespace, key_names))
+
+    def _add_instance(self, class_name, properties, namespace=V2_NAMESPACE,
+                      key_names=None):
+        if key_names is None:
+            key_names = _CLASS_KEYS.get(class_name, _DEFAULT_KEYS)
+        path = self._get_path(namespace, class_name, properties, key_names)
+        instance = _Instance(namespace, class_name, properties, key_names,
+                             path)
+        self._classes[namespace][class_name].append(instance)
+        if path:
+            self._paths[_normalize_path(path)] = instance
+        return instance
+
+    def _remove_instance(self, instance):
+        self._classes[instance.namespace][instance.class_name].remove(
+            instance)
+        self._paths.pop(_normalize_path(instance.path), None)
+        for (assoc_class, other) in instance.links:
+            other.links = [link for link in other.links
+                           if link[1] is not instance]
+        instance.links = []
+
+    def _link(self, instance, other, association_class):
+        instance.links.append((association_class, other))
+        other.links.append((association_class, instance))
+
+    def associate(self, obj, other, association_class=None):
+        with self._lock:
+            self._link(self._get_instance(obj.path_()),
+                       self._get_instance(other.path_()), association_class)
+
+    def _new_guid(self):
+        return str(uuid.uuid4()).upper()
+
+    def _add_host_objects(self):
+        self._host = self._add_instance(
+            COMPUTER_SYSTEM,
+            {'CreationClassName': COMPUTER_SYSTEM, 'Name': self.host_name,
+             'ElementName': self.host_name,
+             'Caption': 'Hosting Computer System',
+             'EnabledState': constants.HYPERV_VM_STATE_ENABLED})
+        service_props = {'SystemCreationClassName': COMPUTER_SYSTEM,
+                         'SystemName': self.host_name}
+        self._add_instance(
+            VIRTUAL_SYSTEM_MANAGEMENT_SERVICE,
+            dict(service_props,
+                 CreationClassName=VIRTUAL_SYSTEM_MANAGEMENT_SERVICE,
+                 Name='vmms'))
+        migration_svc = self._add_instance(
+            MIGRATION_SERVICE,
+            dict(service_props, CreationClassName=MIGRATION_SERVICE,
+                 Name='vmms',
+                 MigrationServiceListenerIPAddressList=['10.0.0.1']))
+        migration_svc_settings = self._add_instance(
+            MIGRATION_SERVICE_SETTING_DATA,
+            {'InstanceID': 'Microsoft:MigrationServiceSettingData',
+             'EnableVirtualSystemMigration': True})
+        self._link(migration_svc, migration_svc_settings,
+                   ELEMENT_SETTING_DATA)
+        for migration_type in (_MIGRATION_TYPE_STAGED,
+                               _MIGRATION_TYPE_VIRTUAL_SYSTEM_AND_STORAGE):
+            self._add_instance(
+                MIGRATION_SETTING_DATA,
+                {'InstanceID': 'Microsoft:MigrationSettingData\\%s' %
+                 migration_type,
+                 'MigrationType': migration_type})
+
+        for class_name, res_sub_type, res_type in _DEFAULT_RESOURCES:
+            self._add_instance(
+                class_name,
+                {'InstanceID': 'Microsoft:Definition\\%s\\Default' %
+                 self._new_guid(),
+                 'ResourceSubType': res_sub_type,
+                 'ResourceType': res_type})
+        for class_name in _DEFAULT_FEATURES:
+            self._add_instance(
+                class_name,
+                {'InstanceID': 'Microsoft:Definition\\%s\\Default' %
+                 self._new_guid()})
+
+    def add_vm(self, name, vm_id=None, generation=constants.VM_GEN_2,
+               state=constants.HYPERV_VM_STATE_DISABLED, notes=None,
+               vcpus=1, memory_mb=512, scsi_controllers=1):
+        """Adds a VM along with its settings and default devices.
+
+        :returns: a snapshot of the Msvm_ComputerSystem instance.
+        """
+        with self._lock:
+            return self._snapshot(self._add_vm(
+                name, vm_id, generation, state, notes, vcpus, memory_mb,
+                scsi_controllers))
+
+    def _add_vm(self, name, vm_id=None, generation=constants.VM_GEN_2,
+                state=constants.HYPERV_VM_STATE_DISABLED, notes=None,
+                vcpus=1, memory_mb=512, scsi_controllers=1,
+                class_name=COMPUTER_SYSTEM, settings=None):
+        vm_id = vm_id or self._new_guid()
+        vm = self._add_instance(
+            class_name,
+            {'CreationClassName': class_name, 'Name': vm_id,
+             'ElementName': name, 'Caption': VM_CAPTION,
+             'EnabledState': state, 'HealthState': 5,
+             'OnTimeInMilliseconds': 0})
+        vssd_props = {
+            'ElementName': name,
+            'Notes': list(notes or []),
+            'VirtualSystemType': VIRTUAL_SYSTEM_TYPE_REALIZED,
+            'VirtualSystemSubType': 'Microsoft:Hyper-V:SubType:%s' %
+            generation}
+        vssd_props.update(settings or {})
+        vssd_props.update(InstanceID='Microsoft:%s' % vm_id,
+                          VirtualSystemIdentifier=vm_id)
+        vssd = self._add_instance(VSSD, vssd_props)
+        self._link(vm, vssd, SETTINGS_DEFINE_STATE)
+
+        self._add_resource(vssd, PROCESSOR_SETTING_DATA,
+                           {'ResourceType': 3,
+                            'ResourceSubType': 'Microsoft:Hyper-V:Processor',
+                            'VirtualQuantity': vcpus})
+        self._add_resource(vssd, MEMORY_SETTING_DATA,
+                           {'ResourceType': 4,
+                            'ResourceSubType': 'Microsoft:Hyper-V:Memory',
+                            'VirtualQuantity': memory_mb,
+                            'Reservation': memory_mb,
+                            'Limit': memory_mb,
+                            'DynamicMemoryEnabled': False})
+        if generation == constants.VM_GEN_1:
+            for address in ('0', '1'):
+                self._add_resource(vssd, RASD,
+                                   {'ResourceType': 5,
+                                    'ResourceSubType': IDE_CTRL_RES_SUB_TYPE,
+                                    'Address': address})
+        for i in range(scsi_controllers):
+            self._add_resource(vssd, RASD,
+                               {'ResourceType': 6,
+                                'ResourceSubType': SCSI_CTRL_RES_SUB_TYPE})
+
+        shutdown_component = self._add_instance(
+            SHUTDOWN_COMPONENT,
+            {'CreationClassName': SHUTDOWN_COMPONENT,
+             'DeviceID': 'Microsoft:%s\\ShutdownComponent' % vm_id,
+             'SystemCreationClassName': class_name,
+             'SystemName': vm_id})
+        self._link(vm, shutdown_component, SYSTEM_DEVICE)
+        return vm
+
+    def _add_resource(self, vssd, class_name, properties):
+        properties = dict(properties)
+        properties['InstanceID'] = '%s\\%s' % (
+            vssd.properties['InstanceID'], self._new_guid())
+        resource = self._add_instance(class_name, properties)
+        self._link(vssd, resource, SETTING_DATA_COMPONENT)
+        return resource
+
+    def _get_vm_settings(self, vm_instance):
+        return [other for (assoc_class, other) in vm_instance.links
+                if other.class_name == VSSD][0]
+
+    def _get_resources(self, vssd, class_name, res_sub_type=None):
+        return [other for (assoc_class, other) in vssd.links
+                if other.class_name == class_name and
+                (not res_sub_type or
+                 other.properties.get('ResourceSubType') == res_sub_type)]
+
+    def get_vm(self, name):
+        """Returns a snapshot of the VM having the given name."""
+        with self._lock:
+            for instance in self._classes[V2_NAMESPACE][COMPUTER_SYSTEM]:
+                if (instance.properties.get('ElementName') == name and
+                        instance.properties.get('Caption') == VM_CAPTION):
+                    return self._snapshot(instance)
+
+    def add_disk(self, vm, disk_path, is_physical=False, slot=None):
+        """Attaches a disk to the first SCSI controller of the VM.
+
+        :param disk_path: the image path, or the mounted disk path for
+                          passthrough disks.
+        :returns: a snapshot of the disk resource.
+        """
+        with self._lock:
+            vssd = self._get_vm_settings(self._get_instance(vm.path_()))
+            controller = self._get_resources(vssd, RASD,
+                                             SCSI_CTRL_RES_SUB_TYPE)[0]
+            drives = [other for (assoc_class, other) in vssd.links
+                      if other.properties.get('Parent') == controller.path]
+            if slot is None:
+                used_slots = set(int(drive.properties['AddressOnParent'])
+                                 for drive in drives)
+                slot = min(set(range(constants.SCSI_CONTROLLER_SLOTS_NUMBER))
+                           - used_slots)
+
+            drive_props = {'ResourceType': 17,
+                           'Parent': controller.path,
+                           'Address': str(slot),
+                           'AddressOnParent': str(slot)}
+            if is_physical:
+                drive_props.update(ResourceSubType=PHYS_DISK_RES_SUB_TYPE,
+                                   HostResource=[disk_path])
+                return self._snapshot(
+                    self._add_resource(vssd, RASD, drive_props))
+
+            drive_props['ResourceSubType'] = DISK_DRIVE_RES_SUB_TYPE
+            drive = self._add_resource(vssd, RASD, drive_props)
+            disk = self._add_resource(vssd, SASD,
+                                      {'ResourceType': 31,
+                                       'ResourceSubType':
+                                       HARD_DISK_RES_SUB_TYPE,
+                                       'Parent': drive.path,
+                                       'HostResource': [disk_path]})
+            return self._snapshot(disk)
+
+    def add_nic(self, vm, nic_name, mac_address=None):
+        with self._lock:
+            vssd = self._get_vm_settings(self._get_instance(vm.path_()))
+            return self._snapshot(self._add_resource(
+                vssd, SYNTH_ETH_PORT_SETTING_DATA,
+                {'ResourceType': 10,
+                 'ResourceSubType': SYNTH_ETH_PORT_RES_SUB_TYPE,
+                 'ElementName': nic_name,
+                 'Address': mac_address or '00155D000000',
+                 'StaticMacAddress': bool(mac_address)}))
+
+    def add_port_allocation(self, vm, port_name, acls=()):
+        """Adds a switch port allocation, along with the given ACLs.
+
+        :param acls: list of dicts, containing the ACL properties.
+        :returns: a snapshot of the port allocation.
+        """
+        with self._lock:
+            vssd = self._get_vm_settings(self._get_instance(vm.path_()))
+            port_alloc = self._add_resource(
+                vssd, PORT_ALLOC_SETTING_DATA,
+                {'ResourceType': 33,
+                 'ResourceSubType': ETH_CONNECTION_RES_SUB_TYPE,
+                 'ElementName': port_name})
+            for acl in acls:
+                acl = dict(acl, InstanceID='%s\\%s' % (
+                    port_alloc.properties['InstanceID'], self._new_guid()))
+                self._link(port_alloc,
+                           self._add_instance(PORT_EXT_ACL_SETTING_DATA, acl),
+                           ELEMENT_SETTING_DATA)
+            return self._snapshot(port_alloc)
+
+    def add_vswitch(self, name, vswitch_id=None):
+        return self.add_object(VIRTUAL_ETHERNET_SWITCH,
+                               CreationClassName=VIRTUAL_ETHERNET_SWITCH,
+                               Name=vswitch_id or self._new_guid(),
+                               ElementName=name)
+
+    def add_switch_port(self, vswitch, port_name):
+        return self.add_object(
+            ETHERNET_SWITCH_PORT,
+            CreationClassName=ETHERNET_SWITCH_PORT,
+            DeviceID='Microsoft:%s' % self._new_guid(),
+            SystemCreationClassName=VIRTUAL_ETHERNET_SWITCH,
+            SystemName=vswitch.Name,
+            Name=port_name,
+            ElementName=port_name)
+
+    def add_mounted_disk(self, drive_number):
+        return self.add_object(
+            DISK_DRIVE,
+            CreationClassName=DISK_DRIVE,
+            DeviceID='Microsoft:%s' % self._new_guid(),
+            SystemCreationClassName=COMPUTER_SYSTEM,
+            SystemName=self.host_name,
+            DriveNumber=drive_number)
+
+    def populate(self, vm_count, disks_per_vm=1, nics_per_vm=1,
+                 name_format='instance-%05d', **vm_kwargs):
+        """Adds multiple VMs, returning their names."""
+        names = []
+        for i in range(vm_count):
+            name = name_format % i
+            vm = self.add_vm(name, notes=[str(uuid.uuid4())], **vm_kwargs)
+            for disk_idx in range(disks_per_vm):
+                self.add_disk(vm, 'C:\\VHDs\\%s\\disk%s.vhdx' % (name,
+                                                                 disk_idx))
+            for nic_idx in range(nics_per_vm):
+                self.add_nic(vm, '%s-nic%s' % (name, nic_idx))
+            names.append(name)
+        return names
+
+    # Jobs.
+
+    def add_job(self, duration=0):
+        """Adds a job completing after the given amount of seconds.
+
+        :returns: the job path.
+        """
+        with self._lock:
+            return self._add_job(duration).path
+
+    def _add_job(self, duration, affected_instance=None):
+        job = self._add_instance(
+            CONCRETE_JOB,
+            {'InstanceID': self._new_guid(),
+             'JobState': constants.WMI_JOB_STATE_RUNNING,
+             'Cancellable': True,
+             'PercentComplete': 0,
+             'ErrorCode': 0,
+             'Description': 'Fake job',
+             'ElapsedTime': '00000000000000.000000:000',
+             'StartTime': time.time(),
+             'Duration': duration})
+        if affected_instance:
+            self._link(job, affected_instance, AFFECTED_JOB_ELEMENT)
+        return job
+
+    def _job_result(self, affected_instance, *outputs):
+        """Returns the job path, the given outputs and the return value."""
+        if self.job_duration is None:
+            return (None, ) + outputs + (0, )
+
+        job = self._add_job(self.job_duration, affected_instance)
+        return ((job.path, ) + outputs +
+                (constants.WMI_JOB_STATUS_STARTED, ))
+
+    def _update_job_state(self, job):
+        props = job.properties
+        if props['JobState'] != constants.WMI_JOB_STATE_RUNNING:
+            return
+        elapsed = time.time() - props['StartTime']
+        if elapsed >= props['Duration']:
+            props['JobState'] = constants.WMI_JOB_STATE_COMPLETED
+            props['PercentComplete'] = 100
+        else:
+            props['PercentComplete'] = int(100 * elapsed / props['Duration'])
+
+    def _request_job_state_change(self, job, requested_state, *args,
+                                  **kwargs):
+        self._update_job_state(job)
+        if (requested_state == _KILL_JOB_STATE_CHANGE_REQUEST and
+                job.properties['JobState'] ==
+                constants.WMI_JOB_STATE_RUNNING):
+            job.properties['JobState'] = constants.JOB_STATE_KILLED
+        return (0, )
+
+    # Computer system methods.
+
+    def _request_state_change(self, vm, requested_state, *args, **kwargs):
+        state = self._VM_STATE_CHANGES.get(requested_state, requested_state)
+        if vm.properties['EnabledState'] == state:
+            return (None, _STATE_CHANGE_INVALID_STATE)
+        vm.properties['EnabledState'] = state
+        return self._job_result(vm)
+
+    def _initiate_shutdown(self, shutdown_component, Force=False,
+                           Reason=None):
+        vm = [other for (assoc_class, other) in shutdown_component.links
+              if assoc_class == SYSTEM_DEVICE][0]
+        vm.properties['EnabledState'] = constants.HYPERV_VM_STATE_DISABLED
+        return (0, )
+
+    # Management service methods.
+
+    def _add_resource_from_text(self, vssd, text):
+        class_name, properties = _from_embedded_instance(text)
+        properties.pop('InstanceID', None)
+        return self._add_resource(vssd, class_name, properties)
+
+    def _get_vssd_for_path(self, path):
+        instance = self._get_instance(path)
+        if instance.class_name == VSSD:
+            return instance
+        return self._get_vm_settings(instance)
+
+    def _define_system(self, service, SystemSettings=None,
+                       ResourceSettings=None, ReferenceConfiguration=None):
+        class_name, settings = _from_embedded_instance(SystemSettings)
+        generation = int((settings.get('VirtualSystemSubType') or
+                          'Microsoft:Hyper-V:SubType:1').split(':')[-1])
+        settings.pop('InstanceID', None)
+        vm = self._add_vm(settings.get('ElementName'), generation=generation,
+                          notes=settings.get('Notes'), scsi_controllers=0,
+                          settings=settings)
+        vssd = self._get_vm_settings(vm)
+        for text in ResourceSettings or []:
+            self._add_resource_from_text(vssd, text)
+        return self._job_result(vm, vm.path)
+
+    def _destroy_vm(self, vm):
+        vssd = self._get_vm_settings(vm)
+        for (assoc_class, resource) in list(vssd.links):
+            if assoc_class == SETTING_DATA_COMPONENT:
+                self._remove_instance(resource)
+        for (assoc_class, other) in list(vm.links):
+            if assoc_class in (SETTINGS_DEFINE_STATE, SYSTEM_DEVICE):
+                self._remove_instance(other)
+        self._remove_instance(vm)
+
+    def _destroy_system(self, service, AffectedSystem=None):
+        self._destroy_vm(self._get_instance(AffectedSystem))
+        return self._job_result(None)
+
+    def _modify_system_settings(self, service, SystemSettings=None):
+        class_name, properties = _from_embedded_instance(SystemSettings)
+        vssd = self._get_instance_by_id(VSSD, properties['InstanceID'])
+        vssd.properties.update(properties)
+        return self._job_result(None)
+
+    def _add_resource_settings(self, service, AffectedConfiguration=None,
+                               ResourceSettings=None):
+        vssd = self._get_vssd_for_path(AffectedConfiguration)
+        paths = [self._add_resource_from_text(vssd, text).path
+                 for text in ResourceSettings or []]
+        return self._job_result(None, paths)
+
+    def _modify_resource_settings(self, service, ResourceSettings=None):
+        paths = []
+        for text in ResourceSettings or []:
+            class_name, properties = _from_embedded_instance(text)
+            resource = self._get_instance_by_id(class_name,
+                                                properties['InstanceID'])
+            resource.properties.update(properties)
+            paths.append(resource.path)
+        return self._job_result(None, paths)
+
+    def _remove_resource_settings(self, service, ResourceSettings=None,
+                                  FeatureSettings=None):
+        for path in ResourceSettings or FeatureSettings or []:
+            self._remove_instance(self._get_instance(path))
+        return self._job_result(None)
+
+    def _add_feature_settings(self, service, AffectedConfiguration=None,
+                              FeatureSettings=None):
+        target = self._get_instance(AffectedConfiguration)
+        paths = []
+        for text in FeatureSettings or []:
+            class_name, properties = _from_embedded_instance(text)
+            properties['InstanceID'] = '%s\\%s' % (
+                target.properties['InstanceID'], self._new_guid())
+            feature = self._add_instance(class_name, properties)
+            self._link(target, feature, ELEMENT_SETTING_DATA)
+            paths.append(feature.path)
+        return self._job_result(None, paths)
+
+    def _get_summary_information(self, service, RequestedInformation=None,
+                                 SettingData=None):
+        summaries = []
+        for path in SettingData or []:
+            vssd = self._get_instance(path)
+            vm = [other for (assoc_class, other) in vssd.links
+                  if assoc_class == SETTINGS_DEFINE_STATE][0]
+            processors = self._get_resources(vssd, PROCESSOR_SETTING_DATA)
+            memory = self._get_resources(vssd, MEMORY_SETTING_DATA)
+            running = (vm.properties['EnabledState'] ==
+                       constants.HYPERV_VM_STATE_ENABLED)
+            summaries.append(FakeWMIObject(self, SUMMARY_INFORMATION, {
+                'ElementName': vm.properties['ElementName'],
+                'Name': vm.properties['Name'],
+                'EnabledState': vm.properties['EnabledState'],
+                'NumberOfProcessors':
+                    processors[0].properties['VirtualQuantity']
+                    if processors else 0,
+                'MemoryUsage': memory[0].properties['VirtualQuantity']
+                    if memory and running else 0,
+                'UpTime': vm.properties['OnTimeInMilliseconds']}))
+        return (0, summaries)
+
+    # Migration service methods.
+
+    def _export_vm(self, vm):
+        """Returns the properties of the VM and of its settings."""
+        vssd = self._get_vm_settings(vm)
+        resources = [(resource.class_name, dict(resource.properties))
+                     for (assoc_class, resource) in vssd.links
+                     if assoc_class == SETTING_DATA_COMPONENT]
+        return dict(vm.properties), dict(vssd.properties), resources
+
+    def _import_vm(self, exported_vm, class_name):
+        vm_props, vssd_props, resources = exported_vm
+        vm = self._add_instance(class_name, dict(vm_props,
+                                                 CreationClassName=class_name))
+        vssd = self._add_instance(VSSD, dict(vssd_props))
+        self._link(vm, vssd, SETTINGS_DEFINE_STATE)
+        for (resource_class, resource_props) in resources:
+            resource = self._add_instance(resource_class,
+                                          dict(resource_props))
+            self._link(vssd, resource, SETTING_DATA_COMPONENT)
+        return vm
+
+    def _migrate_virtual_system(self, service, ComputerSystem=None,
+                                DestinationHost=None,
+                                MigrationSettingData=None,
+                                NewResourceSettingData=None):
+        vm = self._get_instance(ComputerSystem)
+        destination = self.module.get_provider(DestinationHost)
+        migration_type = _from_embedded_instance(
+            MigrationSettingData)[1]['MigrationType']
+        exported_vm = self._export_vm(vm)
+        vm_id = vm.properties['Name']
+
+        with destination._lock:
+            for planned_vm in list(destination._classes[V2_NAMESPACE][
+                    PLANNED_COMPUTER_SYSTEM]):
+                if planned_vm.properties['Name'] == vm_id:
+                    destination._destroy_vm(planned_vm)
+
+            if migration_type == _MIGRATION_TYPE_STAGED:
+                destination._import_vm(exported_vm, PLANNED_COMPUTER_SYSTEM)
+            else:
+                destination._import_vm(exported_vm, COMPUTER_SYSTEM)
+
+        if migration_type != _MIGRATION_TYPE_STAGED:
+            self._destroy_vm(vm)
+        return self._job_result(None)
+
+
+class FakeWMIModule(object):
+    """Replacement of the wmi module, serving the requests using
+    FakeWMIProvider objects.
+
+    The local host's provider is used for the '.' and 'localhost' hosts.
+    Connections to unknown hosts fail with RPC_S_SERVER_UNAVAILABLE.
+    """
+
+    x_wmi = FakeWMIError
+    x_wmi_timed_out = FakeWMITimedOut
+
+    def __init__(self, provider=None):
+        self.provider = provider or FakeWMIProvider()
+        self._providers = {}
+        self.add_host(self.provider)
+
+    def add_host(self, provider):
+        provider.module = self
+        self._providers[provider.host_name.lower()] = provider
+        return provider
+
+    def get_provider(self, host):
+        if not host or host.lower() in ('.', 'localhost'):
+            return self.provider
+        provider = self._providers.get(host.lower())
+        if not provider:
+            raise FakeWMIError(
+                'The RPC server is unavailable: %s' % host,
+                hresult=baseutils.RPC_S_SERVER_UNAVAILABLE)
+        return provider
+
+    def WMI(self, computer='.', impersonation_level='',
+            authentication_level='', authority='', privileges='', moniker='',
+            wmi=None, namespace='', suffix='', user='', password='',
+            find_classes=False, debug=False):
+        if moniker:
+            moniker = moniker.replace('\\', '/')
+            if moniker.lower().startswith('winmgmts:'):
+                moniker = moniker[len('winmgmts:'):]
+            moniker = re.sub(r'^\{[^}]*\}!', '', moniker)
+            host, path = moniker.lstrip('/').split('/', 1)
+            provider = self.get_provider(host)
+            if ':' in path:
+                return provider.get_object(path)
+            return provider.connect(path)
+        return self.get_provider(computer).connect(namespace or
+                                                   CIMV2_NAMESPACE)
+
+    def _wmi_object(self, ole_object, *args, **kwargs):
+        return ole_object
+
+    def _get_patched_modules(self):
+        # The os-win modules import wmi only on Windows, relying on the
+        # builtins module otherwise.
+        return [module for name, module in list(sys.modules.items())
+                if module and name.startswith('os_win.') and
+                'wmi' in getattr(module, '__dict__', {})]
+
+    @staticmethod
+    def _stop_event_watchers():
+        """Stops and drops the event watchers shared by the utils objects.
+
+        The watchers use the wmi module from their own threads, which
+        would outlive the patch otherwise.
+        """
+        registries = [(jobutils._job_watchers, jobutils._job_watchers_lock),
+                      (vmpowerstate._listeners, vmpowerstate._listeners_lock),
+                      (vminventory._vm_inventories,
+                       vminventory._vm_inventories_lock)]
+        watchers = []
+        for registry, lock in registries:
+            with lock:
+                watchers += list(registry.values())
+                registry.clear()
+        with vmutils._drive_event_watchers_lock:
+            for drive_event_watchers in vmutils._drive_event_watchers.values():
+                watchers += drive_event_watchers
+            vmutils._drive_event_watchers.clear()
+
+        for watcher in watchers:
+            watcher.stop()
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Makes the os-win modules use this fake wmi module."""
+        fake_pythoncom = mock.Mock()
+        patchers = [mock.patch.object(builtins, 'wmi', self, create=True),
+                    mock.patch.object(builtins, 'pythoncom', fake_pythoncom,
+                                      create=True),
+                    # Event subscriptions are not supported.
+                    mock.patch.object(jobutils.JobUtils, '_use_job_events',
+                                      False)]
+        patchers += [mock.patch.object(module, 'wmi', self)
+                     for module in self._get_patched_modules()]
+        self._stop_event_watchers()
+        for patcher in patchers:
+            patcher.start()
+        baseutils.get_connection_pool().clear()
+        try:
+            yield self
+        finally:
+            self._stop_event_watchers()
+            baseutils.get_connection_pool().clear()
+            for patcher in reversed(patchers):
+                patcher.stop()
@@ -14,10 +14,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+import contextlib
+
 import mock
 from oslotest import base
 from six.moves import builtins
 
+from os_win.utils import baseutils
+from os_win.utils import instrumentation
+
 
 class OsWinBaseTestCase(base.BaseTestCase):
     def setUp(self):
@@ -28,3 +34,48 @@ class OsWinBaseTestCase(base.BaseTestCase):
                                         new=self._mock_wmi)
         wmi_patcher.start()
         self.addCleanup(mock.patch.stopall)
+
+        # Pooled connections must not leak between tests.
+        baseutils.get_connection_pool().clear()
+        self.addCleanup(baseutils.get_connection_pool().clear)
+
+    @contextlib.contextmanager
+    def wmi_budget(self, queries=None, associators=None, methods=None,
+                   job_waits=None):
+        """Fails the test if the block exceeds the given WMI call budget.
+
+        Queries include the class enumerations, e.g.
+        conn.Msvm_ComputerSystem(), as well as the objects retrieved by
+        path. The calls performed through the objects cached by the utils
+        classes are counted as well, as long as the instrumentation was
+        enabled when those objects were retrieved. Budgets which are not
+        specified are not checked.
+
+        :returns: the instrumentation.CallTracker counting the calls.
+        """
+        with instrumentation.track_calls() as tracker:
+            yield tracker
+
+        totals = collections.Counter()
+        for counts in tracker.get_counts().values():
+            totals.update(counts)
+        calls = {
+            'queries': (totals[instrumentation.QUERY] +
+                        totals[instrumentation.ENUMERATION] +
+                        totals[instrumentation.GET_OBJECT]),
+            'associators': totals[instrumentation.ASSOCIATORS],
+            'methods': totals[instrumentation.METHOD],
+            'job_waits': totals[instrumentation.JOB_WAIT]}
+        budget = {'queries': queries,
+                  'associators': associators,
+                  'methods': methods,
+                  'job_waits': job_waits}
+
+        exceeded = ['%s: %d > %d' % (name, calls[name], budget[name])
+                    for name in sorted(budget)
+                    if budget[name] is not None and
+                    calls[name] > budget[name]]
+        if exceeded:
+            self.fail("WMI call budget exceeded (%s). Calls per public "
+                      "method: %s" % (', '.join(exceeded),
+                                      tracker.get_counts()))
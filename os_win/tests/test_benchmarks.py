@@ -0,0 +1,58 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+from os_win.tests.benchmarks import base
+from os_win.tests.benchmarks import scenarios
+from os_win.tests import test_base
+
+
+class BenchmarksTestCase(test_base.OsWinBaseTestCase):
+    """Checks the WMI round trips against the saved baseline."""
+
+    _BASELINE_PATH = os.path.join(os.path.dirname(base.__file__),
+                                  'baselines', 'small.json')
+
+    def test_round_trips(self):
+        results = base.run_scenarios(scenarios.get_scenarios('small'))
+
+        regressions, warnings = base.compare_results(
+            results, base.load_results(self._BASELINE_PATH),
+            tolerance=float('inf'))
+        self.assertEqual([], regressions)
+        self.assertEqual([], warnings)
+
+    def test_compare_results(self):
+        baseline = {'scenario[a=1]': {'round_trips': 2,
+                                      'cold_round_trips': 3,
+                                      'wall_time': 1,
+                                      'allocated_bytes': 100}}
+        results = {'scenario[a=1]': {'round_trips': 3,
+                                     'cold_round_trips': 3,
+                                     'wall_time': 2,
+                                     'allocated_bytes': 120},
+                   'scenario[a=2]': {}}
+
+        regressions, warnings = base.compare_results(results, baseline,
+                                                     tolerance=0.5)
+
+        self.assertEqual(
+            ['scenario[a=1]: round_trips increased from 2 to 3.'],
+            regressions)
+        self.assertEqual(
+            sorted(['scenario[a=2]: missing from the baseline.',
+                    'scenario[a=1]: wall_time increased from 1 to 2.']),
+            sorted(warnings))
@@ -0,0 +1,259 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+import mock
+
+from os_win import constants
+from os_win import exceptions
+from os_win.tests import fake_wmi
+from os_win.tests import test_base
+from os_win.utils.compute import livemigrationutils
+from os_win.utils.compute import vmutils
+from os_win.utils import instrumentation
+from os_win.utils import jobutils
+from os_win.utils.network import networkutils
+
+
+class FakeWMITestCase(test_base.OsWinBaseTestCase):
+    """Runs the utils classes against the fake WMI provider."""
+
+    def setUp(self):
+        super(FakeWMITestCase, self).setUp()
+        self._provider = fake_wmi.FakeWMIProvider()
+        self._fake_wmi = fake_wmi.FakeWMIModule(self._provider)
+        patch_context = self._fake_wmi.patch()
+        patch_context.__enter__()
+        self.addCleanup(patch_context.__exit__, None, None, None)
+        # The objects cached by the utils classes are only instrumented if
+        # retrieved while the instrumentation is enabled.
+        instrumentation.enable()
+        self.addCleanup(instrumentation.reset)
+        self.addCleanup(instrumentation.disable)
+
+        self._vmutils = vmutils.VMUtils()
+
+    def test_query_parser(self):
+        self._provider.add_vm("it's a vm")
+        conn = self._fake_wmi.WMI(moniker='//./root/virtualization/v2')
+
+        vms = conn.query(
+            "SELECT ElementName FROM Msvm_ComputerSystem "
+            "WHERE (ElementName = 'it''s a vm' OR ElementName = 'other') "
+            "AND NOT EnabledState = 2 AND Caption LIKE 'Virtual%'")
+
+        self.assertEqual(["it's a vm"], [vm.ElementName for vm in vms])
+        # The key properties were not selected.
+        self.assertEqual('', vms[0].path_())
+
+    def test_unknown_host(self):
+        exc = self.assertRaises(self._fake_wmi.x_wmi, self._fake_wmi.WMI,
+                                moniker='//unknown/root/virtualization/v2')
+        self.assertTrue(vmutils.baseutils.is_rpc_failure(exc))
+
+    def test_list_instances(self):
+        vm_names = self._provider.populate(10)
+
+        self.assertEqual(vm_names, self._vmutils.list_instances())
+        self.assertTrue(self._vmutils.vm_exists(vm_names[0]))
+        self.assertFalse(self._vmutils.vm_exists('missing_vm'))
+
+    def test_get_vms_summary_info(self):
+        self._provider.add_vm('vm1', vcpus=2,
+                              state=constants.HYPERV_VM_STATE_ENABLED)
+        self._provider.add_vm('vm2')
+
+        summary_info = self._vmutils.get_vms_summary_info()
+
+        self.assertEqual(set(['vm1', 'vm2']), set(summary_info))
+        self.assertEqual(2, summary_info['vm1']['NumberOfProcessors'])
+        self.assertEqual(constants.HYPERV_VM_STATE_DISABLED,
+                         self._vmutils.get_vm_state('vm2'))
+
+    def _test_set_vm_state(self, job_duration=None):
+        self._provider.job_duration = job_duration
+        self._provider.add_vm('vm1')
+
+        self._vmutils.set_vm_state('vm1', constants.HYPERV_VM_STATE_ENABLED)
+        # Already enabled.
+        self._vmutils.set_vm_state('vm1', constants.HYPERV_VM_STATE_ENABLED)
+
+        self.assertEqual(constants.HYPERV_VM_STATE_ENABLED,
+                         self._provider.get_vm('vm1').EnabledState)
+
+    def test_set_vm_state(self):
+        self._test_set_vm_state()
+
+    @mock.patch.object(jobutils.JobUtils, '_JOB_POLL_INITIAL_INTERVAL', 0)
+    def test_set_vm_state_using_jobs(self):
+        self._test_set_vm_state(job_duration=0)
+
+    def test_job_timeout(self):
+        self._provider.job_duration = 60
+        vm = self._provider.add_vm('vm1')
+        (job_path, ret_val) = vm.RequestStateChange(
+            constants.HYPERV_VM_STATE_ENABLED)
+
+        self.assertEqual(constants.WMI_JOB_STATUS_STARTED, ret_val)
+        self.assertRaises(exceptions.WMIJobTimeoutException,
+                          self._vmutils._jobutils._wait_for_job,
+                          job_path, timeout=0)
+
+        jobs = self._vmutils._jobutils.stop_jobs(vm)
+        self.assertEqual(constants.JOB_STATE_KILLED,
+                         self._fake_wmi.WMI(moniker=jobs[0].path_()).JobState)
+
+    def test_job_events_disabled(self):
+        # Event subscriptions are not supported, so the jobs are polled.
+        self.assertIsNone(self._vmutils._jobutils._get_job_watcher())
+
+    def test_stop_event_watchers(self):
+        mock_job_watcher = mock.Mock()
+        mock_drive_event_watcher = mock.Mock()
+        jobutils._job_watchers['fake_host'] = mock_job_watcher
+        vmutils._drive_event_watchers['fake_host'] = [
+            mock_drive_event_watcher]
+
+        self._fake_wmi._stop_event_watchers()
+
+        mock_job_watcher.stop.assert_called_once_with()
+        mock_drive_event_watcher.stop.assert_called_once_with()
+        self.assertEqual({}, jobutils._job_watchers)
+        self.assertEqual({}, vmutils._drive_event_watchers)
+
+    def test_create_and_destroy_vm(self):
+        self._vmutils.create_vm('vm1', False, constants.VM_GEN_2,
+                                'C:\\vm1', ['fake_notes'])
+        self._vmutils.create_scsi_controller('vm1')
+
+        self.assertEqual(['vm1'], self._vmutils.list_instances())
+        self.assertEqual([('vm1', ['fake_notes'])],
+                         self._vmutils.list_instance_notes())
+
+        self._vmutils.destroy_vm('vm1')
+        self.assertEqual([], self._vmutils.list_instances())
+
+    def test_attach_and_detach_disks(self):
+        vm = self._provider.add_vm('vm1')
+        self._provider.add_disk(vm, 'C:\\disk0.vhdx')
+        controller_path = self._vmutils.get_vm_scsi_controller('vm1')
+
+        self._vmutils.attach_scsi_drive('vm1', 'C:\\disk1.vhdx')
+
+        self.assertEqual(['C:\\disk0.vhdx', 'C:\\disk1.vhdx'],
+                         sorted(self._vmutils.get_vm_storage_paths('vm1')[0]))
+        self.assertEqual(2, len(self._vmutils.get_attached_disks(
+            controller_path)))
+        self.assertEqual(2, self._vmutils.get_free_controller_slot(
+            controller_path))
+
+        self._vmutils.detach_vm_disk('vm1', 'C:\\disk0.vhdx',
+                                     is_physical=False)
+        self.assertEqual(['C:\\disk1.vhdx'],
+                         self._vmutils.get_vm_storage_paths('vm1')[0])
+
+    def test_call_counts_and_latency(self):
+        self._provider.latency = {fake_wmi.QUERY: 0.001}
+        self._provider.populate(3)
+
+        with mock.patch('time.sleep') as mock_sleep:
+            self._vmutils.list_instances()
+
+        mock_sleep.assert_called_once_with(0.001)
+        self.assertEqual(
+            1, self._provider.call_counts[(fake_wmi.QUERY, fake_wmi.VSSD,
+                                           'query')])
+
+    def test_get_port_by_id(self):
+        vswitch = self._provider.add_vswitch('vswitch')
+        self._provider.add_switch_port(vswitch, 'port1')
+
+        netutils = networkutils.NetworkUtils()
+
+        with self.wmi_budget(queries=2, associators=0, methods=0):
+            port = netutils.get_port_by_id('port1', 'vswitch')
+        self.assertEqual('port1', port.ElementName)
+        self.assertIsNone(netutils.get_port_by_id('port2', 'vswitch'))
+
+    def test_live_migrate_vm(self):
+        dest_provider = fake_wmi.FakeWMIProvider(host_name='DESTHOST')
+        self._fake_wmi.add_host(dest_provider)
+        self._provider.add_vm('vm1', state=constants.HYPERV_VM_STATE_ENABLED)
+        migrationutils = livemigrationutils.LiveMigrationUtils()
+
+        with mock.patch.object(migrationutils, '_get_physical_disk_paths',
+                               return_value={}):
+            migrationutils.live_migrate_vm('vm1', 'DESTHOST')
+
+        self.assertIsNone(self._provider.get_vm('vm1'))
+        self.assertIsNotNone(dest_provider.get_vm('vm1'))
+
+    def test_concurrent_operations(self):
+        self._provider.populate(2, disks_per_vm=0)
+        vm_names = ['instance-00000', 'instance-00001']
+        # Caches the services before starting the threads.
+        self._vmutils.get_vm_scsi_controller(vm_names[0])
+
+        def attach_drives(vm_name):
+            for index in range(5):
+                self._vmutils.attach_scsi_drive(
+                    vm_name, 'C:\\%s-%s.vhdx' % (vm_name, index))
+
+        threads = [threading.Thread(target=attach_drives, args=(vm_name, ))
+                   for vm_name in vm_names * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for vm_name in vm_names:
+            controller_path = self._vmutils.get_vm_scsi_controller(vm_name)
+            addresses = [disk.AddressOnParent for disk in
+                         self._vmutils.get_attached_disks(controller_path)]
+            self.assertEqual(10, len(set(addresses)))
+        self.assertFalse(self._vmutils._vm_locks._vm_locks)
+
+    def test_wmi_budget(self):
+        self._provider.populate(20, disks_per_vm=2)
+        # Warms up the cached services and default setting data.
+        self._vmutils.attach_scsi_drive('instance-00001', 'C:\\disk.vhdx')
+
+        with self.wmi_budget(queries=2, associators=2, methods=2):
+            self._vmutils.attach_scsi_drive('instance-00002',
+                                            'C:\\disk.vhdx')
+        with self.wmi_budget(queries=2, associators=0, methods=1):
+            self._vmutils.get_vms_summary_info()
+
+    def test_wmi_budget_cached_service(self):
+        self._provider.add_vm('vm1')
+        # Caches the management service outside of the budgeted block.
+        self._vmutils._vs_man_svc
+
+        with self.wmi_budget() as tracker:
+            self._vmutils.destroy_vm('vm1')
+
+        method_calls = [counts.get(instrumentation.METHOD, 0)
+                        for counts in tracker.get_counts().values()]
+        self.assertEqual(1, sum(method_calls))
+
+    def test_wmi_budget_exceeded(self):
+        self._provider.populate(2)
+
+        def list_instances():
+            with self.wmi_budget(queries=0):
+                self._vmutils.list_instances()
+
+        self.assertRaises(self.failureException, list_instances)
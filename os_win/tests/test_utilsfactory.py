@@ -39,6 +39,11 @@ CONF = cfg.CONF
 
 class TestHyperVUtilsFactory(test_base.OsWinBaseTestCase):
 
+    def setUp(self):
+        super(TestHyperVUtilsFactory, self).setUp()
+        utilsfactory.reset_cache()
+        self.addCleanup(utilsfactory.reset_cache)
+
     @mock.patch.object(utilsfactory.utils, 'get_windows_version')
     def test_get_class_unsupported_win_version(self, mock_get_windows_version):
         mock_get_windows_version.return_value = '5.2'
@@ -50,6 +55,67 @@ class TestHyperVUtilsFactory(test_base.OsWinBaseTestCase):
                           utilsfactory._get_class,
                           'invalid_class_type')
 
+    @mock.patch.object(utilsfactory.utils, 'get_windows_version')
+    def test_get_class_memoized(self, mock_get_windows_version):
+        mock_get_windows_version.return_value = '6.2'
+
+        utils_class = utilsfactory._get_class('hostutils')
+        self.assertEqual(utils_class, utilsfactory._get_class('hostutils'))
+
+        self.assertEqual(hostutils.HostUtils, utils_class)
+        mock_get_windows_version.assert_called_once_with()
+
+    @mock.patch.object(utilsfactory.utils, 'get_windows_version')
+    def test_get_class_memoized_per_host(self, mock_get_windows_version):
+        mock_get_windows_version.return_value = '6.2'
+
+        utilsfactory._get_class('hostutils')
+        utilsfactory._get_class('hostutils', '.')
+        utils_class = utilsfactory._get_class('hostutils',
+                                              mock.sentinel.host)
+        utilsfactory._get_class('hostutils', mock.sentinel.host)
+
+        # The local Windows version is used for every host, the resolved
+        # classes being cached separately for each host.
+        self.assertEqual(hostutils.HostUtils, utils_class)
+        self.assertEqual(2, mock_get_windows_version.call_count)
+
+    @mock.patch.object(utilsfactory, '_get_class')
+    def _test_get_utils(self, mock_get_class, shared=False):
+        CONF.set_override('share_utils_instances', shared, 'hyperv')
+        self.addCleanup(CONF.clear_override, 'share_utils_instances',
+                        'hyperv')
+        mock_class = mock_get_class.return_value
+        mock_class.side_effect = lambda *args: mock.Mock()
+
+        first_instance = utilsfactory.get_vmutils(mock.sentinel.host)
+        second_instance = utilsfactory.get_vmutils(mock.sentinel.host)
+        other_host_instance = utilsfactory.get_vmutils()
+
+        self.assertEqual(shared, first_instance is second_instance)
+        self.assertIsNot(first_instance, other_host_instance)
+        mock_class.assert_any_call(mock.sentinel.host)
+        mock_get_class.assert_any_call('vmutils', mock.sentinel.host)
+        mock_get_class.assert_called_with('vmutils', '.')
+
+    def test_get_utils(self):
+        self._test_get_utils()
+
+    @mock.patch.object(utilsfactory, '_get_utils')
+    def test_get_vmutils_inventory(self, mock_get_utils):
+        CONF.set_override('use_vm_inventory', True, 'hyperv')
+        self.addCleanup(CONF.clear_override, 'use_vm_inventory', 'hyperv')
+
+        vmutils = utilsfactory.get_vmutils(mock.sentinel.host)
+
+        self.assertEqual(mock_get_utils.return_value, vmutils)
+        mock_get_utils.assert_called_once_with(class_type='vmutils',
+                                               host=mock.sentinel.host)
+        vmutils.enable_vm_inventory.assert_called_once_with()
+
+    def test_get_utils_shared(self):
+        self._test_get_utils(shared=True)
+
     @mock.patch.object(utilsfactory.utils, 'get_windows_version')
     def _check_get_class(self, mock_get_windows_version, expected_class,
                        class_type):
@@ -107,6 +173,8 @@ class TestHyperVUtilsFactory(test_base.OsWinBaseTestCase):
     def _test_get_initiator_utils(self, mock_get_windows_version,
                                   expected_class, force_v1=False):
         CONF.set_override('force_volumeutils_v1', force_v1, 'hyperv')
+        self.addCleanup(CONF.clear_override, 'force_volumeutils_v1',
+                        'hyperv')
         mock_get_windows_version.return_value = '6.2'
 
         actual_class = type(utilsfactory.get_iscsi_initiator_utils())
@@ -201,8 +201,8 @@ class LiveMigrationUtilsTestCase(test_base.OsWinBaseTestCase):
             mock.sentinel.FAKE_IQN, mock.sentinel.FAKE_LUN)
         m_remote_iscsi_init.get_device_number_for_target.return_value = (
             mock.sentinel.FAKE_DEV_NUM)
-        mock_vm_utils.get_mounted_disk_by_drive_number.return_value = (
-            mock.sentinel.FAKE_DISK_PATH)
+        mock_vm_utils.get_mounted_disks_by_drive_numbers.return_value = {
+            mock.sentinel.FAKE_DEV_NUM: mock.sentinel.FAKE_DISK_PATH}
 
         disk_paths = self.liveutils._get_remote_disk_data(
             mock_vm_utils, disk_paths, mock.sentinel.FAKE_HOST)
@@ -211,8 +211,8 @@ class LiveMigrationUtilsTestCase(test_base.OsWinBaseTestCase):
             mock.sentinel.FAKE_DISK_PATH)
         m_remote_iscsi_init.get_device_number_for_target.assert_called_with(
             mock.sentinel.FAKE_IQN, mock.sentinel.FAKE_LUN)
-        mock_vm_utils.get_mounted_disk_by_drive_number.assert_called_once_with(
-            mock.sentinel.FAKE_DEV_NUM)
+        mock_get_disks = mock_vm_utils.get_mounted_disks_by_drive_numbers
+        mock_get_disks.assert_called_once_with([mock.sentinel.FAKE_DEV_NUM])
 
         self.assertEqual(
             {mock.sentinel.FAKE_RASD_PATH: mock.sentinel.FAKE_DISK_PATH},
@@ -0,0 +1,120 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+from oslotest import base
+
+from os_win import exceptions
+from os_win.utils.compute import slotallocator
+
+
+class ControllerSlotAllocatorTestCase(base.BaseTestCase):
+    """Unit tests for the ControllerSlotAllocator class."""
+
+    _FAKE_CTRL_PATH = 'fake_ctrl_path'
+    _SLOTS_COUNT = 4
+
+    def setUp(self):
+        super(ControllerSlotAllocatorTestCase, self).setUp()
+        self._allocator = slotallocator.ControllerSlotAllocator(
+            self._SLOTS_COUNT)
+        self._get_used_slots = mock.Mock(return_value=[1])
+
+    def _reserve(self, count=1, ctrl_path=_FAKE_CTRL_PATH):
+        return self._allocator.reserve_slots(ctrl_path, count,
+                                             self._get_used_slots)
+
+    def test_reserve_slots(self):
+        self.assertEqual([0, 2], self._reserve(count=2))
+        self.assertEqual([3], self._reserve())
+        self._get_used_slots.assert_called_once_with()
+
+    def test_reserve_slots_exceeded(self):
+        self._reserve(count=3)
+        # The controller paths are case insensitive. The used slots are
+        # retrieved again before giving up.
+        self.assertRaises(exceptions.HyperVException, self._reserve,
+                          ctrl_path=self._FAKE_CTRL_PATH.upper())
+        self.assertEqual(2, self._get_used_slots.call_count)
+
+    def test_reserve_slots_reloads_used_slots(self):
+        self._reserve(count=3)
+        self._allocator.commit_slots(self._FAKE_CTRL_PATH, [0, 2, 3])
+        # The disk using slot 1 was detached by other means.
+        self._get_used_slots.return_value = [0, 2, 3]
+
+        self.assertEqual([1], self._reserve())
+        self.assertEqual(2, self._get_used_slots.call_count)
+
+    def test_commit_slots(self):
+        self._reserve(count=3)
+        self._allocator.commit_slots(self._FAKE_CTRL_PATH, [0])
+
+        self.assertEqual(0b0011, self._allocator._used_slots[
+            self._FAKE_CTRL_PATH])
+        self.assertEqual([2, 3], sorted(self._allocator._reservations[
+            self._FAKE_CTRL_PATH]))
+
+    def test_release_slots(self):
+        self._reserve(count=2)
+        self._allocator.release_slots(self._FAKE_CTRL_PATH, [0, 1])
+
+        self.assertEqual([0, 1], self._reserve(count=2))
+
+    def test_release_reservations(self):
+        self.assertEqual([0], self._reserve())
+        # The slot was taken behind the allocator's back, so attaching the
+        # disk failed.
+        self._allocator.release_reservations(self._FAKE_CTRL_PATH, [0])
+        self._allocator.resync(self._FAKE_CTRL_PATH)
+        self._get_used_slots.return_value = [0, 1]
+
+        self.assertEqual([2], self._reserve())
+        self.assertEqual(2, self._get_used_slots.call_count)
+
+    def test_update_slot(self):
+        self._reserve()
+        self._allocator.update_slot(self._FAKE_CTRL_PATH, 1, used=True)
+        self._allocator.update_slot(self._FAKE_CTRL_PATH, 2, used=False)
+        self.assertEqual(0b0010, self._allocator._used_slots[
+            self._FAKE_CTRL_PATH])
+
+        # A disk was attached behind the allocator's back.
+        self._allocator.update_slot(self._FAKE_CTRL_PATH, 2, used=True)
+        self._get_used_slots.return_value = [1, 2]
+
+        self.assertEqual([3], self._reserve())
+        self.assertEqual(2, self._get_used_slots.call_count)
+
+    def test_update_slot_unknown_controller(self):
+        self._allocator.update_slot(self._FAKE_CTRL_PATH, 1, used=True)
+        self.assertEqual({}, self._allocator._used_slots)
+
+    @mock.patch('time.time')
+    def test_expired_reservation(self, mock_time):
+        mock_time.return_value = 0
+        self._reserve()
+
+        mock_time.return_value = self._allocator._RESERVATION_TIMEOUT + 1
+        self.assertEqual([0], self._reserve())
+
+    def test_resync(self):
+        self._reserve()
+        self._allocator.resync(self._FAKE_CTRL_PATH)
+        self._get_used_slots.return_value = []
+
+        # The reservation is preserved.
+        self.assertEqual([1], self._reserve())
+        self.assertEqual(2, self._get_used_slots.call_count)
@@ -0,0 +1,225 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win import constants
+from os_win.tests import test_base
+from os_win.utils import baseutils
+from os_win.utils.compute import vminventory
+
+
+class VMInventoryTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V VMInventory class."""
+
+    _FAKE_UUID = '04e79212-39bc-4065-933c-50f6d48a57f6'
+
+    def setUp(self):
+        super(VMInventoryTestCase, self).setUp()
+        self._inventory = vminventory.VMInventory()
+        self._inventory._conn = mock.MagicMock()
+        self._inventory._event_watcher._available = True
+
+    def _get_fake_vm(self, vm_name='fake_vm', vm_id='fake_id',
+                     notes=(_FAKE_UUID, ), vm_gen=2):
+        vm = mock.MagicMock(ElementName=vm_name, Name=vm_id,
+                            EnabledState=mock.sentinel.state)
+        vssd = mock.MagicMock(
+            VirtualSystemIdentifier=vm_id.upper(), Notes=list(notes),
+            VirtualSystemType=self._inventory._VIRTUAL_SYSTEM_TYPE_REALIZED,
+            VirtualSystemSubType='Microsoft:Hyper-V:SubType:%s' % vm_gen)
+        return vm, vssd
+
+    def _load(self, *vms):
+        conn = self._inventory._conn
+        conn.Msvm_ComputerSystem.return_value = [vm for vm, vssd in vms]
+        conn.Msvm_VirtualSystemSettingData.return_value = [
+            vssd for vm, vssd in vms]
+        self._inventory._ensure_loaded()
+
+    @mock.patch.object(vminventory, 'VMInventory')
+    def test_get_vm_inventory(self, mock_vm_inventory):
+        self.addCleanup(vminventory._vm_inventories.clear)
+
+        inventory = vminventory.get_vm_inventory(mock.sentinel.host)
+
+        self.assertEqual(mock_vm_inventory.return_value, inventory)
+        self.assertIs(inventory,
+                      vminventory.get_vm_inventory(mock.sentinel.host))
+        mock_vm_inventory.assert_called_once_with(mock.sentinel.host)
+        inventory.start.assert_called_once_with()
+
+    def test_get_vm(self):
+        vm, vssd = self._get_fake_vm()
+        self._load((vm, vssd))
+
+        self.assertEqual(vm, self._inventory.get_vm('fake_vm'))
+        self.assertIsNone(self._inventory.get_vm('missing_vm'))
+
+        conn = self._inventory._conn
+        conn.Msvm_ComputerSystem.assert_called_once_with(
+            Caption=constants.VM_CAPTION)
+        conn.Msvm_VirtualSystemSettingData.assert_called_once_with(
+            VirtualSystemType=self._inventory._VIRTUAL_SYSTEM_TYPE_REALIZED)
+
+    def test_get_vm_unavailable(self):
+        self._inventory._event_watcher._available = False
+        self.assertIsNone(self._inventory.get_vm('fake_vm'))
+        self.assertFalse(self._inventory._conn.Msvm_ComputerSystem.called)
+
+    def test_get_vm_info(self):
+        vm, vssd = self._get_fake_vm()
+        self._load((vm, vssd))
+
+        expected_info = {'path': vm.path_.return_value,
+                         'id': 'fake_id',
+                         'state': mock.sentinel.state,
+                         'notes': [self._FAKE_UUID],
+                         'instance_uuid': self._FAKE_UUID,
+                         'generation': constants.VM_GEN_2}
+        self.assertEqual(expected_info,
+                         self._inventory.get_vm_info('fake_vm'))
+
+    def test_get_vm_name(self):
+        self._load(self._get_fake_vm())
+        self.assertEqual('fake_vm',
+                         self._inventory.get_vm_name(self._FAKE_UUID))
+
+    def test_duplicate_vm_names(self):
+        self._load(self._get_fake_vm(vm_id='fake_id_1'),
+                   self._get_fake_vm(vm_id='fake_id_2'),
+                   self._get_fake_vm(vm_id='fake_id_3'))
+
+        self.assertIsNone(self._inventory.get_vm('fake_vm'))
+        self.assertEqual({}, self._inventory._vm_ids)
+
+    def test_add_vm(self):
+        self._load()
+        vm, vssd = self._get_fake_vm()
+        vm.associators.return_value = [mock.Mock(), vssd]
+
+        self._inventory.add_vm(vm)
+
+        self.assertEqual(vm, self._inventory.get_vm('fake_vm'))
+        vssd_class = self._inventory._VIRTUAL_SYSTEM_SETTING_DATA_CLASS
+        vm.associators.assert_called_once_with(wmi_result_class=vssd_class)
+
+    def test_remove_vm(self):
+        self._load(self._get_fake_vm())
+
+        self._inventory.remove_vm('fake_vm')
+
+        self.assertIsNone(self._inventory.get_vm('fake_vm'))
+        self.assertIsNone(self._inventory.get_vm_name(self._FAKE_UUID))
+
+    def _get_fake_event(self, event_type, event_class, **kwargs):
+        event = mock.Mock(event_type=event_type, **kwargs)
+        event.path.return_value.Class = event_class
+        return event
+
+    def test_process_deletion_event(self):
+        self._load(self._get_fake_vm())
+        event = self._get_fake_event(
+            'deletion', self._inventory._COMPUTER_SYSTEM_CLASS,
+            Name='FAKE_ID')
+
+        self._inventory._process_event(event)
+
+        self.assertIsNone(self._inventory.get_vm('fake_vm'))
+
+    def test_process_rename_event(self):
+        self._load(self._get_fake_vm())
+        event = self._get_fake_event(
+            'modification', self._inventory._COMPUTER_SYSTEM_CLASS,
+            Name='fake_id', ElementName='new_name',
+            EnabledState=mock.sentinel.new_state)
+
+        self._inventory._process_event(event)
+
+        self.assertIsNone(self._inventory.get_vm('fake_vm'))
+        vm_info = self._inventory.get_vm_info('new_name')
+        # The renamed VM is retrieved again, only once.
+        with mock.patch.object(baseutils, 'get_wmi_object') as mock_get_obj:
+            for i in range(2):
+                self.assertEqual(mock_get_obj.return_value,
+                                 self._inventory.get_vm('new_name'))
+        mock_get_obj.assert_called_once_with(vm_info['path'])
+        self.assertEqual(mock.sentinel.new_state, vm_info['state'])
+        self.assertEqual('new_name',
+                         self._inventory.get_vm_name(self._FAKE_UUID))
+
+    def test_process_settings_event(self):
+        self._load(self._get_fake_vm())
+        vm, vssd = self._get_fake_vm(notes=['other notes'], vm_gen=1)
+        event = self._get_fake_event(
+            'modification',
+            self._inventory._VIRTUAL_SYSTEM_SETTING_DATA_CLASS,
+            VirtualSystemType=vssd.VirtualSystemType,
+            VirtualSystemIdentifier=vssd.VirtualSystemIdentifier,
+            Notes=vssd.Notes,
+            VirtualSystemSubType=vssd.VirtualSystemSubType)
+
+        self._inventory._process_event(event)
+
+        vm_info = self._inventory.get_vm_info('fake_vm')
+        self.assertEqual(['other notes'], vm_info['notes'])
+        self.assertIsNone(vm_info['instance_uuid'])
+        self.assertEqual(constants.VM_GEN_1, vm_info['generation'])
+        self.assertIsNone(self._inventory.get_vm_name(self._FAKE_UUID))
+
+    def test_process_unknown_vm_event(self):
+        self._load(self._get_fake_vm())
+        event = self._get_fake_event(
+            'deletion', self._inventory._COMPUTER_SYSTEM_CLASS,
+            Name='other_id')
+
+        self._inventory._process_event(event)
+
+        self.assertIsNotNone(self._inventory.get_vm('fake_vm'))
+
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_start(self, mock_event_watcher_cls):
+        inventory = vminventory.VMInventory('fake_host')
+        inventory.start()
+
+        mock_event_watcher = mock_event_watcher_cls.return_value
+        mock_event_watcher.start.assert_called_once_with()
+        self.assertEqual(mock_event_watcher.available, inventory.available)
+        self.assertEqual('fake_host',
+                         mock_event_watcher_cls.call_args[1]['host'])
+
+    def test_process_timeout(self):
+        self._load(self._get_fake_vm())
+        self._inventory._process_event(None)
+        self.assertIsNotNone(self._inventory.get_vm('fake_vm'))
+
+    def test_on_state_change(self):
+        self._load(self._get_fake_vm())
+
+        self._inventory._on_state_change(available=False)
+        # The inventory is reset by its users, not by the event thread.
+        self.assertTrue(self._inventory._loaded)
+
+        self._inventory._apply_pending_events()
+        self.assertEqual({}, self._inventory._vms)
+        self.assertFalse(self._inventory._loaded)
+
+    def test_queue_event_limit(self):
+        self._inventory._MAX_PENDING_EVENTS = 2
+        for i in range(3):
+            self._inventory._queue_event(mock.sentinel.event)
+
+        self.assertEqual([vminventory._RESET, mock.sentinel.event],
+                         list(self._inventory._pending_events))
@@ -0,0 +1,180 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+from six.moves import queue
+
+from os_win import constants
+from os_win.tests import test_base
+from os_win.utils.compute import vmpowerstate
+
+
+class VMPowerStateListenerTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the Hyper-V VMPowerStateListener class."""
+
+    _FAKE_VM_NAME = 'fake_vm'
+
+    def setUp(self):
+        super(VMPowerStateListenerTestCase, self).setUp()
+        self._vmutils = mock.Mock()
+        self._vmutils.get_vm_power_state.side_effect = (
+            lambda enabled_state: enabled_state)
+        self._listener = vmpowerstate.VMPowerStateListener(self._vmutils)
+        self._listener._conn = mock.MagicMock()
+        self._listener._event_watchers = [mock.Mock(), mock.Mock()]
+        self._listener._dispatcher = mock.Mock()
+        # The notifications are dispatched right away.
+        self._listener._dispatcher.dispatch.side_effect = (
+            lambda func, *args: func(*args))
+
+    @mock.patch.object(vmpowerstate, 'VMPowerStateListener')
+    def test_get_power_state_listener(self, mock_listener_cls):
+        self.addCleanup(vmpowerstate._listeners.clear)
+
+        listener = vmpowerstate.get_power_state_listener(
+            self._vmutils, mock.sentinel.host)
+
+        self.assertEqual(mock_listener_cls.return_value, listener)
+        self.assertIs(listener, vmpowerstate.get_power_state_listener(
+            self._vmutils, mock.sentinel.host))
+        mock_listener_cls.assert_called_once_with(self._vmutils,
+                                                  mock.sentinel.host)
+        listener.start.assert_called_once_with()
+
+    def test_start(self):
+        self._listener._reload_needed = True
+        self._listener._conn.Msvm_ComputerSystem.return_value = [
+            mock.Mock(ElementName=self._FAKE_VM_NAME,
+                      EnabledState=constants.HYPERV_VM_STATE_ENABLED)]
+
+        self._listener.start()
+
+        self.assertEqual(
+            {self._FAKE_VM_NAME: constants.HYPERV_VM_STATE_ENABLED},
+            self._listener.get_vm_power_states())
+        self._listener._conn.Msvm_ComputerSystem.assert_called_once_with(
+            ['ElementName', 'EnabledState'],
+            Caption=constants.VM_CAPTION)
+        self._listener._dispatcher.start.assert_called_once_with()
+        for watcher in self._listener._event_watchers:
+            watcher.start.assert_called_once_with()
+        self.assertFalse(self._listener._reload_needed)
+
+    def test_stop(self):
+        self._listener.stop()
+
+        for watcher in self._listener._event_watchers:
+            watcher.stop.assert_called_once_with()
+        self._listener._dispatcher.stop.assert_called_once_with()
+
+    @mock.patch.object(vmpowerstate.VMPowerStateListener, '_load_states')
+    def test_get_vm_power_state_reload(self, mock_load_states):
+        self._listener._on_state_change(available=False)
+        self.assertIsNone(
+            self._listener.get_vm_power_state(self._FAKE_VM_NAME))
+        self.assertFalse(mock_load_states.called)
+
+        self._listener._on_state_change(available=True)
+        self._listener.get_vm_power_state(self._FAKE_VM_NAME)
+        mock_load_states.assert_called_once_with()
+
+    def test_process_lifecycle_event(self):
+        self._listener._states = {
+            self._FAKE_VM_NAME: constants.HYPERV_VM_STATE_ENABLED}
+        self._listener._pending_changes = {
+            self._FAKE_VM_NAME: (constants.HYPERV_VM_STATE_DISABLED, 0)}
+
+        self._listener._process_lifecycle_event(None)
+        self._listener._process_lifecycle_event(
+            mock.Mock(event_type='deletion', ElementName=self._FAKE_VM_NAME))
+        self._listener._process_lifecycle_event(
+            mock.Mock(event_type='creation', ElementName='new_vm',
+                      EnabledState=constants.HYPERV_VM_STATE_DISABLED))
+
+        self.assertEqual({'new_vm': constants.HYPERV_VM_STATE_DISABLED},
+                         self._listener._states)
+        self.assertEqual({}, self._listener._pending_changes)
+
+    @mock.patch('time.time')
+    def test_publish_pending_changes(self, mock_time):
+        mock_subscriber = mock.Mock()
+        mock_failing_subscriber = mock.Mock(side_effect=Exception)
+        self._listener.subscribe(mock_failing_subscriber)
+        self._listener.subscribe(mock_subscriber)
+        self._listener._states = {
+            self._FAKE_VM_NAME: constants.HYPERV_VM_STATE_ENABLED,
+            'other_vm': constants.HYPERV_VM_STATE_ENABLED}
+
+        mock_time.return_value = 0
+        self._listener._add_pending_change(
+            self._FAKE_VM_NAME, constants.HYPERV_VM_STATE_SHUTTING_DOWN)
+        self._listener._add_pending_change(
+            'other_vm', constants.HYPERV_VM_STATE_SHUTTING_DOWN)
+        mock_time.return_value = 0.5
+        self._listener._add_pending_change(
+            self._FAKE_VM_NAME, constants.HYPERV_VM_STATE_DISABLED)
+        # The other VM flapped back to the published state.
+        self._listener._add_pending_change(
+            'other_vm', constants.HYPERV_VM_STATE_ENABLED)
+        self._listener._publish_pending_changes()
+        self.assertFalse(mock_subscriber.called)
+
+        mock_time.return_value = self._listener._COALESCE_INTERVAL
+        self._listener._publish_pending_changes()
+
+        mock_failing_subscriber.assert_called_once_with(
+            (self._FAKE_VM_NAME, constants.HYPERV_VM_STATE_DISABLED))
+        mock_subscriber.assert_called_once_with(
+            (self._FAKE_VM_NAME, constants.HYPERV_VM_STATE_DISABLED))
+        self.assertEqual(constants.HYPERV_VM_STATE_DISABLED,
+                         self._listener.get_vm_power_state(
+                             self._FAKE_VM_NAME))
+        self.assertEqual({}, self._listener._pending_changes)
+
+    @mock.patch('time.time')
+    def test_queue_subscriber(self, mock_time):
+        notifications = queue.Queue()
+        self._listener.subscribe(notifications.put)
+
+        mock_time.return_value = 0
+        self._listener._add_pending_change(
+            self._FAKE_VM_NAME, constants.HYPERV_VM_STATE_DISABLED)
+        mock_time.return_value = self._listener._COALESCE_INTERVAL
+        self._listener._publish_pending_changes()
+
+        self.assertEqual(
+            (self._FAKE_VM_NAME, constants.HYPERV_VM_STATE_DISABLED),
+            notifications.get_nowait())
+        self.assertTrue(notifications.empty())
+
+    def test_unsubscribe(self):
+        subscription_id = self._listener.subscribe(mock.sentinel.subscriber)
+        self._listener.unsubscribe(subscription_id)
+        self.assertEqual({}, self._listener._subscribers)
+
+    @mock.patch.object(vmpowerstate.VMPowerStateListener,
+                       '_publish_pending_changes')
+    @mock.patch.object(vmpowerstate.VMPowerStateListener,
+                       '_add_pending_change')
+    def test_process_event(self, mock_add_pending_change,
+                           mock_publish_pending_changes):
+        mock_event = mock.Mock()
+
+        self._listener._process_event(mock_event)
+        self._listener._process_event(None)
+
+        mock_add_pending_change.assert_called_once_with(
+            mock_event.ElementName, mock_event.EnabledState)
+        self.assertEqual(2, mock_publish_pending_changes.call_count)
@@ -13,12 +13,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+
 import mock
 from six.moves import range  # noqa
 
 from os_win import constants
 from os_win import exceptions
 from os_win.tests import test_base
+from os_win.utils import baseutils
+from os_win.utils.compute import slotallocator
 from os_win.utils.compute import vmutils
 
 
@@ -70,6 +74,11 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self._vmutils._conn = mock.MagicMock()
         self._vmutils._jobutils = mock.MagicMock()
         self._vmutils._pathutils = mock.MagicMock()
+        self._vmutils._scsi_slot_allocator = (
+            slotallocator.ControllerSlotAllocator(
+                constants.SCSI_CONTROLLER_SLOTS_NUMBER))
+        self._vmutils._disk_resource_indexes = {}
+        self._vmutils._disk_index_generations = collections.Counter()
 
     def test_vs_man_svc(self):
         expected = self._vmutils._conn.Msvm_VirtualSystemManagementService()[0]
@@ -93,6 +102,58 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         summary = self._vmutils.get_vm_summary_info(self._FAKE_VM_NAME)
         self.assertEqual(self._FAKE_SUMMARY_INFO, summary)
 
+    def _test_get_vms_summary_info(self, vm_names=None):
+        mock_vssd_1 = mock.Mock(ElementName=mock.sentinel.vm_name_1)
+        mock_vssd_2 = mock.Mock(ElementName=mock.sentinel.vm_name_2)
+        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = [
+            mock_vssd_1, mock_vssd_2]
+        expected_vssds = ([mock_vssd_1, mock_vssd_2] if vm_names is None
+                          else [mock_vssd_2])
+
+        mock_summaries = [
+            mock.MagicMock(ElementName=vssd.ElementName,
+                           **self._FAKE_SUMMARY_INFO)
+            for vssd in expected_vssds]
+        mock_svc = self._vmutils._vs_man_svc
+        mock_svc.GetSummaryInformation.return_value = (self._FAKE_RET_VAL,
+                                                       mock_summaries)
+
+        summaries = self._vmutils.get_vms_summary_info(vm_names)
+
+        expected_summaries = dict((vssd.ElementName, self._FAKE_SUMMARY_INFO)
+                                  for vssd in expected_vssds)
+        self.assertEqual(expected_summaries, summaries)
+        mock_vssd_cls = self._vmutils._conn.Msvm_VirtualSystemSettingData
+        mock_vssd_cls.assert_called_once_with(
+            ['ElementName', 'InstanceID'],
+            VirtualSystemType=self._vmutils._VIRTUAL_SYSTEM_TYPE_REALIZED)
+        mock_svc.GetSummaryInformation.assert_called_once_with(
+            mock.ANY, [vssd.path_.return_value for vssd in expected_vssds])
+
+    def test_get_vms_summary_info(self):
+        self._test_get_vms_summary_info()
+
+    def test_get_vms_summary_info_filtered(self):
+        self._test_get_vms_summary_info(vm_names=[mock.sentinel.vm_name_2,
+                                                  mock.sentinel.missing_vm])
+
+    def test_get_vms_summary_info_no_vms(self):
+        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = []
+
+        self.assertEqual({}, self._vmutils.get_vms_summary_info())
+        self.assertFalse(
+            self._vmutils._vs_man_svc.GetSummaryInformation.called)
+
+    def test_get_vms_summary_info_exception(self):
+        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = [
+            mock.Mock(ElementName=self._FAKE_VM_NAME)]
+        mock_svc = self._vmutils._vs_man_svc
+        mock_svc.GetSummaryInformation.return_value = (mock.sentinel.err,
+                                                       [])
+
+        self.assertRaises(exceptions.HyperVException,
+                          self._vmutils.get_vms_summary_info)
+
     def _lookup_vm(self):
         mock_vm = mock.MagicMock()
         self._vmutils._lookup_vm_check = mock.MagicMock(
@@ -102,23 +163,157 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
     def test_lookup_vm_ok(self):
         mock_vm = mock.MagicMock()
-        self._vmutils._conn.Msvm_ComputerSystem.return_value = [mock_vm]
+        self._vmutils._conn.query.return_value = [mock_vm]
         vm = self._vmutils._lookup_vm_check(self._FAKE_VM_NAME)
         self.assertEqual(mock_vm, vm)
+        self._vmutils._conn.query.assert_called_once_with(
+            "SELECT * FROM Msvm_ComputerSystem WHERE ElementName = '%s'" %
+            self._FAKE_VM_NAME)
+
+    def test_lookup_vm_properties(self):
+        mock_inventory = mock.Mock()
+        mock_inventory.get_vm.return_value = None
+        self._vmutils._vm_inventory = mock_inventory
+        mock_vm = mock.MagicMock()
+        self._vmutils._conn.query.return_value = [mock_vm]
+
+        vm = self._vmutils._lookup_vm("fake'vm", ['Name'])
+
+        self.assertEqual(mock_vm, vm)
+        self._vmutils._conn.query.assert_called_once_with(
+            "SELECT Name FROM Msvm_ComputerSystem "
+            "WHERE ElementName = 'fake''vm'")
+        self.assertFalse(mock_inventory.add_vm.called)
 
     def test_lookup_vm_multiple(self):
         mockvm = mock.MagicMock()
-        self._vmutils._conn.Msvm_ComputerSystem.return_value = [mockvm, mockvm]
+        self._vmutils._conn.query.return_value = [mockvm, mockvm]
         self.assertRaises(exceptions.HyperVException,
                           self._vmutils._lookup_vm_check,
                           self._FAKE_VM_NAME)
 
     def test_lookup_vm_none(self):
-        self._vmutils._conn.Msvm_ComputerSystem.return_value = []
+        self._vmutils._conn.query.return_value = []
         self.assertRaises(exceptions.HyperVVMNotFoundException,
                           self._vmutils._lookup_vm_check,
                           self._FAKE_VM_NAME)
 
+    @mock.patch.object(vmutils.vminventory, 'get_vm_inventory')
+    def test_enable_vm_inventory(self, mock_get_vm_inventory):
+        self._vmutils.enable_vm_inventory()
+
+        self.assertEqual(mock_get_vm_inventory.return_value,
+                         self._vmutils._vm_inventory)
+        mock_get_vm_inventory.assert_called_once_with('.')
+
+    def test_lookup_vm_inventory(self):
+        mock_inventory = mock.Mock()
+        self._vmutils._vm_inventory = mock_inventory
+
+        vm = self._vmutils._lookup_vm(self._FAKE_VM_NAME)
+
+        self.assertEqual(mock_inventory.get_vm.return_value, vm)
+        mock_inventory.get_vm.assert_called_once_with(self._FAKE_VM_NAME)
+        self.assertFalse(self._vmutils._conn.query.called)
+
+    def test_lookup_vm_inventory_miss(self):
+        mock_inventory = mock.Mock()
+        mock_inventory.get_vm.return_value = None
+        self._vmutils._vm_inventory = mock_inventory
+        mock_vm = mock.Mock()
+        self._vmutils._conn.query.return_value = [mock_vm]
+
+        vm = self._vmutils._lookup_vm(self._FAKE_VM_NAME)
+
+        self.assertEqual(mock_vm, vm)
+        mock_inventory.add_vm.assert_called_once_with(mock_vm)
+
+    def test_lookup_vm_handle(self):
+        mock_handle = vmutils.VMHandle(mock.sentinel.vm, self._vmutils)
+
+        vm = self._vmutils._lookup_vm(mock_handle)
+
+        self.assertIs(mock_handle, vm)
+        self.assertFalse(self._vmutils._conn.query.called)
+
+    def test_get_vm_handle(self):
+        mock_vm = self._lookup_vm()
+
+        vm_handle = self._vmutils.get_vm_handle(self._FAKE_VM_NAME)
+
+        self.assertIsInstance(vm_handle, vmutils.VMHandle)
+        self.assertEqual(mock_vm, vm_handle.vm)
+        self.assertEqual(mock_vm.ElementName, vm_handle.name)
+        self.assertEqual(self._FAKE_VM_PATH, vm_handle.path_())
+        self._vmutils._lookup_vm_check.assert_called_once_with(
+            self._FAKE_VM_NAME)
+
+    def test_lock_vm(self):
+        mock_vm = self._lookup_vm()
+        self._vmutils._vm_locks = mock.MagicMock()
+
+        with self._vmutils.lock_vm(self._FAKE_VM_NAME,
+                                   shared=mock.sentinel.shared) as vm:
+            self.assertEqual(mock_vm, vm)
+
+        self._vmutils._lookup_vm_check.assert_called_once_with(
+            self._FAKE_VM_NAME)
+        self._vmutils._vm_locks.lock_objects.assert_called_once_with(
+            [mock_vm], mock.sentinel.shared)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_vm_setting_data')
+    def test_vm_handle_resources(self, mock_get_vm_setting_data):
+        mock_vm = mock.Mock()
+        mock_vmsettings = mock_get_vm_setting_data.return_value
+        vm_handle = vmutils.VMHandle(mock_vm, self._vmutils)
+
+        for i in range(2):
+            self.assertEqual(mock_vmsettings, vm_handle.vmsettings)
+            self.assertEqual(
+                mock_vmsettings.associators.return_value,
+                vm_handle.get_resources(mock.sentinel.resource_class))
+
+        mock_get_vm_setting_data.assert_called_once_with(mock_vm)
+        mock_vmsettings.associators.assert_called_once_with(
+            wmi_result_class=mock.sentinel.resource_class)
+
+        vm_handle.invalidate()
+        vm_handle.get_resources(mock.sentinel.resource_class)
+
+        self.assertEqual(2, mock_get_vm_setting_data.call_count)
+        self.assertEqual(2, mock_vmsettings.associators.call_count)
+
+    def test_get_vm_setting_data_handle(self):
+        vm_handle = mock.Mock(spec=vmutils.VMHandle)
+        vmsettings = self._vmutils._get_vm_setting_data(vm_handle)
+        self.assertEqual(vm_handle.vmsettings, vmsettings)
+
+    def test_get_vm_disks_handle(self):
+        vm_handle = mock.Mock(spec=vmutils.VMHandle)
+        mock_rasds = self._create_mock_disks()
+        vm_handle.get_resources.return_value = mock_rasds
+
+        (disks, volumes) = self._vmutils._get_vm_disks(vm_handle)
+
+        self.assertEqual([mock_rasds[0]], disks)
+        self.assertEqual([mock_rasds[1]], volumes)
+        vm_handle.get_resources.assert_has_calls(
+            [mock.call(self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS),
+             mock.call(self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS)])
+
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    def test_attach_drives_invalidates_handle(self, mock_get_new_rsd):
+        vm_handle = mock.Mock(spec=vmutils.VMHandle)
+        self._vmutils._scsi_slot_allocator = mock.Mock()
+        mock_add_res = self._vmutils._jobutils.add_multiple_virt_resources
+        mock_add_res.return_value = [mock.sentinel.drive_path]
+
+        self._vmutils._attach_drives(
+            vm_handle, [(mock.sentinel.vhd_path, mock.sentinel.ctrl_path,
+                         0, constants.DISK)])
+
+        vm_handle.invalidate.assert_called_once_with()
+
     def test_set_vm_memory_static(self):
         self._test_set_vm_memory_dynamic(1.0)
 
@@ -231,6 +426,32 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self.assertEqual([mock_rasds[0]], disks)
         self.assertEqual([mock_rasds[1]], volumes)
 
+    @mock.patch.object(vmutils.VMUtils, '_query_records')
+    def test_get_vm_disks_detached(self, mock_query_records):
+        mock_vm = self._lookup_vm()
+        mock_vm.Name = 'fake_id'
+        mock_query_records.side_effect = [mock.sentinel.disks,
+                                          mock.sentinel.volumes]
+
+        (disks, volumes) = self._vmutils.get_vm_disks(mock.sentinel.vm_name,
+                                                      detached=True)
+
+        self.assertEqual(mock.sentinel.disks, disks)
+        self.assertEqual(mock.sentinel.volumes, volumes)
+        vm_filter = "InstanceID LIKE 'Microsoft:fake_id\\%'"
+        mock_query_records.assert_has_calls([
+            mock.call(vmutils.DiskResourceRecord,
+                      self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS,
+                      vm_filter,
+                      conditions={'ResourceSubType': (
+                          self._vmutils._HARD_DISK_RES_SUB_TYPE,
+                          self._vmutils._DVD_DISK_RES_SUB_TYPE)}),
+            mock.call(vmutils.DiskResourceRecord,
+                      self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                      vm_filter,
+                      conditions={'ResourceSubType':
+                                  self._vmutils._PHYS_DISK_RES_SUB_TYPE})])
+
     def _create_mock_disks(self):
         mock_rasd1 = mock.MagicMock()
         mock_rasd1.ResourceSubType = self._vmutils._HARD_DISK_RES_SUB_TYPE
@@ -335,7 +556,7 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
             self._FAKE_CTRL_PATH)
 
         mock_get_attached_disks.assert_called_once_with(
-            self._FAKE_CTRL_PATH)
+            self._FAKE_CTRL_PATH, detached=True)
 
         self.assertEqual(response, 0)
 
@@ -350,7 +571,17 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
                 [fake_drive] * constants.SCSI_CONTROLLER_SLOTS_NUMBER)
             self.assertRaises(exceptions.HyperVException,
                               self._vmutils.get_free_controller_slot,
-                              mock.sentinel.scsi_controller_path)
+                              self._FAKE_CTRL_PATH)
+
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_get_free_controller_slots(self, mock_get_attached_disks):
+        mock_get_attached_disks.return_value = [
+            mock.Mock(AddressOnParent='0'), mock.Mock(AddressOnParent='2')]
+
+        slots = self._vmutils._get_free_controller_slots(
+            self._FAKE_CTRL_PATH, 3)
+
+        self.assertEqual([1, 3, 4], slots)
 
     def test_get_vm_ide_controller(self):
         self._prepare_get_vm_controller(self._vmutils._IDE_CTRL_RES_SUB_TYPE)
@@ -380,43 +611,394 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_rasds.ResourceSubType = mock_subtype
         return mock_rasds
 
-    @mock.patch.object(vmutils.VMUtils, 'get_free_controller_slot')
-    @mock.patch.object(vmutils.VMUtils, '_get_vm_scsi_controller')
-    def test_attach_scsi_drive(self, mock_get_vm_scsi_controller,
-                               mock_get_free_controller_slot):
-        mock_vm = self._lookup_vm()
-        mock_get_vm_scsi_controller.return_value = self._FAKE_CTRL_PATH
-        mock_get_free_controller_slot.return_value = self._FAKE_DRIVE_ADDR
-
-        with mock.patch.object(self._vmutils,
-                               'attach_drive') as mock_attach_drive:
-            self._vmutils.attach_scsi_drive(mock_vm, self._FAKE_PATH,
-                                            constants.DISK)
+    @mock.patch.object(vmutils.VMUtils, 'attach_scsi_drives')
+    def test_attach_scsi_drive(self, mock_attach_scsi_drives):
+        self._vmutils.attach_scsi_drive(self._FAKE_VM_NAME,
+                                        self._FAKE_PATH,
+                                        constants.DVD)
 
-            mock_get_vm_scsi_controller.assert_called_once_with(mock_vm)
-            mock_get_free_controller_slot.assert_called_once_with(
-                self._FAKE_CTRL_PATH)
-            mock_attach_drive.assert_called_once_with(
-                mock_vm, self._FAKE_PATH, self._FAKE_CTRL_PATH,
-                self._FAKE_DRIVE_ADDR, constants.DISK)
+        mock_attach_scsi_drives.assert_called_once_with(
+            self._FAKE_VM_NAME, [self._FAKE_PATH], constants.DVD)
 
     @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
     @mock.patch.object(vmutils.VMUtils, '_get_vm_ide_controller')
     def test_attach_ide_drive(self, mock_get_ide_ctrl, mock_get_new_rsd):
         mock_vm = self._lookup_vm()
         mock_rsd = mock_get_new_rsd.return_value
+        mock_add_res = self._vmutils._jobutils.add_multiple_virt_resources
+        mock_add_res.return_value = [mock.sentinel.drive_path]
 
         self._vmutils.attach_ide_drive(self._FAKE_VM_NAME,
                                        self._FAKE_CTRL_PATH,
                                        self._FAKE_CTRL_ADDR,
                                        self._FAKE_DRIVE_ADDR)
 
-        self._vmutils._jobutils.add_virt_resource.assert_called_with(
-            mock_rsd, mock_vm)
+        mock_add_res.assert_has_calls([mock.call([mock_rsd], mock_vm)] * 2)
+        self.assertEqual(mock.sentinel.drive_path, mock_rsd.Parent)
 
-        mock_get_ide_ctrl.assert_called_with(mock_vm, self._FAKE_CTRL_ADDR)
+        mock_vm_handle = mock_get_ide_ctrl.call_args[0][0]
+        self.assertIsInstance(mock_vm_handle, vmutils.VMHandle)
+        self.assertEqual(mock_vm, mock_vm_handle.vm)
+        mock_get_ide_ctrl.assert_called_with(mock_vm_handle,
+                                             self._FAKE_CTRL_ADDR)
         self.assertTrue(mock_get_new_rsd.called)
 
+    @mock.patch.object(vmutils.VMUtils, 'get_vm_handle')
+    @mock.patch.object(vmutils.VMUtils, '_attach_drives')
+    @mock.patch.object(vmutils.VMUtils, '_get_free_controller_slots')
+    @mock.patch.object(vmutils.VMUtils, '_get_vm_scsi_controller')
+    def test_attach_scsi_drives(self, mock_get_vm_scsi_controller,
+                                mock_get_free_controller_slots,
+                                mock_attach_drives, mock_get_vm_handle):
+        mock_vm_handle = mock_get_vm_handle.return_value
+        self._vmutils._lookup_vm_check = mock.Mock(
+            return_value=mock_vm_handle)
+        self._vmutils._vm_locks = mock.MagicMock()
+        mock_get_vm_scsi_controller.return_value = self._FAKE_CTRL_PATH
+        mock_get_free_controller_slots.return_value = [1, 2]
+
+        slots = self._vmutils.attach_scsi_drives(
+            self._FAKE_VM_NAME, [mock.sentinel.path_0, mock.sentinel.path_1])
+
+        self.assertEqual([1, 2], slots)
+        mock_get_vm_handle.assert_called_once_with(self._FAKE_VM_NAME)
+        self._vmutils._vm_locks.lock_objects.assert_called_once_with(
+            [mock_vm_handle], False)
+        mock_get_vm_scsi_controller.assert_called_once_with(mock_vm_handle)
+        mock_get_free_controller_slots.assert_called_once_with(
+            self._FAKE_CTRL_PATH, 2)
+        mock_attach_drives.assert_called_once_with(
+            mock_vm_handle,
+            [(mock.sentinel.path_0, self._FAKE_CTRL_PATH, 1, constants.DISK),
+             (mock.sentinel.path_1, self._FAKE_CTRL_PATH, 2, constants.DISK)])
+
+    @mock.patch.object(vmutils.VMUtils, 'get_vm_handle')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    @mock.patch.object(vmutils.VMUtils, '_get_vm_scsi_controller')
+    def test_attach_scsi_drives_releases_slots(self,
+                                               mock_get_vm_scsi_controller,
+                                               mock_get_new_rsd,
+                                               mock_get_vm_handle):
+        mock_vm_handle = mock_get_vm_handle.return_value
+        self._vmutils._lookup_vm_check = mock.Mock(
+            return_value=mock_vm_handle)
+        mock_allocator = mock.Mock()
+        mock_allocator.reserve_slots.return_value = [self._FAKE_DRIVE_ADDR]
+        self._vmutils._scsi_slot_allocator = mock_allocator
+        mock_get_vm_scsi_controller.return_value = self._FAKE_CTRL_PATH
+        mock_add_res = self._vmutils._jobutils.add_multiple_virt_resources
+        mock_add_res.side_effect = exceptions.HyperVException
+
+        self.assertRaises(exceptions.HyperVException,
+                          self._vmutils.attach_scsi_drives,
+                          self._FAKE_VM_NAME, [self._FAKE_PATH])
+
+        mock_allocator.release_reservations.assert_called_once_with(
+            self._FAKE_CTRL_PATH, [self._FAKE_DRIVE_ADDR])
+        self.assertFalse(mock_allocator.commit_slots.called)
+
+    @mock.patch.object(vmutils.VMUtils, '_index_disk_resources')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    def test_attach_drives(self, mock_get_new_rsd, mock_index_disk_resources):
+        mock_vm = self._lookup_vm()
+        mock_allocator = mock.Mock()
+        self._vmutils._scsi_slot_allocator = mock_allocator
+        mock_get_new_rsd.side_effect = lambda *args: mock.MagicMock()
+        mock_add_res = self._vmutils._jobutils.add_multiple_virt_resources
+        mock_add_res.side_effect = [
+            [mock.sentinel.drive_path_0, mock.sentinel.drive_path_1],
+            mock.sentinel.disk_paths]
+
+        self._vmutils.attach_drives(
+            self._FAKE_VM_NAME,
+            [(mock.sentinel.vhd_path, mock.sentinel.ctrl_path_0, 0,
+              constants.DISK),
+             (mock.sentinel.iso_path, mock.sentinel.ctrl_path_1, 1,
+              constants.DVD)])
+
+        self.assertEqual(2, mock_add_res.call_count)
+        drives = mock_add_res.call_args_list[0][0][0]
+        self.assertEqual([mock.sentinel.ctrl_path_0,
+                          mock.sentinel.ctrl_path_1],
+                         [drive.Parent for drive in drives])
+        self.assertEqual([0, 1], [drive.AddressOnParent for drive in drives])
+
+        images, parent = mock_add_res.call_args_list[1][0]
+        self.assertEqual(mock_vm, parent)
+        self.assertEqual([mock.sentinel.drive_path_0,
+                          mock.sentinel.drive_path_1],
+                         [image.Parent for image in images])
+        self.assertEqual([[mock.sentinel.vhd_path], [mock.sentinel.iso_path]],
+                         [image.HostResource for image in images])
+        mock_get_new_rsd.assert_has_calls(
+            [mock.call(self._vmutils._DISK_DRIVE_RES_SUB_TYPE),
+             mock.call(self._vmutils._DVD_DRIVE_RES_SUB_TYPE),
+             mock.call(self._vmutils._HARD_DISK_RES_SUB_TYPE,
+                       self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS),
+             mock.call(self._vmutils._DVD_DISK_RES_SUB_TYPE,
+                       self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS)])
+        mock_allocator.commit_slots.assert_has_calls(
+            [mock.call(mock.sentinel.ctrl_path_0, [0]),
+             mock.call(mock.sentinel.ctrl_path_1, [1])])
+        mock_index_disk_resources.assert_called_once_with(
+            mock.sentinel.disk_paths, is_physical=False)
+
+    def test_add_drives_unsupported_drive_type(self):
+        self.assertRaises(exceptions.HyperVException,
+                          self._vmutils._add_drives, mock.sentinel.vm,
+                          [(mock.sentinel.vhd_path, mock.sentinel.ctrl_path,
+                            0, mock.sentinel.drive_type)])
+        self.assertFalse(
+            self._vmutils._jobutils.add_multiple_virt_resources.called)
+
+    @mock.patch.object(vmutils.VMUtils, '_add_drives')
+    def test_attach_drives_failed(self, mock_add_drives):
+        mock_allocator = mock.Mock()
+        self._vmutils._scsi_slot_allocator = mock_allocator
+        mock_add_drives.side_effect = exceptions.HyperVException
+        self._vmutils._disk_resource_indexes[False] = {}
+
+        self.assertRaises(
+            exceptions.HyperVException,
+            self._vmutils._attach_drives, mock.sentinel.vm,
+            [(mock.sentinel.vhd_path, mock.sentinel.ctrl_path, 1,
+              constants.DISK)])
+
+        mock_allocator.release_reservations.assert_called_once_with(
+            mock.sentinel.ctrl_path, [1])
+        mock_allocator.resync.assert_called_once_with(
+            mock.sentinel.ctrl_path)
+        self.assertFalse(mock_allocator.release_slots.called)
+        self.assertFalse(mock_allocator.commit_slots.called)
+        # Some of the images may have been attached.
+        self.assertNotIn(False, self._vmutils._disk_resource_indexes)
+
+    @mock.patch.object(vmutils.VMUtils, '_add_drives')
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_attach_drives_slot_taken(self, mock_get_attached_disks,
+                                      mock_add_drives):
+        mock_get_attached_disks.return_value = [
+            mock.Mock(AddressOnParent='0')]
+        slot = self._vmutils.get_free_controller_slot(self._FAKE_CTRL_PATH)
+        # Another disk was attached to the slot behind the allocator's
+        # back, so attaching the disk fails.
+        mock_get_attached_disks.return_value.append(
+            mock.Mock(AddressOnParent=str(slot)))
+        mock_add_drives.side_effect = exceptions.HyperVException
+
+        self.assertRaises(
+            exceptions.HyperVException,
+            self._vmutils._attach_drives, mock.sentinel.vm,
+            [(mock.sentinel.vhd_path, self._FAKE_CTRL_PATH, slot,
+              constants.DISK)])
+
+        self.assertEqual(1, slot)
+        self.assertEqual(
+            2, self._vmutils.get_free_controller_slot(self._FAKE_CTRL_PATH))
+        self.assertEqual(2, mock_get_attached_disks.call_count)
+
+    def test_release_controller_slots(self):
+        mock_allocator = mock.Mock()
+        self._vmutils._scsi_slot_allocator = mock_allocator
+        mock_drive = mock.Mock(Parent=mock.sentinel.ctrl_path,
+                               AddressOnParent='3')
+
+        self._vmutils._release_controller_slots([mock_drive])
+
+        mock_allocator.release_slots.assert_called_once_with(
+            mock.sentinel.ctrl_path, [3])
+
+    @mock.patch.object(vmutils.baseutils, 'WMIEventWatcher')
+    def test_enable_drive_events(self, mock_event_watcher_cls):
+        self._vmutils._host = 'fake_host'
+        self.addCleanup(vmutils._drive_event_watchers.pop, 'fake_host')
+
+        def fake_start():
+            # The watchers are started without holding the lock.
+            self.assertFalse(vmutils._drive_event_watchers_lock.locked())
+
+        mock_event_watcher_cls.return_value.start.side_effect = fake_start
+
+        for i in range(2):
+            self._vmutils.enable_drive_events()
+
+        mock_event_watcher_cls.assert_has_calls([
+            mock.call(
+                mock.ANY, self._vmutils._process_drive_event,
+                host='fake_host',
+                namespace=self._vmutils._WMI_VIRT_NAMESPACE,
+                fields=['Parent', 'AddressOnParent', 'ResourceSubType',
+                        'HostResource'],
+                state_callback=self._vmutils._on_drive_events_state_change,
+                description='WMI drive'),
+            mock.call(
+                mock.ANY, self._vmutils._process_disk_image_event,
+                host='fake_host',
+                namespace=self._vmutils._WMI_VIRT_NAMESPACE,
+                fields=['HostResource'],
+                state_callback=(
+                    self._vmutils._on_disk_image_events_state_change),
+                description='WMI disk image')], any_order=True)
+        self.assertEqual(2, mock_event_watcher_cls.call_count)
+        self.assertEqual(
+            2, mock_event_watcher_cls.return_value.start.call_count)
+        drive_query = mock_event_watcher_cls.call_args_list[0][0][0]
+        self.assertIn("TargetInstance.ResourceSubType = '%s'" %
+                      self._vmutils._DISK_DRIVE_RES_SUB_TYPE, drive_query)
+        disk_image_query = mock_event_watcher_cls.call_args_list[1][0][0]
+        self.assertIn(self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS,
+                      disk_image_query)
+
+    @mock.patch.object(vmutils.baseutils, 'WMIEventWatcher')
+    def test_drive_events_disabled(self, mock_event_watcher_cls):
+        # The drive events are opt-in.
+        self._vmutils._host = 'fake_host'
+        self._vmutils._get_mounted_disk_resources_from_paths(
+            ['C:\\Disk.vhdx'], is_physical=True)
+        self.assertNotIn('fake_host', vmutils._drive_event_watchers)
+        self.assertFalse(mock_event_watcher_cls.called)
+
+    def test_drive_events_available(self):
+        self._vmutils._host = 'fake_host'
+        self.assertFalse(self._vmutils._drive_events_available())
+
+        watchers = [mock.Mock(available=True), mock.Mock(available=False)]
+        with mock.patch.dict(vmutils._drive_event_watchers,
+                             {'fake_host': watchers}):
+            self.assertFalse(self._vmutils._drive_events_available())
+            watchers[1].available = True
+            self.assertTrue(self._vmutils._drive_events_available())
+
+    def test_process_drive_event(self):
+        mock_allocator = mock.Mock()
+        self._vmutils._scsi_slot_allocator = mock_allocator
+        self._vmutils._disk_resource_indexes[True] = {
+            'c:\\disk.vhdx': mock.sentinel.disk,
+            'c:\\other_disk.vhdx': mock.sentinel.other_disk}
+
+        self._vmutils._process_drive_event(None)
+        self._vmutils._process_drive_event(
+            mock.Mock(Parent=mock.sentinel.ctrl_path, AddressOnParent='2',
+                      ResourceSubType=self._vmutils._DISK_DRIVE_RES_SUB_TYPE,
+                      event_type='creation'))
+        self._vmutils._process_drive_event(
+            mock.Mock(Parent=mock.sentinel.ctrl_path, AddressOnParent='3',
+                      ResourceSubType=self._vmutils._PHYS_DISK_RES_SUB_TYPE,
+                      HostResource=['C:\\Disk.vhdx'],
+                      event_type='deletion'))
+
+        mock_allocator.update_slot.assert_has_calls(
+            [mock.call(mock.sentinel.ctrl_path, 2, used=True),
+             mock.call(mock.sentinel.ctrl_path, 3, used=False)])
+        self.assertEqual(2, mock_allocator.update_slot.call_count)
+        # Only the affected index entry is dropped.
+        self.assertEqual({'c:\\other_disk.vhdx': mock.sentinel.other_disk},
+                         self._vmutils._disk_resource_indexes[True])
+        self.assertEqual(1, self._vmutils._disk_index_generations[True])
+
+    def test_on_drive_events_state_change(self):
+        mock_allocator = mock.Mock()
+        self._vmutils._scsi_slot_allocator = mock_allocator
+        self._vmutils._disk_resource_indexes[True] = {}
+
+        self._vmutils._on_drive_events_state_change(available=True)
+        mock_allocator.resync.assert_called_once_with()
+        self.assertNotIn(True, self._vmutils._disk_resource_indexes)
+
+    def _test_process_disk_image_event(self, event, expected_index):
+        self._vmutils._disk_resource_indexes[False] = {
+            'c:\\disk.vhdx': mock.sentinel.disk,
+            'c:\\other_disk.vhdx': mock.sentinel.other_disk}
+
+        self._vmutils._process_disk_image_event(event)
+
+        self.assertEqual(expected_index,
+                         self._vmutils._disk_resource_indexes.get(False))
+
+    def test_process_disk_image_event_timeout(self):
+        self._test_process_disk_image_event(
+            None, {'c:\\disk.vhdx': mock.sentinel.disk,
+                   'c:\\other_disk.vhdx': mock.sentinel.other_disk})
+
+    def test_process_disk_image_event_indexed(self):
+        # The disk was indexed when attaching it.
+        self._test_process_disk_image_event(
+            mock.Mock(HostResource=['C:\\Disk.vhdx'], event_type='creation'),
+            {'c:\\disk.vhdx': mock.sentinel.disk,
+             'c:\\other_disk.vhdx': mock.sentinel.other_disk})
+
+    def test_process_disk_image_event_not_indexed(self):
+        self._test_process_disk_image_event(
+            mock.Mock(HostResource=['C:\\New.vhdx'], event_type='creation'),
+            None)
+
+    def test_process_disk_image_event_deletion(self):
+        self._test_process_disk_image_event(
+            mock.Mock(HostResource=['C:\\Disk.vhdx'], event_type='deletion'),
+            {'c:\\other_disk.vhdx': mock.sentinel.other_disk})
+
+    def test_process_disk_image_event_unchanged_path(self):
+        self._test_process_disk_image_event(
+            mock.Mock(HostResource=['C:\\Disk.vhdx'],
+                      previous=mock.Mock(HostResource=['C:\\Disk.vhdx']),
+                      event_type='modification'),
+            {'c:\\disk.vhdx': mock.sentinel.disk,
+             'c:\\other_disk.vhdx': mock.sentinel.other_disk})
+
+    def test_process_disk_image_event_replaced(self):
+        self._test_process_disk_image_event(
+            mock.Mock(HostResource=[],
+                      previous=mock.Mock(HostResource=['C:\\Disk.vhdx']),
+                      event_type='modification'),
+            {'c:\\other_disk.vhdx': mock.sentinel.other_disk})
+
+    def test_process_disk_image_event_unknown_previous(self):
+        self._test_process_disk_image_event(
+            mock.Mock(HostResource=['C:\\Disk.vhdx'], previous=None,
+                      event_type='modification'),
+            None)
+
+    def test_index_disk_resources(self):
+        mock_disk = mock.Mock(HostResource=['C:\\New.vhdx'])
+        self._vmutils._conn.query.return_value = [mock_disk]
+        self._vmutils._disk_resource_indexes[False] = {
+            'c:\\disk.vhdx': mock.sentinel.disk}
+
+        self._vmutils._index_disk_resources([self._FAKE_RES_PATH],
+                                            is_physical=False)
+
+        self.assertEqual({'c:\\disk.vhdx': mock.sentinel.disk,
+                          'c:\\new.vhdx': mock_disk},
+                         self._vmutils._disk_resource_indexes[False])
+        self._vmutils._conn.query.assert_called_once_with(
+            vmutils.baseutils.build_query(
+                self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS,
+                conditions={'__PATH': [self._FAKE_RES_PATH]}))
+        self.assertEqual(1, self._vmutils._disk_index_generations[False])
+
+    def test_index_disk_resources_not_loaded(self):
+        self._vmutils._index_disk_resources([mock.sentinel.res_path],
+                                            is_physical=True)
+
+        self.assertFalse(self._vmutils._conn.query.called)
+        self.assertEqual(1, self._vmutils._disk_index_generations[True])
+
+    @mock.patch.object(vmutils.VMUtils, 'get_attached_disks')
+    def test_get_free_controller_slot_reserved(self, mock_get_attached_disks):
+        mock_get_attached_disks.return_value = [
+            mock.Mock(AddressOnParent='0')]
+
+        slots = [self._vmutils.get_free_controller_slot(self._FAKE_CTRL_PATH)
+                 for i in range(2)]
+        self._vmutils.release_controller_slots(self._FAKE_CTRL_PATH,
+                                               [slots[0]])
+        slot = self._vmutils.get_free_controller_slot(self._FAKE_CTRL_PATH)
+
+        self.assertEqual([1, 2], slots)
+        self.assertEqual(1, slot)
+        mock_get_attached_disks.assert_called_once_with(self._FAKE_CTRL_PATH,
+                                                        detached=True)
+
     @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
     def test_create_scsi_controller(self, mock_get_new_rsd):
         mock_vm = self._lookup_vm()
@@ -426,15 +1008,18 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self._vmutils._jobutils.add_virt_resource.assert_called_once_with(
             mock_get_new_rsd.return_value, mock_vm)
 
+    @mock.patch.object(vmutils.VMUtils, '_index_disk_resources')
     @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
-    @mock.patch.object(vmutils, 'wmi', create=True)
-    def _test_attach_volume_to_controller(self, mock_wmi, mock_get_new_rsd,
+    @mock.patch.object(baseutils, 'get_wmi_object')
+    def _test_attach_volume_to_controller(self, mock_get_wmi_obj,
+                                          mock_get_new_rsd,
+                                          mock_index_disk_resources,
                                           disk_serial=None):
         mock_vm = self._lookup_vm()
         mock_diskdrive = mock.MagicMock()
         jobutils = self._vmutils._jobutils
         jobutils.add_virt_resource.return_value = [mock_diskdrive]
-        mock_wmi.WMI.return_value = mock_diskdrive
+        mock_get_wmi_obj.return_value = mock_diskdrive
 
         self._vmutils.attach_volume_to_controller(
             self._FAKE_VM_NAME, self._FAKE_CTRL_PATH, self._FAKE_CTRL_ADDR,
@@ -447,6 +1032,41 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
             jobutils.modify_virt_resource.assert_called_once_with(
                 mock_diskdrive)
             self.assertEqual(disk_serial, mock_diskdrive.ElementName)
+        mock_index_disk_resources.assert_called_once_with(
+            [mock_diskdrive], is_physical=True)
+
+    @mock.patch.object(vmutils.VMUtils, '_index_disk_resources')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    @mock.patch.object(baseutils, 'get_wmi_object')
+    def test_attach_volumes_to_controller(self, mock_get_wmi_obj,
+                                          mock_get_new_rsd,
+                                          mock_index_disk_resources):
+        mock_vm = self._lookup_vm()
+        mock_get_new_rsd.side_effect = lambda *args: mock.MagicMock()
+        jobutils = self._vmutils._jobutils
+        jobutils.add_multiple_virt_resources.return_value = [
+            mock.sentinel.diskdrive_path_0, mock.sentinel.diskdrive_path_1]
+        mock_diskdrive = mock_get_wmi_obj.return_value
+
+        self._vmutils.attach_volumes_to_controller(
+            self._FAKE_VM_NAME, self._FAKE_CTRL_PATH,
+            [(0, mock.sentinel.disk_path_0, None),
+             (1, mock.sentinel.disk_path_1, mock.sentinel.serial)])
+
+        diskdrives, parent = jobutils.add_multiple_virt_resources.call_args[0]
+        self.assertEqual(mock_vm, parent)
+        self.assertEqual([0, 1], [d.AddressOnParent for d in diskdrives])
+        self.assertEqual([[mock.sentinel.disk_path_0],
+                          [mock.sentinel.disk_path_1]],
+                         [d.HostResource for d in diskdrives])
+        mock_get_wmi_obj.assert_called_once_with(
+            mock.sentinel.diskdrive_path_1)
+        self.assertEqual(mock.sentinel.serial, mock_diskdrive.ElementName)
+        jobutils.modify_multiple_virt_resources.assert_called_once_with(
+            [mock_diskdrive])
+        mock_index_disk_resources.assert_called_once_with(
+            [mock.sentinel.diskdrive_path_0, mock.sentinel.diskdrive_path_1],
+            is_physical=True)
 
     def test_attach_volume_to_controller_without_disk_serial(self):
         self._test_attach_volume_to_controller()
@@ -459,22 +1079,31 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     def test_create_nic(self, mock_get_new_virt_res):
         mock_vm = self._lookup_vm()
         mock_nic = mock_get_new_virt_res.return_value
+        self._vmutils._vm_locks = mock.MagicMock()
 
         self._vmutils.create_nic(
             self._FAKE_VM_NAME, self._FAKE_RES_NAME, self._FAKE_ADDRESS)
 
         self._vmutils._jobutils.add_virt_resource.assert_called_once_with(
             mock_nic, mock_vm)
+        self._vmutils._vm_locks.lock_objects.assert_called_once_with(
+            [mock_vm], False)
 
     @mock.patch.object(vmutils.VMUtils, '_get_nic_data_by_name')
     def test_destroy_nic(self, mock_get_nic_data_by_name):
+        mock_vm = self._lookup_vm()
         mock_nic_data = mock_get_nic_data_by_name.return_value
+        self._vmutils._vm_locks = mock.MagicMock()
 
         self._vmutils.destroy_nic(self._FAKE_VM_NAME,
                                   mock.sentinel.FAKE_NIC_NAME)
 
         self._vmutils._jobutils.remove_virt_resource.assert_called_once_with(
             mock_nic_data)
+        mock_get_nic_data_by_name.assert_called_once_with(
+            mock.sentinel.FAKE_NIC_NAME)
+        self._vmutils._vm_locks.lock_objects.assert_called_once_with(
+            [mock_vm], False)
 
     def test_set_vm_state(self):
         mock_vm = self._lookup_vm()
@@ -486,6 +1115,184 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_vm.RequestStateChange.assert_called_with(
             constants.HYPERV_VM_STATE_ENABLED)
 
+    def _get_mock_vms(self, *vm_names):
+        mock_vms = [mock.Mock(ElementName=vm_name, Name='%s_id' % vm_name)
+                    for vm_name in vm_names]
+        self._vmutils._conn.Msvm_ComputerSystem.return_value = mock_vms
+        for mock_vm in mock_vms:
+            mock_vm.RequestStateChange.return_value = (
+                mock.sentinel.job_path, mock.sentinel.ret_val)
+        return mock_vms
+
+    def test_set_vms_state(self):
+        mock_vms = self._get_mock_vms('vm1', 'vm2', 'vm3', 'dup', 'dup')
+        mock_check_ret_val = self._vmutils._jobutils.check_ret_val_async
+        mock_job_handles = [mock.Mock(), mock.Mock(), mock.Mock()]
+        mock_job_handles[1].result.side_effect = exceptions.HyperVException
+        mock_check_ret_val.side_effect = mock_job_handles
+        # The second job finishes first.
+        mock_wait_for_any = self._vmutils._jobutils.wait_for_any
+        mock_wait_for_any.return_value = [mock_job_handles[1]]
+        self._vmutils._vm_locks = mock.MagicMock()
+
+        results = self._vmutils.set_vms_state(
+            ['vm1', 'vm2', 'vm3', 'dup', 'missing_vm'],
+            constants.HYPERV_VM_STATE_ENABLED, max_concurrency=2)
+
+        self.assertEqual(['dup', 'missing_vm', 'vm1', 'vm2', 'vm3'],
+                         sorted(results))
+        self.assertIsNone(results['vm1'])
+        self.assertIsInstance(results['vm2'], exceptions.HyperVException)
+        self.assertIsNone(results['vm3'])
+        self.assertIsInstance(results['dup'], exceptions.HyperVException)
+        self.assertIsInstance(results['missing_vm'],
+                              exceptions.HyperVVMNotFoundException)
+
+        for mock_vm in mock_vms[:3]:
+            mock_vm.RequestStateChange.assert_called_once_with(
+                self._vmutils._vm_power_states_map[
+                    constants.HYPERV_VM_STATE_ENABLED])
+        self.assertFalse(mock_vms[3].RequestStateChange.called)
+        mock_check_ret_val.assert_called_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path,
+            self._vmutils._VM_STATE_CHANGE_SUCCESS_VALUES)
+        for mock_job_handle in mock_job_handles:
+            mock_job_handle.result.assert_called_once_with()
+        mock_wait_for_any.assert_called_once_with(mock_job_handles[:2])
+        # Each VM is locked separately, only for its state change request.
+        mock_lock_objects = self._vmutils._vm_locks.lock_objects
+        mock_lock_objects.assert_has_calls(
+            [mock.call([mock_vm]) for mock_vm in mock_vms[:3]],
+            any_order=True)
+        self.assertEqual(3, mock_lock_objects.call_count)
+        self._vmutils._conn.Msvm_ComputerSystem.assert_called_once_with(
+            ['ElementName', 'CreationClassName', 'Name'],
+            Caption=constants.VM_CAPTION)
+
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    def test_set_vms_state_soft_shutdown(self, mock_sleep, mock_time):
+        mock_time.side_effect = [0, 1, 5]
+        mock_vms = self._get_mock_vms('vm1', 'vm2', 'vm3')
+        mock_components = [mock.Mock(SystemName='VM1_ID'),
+                           mock.Mock(SystemName='VM2_ID'),
+                           mock.Mock(SystemName='other_vm_id')]
+        mock_components[0].InitiateShutdown.return_value = (0, )
+        mock_components[1].InitiateShutdown.return_value = (0, )
+        self._vmutils._conn.query.return_value = mock_components
+        disabled_state = self._vmutils._vm_power_states_map[
+            constants.HYPERV_VM_STATE_DISABLED]
+        # vm1 shuts down during the second poll, vm2 ignores the request.
+        self._vmutils._conn.Msvm_ComputerSystem.side_effect = [
+            mock_vms,
+            [mock.Mock(ElementName='vm1', EnabledState=2)],
+            [mock.Mock(ElementName='vm1', EnabledState=disabled_state)]]
+        self._vmutils._vm_locks = mock.MagicMock()
+
+        results = self._vmutils.set_vms_state(
+            ['vm1', 'vm2', 'vm3'], constants.HYPERV_VM_STATE_DISABLED,
+            soft_shutdown_timeout=4)
+
+        self.assertEqual({'vm1': None, 'vm2': None, 'vm3': None}, results)
+        self._vmutils._conn.query.assert_called_once_with(
+            "SELECT CreationClassName, DeviceID, SystemCreationClassName, "
+            "SystemName FROM %s" % self._vmutils._SHUTDOWN_COMPONENT)
+        for mock_component in mock_components[:2]:
+            mock_component.InitiateShutdown.assert_called_once_with(
+                Force=False, Reason=self._vmutils._SOFT_SHUTDOWN_REASON)
+        self.assertFalse(mock_components[2].InitiateShutdown.called)
+        self.assertFalse(mock_vms[0].RequestStateChange.called)
+        for mock_vm in mock_vms[1:]:
+            mock_vm.RequestStateChange.assert_called_once_with(
+                disabled_state)
+        mock_sleep.assert_called_once_with(
+            self._vmutils._SOFT_SHUTDOWN_POLL_INTERVAL)
+        # The VMs are locked while requesting the shutdown and the state
+        # change, not while waiting for the guests to shut down.
+        mock_lock_objects = self._vmutils._vm_locks.lock_objects
+        mock_lock_objects.assert_has_calls(
+            [mock.call([mock_vms[0]]), mock.call([mock_vms[1]]),
+             mock.call([mock_vms[1]]), mock.call([mock_vms[2]])],
+            any_order=True)
+        self.assertEqual(4, mock_lock_objects.call_count)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_disk_resources')
+    def test_get_vms_disks(self, mock_get_disk_resources):
+        mock_vms = [mock.Mock(ElementName='vm1', Name='id1'),
+                    mock.Mock(ElementName='vm2', Name='id2'),
+                    mock.Mock(ElementName='dup', Name='id3'),
+                    mock.Mock(ElementName='dup', Name='id4')]
+        self._vmutils._conn.Msvm_ComputerSystem.return_value = mock_vms
+
+        mock_disk = mock.Mock(
+            InstanceID='Microsoft:ID1\\disk\\0',
+            ResourceSubType=self._vmutils._HARD_DISK_RES_SUB_TYPE)
+        mock_dup_disk = mock.Mock(
+            InstanceID='Microsoft:ID3\\disk\\0',
+            ResourceSubType=self._vmutils._DVD_DISK_RES_SUB_TYPE)
+        mock_snapshot_disk = mock.Mock(
+            InstanceID='Microsoft:snapshot_id\\disk\\0',
+            ResourceSubType=self._vmutils._HARD_DISK_RES_SUB_TYPE)
+        mock_volume = mock.Mock(
+            InstanceID='Microsoft:ID2\\volume\\0',
+            ResourceSubType=self._vmutils._PHYS_DISK_RES_SUB_TYPE)
+        mock_get_disk_resources.side_effect = [
+            [mock_disk, mock_dup_disk, mock_snapshot_disk], [mock_volume]]
+
+        vms_disks = self._vmutils.get_vms_disks()
+
+        self.assertEqual({'vm1': ([mock_disk], []),
+                          'vm2': ([], [mock_volume])},
+                         vms_disks)
+        self._vmutils._conn.Msvm_ComputerSystem.assert_called_once_with(
+            ['ElementName', 'Name'],
+            Caption=constants.VM_CAPTION)
+        mock_get_disk_resources.assert_has_calls(
+            [mock.call(is_physical=False), mock.call(is_physical=True)])
+
+    @mock.patch.object(vmutils.VMUtils, 'get_vms_disks')
+    def test_get_vms_storage_paths(self, mock_get_vms_disks):
+        mock_disk = mock.Mock(HostResource=[self._FAKE_VHD_PATH])
+        mock_volume = mock.Mock(HostResource=[self._FAKE_VOLUME_DRIVE_PATH])
+        mock_get_vms_disks.return_value = {
+            self._FAKE_VM_NAME: ([mock_disk], [mock_volume])}
+
+        storage_paths = self._vmutils.get_vms_storage_paths()
+
+        self.assertEqual(
+            {self._FAKE_VM_NAME: ([self._FAKE_VHD_PATH],
+                                  [self._FAKE_VOLUME_DRIVE_PATH])},
+            storage_paths)
+
+    @mock.patch.object(vmutils.VMUtils, 'get_vms_disks')
+    def test_get_vms_physical_disk_mapping(self, mock_get_vms_disks):
+        mock_volume = mock.Mock(HostResource=[self._FAKE_VOLUME_DRIVE_PATH])
+        mock_get_vms_disks.return_value = {
+            self._FAKE_VM_NAME: ([], [mock_volume])}
+
+        mappings = self._vmutils.get_vms_physical_disk_mapping()
+
+        expected_mapping = {
+            mock_volume.ElementName: {
+                'resource_path': mock_volume.Path_.return_value,
+                'mounted_disk_path': self._FAKE_VOLUME_DRIVE_PATH}}
+        self.assertEqual({self._FAKE_VM_NAME: expected_mapping}, mappings)
+
+    @mock.patch.object(vmutils.VMUtils, 'get_vms_disks')
+    def test_get_vms_dvd_disk_paths(self, mock_get_vms_disks):
+        mock_dvd = mock.Mock(
+            HostResource=[mock.sentinel.dvd_path],
+            ResourceSubType=self._vmutils._DVD_DISK_RES_SUB_TYPE)
+        mock_disk = mock.Mock(
+            ResourceSubType=self._vmutils._HARD_DISK_RES_SUB_TYPE)
+        mock_get_vms_disks.return_value = {
+            self._FAKE_VM_NAME: ([mock_dvd, mock_disk], [])}
+
+        dvd_paths = self._vmutils.get_vms_dvd_disk_paths()
+
+        self.assertEqual({self._FAKE_VM_NAME: [mock.sentinel.dvd_path]},
+                         dvd_paths)
+
     def test_destroy_vm(self):
         self._lookup_vm()
 
@@ -493,10 +1300,14 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         getattr(mock_svc, self._DESTROY_SYSTEM).return_value = (
             self._FAKE_JOB_PATH, self._FAKE_RET_VAL)
 
+        self._vmutils._vm_inventory = mock.Mock()
+
         self._vmutils.destroy_vm(self._FAKE_VM_NAME)
 
         getattr(mock_svc, self._DESTROY_SYSTEM).assert_called_with(
             self._FAKE_VM_PATH)
+        self._vmutils._vm_inventory.remove_vm.assert_called_once_with(
+            self._FAKE_VM_NAME)
 
     @mock.patch.object(vmutils.VMUtils, '_get_vm_disks')
     def test_get_vm_physical_disk_mapping(self, mock_get_vm_disks):
@@ -516,17 +1327,26 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         result = self._vmutils.get_vm_physical_disk_mapping(self._FAKE_VM_NAME)
         self.assertEqual(expected_mapping, result)
 
-    @mock.patch.object(vmutils, 'wmi', create=True)
-    def test_set_disk_host_res(self, mock_wmi):
-        mock_diskdrive = mock_wmi.WMI.return_value
+    @mock.patch.object(vmutils.VMUtils, '_index_disk_resources')
+    @mock.patch.object(baseutils, 'get_wmi_object')
+    def test_set_disk_host_res(self, mock_get_wmi_obj,
+                               mock_index_disk_resources):
+        mock_diskdrive = mock_get_wmi_obj.return_value
+        mock_diskdrive.HostResource = ['C:\\Old.vhdx']
+        self._vmutils._disk_resource_indexes[True] = {
+            'c:\\old.vhdx': mock_diskdrive}
 
         self._vmutils.set_disk_host_res(self._FAKE_RES_PATH,
                                         self._FAKE_MOUNTED_DISK_PATH)
 
+        self.assertEqual({}, self._vmutils._disk_resource_indexes[True])
+        mock_index_disk_resources.assert_called_once_with(
+            [self._FAKE_RES_PATH], is_physical=True)
+
         self._vmutils._jobutils.modify_virt_resource.assert_called_once_with(
             mock_diskdrive)
 
-        mock_wmi.WMI.assert_called_once_with(moniker=self._FAKE_RES_PATH)
+        mock_get_wmi_obj.assert_called_once_with(self._FAKE_RES_PATH)
         self.assertEqual(mock_diskdrive.HostResource,
                          [self._FAKE_MOUNTED_DISK_PATH])
 
@@ -552,8 +1372,7 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
             mock.sentinel.fake_new_mounted_disk_path,
             mock_rasds[0].HostResource[0])
 
-    @mock.patch.object(vmutils, 'wmi', create=True)
-    def test_take_vm_snapshot(self, mock_wmi):
+    def test_take_vm_snapshot(self):
         self._lookup_vm()
 
         mock_svc = self._get_snapshot_service()
@@ -646,6 +1465,84 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         self._vmutils._jobutils.remove_virt_resource.assert_called_once_with(
             mock_disk)
 
+    @mock.patch.object(vmutils.VMUtils, '_release_controller_slots')
+    @mock.patch.object(vmutils.VMUtils,
+                       '_get_mounted_disk_resources_from_paths')
+    def _test_detach_vm_disks(self, mock_get_disk_resources,
+                              mock_release_slots, is_physical=True):
+        mock_disk = mock.Mock(Parent='fake_parent_path')
+        mock_get_disk_resources.return_value = {
+            self._FAKE_HOST_RESOURCE: mock_disk}
+        mock_parents = self._vmutils._conn.query.return_value
+
+        self._vmutils.detach_vm_disks([self._FAKE_HOST_RESOURCE],
+                                      is_physical=is_physical)
+
+        mock_get_disk_resources.assert_called_once_with(
+            [self._FAKE_HOST_RESOURCE], is_physical)
+        mock_remove = self._vmutils._jobutils.remove_multiple_virt_resources
+        if is_physical:
+            mock_remove.assert_called_once_with([mock_disk])
+            self.assertFalse(self._vmutils._conn.query.called)
+            mock_release_slots.assert_called_once_with([mock_disk])
+        else:
+            self._vmutils._conn.query.assert_called_once_with(
+                "SELECT InstanceID, Parent, AddressOnParent "
+                "FROM Msvm_ResourceAllocationSettingData "
+                "WHERE (__PATH = 'fake_parent_path')")
+            mock_remove.assert_has_calls([mock.call([mock_disk]),
+                                          mock.call(mock_parents)])
+            mock_release_slots.assert_called_once_with(mock_parents)
+
+    def test_detach_vm_disks_physical(self):
+        self._test_detach_vm_disks()
+
+    def test_detach_vm_disks_images(self):
+        self._test_detach_vm_disks(is_physical=False)
+
+    @mock.patch.object(vmutils.VMUtils, '_release_controller_slots')
+    @mock.patch.object(vmutils.VMUtils,
+                       '_get_mounted_disk_resources_from_paths')
+    def test_detach_vm_disks_multiple_vms(self, mock_get_disk_resources,
+                                          mock_release_slots):
+        vm_ids = ['0E3C4FD4-5C3E-4D23-A0C6-B0B6A0F3A7C1',
+                  '9B5F5E1E-8D40-4C8E-9C9B-2F0E5A7E3C11']
+        mock_disks = [
+            mock.Mock(InstanceID='Microsoft:%s\\%s' % (vm_ids[i % 2], i))
+            for i in range(3)]
+        mock_get_disk_resources.return_value = dict(
+            ('c:\\disk%s.vhdx' % i, mock_disk)
+            for i, mock_disk in enumerate(mock_disks))
+        mock_remove = self._vmutils._jobutils.remove_multiple_virt_resources
+        self._vmutils._disk_resource_indexes[True] = {}
+
+        self._vmutils.detach_vm_disks(
+            list(mock_get_disk_resources.return_value), is_physical=True)
+
+        self.assertEqual(2, mock_remove.call_count)
+        self.assertEqual(
+            set([(mock_disks[1], ), (mock_disks[0], mock_disks[2])]),
+            set(tuple(sorted(call_args[0][0], key=mock_disks.index))
+                for call_args in mock_remove.call_args_list))
+
+        mock_remove.side_effect = exceptions.HyperVException
+        self.assertRaises(exceptions.HyperVException,
+                          self._vmutils.detach_vm_disks,
+                          ['c:\\disk0.vhdx'], is_physical=True)
+        self.assertNotIn(True, self._vmutils._disk_resource_indexes)
+
+    def test_get_mounted_disk_resources_from_paths(self):
+        mock_disk_1 = mock.MagicMock(HostResource=[])
+        mock_disk_2 = mock.MagicMock(HostResource=['C:\\Disk.vhdx'])
+        mock_disk_3 = mock.MagicMock(HostResource=['C:\\other.vhdx'])
+        self._vmutils._conn.query.return_value = [
+            mock_disk_1, mock_disk_2, mock_disk_3]
+
+        disk_resources = self._vmutils._get_mounted_disk_resources_from_paths(
+            ['c:\\disk.vhdx', 'c:\\missing.vhdx'], False)
+
+        self.assertEqual({'c:\\disk.vhdx': mock_disk_2}, disk_resources)
+
     def test_get_mounted_disk_resource_from_path(self):
         mock_disk_1 = mock.MagicMock()
         mock_disk_2 = mock.MagicMock()
@@ -657,6 +1554,122 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self.assertEqual(mock_disk_2, physical_disk)
 
+    def test_get_mounted_disk_resources_from_index(self):
+        mock_disk = mock.MagicMock(HostResource=['C:\\Disk.vhdx'])
+        mock_disk.path_.return_value = 'fake_disk_path'
+        mock_refreshed_disk = mock.MagicMock(HostResource=['C:\\Disk.vhdx'])
+        self._vmutils._disk_resource_indexes[False] = {
+            'c:\\disk.vhdx': mock_disk}
+        self._vmutils._conn.query.return_value = [mock_refreshed_disk]
+
+        disk_resources = self._vmutils._get_mounted_disk_resources_from_paths(
+            ['C:\\Disk.vhdx'], False)
+
+        self.assertEqual({'c:\\disk.vhdx': mock_refreshed_disk},
+                         disk_resources)
+        self._vmutils._conn.query.assert_called_once_with(
+            "SELECT * FROM %s WHERE __PATH = 'fake_disk_path'" %
+            self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS)
+
+    @mock.patch.object(vmutils.VMUtils, '_drive_events_available',
+                       return_value=True)
+    @mock.patch.object(vmutils.VMUtils, '_get_disk_resources')
+    def test_get_mounted_disk_resources_event_driven(
+            self, mock_get_disk_resources, mock_events_available):
+        mock_disk = mock.MagicMock(HostResource=['C:\\Disk.vhdx'])
+        mock_get_disk_resources.return_value = [mock_disk]
+
+        for i in range(2):
+            disk_resources = (
+                self._vmutils._get_mounted_disk_resources_from_paths(
+                    ['C:\\Disk.vhdx', 'C:\\Other.vhdx'], False))
+            self.assertEqual({'c:\\disk.vhdx': mock_disk}, disk_resources)
+
+        # The index is trusted, no other query being performed.
+        mock_get_disk_resources.assert_called_once_with(False)
+        self.assertFalse(self._vmutils._conn.query.called)
+
+        # Disks attached by other means are not indexed yet.
+        self._vmutils._process_disk_image_event(
+            mock.Mock(HostResource=['C:\\New.vhdx'], event_type='creation'))
+        self._vmutils._get_mounted_disk_resources_from_paths(
+            ['C:\\Disk.vhdx'], False)
+        self.assertEqual(2, mock_get_disk_resources.call_count)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_disk_resources')
+    def test_load_disk_resource_index_invalidated(self,
+                                                  mock_get_disk_resources):
+        mock_disk = mock.MagicMock(HostResource=['C:\\Disk.vhdx'])
+
+        def fake_get_disk_resources(is_physical):
+            # A disk image event arrives during the query.
+            self._vmutils._process_disk_image_event(
+                mock.Mock(HostResource=['C:\\Disk.vhdx'],
+                          event_type='deletion'))
+            return [mock_disk]
+
+        mock_get_disk_resources.side_effect = fake_get_disk_resources
+
+        index = self._vmutils._load_disk_resource_index(False)
+
+        self.assertEqual({'c:\\disk.vhdx': mock_disk}, index)
+        self.assertNotIn(False, self._vmutils._disk_resource_indexes)
+
+    @mock.patch.object(vmutils.VMUtils, '_get_disk_resources')
+    def test_get_mounted_disk_resources_stale_index(self,
+                                                    mock_get_disk_resources):
+        mock_disk = mock.MagicMock(HostResource=['C:\\Disk.vhdx'])
+        self._vmutils._disk_resource_indexes[True] = {
+            'c:\\disk.vhdx': mock.Mock()}
+        # The indexed resource no longer exists.
+        self._vmutils._conn.query.return_value = []
+        mock_get_disk_resources.return_value = [mock_disk]
+
+        disk_resources = self._vmutils._get_mounted_disk_resources_from_paths(
+            ['C:\\Disk.vhdx'], True)
+
+        self.assertEqual({'c:\\disk.vhdx': mock_disk}, disk_resources)
+        self.assertEqual({'c:\\disk.vhdx': mock_disk},
+                         self._vmutils._disk_resource_indexes[True])
+        mock_get_disk_resources.assert_called_once_with(True)
+
+    @mock.patch.object(vmutils.VMUtils,
+                       '_get_mounted_disk_resources_from_paths')
+    def test_are_disks_attached(self, mock_get_disk_resources):
+        mock_get_disk_resources.return_value = {
+            'c:\\disk.vhdx': mock.sentinel.disk}
+
+        attached = self._vmutils.are_disks_attached(
+            ['C:\\Disk.vhdx', 'C:\\other.vhdx'], is_physical=False)
+
+        self.assertEqual({'C:\\Disk.vhdx': True, 'C:\\other.vhdx': False},
+                         attached)
+        mock_get_disk_resources.assert_called_once_with(
+            ['C:\\Disk.vhdx', 'C:\\other.vhdx'], False)
+
+    def test_drop_indexed_disk_resources(self):
+        self._vmutils._disk_resource_indexes[True] = {
+            'c:\\disk.vhdx': mock.sentinel.disk,
+            'c:\\other.vhdx': mock.sentinel.other_disk}
+
+        self._vmutils._drop_indexed_disk_resources(['C:\\Disk.vhdx'], True)
+
+        self.assertEqual({'c:\\other.vhdx': mock.sentinel.other_disk},
+                         self._vmutils._disk_resource_indexes[True])
+
+    def test_get_mounted_disks_by_drive_numbers(self):
+        mock_disk = mock.Mock(DriveNumber=1)
+        self._vmutils._conn.query.return_value = [mock_disk]
+
+        disk_paths = self._vmutils.get_mounted_disks_by_drive_numbers(
+            ['1', '2'])
+
+        self.assertEqual({'1': mock_disk.path_.return_value}, disk_paths)
+        self._vmutils._conn.query.assert_called_once_with(
+            "SELECT CreationClassName, DeviceID, SystemCreationClassName, "
+            "SystemName, DriveNumber FROM Msvm_DiskDrive "
+            "WHERE (DriveNumber = 1 OR DriveNumber = 2)")
+
     def test_get_dev_number_from_dev_name(self):
         fake_physical_device_name = r'\\.\PhysicalDrive1'
         expected_device_number = '1'
@@ -691,19 +1704,29 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         return self._vmutils._conn.Msvm_VirtualSystemSnapshotService()[0]
 
     def test_get_active_instances(self):
-        fake_vm = mock.MagicMock()
-
-        type(fake_vm).ElementName = mock.PropertyMock(
-            side_effect=['active_vm', 'inactive_vm'])
-        type(fake_vm).EnabledState = mock.PropertyMock(
-            side_effect=[constants.HYPERV_VM_STATE_ENABLED,
-                         constants.HYPERV_VM_STATE_DISABLED])
-        self._vmutils.list_instances = mock.MagicMock(
-            return_value=[mock.sentinel.fake_vm_name] * 2)
-        self._vmutils._lookup_vm = mock.MagicMock(side_effect=[fake_vm] * 2)
+        self._vmutils._conn._raw_query.return_value = [
+            mock.Mock(ElementName=mock.sentinel.vm_name_1),
+            mock.Mock(ElementName=mock.sentinel.vm_name_2)]
+        self._mock_wmi._wmi_object.side_effect = lambda obj: obj
+
         active_instances = self._vmutils.get_active_instances()
 
-        self.assertEqual(['active_vm'], active_instances)
+        self.assertEqual([mock.sentinel.vm_name_1, mock.sentinel.vm_name_2],
+                         active_instances)
+        self._vmutils._conn._raw_query.assert_called_once_with(
+            "SELECT ElementName FROM Msvm_ComputerSystem "
+            "WHERE Caption = 'Virtual Machine' AND EnabledState = 2")
+
+    def test_iter_active_instances(self):
+        self._vmutils._conn._raw_query.return_value = iter(
+            [mock.Mock(ElementName=mock.sentinel.vm_name)])
+        self._mock_wmi._wmi_object.side_effect = lambda obj: obj
+
+        active_instances = self._vmutils.iter_active_instances()
+
+        self.assertFalse(self._vmutils._conn._raw_query.called)
+        self.assertEqual(mock.sentinel.vm_name, next(active_instances))
+        self.assertRaises(StopIteration, next, active_instances)
 
     def _test_get_vm_serial_port_connection(self, new_connection=None):
         old_serial_connection = 'old_serial_connection'
@@ -799,14 +1822,28 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
                  'Notes': ['4f54fb69-d3a2-45b7-bb9b-b6e6b3d893b3']}
         vs.configure_mock(**attrs)
         vs2 = mock.MagicMock(ElementName='fake_name2', Notes=None)
-        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = [vs,
-                                                                          vs2]
+        self._vmutils._conn._raw_query.return_value = [vs, vs2]
+        self._mock_wmi._wmi_object.side_effect = lambda obj: obj
+
         response = self._vmutils.list_instance_notes()
 
         self.assertEqual([(attrs['ElementName'], attrs['Notes'])], response)
-        self._vmutils._conn.Msvm_VirtualSystemSettingData.assert_called_with(
-            ['ElementName', 'Notes'],
-            VirtualSystemType=self._vmutils._VIRTUAL_SYSTEM_TYPE_REALIZED)
+        self._vmutils._conn._raw_query.assert_called_once_with(
+            "SELECT ElementName, Notes FROM Msvm_VirtualSystemSettingData "
+            "WHERE VirtualSystemType = '%s'" %
+            self._vmutils._VIRTUAL_SYSTEM_TYPE_REALIZED)
+
+    def test_iter_instance_notes(self):
+        self._vmutils._conn._raw_query.return_value = iter(
+            [mock.Mock(ElementName=mock.sentinel.vm_name, Notes=['', 'n'])])
+        self._mock_wmi._wmi_object.side_effect = lambda obj: obj
+
+        instance_notes = self._vmutils.iter_instance_notes()
+
+        self.assertFalse(self._vmutils._conn._raw_query.called)
+        self.assertEqual((mock.sentinel.vm_name, ['n']),
+                         next(instance_notes))
+        self.assertRaises(StopIteration, next, instance_notes)
 
     def test_modify_virtual_system(self):
         mock_vs_man_svc = self._vmutils._vs_man_svc
@@ -888,6 +1925,150 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     def test_create_vm_obj_no_vm_path(self):
         self._test_create_vm_obj(vm_path=None)
 
+    @mock.patch.object(vmutils.VMUtils, '_get_defined_vm')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_vm_setting_data')
+    def test_create_vm_async(self, mock_get_vs_data, mock_get_defined_vm):
+        mock_vs_man_svc = self._vmutils._vs_man_svc
+        mock_vs_man_svc.DefineSystem.return_value = (
+            mock.sentinel.job_path, mock.sentinel.vm_path,
+            mock.sentinel.ret_val)
+        mock_check_ret_val_async = (
+            self._vmutils._jobutils.check_ret_val_async)
+
+        job_handle = self._vmutils.create_vm_async(
+            mock.sentinel.vm_name, mock.sentinel.vnuma_enabled,
+            mock.sentinel.vm_gen, mock.sentinel.instance_path,
+            mock.sentinel.notes)
+
+        self.assertEqual(mock_check_ret_val_async.return_value, job_handle)
+        mock_get_vs_data.assert_called_once_with(
+            mock.sentinel.vm_name, mock.sentinel.vnuma_enabled,
+            mock.sentinel.vm_gen, mock.sentinel.notes,
+            mock.sentinel.instance_path)
+        mock_vs_man_svc.DefineSystem.assert_called_once_with(
+            ResourceSettings=[], ReferenceConfiguration=None,
+            SystemSettings=mock_get_vs_data.return_value.GetText_(1))
+        mock_check_ret_val_async.assert_called_once_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path,
+            result_func=mock.ANY)
+
+        result_func = mock_check_ret_val_async.call_args[1]['result_func']
+        self.assertEqual(mock_get_defined_vm.return_value,
+                         result_func(mock.sentinel.job))
+        mock_get_defined_vm.assert_called_once_with(mock.sentinel.vm_path,
+                                                    mock.sentinel.job)
+
+    @mock.patch.object(vmutils.VMUtils, '_set_boot_order_gen2')
+    @mock.patch.object(vmutils.VMUtils, '_get_vm_setting_data')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_resource_setting_data')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_setting_data')
+    @mock.patch.object(vmutils.VMUtils, '_get_defined_vm')
+    @mock.patch.object(vmutils.VMUtils, '_get_new_vm_setting_data')
+    def test_create_vm_from_spec(self, mock_get_vs_data,
+                                 mock_get_defined_vm, mock_get_new_sd,
+                                 mock_get_new_rsd, mock_get_vm_setting_data,
+                                 mock_set_boot_order_gen2):
+        mock_vs_man_svc = self._vmutils._vs_man_svc
+        mock_vs_man_svc.DefineSystem.return_value = (
+            mock.sentinel.job_path, mock.sentinel.vm_path,
+            mock.sentinel.ret_val)
+        mock_get_new_sd.side_effect = lambda *args: mock.MagicMock()
+        mock_get_new_rsd.side_effect = lambda *args: mock.MagicMock()
+
+        mock_ide_ctrl = mock.MagicMock(
+            ResourceSubType=self._vmutils._IDE_CTRL_RES_SUB_TYPE,
+            Address='0')
+        mock_scsi_ctrl = mock.MagicMock(
+            ResourceSubType=self._vmutils._SCSI_CTRL_RES_SUB_TYPE)
+        mock_serial_port = mock.MagicMock(
+            ResourceSubType=self._vmutils._SERIAL_PORT_RES_SUB_TYPE)
+        mock_vmsettings = mock_get_vm_setting_data.return_value
+        mock_vmsettings.associators.side_effect = [
+            [mock_ide_ctrl, mock_scsi_ctrl], [mock_serial_port]]
+
+        mock_add_res = self._vmutils._jobutils.add_multiple_virt_resources
+        mock_add_res.side_effect = [
+            [mock.sentinel.drive_path_0, mock.sentinel.drive_path_1,
+             mock.sentinel.drive_path_2],
+            mock.sentinel.disk_paths]
+
+        vm_spec = {
+            'name': mock.sentinel.vm_name,
+            'generation': constants.VM_GEN_2,
+            'instance_path': mock.sentinel.instance_path,
+            'memory_mb': 1024,
+            'dynamic_memory_ratio': 2,
+            'vcpus': 2,
+            'scsi_controllers': 1,
+            'disks': [
+                {'path': mock.sentinel.root_path,
+                 'ctrl_type': constants.CTRL_TYPE_IDE},
+                {'path': mock.sentinel.vol_path_0,
+                 'ctrl_type': constants.CTRL_TYPE_SCSI},
+                {'path': mock.sentinel.vol_path_1,
+                 'ctrl_type': constants.CTRL_TYPE_SCSI,
+                 'drive_type': constants.DVD}],
+            'nics': [{'name': mock.sentinel.nic_name,
+                      'mac_address': '00:11:22:33:44:55'}],
+            'serial_ports': {1: mock.sentinel.pipe_path},
+            'boot_order': [mock.sentinel.root_path]}
+
+        self._vmutils.create_vm_from_spec(vm_spec)
+
+        mock_get_vs_data.assert_called_once_with(
+            mock.sentinel.vm_name, False, constants.VM_GEN_2, None,
+            mock.sentinel.instance_path)
+        define_kwargs = mock_vs_man_svc.DefineSystem.call_args[1]
+        # memory, processor, the SCSI controller and the NIC.
+        self.assertEqual(4, len(define_kwargs['ResourceSettings']))
+        mock_get_defined_vm.assert_called_once_with(
+            mock.sentinel.vm_path,
+            self._vmutils._jobutils.check_ret_val.return_value)
+        mock_vm = mock_get_defined_vm.return_value
+
+        self.assertEqual(2, mock_add_res.call_count)
+        drives, parent = mock_add_res.call_args_list[0][0]
+        self.assertEqual(mock_vm, parent)
+        self.assertEqual([mock_ide_ctrl.path_.return_value,
+                          mock_scsi_ctrl.path_.return_value,
+                          mock_scsi_ctrl.path_.return_value],
+                         [drive.Parent for drive in drives])
+        self.assertEqual([0, 0, 1], [drive.Address for drive in drives])
+
+        disks = mock_add_res.call_args_list[1][0][0]
+        self.assertEqual([mock.sentinel.drive_path_0,
+                          mock.sentinel.drive_path_1,
+                          mock.sentinel.drive_path_2],
+                         [disk.Parent for disk in disks])
+        self.assertEqual([[mock.sentinel.root_path],
+                          [mock.sentinel.vol_path_0],
+                          [mock.sentinel.vol_path_1]],
+                         [disk.HostResource for disk in disks])
+
+        self.assertEqual([mock.sentinel.pipe_path],
+                         mock_serial_port.Connection)
+        jobutils = self._vmutils._jobutils
+        jobutils.modify_multiple_virt_resources.assert_called_once_with(
+            [mock_serial_port])
+        mock_set_boot_order_gen2.assert_called_once_with(
+            mock.sentinel.vm_name, [mock.sentinel.root_path])
+
+    @mock.patch.object(vmutils.VMUtils, '_attach_drives')
+    def test_add_vm_disks_from_spec_unsupported_drive_type(
+            self, mock_attach_drives):
+        mock_vmsettings = mock.Mock()
+        mock_vmsettings.associators.return_value = [mock.Mock(
+            ResourceSubType=self._vmutils._SCSI_CTRL_RES_SUB_TYPE)]
+
+        self.assertRaises(
+            exceptions.HyperVException,
+            self._vmutils._add_vm_disks_from_spec,
+            mock.sentinel.vm, mock_vmsettings,
+            [{'path': mock.sentinel.path,
+              'ctrl_type': constants.CTRL_TYPE_SCSI,
+              'drive_type': mock.sentinel.drive_type}])
+        self.assertFalse(mock_attach_drives.called)
+
     def test_create_vm_obj_vnuma_disabled(self):
         self._test_create_vm_obj(vm_path=None, vnuma_enabled=False)
 
@@ -895,21 +2076,34 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         vs = mock.MagicMock()
         attrs = {'ElementName': 'fake_name'}
         vs.configure_mock(**attrs)
-        self._vmutils._conn.Msvm_VirtualSystemSettingData.return_value = [vs]
+        self._vmutils._conn._raw_query.return_value = [vs]
+        self._mock_wmi._wmi_object.side_effect = lambda obj: obj
+
         response = self._vmutils.list_instances()
 
         self.assertEqual([(attrs['ElementName'])], response)
-        self._vmutils._conn.Msvm_VirtualSystemSettingData.assert_called_with(
-            ['ElementName'],
-            VirtualSystemType=self._vmutils._VIRTUAL_SYSTEM_TYPE_REALIZED)
+        self._vmutils._conn._raw_query.assert_called_once_with(
+            "SELECT ElementName FROM Msvm_VirtualSystemSettingData "
+            "WHERE VirtualSystemType = '%s'" %
+            self._vmutils._VIRTUAL_SYSTEM_TYPE_REALIZED)
+
+    def test_iter_instances(self):
+        self._vmutils._conn._raw_query.return_value = iter(
+            [mock.Mock(ElementName=mock.sentinel.vm_name)])
+        self._mock_wmi._wmi_object.side_effect = lambda obj: obj
+
+        instances = self._vmutils.iter_instances()
+
+        self.assertFalse(self._vmutils._conn._raw_query.called)
+        self.assertEqual(mock.sentinel.vm_name, next(instances))
+        self.assertRaises(StopIteration, next, instances)
 
     def test_get_attached_disks(self):
-        mock_scsi_ctrl_path = mock.MagicMock()
         expected_query = ("SELECT * FROM %(class_name)s "
-                          "WHERE (ResourceSubType='%(res_sub_type)s' OR "
-                          "ResourceSubType='%(res_sub_type_virt)s' OR "
-                          "ResourceSubType='%(res_sub_type_dvd)s') AND "
-                          "Parent = '%(parent)s'" %
+                          "WHERE Parent = 'fake''ctrl' AND "
+                          "(ResourceSubType = '%(res_sub_type)s' OR "
+                          "ResourceSubType = '%(res_sub_type_virt)s' OR "
+                          "ResourceSubType = '%(res_sub_type_dvd)s')" %
                           {"class_name":
                            self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
                            "res_sub_type":
@@ -917,15 +2111,26 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
                            "res_sub_type_virt":
                            self._vmutils._DISK_DRIVE_RES_SUB_TYPE,
                            "res_sub_type_dvd":
-                           self._vmutils._DVD_DRIVE_RES_SUB_TYPE,
-                           "parent": mock_scsi_ctrl_path.replace("'", "''")})
+                           self._vmutils._DVD_DRIVE_RES_SUB_TYPE})
         expected_disks = self._vmutils._conn.query.return_value
 
-        ret_disks = self._vmutils.get_attached_disks(mock_scsi_ctrl_path)
+        ret_disks = self._vmutils.get_attached_disks("fake'ctrl")
 
         self._vmutils._conn.query.assert_called_once_with(expected_query)
         self.assertEqual(expected_disks, ret_disks)
 
+    @mock.patch.object(vmutils.VMUtils, '_query_records')
+    def test_get_attached_disks_detached(self, mock_query_records):
+        ret_disks = self._vmutils.get_attached_disks(self._FAKE_CTRL_PATH,
+                                                     detached=True)
+
+        self.assertEqual(mock_query_records.return_value, ret_disks)
+        mock_query_records.assert_called_once_with(
+            vmutils.DiskResourceRecord,
+            self._vmutils._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+            conditions=self._vmutils._get_attached_disks_conditions(
+                self._FAKE_CTRL_PATH))
+
     def _get_fake_instance_notes(self):
         return [self._FAKE_VM_UUID]
 
@@ -987,6 +2192,13 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
             self.assertEqual(watcher.return_value, listener)
 
+    @mock.patch.object(vmutils.vmpowerstate, 'get_power_state_listener')
+    def test_get_vm_power_state_listener_service(self, mock_get_listener):
+        listener = self._vmutils.get_vm_power_state_listener_service()
+
+        self.assertEqual(mock_get_listener.return_value, listener)
+        mock_get_listener.assert_called_once_with(self._vmutils, '.')
+
     @mock.patch.object(vmutils.VMUtils, '_get_vm_setting_data')
     def _test_get_vm_generation(self, vm_gen, mock_get_vm_setting_data):
         self._lookup_vm()
@@ -998,6 +2210,53 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         self.assertEqual(vm_gen, ret)
 
+    def _setup_vm_inventory_info(self, **vm_info):
+        self._lookup_vm()
+        mock_inventory = mock.Mock()
+        mock_inventory.get_vm_info.return_value = vm_info
+        self._vmutils._vm_inventory = mock_inventory
+        return mock_inventory
+
+    def test_get_vm_generation_inventory(self):
+        mock_inventory = self._setup_vm_inventory_info(
+            generation=constants.VM_GEN_2)
+
+        vm_gen = self._vmutils.get_vm_generation(self._FAKE_VM_NAME)
+
+        self.assertEqual(constants.VM_GEN_2, vm_gen)
+        self._vmutils._lookup_vm_check.assert_called_once_with(
+            self._FAKE_VM_NAME)
+        mock_inventory.get_vm_info.assert_called_once_with(self._FAKE_VM_NAME)
+
+    def test_get_instance_uuid_inventory(self):
+        self._setup_vm_inventory_info(notes=[self._FAKE_VM_UUID])
+
+        instance_uuid = self._vmutils.get_instance_uuid(self._FAKE_VM_NAME)
+
+        self.assertEqual(self._FAKE_VM_UUID, instance_uuid)
+
+    def test_get_vm_name_by_instance_uuid_inventory(self):
+        mock_inventory = mock.Mock()
+        self._vmutils._vm_inventory = mock_inventory
+
+        vm_name = self._vmutils.get_vm_name_by_instance_uuid(
+            mock.sentinel.instance_uuid)
+
+        self.assertEqual(mock_inventory.get_vm_name.return_value, vm_name)
+        mock_inventory.get_vm_name.assert_called_once_with(
+            mock.sentinel.instance_uuid)
+
+    @mock.patch.object(vmutils.VMUtils, 'iter_instance_notes')
+    def test_get_vm_name_by_instance_uuid(self, mock_list_instance_notes):
+        mock_list_instance_notes.return_value = [
+            (mock.sentinel.vm_name_1, []),
+            (mock.sentinel.vm_name_2, [mock.sentinel.instance_uuid])]
+
+        vm_name = self._vmutils.get_vm_name_by_instance_uuid(
+            mock.sentinel.instance_uuid)
+
+        self.assertEqual(mock.sentinel.vm_name_2, vm_name)
+
     def test_get_vm_generation_gen1(self):
         self._test_get_vm_generation(constants.VM_GEN_1)
 
@@ -1044,7 +2303,9 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     @mock.patch.object(vmutils.VMUtils,
                        '_get_mounted_disk_resource_from_path')
     def test_set_disk_qos_specs(self, mock_get_disk_resource):
-        mock_disk = mock_get_disk_resource.return_value
+        mock_indexed_disk = mock_get_disk_resource.return_value
+        mock_disk = mock.Mock()
+        self._vmutils._conn.query.return_value = [mock_disk]
 
         self._vmutils.set_disk_qos_specs(mock.sentinel.disk_path,
                                          max_iops=mock.sentinel.max_iops,
@@ -1052,6 +2313,13 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
 
         mock_get_disk_resource.assert_called_once_with(
             mock.sentinel.disk_path, is_physical=False)
+        # The shared indexed resource is not modified.
+        self._vmutils._conn.query.assert_called_once_with(
+            vmutils.baseutils.build_query(
+                self._vmutils._STORAGE_ALLOC_SETTING_DATA_CLASS,
+                conditions={'__PATH': mock_indexed_disk.path_.return_value}))
+        self.assertNotEqual(mock.sentinel.max_iops,
+                            mock_indexed_disk.IOPSLimit)
         self.assertEqual(mock.sentinel.max_iops, mock_disk.IOPSLimit)
         self.assertEqual(mock.sentinel.min_iops, mock_disk.IOPSReservation)
         self._vmutils._jobutils.modify_virt_resource.assert_called_once_with(
@@ -1079,8 +2347,9 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
     @mock.patch.object(vmutils.VMUtils, '_is_drive_physical')
     @mock.patch.object(vmutils.VMUtils,
                        '_get_mounted_disk_resource_from_path')
-    @mock.patch.object(vmutils, 'wmi', create=True)
-    def _test_drive_to_boot_source(self, mock_wmi, mock_get_disk_res_from_path,
+    @mock.patch.object(baseutils, 'get_wmi_object')
+    def _test_drive_to_boot_source(self, mock_get_wmi_obj,
+                                  mock_get_disk_res_from_path,
                                   mock_is_drive_physical, is_physical):
         mock_is_drive_physical.return_value = is_physical
         mock_drive = mock.MagicMock(Parent=mock.sentinel.fake_drive_parent)
@@ -1088,7 +2357,7 @@ class VMUtilsTestCase(test_base.OsWinBaseTestCase):
         mock_get_disk_res_from_path.return_value = mock_drive
         mock_rads = mock.MagicMock()
         mock_rads.associators.return_value = [mock.sentinel.bssd]
-        mock_wmi.WMI.return_value = mock_rads
+        mock_get_wmi_obj.return_value = mock_rads
 
         ret = self._vmutils._drive_to_boot_source(mock.sentinel.drive_path)
 
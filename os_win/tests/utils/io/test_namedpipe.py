@@ -13,7 +13,6 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import errno
 import mock
 from oslotest import base
 from six.moves import builtins
@@ -307,19 +306,33 @@ class NamedPipeTestCase(base.BaseTestCase):
         self.assertEqual(mock_open.return_value,
                          self._handler._log_file_handle)
 
-    @mock.patch.object(namedpipe, 'time')
-    def test_retry_if_file_in_use_exceeded_retries(self, mock_time):
+    @mock.patch.object(namedpipe.NamedPipeHandler._LOG_ROTATE_RETRY_POLICY,
+                       'sleep')
+    def test_retry_if_file_in_use_exceeded_retries(self, mock_sleep):
         class FakeWindowsException(Exception):
-            errno = errno.EACCES
+            winerror = namedpipe.ERROR_SHARING_VIOLATION
 
         raise_count = self._handler._MAX_LOG_ROTATE_RETRIES + 1
         mock_func_side_eff = [FakeWindowsException] * raise_count
         mock_func = mock.Mock(side_effect=mock_func_side_eff)
 
-        with mock.patch.object(namedpipe, 'WindowsError',
-                               FakeWindowsException, create=True):
-            self.assertRaises(FakeWindowsException,
-                              self._handler._retry_if_file_in_use,
-                              mock_func, mock.sentinel.arg)
-            mock_time.sleep.assert_has_calls(
-                [mock.call(1)] * self._handler._MAX_LOG_ROTATE_RETRIES)
+        self.assertRaises(FakeWindowsException,
+                          self._handler._retry_if_file_in_use,
+                          mock_func, mock.sentinel.arg)
+        self.assertEqual(self._handler._MAX_LOG_ROTATE_RETRIES,
+                         mock_sleep.call_count)
+        mock_func.assert_has_calls([mock.call(mock.sentinel.arg)] *
+                                   raise_count)
+
+    @mock.patch.object(namedpipe.NamedPipeHandler._LOG_ROTATE_RETRY_POLICY,
+                       'sleep')
+    def test_retry_if_file_in_use_unexpected_error(self, mock_sleep):
+        class FakeWindowsException(Exception):
+            winerror = 2
+
+        mock_func = mock.Mock(side_effect=FakeWindowsException)
+
+        self.assertRaises(FakeWindowsException,
+                          self._handler._retry_if_file_in_use,
+                          mock_func, mock.sentinel.arg)
+        self.assertFalse(mock_sleep.called)
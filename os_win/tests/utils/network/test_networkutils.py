@@ -49,6 +49,57 @@ class NetworkUtilsTestCase(base.BaseTestCase):
         self.netutils._conn = mock.MagicMock()
         self.netutils._jobutils = mock.MagicMock()
 
+    @mock.patch.object(networkutils.NetworkUtils, '_iter_query')
+    @mock.patch.object(networkutils.NetworkUtils, '_get_vswitch')
+    def test_get_switch_ports(self, mock_get_vswitch, mock_iter_query):
+        mock_get_vswitch.return_value.Name = 'fake_vswitch_id'
+        mock_iter_query.return_value = [
+            mock.Mock(Name=mock.sentinel.port_1),
+            mock.Mock(Name=mock.sentinel.port_2)]
+
+        switch_ports = self.netutils.get_switch_ports(self._FAKE_VSWITCH_NAME)
+
+        self.assertEqual(set([mock.sentinel.port_1, mock.sentinel.port_2]),
+                         switch_ports)
+        mock_get_vswitch.assert_called_once_with(self._FAKE_VSWITCH_NAME)
+        mock_iter_query.assert_called_once_with(
+            "SELECT Name FROM Msvm_EthernetSwitchPort "
+            "WHERE SystemName = 'fake_vswitch_id'")
+
+    @mock.patch.object(networkutils.NetworkUtils, '_get_vswitch')
+    def test_get_port_by_id(self, mock_get_vswitch):
+        mock_get_vswitch.return_value.Name = 'fake_vswitch_id'
+        mock_port = mock.Mock()
+        self.netutils._conn.query.return_value = [mock_port]
+
+        port = self.netutils.get_port_by_id('fake_port_id',
+                                            self._FAKE_VSWITCH_NAME)
+
+        self.assertEqual(mock_port, port)
+        self.netutils._conn.query.assert_called_once_with(
+            "SELECT * FROM Msvm_EthernetSwitchPort "
+            "WHERE ElementName = 'fake_port_id' "
+            "AND SystemName = 'fake_vswitch_id'")
+
+    @mock.patch.object(networkutils.NetworkUtils, '_iter_query')
+    def test_iter_vnic_ids(self, mock_iter_query):
+        mock_iter_query.return_value = [
+            mock.Mock(ElementName=mock.sentinel.vnic_id),
+            mock.Mock(ElementName=None),
+            mock.Mock(ElementName=mock.sentinel.vnic_id)]
+
+        vnic_ids = list(self.netutils.iter_vnic_ids())
+
+        self.assertEqual([mock.sentinel.vnic_id], vnic_ids)
+        mock_iter_query.assert_called_once_with(
+            "SELECT ElementName FROM Msvm_SyntheticEthernetPortSettingData")
+
+    @mock.patch.object(networkutils.NetworkUtils, 'iter_vnic_ids')
+    def test_get_vnic_ids(self, mock_iter_vnic_ids):
+        mock_iter_vnic_ids.return_value = [mock.sentinel.vnic_id]
+        self.assertEqual(set([mock.sentinel.vnic_id]),
+                         self.netutils.get_vnic_ids())
+
     def test_get_external_vswitch(self):
         mock_vswitch = mock.MagicMock()
         mock_vswitch.path_.return_value = mock.sentinel.FAKE_VSWITCH_PATH
@@ -36,6 +36,7 @@ class ISCSITargetUtilsTestCase(test_base.OsWinBaseTestCase):
         self._mock_wmi.x_wmi = FakeWMIExc
 
         self._tgutils = tg_utils.ISCSITargetUtils()
+        self._tgutils._conn_wmi = mock.MagicMock()
         self._tgutils._pathutils = mock.Mock()
 
     def test_ensure_wt_provider_unavailable(self):
@@ -0,0 +1,500 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pickle
+import threading
+
+import eventlet
+import mock
+
+from os_win.tests import test_base
+from os_win.utils import baseutils
+
+
+class FakeRPCError(Exception):
+    def __init__(self, hresult=baseutils.RPC_S_SERVER_UNAVAILABLE):
+        self.com_error = mock.Mock(hresult=hresult)
+        super(FakeRPCError, self).__init__()
+
+
+class WMIConnectionPoolTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the shared WMI connection pool."""
+
+    def setUp(self):
+        super(WMIConnectionPoolTestCase, self).setUp()
+        self._pool = baseutils.WMIConnectionPool(health_check_interval=None)
+        self._mock_wmi.WMI.side_effect = (
+            lambda *args, **kwargs: mock.MagicMock())
+
+    def test_get_connection_lazy(self):
+        self._pool.get_connection('root/virtualization/v2')
+        self.assertFalse(self._mock_wmi.WMI.called)
+
+    def test_get_connection_connect(self):
+        self._pool.get_connection('root/virtualization/v2', connect=True)
+        self._mock_wmi.WMI.assert_called_once_with(
+            moniker='//./root/virtualization/v2')
+
+    def test_get_connection_privileges(self):
+        conn = self._pool.get_connection('root/cimv2',
+                                         privileges=['Shutdown'])
+        conn.Win32_OperatingSystem()
+
+        self._mock_wmi.WMI.assert_called_once_with(
+            computer='.', namespace='root/cimv2', privileges=['Shutdown'])
+
+    def test_connection_shared(self):
+        conn_a = self._pool.get_connection('root/virtualization/v2')
+        conn_b = self._pool.get_connection('//root\\Virtualization\\v2/')
+
+        conn_a.Msvm_ComputerSystem()
+        conn_b.Msvm_ComputerSystem()
+
+        self.assertEqual(1, self._mock_wmi.WMI.call_count)
+
+    def test_connection_per_host(self):
+        self._pool.get_connection('root/virtualization/v2').Msvm_Foo()
+        self._pool.get_connection('root/virtualization/v2',
+                                  host='fake_host').Msvm_Foo()
+
+        self.assertEqual(2, self._mock_wmi.WMI.call_count)
+
+    def test_connection_per_native_thread(self):
+        conn = self._pool.get_connection('root/virtualization/v2')
+        raw_conns = []
+
+        def get_raw_conn():
+            raw_conns.append(self._pool.get_raw_connection(conn._key))
+
+        get_raw_conn()
+        # Greenthreads share the native thread, hence the connection.
+        eventlet.spawn(get_raw_conn).wait()
+        thread = threading.Thread(target=get_raw_conn)
+        thread.start()
+        thread.join()
+
+        self.assertIs(raw_conns[0], raw_conns[1])
+        self.assertIsNot(raw_conns[0], raw_conns[2])
+        self.assertEqual(2, self._mock_wmi.WMI.call_count)
+
+    def test_clear(self):
+        conn = self._pool.get_connection('root/virtualization/v2')
+        raw_conn = self._pool.get_raw_connection(conn._key)
+
+        self._pool.clear()
+
+        self.assertIsNot(raw_conn, self._pool.get_raw_connection(conn._key))
+        self.assertEqual(2, self._mock_wmi.WMI.call_count)
+
+    def test_reconnect_on_rpc_failure(self):
+        conn = self._pool.get_connection('root/virtualization/v2')
+        first_conn = self._pool.get_raw_connection(conn._key)
+        first_conn.query.side_effect = FakeRPCError
+
+        result = conn.query(mock.sentinel.query)
+
+        second_conn = self._pool.get_raw_connection(conn._key)
+        self.assertIsNot(first_conn, second_conn)
+        self.assertEqual(second_conn.query.return_value, result)
+        second_conn.query.assert_called_once_with(mock.sentinel.query)
+
+    def test_no_reconnect_on_other_failure(self):
+        conn = self._pool.get_connection('root/virtualization/v2')
+        raw_conn = self._pool.get_raw_connection(conn._key)
+        raw_conn.query.side_effect = FakeRPCError(hresult=mock.sentinel.hres)
+
+        self.assertRaises(FakeRPCError, conn.query, mock.sentinel.query)
+        self.assertIs(raw_conn, self._pool.get_raw_connection(conn._key))
+
+    def test_connect_outside_pool_lock(self):
+        other_key = self._pool._get_key('root/cimv2', '.', None)
+        other_conns = []
+
+        def fake_connect(*args, **kwargs):
+            if kwargs.get('moniker') == '//./root/virtualization/v2':
+                # Other connections may be retrieved while connecting.
+                thread = threading.Thread(
+                    target=lambda: other_conns.append(
+                        self._pool.get_raw_connection(other_key)))
+                thread.start()
+                thread.join(5)
+                self.assertFalse(thread.is_alive())
+            return mock.MagicMock()
+
+        self._mock_wmi.WMI.side_effect = fake_connect
+        conn = self._pool.get_connection('root/virtualization/v2',
+                                         connect=True)
+
+        self.assertEqual(1, len(other_conns))
+        self.assertIsNot(other_conns[0],
+                         self._pool.get_raw_connection(conn._key))
+        self.assertEqual(2, self._mock_wmi.WMI.call_count)
+
+    def test_forwarded_class_attributes(self):
+        conn = self._pool.get_connection('root/virtualization/v2')
+        raw_conn = self._pool.get_raw_connection(conn._key)
+
+        self.assertEqual(raw_conn.Msvm_VirtualSystemSettingData.new(),
+                         conn.Msvm_VirtualSystemSettingData.new())
+
+    @mock.patch('time.time')
+    def _test_health_check(self, mock_time, healthy=True):
+        self._pool._health_check_interval = 10
+        mock_time.return_value = 0
+        conn = self._pool.get_connection('root/virtualization/v2')
+        raw_conn = self._pool.get_raw_connection(conn._key)
+        if not healthy:
+            raw_conn.query.side_effect = FakeRPCError
+
+        mock_time.return_value = 11
+        new_raw_conn = self._pool.get_raw_connection(conn._key)
+
+        raw_conn.query.assert_called_once_with(
+            self._pool._HEALTH_CHECK_QUERY)
+        self.assertEqual(healthy, raw_conn is new_raw_conn)
+
+    def test_health_check_ok(self):
+        self._test_health_check()
+
+    def test_health_check_failed(self):
+        self._test_health_check(healthy=False)
+
+    def test_is_rpc_failure(self):
+        self.assertTrue(baseutils.is_rpc_failure(FakeRPCError()))
+        self.assertFalse(baseutils.is_rpc_failure(Exception()))
+
+
+class QueryBuilderTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WQL query builder."""
+
+    def setUp(self):
+        super(QueryBuilderTestCase, self).setUp()
+        self.addCleanup(baseutils._query_templates.clear)
+
+    def test_escape_wql_value(self):
+        self.assertEqual("'fake''name'",
+                         baseutils.escape_wql_value("fake'name"))
+        self.assertEqual('3', baseutils.escape_wql_value(3))
+        self.assertEqual('TRUE', baseutils.escape_wql_value(True))
+
+    def test_build_query_all_properties(self):
+        self.assertEqual("SELECT * FROM Fake_Class",
+                         baseutils.build_query('Fake_Class'))
+
+    def test_build_query(self):
+        query = baseutils.build_query(
+            'Fake_Class', ['Name', 'ElementName'],
+            {'Name': "fake'id", 'Type': (1, 2)}, where="Other LIKE '%x'")
+
+        self.assertEqual("SELECT Name, ElementName FROM Fake_Class "
+                         "WHERE Name = 'fake''id' AND "
+                         "(Type = 1 OR Type = 2) AND Other LIKE '%x'", query)
+
+    def test_build_query_cached_template(self):
+        baseutils.build_query('Fake_Class', ['Name'], {'Name': 'id1'})
+        query = baseutils.build_query('Fake_Class', ['Name'],
+                                      {'Name': 'id2'})
+
+        self.assertEqual(1, len(baseutils._query_templates))
+        self.assertEqual("SELECT Name FROM Fake_Class WHERE Name = 'id2'",
+                         query)
+
+
+class FakeRecord(baseutils.WMIRecord):
+    __slots__ = ('Name', 'ElementName')
+
+
+class WMIRecordTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WMIRecord class."""
+
+    def _get_record(self):
+        return FakeRecord(path='fake_path', Name='fake_id',
+                          ElementName='fake_name')
+
+    def test_get_fields(self):
+        self.assertEqual(['path', 'Name', 'ElementName'],
+                         FakeRecord.get_fields())
+        self.assertEqual(['Name', 'ElementName'],
+                         FakeRecord.get_properties())
+
+    def test_from_wmi_object(self):
+        mock_obj = mock.Mock(Name='fake_id', ElementName='fake_name')
+        mock_obj.path_.return_value = 'fake_path'
+
+        record = FakeRecord.from_wmi_object(mock_obj)
+
+        self.assertEqual(self._get_record(), record)
+
+    def test_immutable(self):
+        record = self._get_record()
+
+        self.assertRaises(AttributeError, setattr, record, 'Name', 'id')
+        self.assertRaises(AttributeError, delattr, record, 'Name')
+        self.assertRaises(AttributeError, setattr, record, 'other', 'val')
+        self.assertEqual('fake_id', record.Name)
+
+    def test_pickle(self):
+        record = self._get_record()
+
+        unpickled_record = pickle.loads(pickle.dumps(record))
+
+        self.assertEqual(record, unpickled_record)
+        self.assertEqual(hash(record), hash(unpickled_record))
+
+
+class BaseUtilsTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the BaseUtils class."""
+
+    @mock.patch.object(baseutils, '_conn_pool')
+    def test_get_wmi_conn(self, mock_pool):
+        conn = baseutils.BaseUtils()._get_wmi_conn(
+            mock.sentinel.namespace, mock.sentinel.host)
+
+        self.assertEqual(mock_pool.get_connection.return_value, conn)
+        mock_pool.get_connection.assert_called_once_with(
+            mock.sentinel.namespace, host=mock.sentinel.host,
+            privileges=None, connect=False)
+
+    def test_iter_query(self):
+        utils = baseutils.BaseUtils()
+        utils._conn = mock.MagicMock()
+        utils._conn._raw_query.return_value = [mock.sentinel.ole_object]
+
+        results = list(utils._iter_query(mock.sentinel.wql))
+
+        self.assertEqual([self._mock_wmi._wmi_object.return_value], results)
+        utils._conn._raw_query.assert_called_once_with(mock.sentinel.wql)
+        self._mock_wmi._wmi_object.assert_called_once_with(
+            mock.sentinel.ole_object)
+
+    def test_query(self):
+        utils = baseutils.BaseUtils()
+        utils._conn = mock.MagicMock()
+
+        results = utils._query('Fake_Class', ['Name'], {'Name': 'fake_id'})
+
+        self.assertEqual(utils._conn.query.return_value, results)
+        utils._conn.query.assert_called_once_with(
+            "SELECT Name FROM Fake_Class WHERE Name = 'fake_id'")
+
+    def _test_query_records(self, where=None):
+        utils = baseutils.BaseUtils()
+        utils._conn = mock.MagicMock()
+        mock_obj = mock.Mock(Name='fake_id', ElementName='fake_name')
+        mock_obj.path_.return_value = 'fake_path'
+        utils._conn._raw_query.return_value = [mock_obj]
+        self._mock_wmi._wmi_object.side_effect = lambda obj: obj
+
+        records = utils._query_records(FakeRecord, 'Fake_Class', where)
+
+        self.assertEqual([FakeRecord(path='fake_path', Name='fake_id',
+                                     ElementName='fake_name')], records)
+        expected_query = "SELECT Name, ElementName FROM Fake_Class"
+        if where:
+            expected_query += " WHERE %s" % where
+        utils._conn._raw_query.assert_called_once_with(expected_query)
+
+    def test_query_records(self):
+        self._test_query_records()
+
+    def test_query_records_filtered(self):
+        self._test_query_records(where="Name = 'fake_id'")
+
+    def _test_get_default_setting_data(self, resource_sub_type=None):
+        utils = baseutils.BaseUtils()
+        utils._conn = mock.MagicMock()
+        mock_template = utils._conn.query.return_value[0]
+
+        for i in range(2):
+            setting_data = utils._get_default_setting_data(
+                mock.sentinel.class_name, resource_sub_type)
+
+            self.assertEqual(self._mock_wmi._wmi_object.return_value,
+                             setting_data)
+            self._mock_wmi._wmi_object.assert_called_with(
+                mock_template.ole_object.Clone_.return_value)
+
+        expected_query = ("SELECT * FROM %s WHERE InstanceID LIKE "
+                          "'%%\\Default'" % mock.sentinel.class_name)
+        if resource_sub_type:
+            expected_query += (" AND ResourceSubType = '%s'" %
+                               resource_sub_type)
+        utils._conn.query.assert_called_once_with(expected_query)
+        self.assertEqual(2, mock_template.ole_object.Clone_.call_count)
+
+    def test_get_default_setting_data(self):
+        self._test_get_default_setting_data()
+
+    def test_get_default_resource_setting_data(self):
+        self._test_get_default_setting_data(
+            resource_sub_type=mock.sentinel.res_sub_type)
+
+
+class WMIEventWatcherTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WMIEventWatcher class."""
+
+    def setUp(self):
+        super(WMIEventWatcherTestCase, self).setUp()
+        self._callback = mock.Mock()
+        self._state_callback = mock.Mock()
+        self._watcher = baseutils.WMIEventWatcher(
+            mock.sentinel.query, self._callback, host='fake_host',
+            fields=mock.sentinel.fields,
+            state_callback=self._state_callback)
+        self._watcher._INITIAL_RESUBSCRIBE_DELAY = 0
+
+        self._mock_pythoncom = mock.patch.object(
+            baseutils, 'pythoncom', create=True).start()
+        self._mock_wmi.x_wmi_timed_out = type('FakeTimeout', (Exception, ),
+                                              {})
+
+    @mock.patch.object(baseutils, 'wait_for_native_event')
+    @mock.patch.object(baseutils.native_threading, 'Thread')
+    def test_start(self, mock_thread, mock_wait):
+        self._watcher.start()
+
+        mock_thread.assert_called_once_with(target=self._watcher._watch)
+        mock_thread.return_value.start.assert_called_once_with()
+        mock_wait.assert_called_once_with(self._watcher._first_attempt_done,
+                                          self._watcher._START_TIMEOUT)
+
+    @mock.patch.object(baseutils, 'wait_for_native_event')
+    @mock.patch.object(baseutils.native_threading, 'Thread')
+    def test_start_no_wait(self, mock_thread, mock_wait):
+        self._watcher.start(wait=False)
+
+        mock_thread.return_value.start.assert_called_once_with()
+        self.assertFalse(mock_wait.called)
+
+    def test_subscribe(self):
+        event_watcher = self._watcher._subscribe()
+
+        mock_conn = self._mock_wmi.WMI.return_value
+        self.assertEqual(mock_conn.watch_for.return_value, event_watcher)
+        self._mock_wmi.WMI.assert_called_once_with(
+            moniker='//fake_host/root/virtualization/v2')
+        mock_conn.watch_for.assert_called_once_with(
+            raw_wql=mock.sentinel.query, fields=mock.sentinel.fields)
+
+    @mock.patch.object(baseutils.WMIEventWatcher, '_subscribe')
+    def test_watch(self, mock_subscribe):
+        events = [mock.sentinel.event, self._mock_wmi.x_wmi_timed_out(),
+                  mock.sentinel.other_event]
+
+        def fake_event_watcher(timeout_ms):
+            if not events:
+                self._watcher.stop()
+                raise Exception
+            event = events.pop(0)
+            if isinstance(event, Exception):
+                raise event
+            return event
+
+        # The subscription is set up again after failures.
+        mock_subscribe.side_effect = [Exception, fake_event_watcher,
+                                      Exception, fake_event_watcher]
+        # Callback failures do not affect the subscription.
+        self._callback.side_effect = [Exception, None, None]
+
+        self._watcher._watch()
+
+        self._callback.assert_has_calls(
+            [mock.call(mock.sentinel.event), mock.call(None),
+             mock.call(mock.sentinel.other_event)])
+        self._state_callback.assert_has_calls(
+            [mock.call(True), mock.call(False)])
+        self.assertEqual(2, self._state_callback.call_count)
+        self.assertEqual(2, mock_subscribe.call_count)
+        self.assertFalse(self._watcher.available)
+        self.assertTrue(self._watcher._first_attempt_done.is_set())
+        self._mock_pythoncom.CoInitialize.assert_called_once_with()
+        self._mock_pythoncom.CoUninitialize.assert_called_once_with()
+
+    @mock.patch.object(baseutils.tpool, 'execute')
+    @mock.patch.object(baseutils.patcher, 'is_monkey_patched')
+    def test_wait_for_native_event(self, mock_is_patched, mock_execute):
+        mock_event = mock.Mock()
+
+        mock_is_patched.return_value = True
+        self.assertEqual(
+            mock_execute.return_value,
+            baseutils.wait_for_native_event(mock_event, mock.sentinel.timeout))
+        mock_execute.assert_called_once_with(mock_event.wait,
+                                             mock.sentinel.timeout)
+
+        mock_is_patched.return_value = False
+        self.assertEqual(
+            mock_event.wait.return_value,
+            baseutils.wait_for_native_event(mock_event, mock.sentinel.timeout))
+        mock_event.wait.assert_called_once_with(mock.sentinel.timeout)
+
+
+class NotificationDispatcherTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the NotificationDispatcher class."""
+
+    def setUp(self):
+        super(NotificationDispatcherTestCase, self).setUp()
+        self._dispatcher = baseutils.NotificationDispatcher()
+
+    @mock.patch.object(baseutils.eventlet, 'spawn_n')
+    @mock.patch.object(baseutils.native_threading, 'Thread')
+    @mock.patch.object(baseutils.patcher, 'is_monkey_patched')
+    def _test_start(self, mock_is_patched, mock_thread, mock_spawn_n,
+                    monkey_patched):
+        mock_is_patched.return_value = monkey_patched
+
+        self._dispatcher.start()
+        # The dispatcher is only started once.
+        self._dispatcher.start()
+
+        if monkey_patched:
+            mock_spawn_n.assert_called_once_with(self._dispatcher._run)
+            self.assertFalse(mock_thread.called)
+        else:
+            mock_thread.assert_called_once_with(target=self._dispatcher._run)
+            mock_thread.return_value.start.assert_called_once_with()
+            self.assertFalse(mock_spawn_n.called)
+
+    def test_start_greenthread(self):
+        self._test_start(monkey_patched=True)
+
+    def test_start_native_thread(self):
+        self._test_start(monkey_patched=False)
+
+    @mock.patch.object(baseutils, 'wait_for_native_event')
+    def test_run(self, mock_wait):
+        mock_func = mock.Mock()
+        self._dispatcher.dispatch(mock_func, mock.sentinel.arg)
+        self._dispatcher.dispatch(mock_func, mock.sentinel.other_arg)
+        self._dispatcher._running = True
+
+        def fake_wait(event, timeout):
+            if mock_wait.call_count == 2:
+                # Pending calls are performed before stopping.
+                self._dispatcher.dispatch(mock_func, mock.sentinel.last_arg)
+                self._dispatcher.stop()
+
+        mock_func.side_effect = [Exception, None, None]
+        mock_wait.side_effect = fake_wait
+
+        self._dispatcher._run()
+
+        mock_func.assert_has_calls([mock.call(mock.sentinel.arg),
+                                    mock.call(mock.sentinel.other_arg),
+                                    mock.call(mock.sentinel.last_arg)])
+        mock_wait.assert_called_with(self._dispatcher._calls_ready,
+                                     self._dispatcher._WAIT_TIMEOUT)
+        self.assertEqual(2, mock_wait.call_count)
+        self.assertFalse(self._dispatcher._running)
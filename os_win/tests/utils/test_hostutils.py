@@ -17,6 +17,7 @@ from oslotest import base
 
 from os_win import constants
 from os_win import exceptions
+from os_win.utils import baseutils
 from os_win.utils import hostutils
 
 
@@ -50,30 +51,49 @@ class HostUtilsTestCase(base.BaseTestCase):
 
         super(HostUtilsTestCase, self).setUp()
 
-    @mock.patch.object(hostutils, 'wmi', create=True)
-    def test_init_wmi_virt_conn(self, mock_wmi):
+    @mock.patch.object(hostutils.HostUtils, '_get_wmi_conn')
+    def test_init_wmi_virt_conn(self, mock_get_wmi_conn):
         self._hostutils._init_wmi_virt_conn()
 
-        self.assertEqual(mock_wmi.WMI.return_value, self._hostutils._virt_v2)
-        mock_wmi.WMI.assert_called_once_with(
-            moniker='//./root/virtualization/v2')
+        self.assertEqual(mock_get_wmi_conn.return_value,
+                         self._hostutils._virt_v2)
+        mock_get_wmi_conn.assert_called_once_with(
+            'root/virtualization/v2', connect=True)
 
-    @mock.patch.object(hostutils, 'wmi', create=True)
-    def test_init_wmi_virt_conn_exception(self, mock_wmi):
+    @mock.patch.object(hostutils.HostUtils, '_get_wmi_conn')
+    def test_init_wmi_virt_conn_exception(self, mock_get_wmi_conn):
         self._hostutils._virt_v2 = None
-        mock_wmi.WMI.side_effect = Exception
+        mock_get_wmi_conn.side_effect = Exception
 
         self._hostutils._init_wmi_virt_conn()
         self.assertIsNone(self._hostutils._virt_v2)
 
+    @mock.patch.object(hostutils.HostUtils, '_get_wmi_conn')
+    def test_init_wmi_virt_conn_missing_namespace(self, mock_get_wmi_conn):
+        self._hostutils._virt_v2 = None
+        exc = Exception()
+        exc.com_error = mock.Mock(
+            hresult=baseutils.WBEM_E_INVALID_NAMESPACE)
+        mock_get_wmi_conn.side_effect = exc
+
+        for i in range(2):
+            self.assertRaises(exceptions.HyperVException,
+                              getattr, self._hostutils, '_conn_virt')
+
+        mock_get_wmi_conn.assert_called_once_with(
+            'root/virtualization/v2', connect=True)
+        self.assertTrue(self._hostutils._virt_namespace_missing)
+
     def test_conn_virt(self):
         self._hostutils._virt_v2 = mock.sentinel.conn
         self.assertEqual(mock.sentinel.conn, self._hostutils._conn_virt)
 
-    def test_conn_virt_uninitialized(self):
+    @mock.patch.object(hostutils.HostUtils, '_init_wmi_virt_conn')
+    def test_conn_virt_uninitialized(self, mock_init_wmi_virt_conn):
         self._hostutils._virt_v2 = None
         self.assertRaises(exceptions.HyperVException,
                           getattr, self._hostutils, '_conn_virt')
+        mock_init_wmi_virt_conn.assert_called_once_with()
 
     @mock.patch('os_win.utils.hostutils.ctypes')
     def test_get_host_tick_count64(self, mock_ctypes):
@@ -0,0 +1,195 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+
+import mock
+
+from os_win import constants
+from os_win.tests import test_base
+from os_win.utils import baseutils
+from os_win.utils import instrumentation
+from os_win.utils import jobutils
+
+
+class InstrumentationTestCase(test_base.OsWinBaseTestCase):
+    """Unit tests for the WMI call instrumentation."""
+
+    def setUp(self):
+        super(InstrumentationTestCase, self).setUp()
+        instrumentation.reset()
+        instrumentation.enable()
+        self.addCleanup(instrumentation.disable)
+        self.addCleanup(instrumentation.reset)
+
+    def test_histogram(self):
+        histogram = instrumentation.Histogram()
+        for value in (0.0005, 0.002, 0.002, 100):
+            histogram.add(value)
+
+        hist_dict = histogram.as_dict()
+        self.assertEqual(4, hist_dict['count'])
+        self.assertEqual(0.0005, hist_dict['min'])
+        self.assertEqual(100, hist_dict['max'])
+        self.assertEqual(1, hist_dict['buckets']['0.001'])
+        self.assertEqual(2, hist_dict['buckets']['0.005'])
+        self.assertEqual(1, hist_dict['buckets']['inf'])
+
+    @mock.patch('time.time')
+    def test_measure(self, mock_time):
+        mock_time.side_effect = [1, 1.5]
+
+        with instrumentation.measure(instrumentation.METHOD,
+                                     'Fake_Class', 'FakeMethod'):
+            pass
+
+        stats = instrumentation.get_stats()
+        key = (instrumentation.METHOD, 'Fake_Class', 'FakeMethod')
+        self.assertEqual(1, stats[key]['count'])
+        self.assertEqual(0.5, stats[key]['total'])
+        self.assertIn('Fake_Class.FakeMethod: count=1',
+                      instrumentation.format_stats())
+
+    def test_measure_disabled(self):
+        instrumentation.disable()
+
+        with instrumentation.measure(instrumentation.METHOD,
+                                     'Fake_Class', 'FakeMethod'):
+            pass
+
+        self.assertEqual({}, instrumentation.get_stats())
+
+    def test_wrapped_object(self):
+        mock_obj = mock.Mock()
+        mock_obj.associators.return_value = [mock.sentinel.assoc]
+
+        obj = instrumentation.wrap([mock_obj], 'Fake_Class')[0]
+        assoc = obj.associators(wmi_result_class='Fake_Result_Class')
+        obj.FakeMethod(mock.sentinel.arg)
+        # Local helpers are not counted as WMI method calls.
+        obj.path_()
+        obj.path()
+        obj.set(FakeProperty=mock.sentinel.value)
+        obj.FakeProperty = mock.sentinel.value
+
+        self.assertEqual(mock_obj, obj)
+        self.assertIsInstance(assoc[0], instrumentation.InstrumentedWMIObject)
+        mock_obj.FakeMethod.assert_called_once_with(mock.sentinel.arg)
+        self.assertEqual(mock.sentinel.value, mock_obj.FakeProperty)
+        self.assertEqual(
+            set([(instrumentation.ASSOCIATORS, 'Fake_Class',
+                  'associators:Fake_Result_Class'),
+                 (instrumentation.METHOD, 'Fake_Class', 'FakeMethod')]),
+            set(instrumentation.get_stats()))
+
+    def test_wrap_disabled(self):
+        instrumentation.disable()
+        self.assertIs(mock.sentinel.obj,
+                      instrumentation.wrap(mock.sentinel.obj, 'Fake_Class'))
+
+    def test_wrapped_mock_result(self):
+        mock_result = mock.MagicMock()
+        mock_result.__iter__.return_value = [mock.sentinel.item]
+
+        obj = instrumentation.wrap(mock_result, 'Fake_Class')
+
+        self.assertIsInstance(obj[0], instrumentation.InstrumentedWMIObject)
+        self.assertEqual([mock.sentinel.item], list(obj))
+        self.assertTrue(obj)
+
+    def test_connection_query(self):
+        mock_raw_conn = mock.Mock()
+        mock_raw_conn.query.return_value = [mock.sentinel.obj]
+        conn = baseutils._WMIConnectionCallable(
+            mock.Mock(), mock.sentinel.key, 'query', mock_raw_conn.query)
+
+        results = conn("SELECT * FROM Fake_Class WHERE Name = 'fake'")
+
+        self.assertIsInstance(results[0],
+                              instrumentation.InstrumentedWMIObject)
+        self.assertEqual(
+            [(instrumentation.QUERY, 'Fake_Class', 'query')],
+            list(instrumentation.get_stats()))
+
+    def test_connection_query_disabled(self):
+        instrumentation.disable()
+        mock_raw_conn = mock.Mock()
+        conn = baseutils._WMIConnectionCallable(
+            mock.Mock(), mock.sentinel.key, 'query', mock_raw_conn.query)
+
+        results = conn(mock.sentinel.wql)
+
+        self.assertIs(mock_raw_conn.query.return_value, results)
+        mock_raw_conn.query.assert_called_once_with(mock.sentinel.wql)
+        self.assertEqual({}, instrumentation.get_stats())
+
+    def test_get_wmi_object(self):
+        path = '//HOST/root/virtualization/v2:Fake_Class.InstanceID="fake"'
+
+        obj = baseutils.get_wmi_object(path)
+
+        self.assertIsInstance(obj, instrumentation.InstrumentedWMIObject)
+        self.assertEqual(self._mock_wmi.WMI.return_value, obj)
+        self._mock_wmi.WMI.assert_called_once_with(moniker=path)
+        self.assertEqual(
+            [(instrumentation.GET_OBJECT, 'Fake_Class', 'get_object')],
+            list(instrumentation.get_stats()))
+
+    @mock.patch.object(jobutils.JobUtils, '_do_wait_for_job')
+    def test_track_calls(self, mock_wait_for_job):
+        instrumentation.disable()
+        job_utils = jobutils.JobUtils()
+
+        with instrumentation.track_calls() as tracker:
+            job_utils.check_ret_val(constants.WMI_JOB_STATUS_STARTED,
+                                    'Msvm_ConcreteJob.InstanceID="fake"')
+
+        self.assertEqual(
+            {'JobUtils.check_ret_val': {instrumentation.JOB_WAIT: 1}},
+            tracker.get_counts())
+        self.assertFalse(instrumentation.is_enabled())
+
+    def test_track_calls_concurrent_trackers(self):
+        instrumentation.disable()
+
+        def use_other_tracker():
+            with instrumentation.track_calls():
+                pass
+
+        with instrumentation.track_calls() as tracker:
+            thread = threading.Thread(target=use_other_tracker)
+            thread.start()
+            thread.join()
+
+            # The other tracker exiting must not stop this one.
+            self.assertTrue(instrumentation.is_enabled())
+            with instrumentation.measure(instrumentation.QUERY,
+                                         'Fake_Class', 'query'):
+                pass
+
+        self.assertEqual({'<unknown>': {instrumentation.QUERY: 1}},
+                         tracker.get_counts())
+        self.assertFalse(instrumentation.is_enabled())
+
+    @mock.patch.object(instrumentation.loopingcall,
+                       'FixedIntervalLoopingCall')
+    def test_start_periodic_dump(self, mock_looping_call):
+        timer = instrumentation.start_periodic_dump(mock.sentinel.interval)
+
+        self.assertEqual(mock_looping_call.return_value, timer)
+        mock_looping_call.assert_called_once_with(instrumentation.log_stats)
+        timer.start.assert_called_once_with(
+            interval=mock.sentinel.interval,
+            initial_delay=mock.sentinel.interval)
@@ -17,6 +17,7 @@ from oslotest import base
 
 from os_win import constants
 from os_win import exceptions
+from os_win.utils import baseutils
 from os_win.utils import jobutils
 
 
@@ -58,17 +59,34 @@ class JobUtilsTestCase(base.BaseTestCase):
         self.assertFalse(mock_wait_for_job.called)
 
     def test_check_ret_val_exception(self):
-        self.assertRaises(exceptions.HyperVException,
-                          self.jobutils.check_ret_val,
-                          mock.sentinel.ret_val_bad,
-                          mock.sentinel.job_path)
+        exc = self.assertRaises(exceptions.WMIJobFailed,
+                                self.jobutils.check_ret_val,
+                                constants.WMI_JOB_ERROR_INVALID_STATE,
+                                mock.sentinel.job_path)
+
+        self.assertEqual(constants.WMI_JOB_ERROR_INVALID_STATE,
+                         exc.error_code)
+        self.assertIn(str(constants.WMI_JOB_ERROR_INVALID_STATE),
+                      exc.message)
 
     def test_wait_for_job_exception_concrete_job(self):
         mock_job = self._prepare_wait_for_job()
         mock_job.path.return_value.Class = self._CONCRETE_JOB
-        self.assertRaises(exceptions.HyperVException,
-                          self.jobutils._wait_for_job,
-                          self._FAKE_JOB_PATH)
+        mock_job.ErrorCode = constants.WMI_JOB_ERROR_FAILED
+        mock_job.ErrorSummaryDescription = 'fake summary'
+        mock_job.ErrorDescription = 'fake description'
+
+        exc = self.assertRaises(exceptions.WMIJobFailed,
+                                self.jobutils._wait_for_job,
+                                self._FAKE_JOB_PATH)
+
+        self.assertEqual(constants.WMI_JOB_ERROR_FAILED, exc.error_code)
+        self.assertEqual(self._FAKE_JOB_STATUS_BAD, exc.job_state)
+        self.assertEqual(
+            "WMI job failed with status %s. Error details: fake summary - "
+            "fake description - Error code: %s" % (
+                self._FAKE_JOB_STATUS_BAD, constants.WMI_JOB_ERROR_FAILED),
+            exc.message)
 
     def test_wait_for_job_exception_with_error(self):
         mock_job = self._prepare_wait_for_job()
@@ -96,6 +114,240 @@ class JobUtilsTestCase(base.BaseTestCase):
         job = self.jobutils._wait_for_job(self._FAKE_JOB_PATH)
         self.assertEqual(mock_job, job)
 
+    @mock.patch('time.sleep')
+    @mock.patch.object(jobutils.JobUtils, '_get_job_watcher')
+    def test_wait_for_job_polling_backoff(self, mock_get_job_watcher,
+                                          mock_sleep):
+        mock_get_job_watcher.return_value = None
+        mock_job = self._prepare_wait_for_job(
+            constants.WMI_JOB_STATE_COMPLETED)
+        running_job = mock.Mock(JobState=constants.WMI_JOB_STATE_RUNNING)
+        baseutils.get_wmi_object.side_effect = [running_job] * 3 + [mock_job]
+
+        job = self.jobutils._wait_for_job(self._FAKE_JOB_PATH)
+
+        self.assertEqual(mock_job, job)
+        mock_sleep.assert_has_calls(
+            [mock.call(0.05), mock.call(0.1), mock.call(0.2)])
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(jobutils.JobUtils, '_get_job_watcher')
+    def test_wait_for_job_events(self, mock_get_job_watcher, mock_sleep):
+        mock_watcher = mock_get_job_watcher.return_value
+        mock_watcher.available = True
+        mock_waiter = mock_watcher.add_waiter.return_value
+        mock_job = self._prepare_wait_for_job(
+            constants.WMI_JOB_STATE_COMPLETED)
+        running_job = mock.Mock(JobState=constants.WMI_JOB_STATE_RUNNING)
+        baseutils.get_wmi_object.side_effect = [running_job, mock_job]
+        job_path = 'Msvm_ConcreteJob.InstanceID="%s"' % mock.sentinel.job_id
+        job_ids = [str(mock.sentinel.job_id)]
+
+        job = self.jobutils._wait_for_job(job_path)
+
+        self.assertEqual(mock_job, job)
+        self.assertFalse(mock_sleep.called)
+        mock_watcher.add_waiter.assert_called_once_with(job_ids)
+        mock_waiter.wait.assert_called_once_with(
+            self.jobutils._JOB_EVENT_RECHECK_INTERVAL)
+        mock_waiter.clear.assert_called_once_with()
+        mock_watcher.remove_waiter.assert_called_once_with(job_ids,
+                                                           mock_waiter)
+
+    @mock.patch('time.sleep')
+    @mock.patch.object(jobutils.JobUtils, '_get_job_watcher')
+    def test_wait_for_job_events_unavailable(self, mock_get_job_watcher,
+                                            mock_sleep):
+        # The waiters poll the job states until the subscription is set up.
+        mock_watcher = mock_get_job_watcher.return_value
+        mock_watcher.available = False
+        mock_waiter = mock_watcher.add_waiter.return_value
+        mock_job = self._prepare_wait_for_job(
+            constants.WMI_JOB_STATE_COMPLETED)
+        running_job = mock.Mock(JobState=constants.WMI_JOB_STATE_RUNNING)
+        baseutils.get_wmi_object.side_effect = [running_job] * 2 + [mock_job]
+        job_path = 'Msvm_ConcreteJob.InstanceID="fake_job_id"'
+
+        job = self.jobutils._wait_for_job(job_path)
+
+        self.assertEqual(mock_job, job)
+        self.assertFalse(mock_sleep.called)
+        mock_waiter.wait.assert_has_calls(
+            [mock.call(self.jobutils._JOB_POLL_INITIAL_INTERVAL),
+             mock.call(self.jobutils._JOB_POLL_INITIAL_INTERVAL *
+                       self.jobutils._JOB_POLL_BACKOFF_FACTOR)])
+        mock_watcher.remove_waiter.assert_called_once_with(['fake_job_id'],
+                                                           mock_waiter)
+
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    @mock.patch.object(jobutils.JobUtils, '_get_job_watcher')
+    def test_wait_for_job_timeout(self, mock_get_job_watcher, mock_sleep,
+                                  mock_time):
+        mock_get_job_watcher.return_value = None
+        mock_time.side_effect = [0, 0, 2]
+        self._prepare_wait_for_job(constants.WMI_JOB_STATE_RUNNING)
+
+        self.assertRaises(exceptions.WMIJobTimeoutException,
+                          self.jobutils._wait_for_job,
+                          self._FAKE_JOB_PATH, timeout=1)
+        mock_sleep.assert_called_once_with(
+            self.jobutils._JOB_POLL_INITIAL_INTERVAL)
+
+    @mock.patch.object(jobutils, 'WMIJobHandle')
+    def test_check_ret_val_async_started(self, mock_job_handle_cls):
+        job_handle = self.jobutils.check_ret_val_async(
+            constants.WMI_JOB_STATUS_STARTED, mock.sentinel.job_path,
+            result_func=mock.sentinel.result_func)
+
+        self.assertEqual(mock_job_handle_cls.return_value, job_handle)
+        mock_job_handle_cls.assert_called_once_with(
+            self.jobutils, mock.sentinel.job_path, mock.sentinel.result_func)
+
+    @mock.patch.object(jobutils, 'WMIJobHandle')
+    def test_check_ret_val_async_ok(self, mock_job_handle_cls):
+        job_handle = self.jobutils.check_ret_val_async(
+            self._FAKE_RET_VAL, mock.sentinel.job_path)
+
+        self.assertEqual(mock_job_handle_cls.return_value, job_handle)
+        mock_job_handle_cls.assert_called_once_with(
+            self.jobutils, result_func=None)
+
+    def test_check_ret_val_async_exception(self):
+        self.assertRaises(exceptions.HyperVException,
+                          self.jobutils.check_ret_val_async,
+                          mock.sentinel.ret_val_bad,
+                          mock.sentinel.job_path)
+
+    @mock.patch('time.time')
+    def test_wait_for_jobs(self, mock_time):
+        mock_time.side_effect = [0, 1, 3]
+        job_handles = [mock.Mock(), mock.Mock()]
+
+        results = self.jobutils.wait_for_jobs(job_handles, timeout=10)
+
+        self.assertEqual([h.result.return_value for h in job_handles],
+                         results)
+        job_handles[0].result.assert_called_once_with(timeout=9)
+        job_handles[1].result.assert_called_once_with(timeout=7)
+
+    def _get_mock_job_handles(self, *done_states):
+        job_handles = []
+        for i, done_states in enumerate(done_states):
+            job_handle = mock.Mock(
+                job_path='Msvm_ConcreteJob.InstanceID="job_%s"' % i)
+            job_handle.done.side_effect = done_states
+            job_handles.append(job_handle)
+        return job_handles
+
+    @mock.patch.object(jobutils.JobUtils, '_get_job_watcher')
+    def test_wait_for_any_events(self, mock_get_job_watcher):
+        mock_watcher = mock_get_job_watcher.return_value
+        mock_watcher.available = True
+        mock_waiter = mock_watcher.add_waiter.return_value
+        # The second job finishes first.
+        job_handles = self._get_mock_job_handles([False, False, False],
+                                                 [False, True])
+
+        finished = self.jobutils.wait_for_any(job_handles)
+
+        self.assertEqual([job_handles[1]], finished)
+        mock_watcher.add_waiter.assert_called_once_with(['job_0', 'job_1'])
+        mock_waiter.wait.assert_called_once_with(
+            self.jobutils._JOB_EVENT_RECHECK_INTERVAL)
+        mock_watcher.remove_waiter.assert_called_once_with(
+            ['job_0', 'job_1'], mock_waiter)
+
+    @mock.patch('time.time')
+    @mock.patch('time.sleep')
+    @mock.patch.object(jobutils.JobUtils, '_get_job_watcher')
+    def test_wait_for_any_timeout(self, mock_get_job_watcher, mock_sleep,
+                                  mock_time):
+        mock_get_job_watcher.return_value = None
+        mock_time.side_effect = [0, 0, 2]
+        job_handles = self._get_mock_job_handles([False, False])
+
+        self.assertEqual([], self.jobutils.wait_for_any(job_handles,
+                                                        timeout=1))
+        mock_sleep.assert_called_once_with(
+            self.jobutils._JOB_POLL_INITIAL_INTERVAL)
+
+    def test_add_multiple_virt_resources(self):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_svc.AddResourceSettings.return_value = (
+            mock.sentinel.job_path, mock.sentinel.new_resources,
+            mock.sentinel.ret_val)
+        mock_res = mock.Mock()
+        mock_parent = mock.Mock()
+        self.jobutils.check_ret_val = mock.Mock()
+
+        new_resources = self.jobutils.add_multiple_virt_resources(
+            [mock_res, mock_res], mock_parent)
+
+        self.assertEqual(mock.sentinel.new_resources, new_resources)
+        mock_svc.AddResourceSettings.assert_called_once_with(
+            mock_parent.path_.return_value,
+            [mock_res.GetText_.return_value] * 2)
+        self.jobutils.check_ret_val.assert_called_once_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path)
+
+    def test_add_virt_resource_async(self):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_svc.AddResourceSettings.return_value = (
+            mock.sentinel.job_path, mock.sentinel.new_resources,
+            mock.sentinel.ret_val)
+        mock_res = mock.Mock()
+        mock_parent = mock.Mock()
+        self.jobutils.check_ret_val_async = mock.Mock()
+
+        job_handle = self.jobutils.add_virt_resource_async(mock_res,
+                                                           mock_parent)
+
+        self.assertEqual(self.jobutils.check_ret_val_async.return_value,
+                         job_handle)
+        mock_svc.AddResourceSettings.assert_called_once_with(
+            mock_parent.path_.return_value, [mock_res.GetText_.return_value])
+        self.jobutils.check_ret_val_async.assert_called_once_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path,
+            result_func=mock.ANY)
+        result_func = (
+            self.jobutils.check_ret_val_async.call_args[1]['result_func'])
+        self.assertEqual(mock.sentinel.new_resources, result_func(None))
+
+    def test_modify_virt_resource_async(self):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_svc.ModifyResourceSettings.return_value = (
+            mock.sentinel.job_path, mock.sentinel.out_set_data,
+            mock.sentinel.ret_val)
+        mock_res = mock.Mock()
+        self.jobutils.check_ret_val_async = mock.Mock()
+
+        job_handle = self.jobutils.modify_virt_resource_async(mock_res)
+
+        self.assertEqual(self.jobutils.check_ret_val_async.return_value,
+                         job_handle)
+        mock_svc.ModifyResourceSettings.assert_called_once_with(
+            ResourceSettings=[mock_res.GetText_.return_value])
+        self.jobutils.check_ret_val_async.assert_called_once_with(
+            mock.sentinel.ret_val, mock.sentinel.job_path)
+
+    @mock.patch.object(jobutils, '_JobWatcher')
+    def test_get_job_watcher(self, mock_job_watcher_cls):
+        self.jobutils._host = mock.sentinel.host
+        self.addCleanup(jobutils._job_watchers.pop, mock.sentinel.host)
+
+        watcher = self.jobutils._get_job_watcher()
+        self.assertEqual(watcher, self.jobutils._get_job_watcher())
+
+        self.assertEqual(mock_job_watcher_cls.return_value, watcher)
+        mock_job_watcher_cls.assert_called_once_with(mock.sentinel.host)
+        # The job subscription is only set up once waiters are added.
+        self.assertFalse(watcher.add_waiter.called)
+
+    def test_get_job_watcher_disabled(self):
+        self.jobutils._use_job_events = False
+        self.assertIsNone(self.jobutils._get_job_watcher())
+
     def test_stop_jobs(self):
         mock_job1 = mock.MagicMock(Cancellable=True)
         mock_job2 = mock.MagicMock(Cancellable=True)
@@ -132,10 +384,10 @@ class JobUtilsTestCase(base.BaseTestCase):
         mock_job.Description = self._FAKE_JOB_DESCRIPTION
         mock_job.ElapsedTime = self._FAKE_ELAPSED_TIME
 
-        wmi_patcher = mock.patch.object(jobutils, 'wmi', create=True)
-        mock_wmi = wmi_patcher.start()
-        self.addCleanup(wmi_patcher.stop)
-        mock_wmi.WMI.return_value = mock_job
+        get_wmi_obj_patcher = mock.patch.object(baseutils, 'get_wmi_object')
+        mock_get_wmi_obj = get_wmi_obj_patcher.start()
+        self.addCleanup(get_wmi_obj_patcher.stop)
+        mock_get_wmi_obj.return_value = mock_job
         return mock_job
 
     def test_modify_virt_resource(self):
@@ -146,15 +398,41 @@ class JobUtilsTestCase(base.BaseTestCase):
     def test_modify_virt_resource_max_retries_exception(self):
         side_effect = exceptions.HyperVException('expected failure.')
         self._check_modify_virt_resource_max_retries(
-            side_effect=side_effect, num_calls=6, expected_fail=True)
+            side_effect=side_effect, num_calls=20, expected_fail=True)
 
     def test_modify_virt_resource_max_retries(self):
         side_effect = [exceptions.HyperVException('expected failure.')] * 5 + [
             (self._FAKE_JOB_PATH, mock.MagicMock(), self._FAKE_RET_VAL)]
         self._check_modify_virt_resource_max_retries(side_effect=side_effect,
-                                                     num_calls=5)
+                                                     num_calls=6)
+
+    @mock.patch('time.sleep')
+    @mock.patch('time.time')
+    def test_modify_virt_resource_retry_timeout(self, mock_time, mock_sleep):
+        clock = [0]
+        mock_time.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = lambda delay: clock.__setitem__(
+            0, clock[0] + delay)
+        mock_svc = self.jobutils._vs_man_svc
+        mock_svc.ModifyResourceSettings.side_effect = (
+            exceptions.HyperVException('expected failure.'))
 
-    @mock.patch('eventlet.greenthread.sleep')
+        self.assertRaises(exceptions.HyperVException,
+                          self.jobutils.modify_virt_resource,
+                          mock.MagicMock())
+
+        # The transient failures are retried for a few seconds.
+        self.assertGreater(clock[0], 4)
+        self.assertLessEqual(clock[0], 5)
+
+    def test_modify_virt_resource_invalid_parameter(self):
+        side_effect = exceptions.WMIJobFailed(
+            'expected failure.',
+            error_code=constants.WMI_JOB_ERROR_INVALID_PARAMETER)
+        self._check_modify_virt_resource_max_retries(
+            side_effect=side_effect, num_calls=1, expected_fail=True)
+
+    @mock.patch('time.sleep')
     def _check_modify_virt_resource_max_retries(
             self, mock_sleep, side_effect, num_calls=1, expected_fail=False):
         mock_svc = self.jobutils._vs_man_svc
@@ -171,19 +449,43 @@ class JobUtilsTestCase(base.BaseTestCase):
 
         mock_calls = [
             mock.call(ResourceSettings=[mock.sentinel.res_data])] * num_calls
-        mock_svc.ModifyResourceSettings.has_calls(mock_calls)
-        mock_sleep.has_calls(mock.call(1) * num_calls)
+        mock_svc.ModifyResourceSettings.assert_has_calls(mock_calls)
+        self.assertEqual(num_calls,
+                         mock_svc.ModifyResourceSettings.call_count)
+        self.assertEqual(num_calls - 1, mock_sleep.call_count)
 
     def test_add_virt_resource(self):
         self._test_virt_method('AddResourceSettings', 3, 'add_virt_resource',
                                True, mock.sentinel.vm_path,
                                [mock.sentinel.res_data])
 
+    def test_modify_multiple_virt_resources(self):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_rsd = self._mock_vsms_method(mock_svc.ModifyResourceSettings, 3)
+
+        self.jobutils.modify_multiple_virt_resources([mock_rsd, mock_rsd])
+
+        mock_svc.ModifyResourceSettings.assert_called_once_with(
+            ResourceSettings=[mock.sentinel.res_data] * 2)
+        self.jobutils.check_ret_val.assert_called_once_with(
+            self._FAKE_RET_VAL, mock.sentinel.job_path)
+
     def test_remove_virt_resource(self):
         self._test_virt_method('RemoveResourceSettings', 2,
                                'remove_virt_resource', False,
                                ResourceSettings=[mock.sentinel.res_path])
 
+    def test_remove_multiple_virt_resources(self):
+        mock_svc = self.jobutils._vs_man_svc
+        mock_rsd = self._mock_vsms_method(mock_svc.RemoveResourceSettings, 2)
+
+        self.jobutils.remove_multiple_virt_resources([mock_rsd, mock_rsd])
+
+        mock_svc.RemoveResourceSettings.assert_called_once_with(
+            ResourceSettings=[mock.sentinel.res_path] * 2)
+        self.jobutils.check_ret_val.assert_called_once_with(
+            self._FAKE_RET_VAL, mock.sentinel.job_path)
+
     def test_add_virt_feature(self):
         self._test_virt_method('AddFeatureSettings', 3, 'add_virt_feature',
                                True, mock.sentinel.vm_path,
@@ -227,3 +529,204 @@ class JobUtilsTestCase(base.BaseTestCase):
         self.jobutils.check_ret_val = mock.MagicMock()
 
         return mock_res_setting_data
+
+
+class WMIJobHandleTestCase(base.BaseTestCase):
+    """Unit tests for the Hyper-V WMIJobHandle class."""
+
+    def setUp(self):
+        super(WMIJobHandleTestCase, self).setUp()
+        self._jobutils = mock.Mock(_KILL_JOB_STATE_CHANGE_REQUEST=5)
+        self._jobutils._is_job_completed.return_value = False
+        self._result_func = mock.Mock()
+        self._job_handle = jobutils.WMIJobHandle(
+            self._jobutils, 'fake\\job_path', self._result_func)
+
+        get_wmi_obj_patcher = mock.patch.object(baseutils, 'get_wmi_object')
+        self._mock_get_wmi_obj = get_wmi_obj_patcher.start()
+        self._mock_job = self._mock_get_wmi_obj.return_value
+        self.addCleanup(get_wmi_obj_patcher.stop)
+
+    def test_result(self):
+        result = self._job_handle.result(timeout=mock.sentinel.timeout)
+        # The job is only waited for once.
+        self._job_handle.result()
+
+        self.assertEqual(self._result_func.return_value, result)
+        self._jobutils._wait_for_job.assert_called_once_with(
+            'fake\\job_path', timeout=mock.sentinel.timeout)
+        self._result_func.assert_called_once_with(
+            self._jobutils._wait_for_job.return_value)
+        self.assertTrue(self._job_handle.done())
+
+    def test_result_sync_operation(self):
+        job_handle = jobutils.WMIJobHandle(self._jobutils,
+                                           result_func=self._result_func)
+
+        self.assertEqual(self._result_func.return_value, job_handle.result())
+        self.assertFalse(self._jobutils._wait_for_job.called)
+        self._result_func.assert_called_once_with(None)
+
+    def test_result_exception(self):
+        self._jobutils._wait_for_job.side_effect = exceptions.HyperVException
+
+        for i in range(2):
+            self.assertRaises(exceptions.HyperVException,
+                              self._job_handle.result)
+        self._jobutils._wait_for_job.assert_called_once_with(
+            'fake\\job_path', timeout=None)
+        self.assertFalse(self._result_func.called)
+
+    def test_result_timeout(self):
+        self._jobutils._wait_for_job.side_effect = (
+            exceptions.WMIJobTimeoutException(job_path=None, timeout=1),
+            mock.sentinel.job)
+
+        self.assertRaises(exceptions.WMIJobTimeoutException,
+                          self._job_handle.result, timeout=1)
+        self.assertEqual(self._result_func.return_value,
+                         self._job_handle.result())
+
+    def test_done(self):
+        self._mock_job.JobState = constants.WMI_JOB_STATE_RUNNING
+        self.assertFalse(self._job_handle.done())
+        self._mock_get_wmi_obj.assert_called_once_with('fake/job_path')
+
+    def test_progress(self):
+        self.assertEqual(self._mock_job.PercentComplete,
+                         self._job_handle.progress)
+
+    def _test_cancel(self, cancellable=True):
+        self._mock_job.Cancellable = cancellable
+
+        canceled = self._job_handle.cancel()
+
+        self.assertEqual(cancellable, canceled)
+        if cancellable:
+            self._mock_job.RequestStateChange.assert_called_once_with(5)
+        else:
+            self.assertFalse(self._mock_job.RequestStateChange.called)
+
+    def test_cancel(self):
+        self._test_cancel()
+
+    def test_cancel_not_cancellable(self):
+        self._test_cancel(cancellable=False)
+
+
+class JobWatcherTestCase(base.BaseTestCase):
+    """Unit tests for the Hyper-V JobWatcher class."""
+
+    def setUp(self):
+        super(JobWatcherTestCase, self).setUp()
+        self._watcher = jobutils._JobWatcher()
+        self._watcher._dispatcher = mock.Mock()
+        # The waiters are woken up by the dispatcher.
+        self._watcher._dispatcher.dispatch.side_effect = (
+            lambda func, *args: func(*args))
+
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_add_waiter(self, mock_event_watcher_cls):
+        waiter = self._watcher.add_waiter(['job_0', 'job_1'])
+        other_waiter = self._watcher.add_waiter(['job_0'])
+
+        self.assertEqual({'JOB_0': {waiter, other_waiter},
+                          'JOB_1': {waiter}},
+                         self._watcher._waiters)
+        mock_event_watcher = mock_event_watcher_cls.return_value
+        mock_event_watcher_cls.assert_called_once_with(
+            mock.ANY, self._watcher._process_event, host='.',
+            fields=['JobState'],
+            state_callback=self._watcher._on_state_change,
+            description='WMI job')
+        self._watcher._dispatcher.start.assert_called_once_with()
+        mock_event_watcher.start.assert_called_once_with(wait=False)
+
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_available(self, mock_event_watcher_cls):
+        self.assertFalse(self._watcher.available)
+
+        mock_event_watcher_cls.return_value.available = True
+        self._watcher.add_waiter(['fake_job'])
+        self.assertTrue(self._watcher.available)
+
+    @mock.patch('time.time')
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_remove_waiter(self, mock_event_watcher_cls, mock_time):
+        waiter = self._watcher.add_waiter(['job_0', 'job_1'])
+        other_waiter = self._watcher.add_waiter(['job_0'])
+
+        self._watcher.remove_waiter(['job_0', 'job_1'], waiter)
+        self.assertEqual({'JOB_0': {other_waiter}}, self._watcher._waiters)
+        self.assertIsNone(self._watcher._idle_since)
+
+        self._watcher.remove_waiter(['job_0'], other_waiter)
+        self.assertEqual({}, self._watcher._waiters)
+        self.assertEqual(mock_time.return_value, self._watcher._idle_since)
+
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_process_event(self, mock_event_watcher_cls):
+        awaited_waiter = self._watcher.add_waiter(['awaited_job'])
+        running_waiter = self._watcher.add_waiter(['running_job'])
+        events = [
+            mock.Mock(JobState=constants.WMI_JOB_STATE_COMPLETED,
+                      InstanceID='other_job'),
+            mock.Mock(JobState=constants.WMI_JOB_STATE_RUNNING,
+                      InstanceID='RUNNING_JOB'),
+            mock.Mock(JobState=constants.WMI_JOB_STATE_COMPLETED,
+                      InstanceID='AWAITED_JOB')]
+
+        for event in events:
+            self._watcher._process_event(event)
+
+        self.assertTrue(awaited_waiter.is_set())
+        self.assertFalse(running_waiter.is_set())
+
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_on_state_change(self, mock_event_watcher_cls):
+        waiters = [self._watcher.add_waiter(['job_0']),
+                   self._watcher.add_waiter(['job_1'])]
+
+        # The waiters switch between waiting for events and polling.
+        self._watcher._on_state_change(available=False)
+        self.assertTrue(all(waiter.is_set() for waiter in waiters))
+
+    @mock.patch('time.time')
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def _test_stop_if_idle(self, mock_event_watcher_cls, mock_time,
+                           idle_time, expect_stopped):
+        mock_event_watcher = mock_event_watcher_cls.return_value
+        mock_time.return_value = 0
+        waiter = self._watcher.add_waiter(['fake_job'])
+        self._watcher.remove_waiter(['fake_job'], waiter)
+
+        mock_time.return_value = idle_time
+        self._watcher._process_event(None)
+
+        self.assertEqual(expect_stopped, mock_event_watcher.stop.called)
+        self.assertEqual(expect_stopped,
+                         self._watcher._dispatcher.stop.called)
+        self.assertEqual(expect_stopped,
+                         self._watcher._event_watcher is None)
+
+    def test_stop_if_idle(self):
+        self._test_stop_if_idle(idle_time=self._watcher._IDLE_TIMEOUT,
+                                expect_stopped=True)
+
+    def test_stop_if_idle_recently_used(self):
+        self._test_stop_if_idle(idle_time=1, expect_stopped=False)
+
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_stop_if_idle_waited_for(self, mock_event_watcher_cls):
+        self._watcher.add_waiter(['fake_job'])
+        self._watcher._process_event(None)
+        self.assertFalse(mock_event_watcher_cls.return_value.stop.called)
+
+    @mock.patch.object(baseutils, 'WMIEventWatcher')
+    def test_stop(self, mock_event_watcher_cls):
+        self._watcher.add_waiter(['fake_job'])
+        self._watcher.stop()
+
+        mock_event_watcher_cls.return_value.stop.assert_called_once_with()
+        self._watcher._dispatcher.stop.assert_called_once_with()
+        self.assertIsNone(self._watcher._event_watcher)
@@ -13,7 +13,6 @@
 #    under the License.
 
 import os
-import six
 
 import mock
 
@@ -72,12 +71,10 @@ class PathUtilsTestCase(test_base.OsWinBaseTestCase):
 
         mock_rmtree.side_effect = [WindowsError(
             pathutils.ERROR_DIR_IS_NOT_EMPTY), True]
-        fake_windows_error = WindowsError
-        with mock.patch.object(six.moves.builtins, 'WindowsError',
-                               fake_windows_error, create=True):
-            self._pathutils.rmtree(mock.sentinel.FAKE_PATH)
+        self._pathutils.rmtree(mock.sentinel.FAKE_PATH)
 
-        mock_sleep.assert_called_once_with(1)
+        self.assertEqual(1, mock_sleep.call_count)
+        self.assertLessEqual(mock_sleep.call_args[0][0], 0.05)
         mock_rmtree.assert_has_calls([mock.call(mock.sentinel.FAKE_PATH),
                                       mock.call(mock.sentinel.FAKE_PATH)])
 
@@ -0,0 +1,169 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from os_win import constants
+from os_win import exceptions
+from os_win.tests import test_base
+from os_win.utils import baseutils
+from os_win.utils import instrumentation
+from os_win.utils import retry
+
+
+class FakeWindowsError(Exception):
+    def __init__(self, winerror):
+        self.winerror = winerror
+
+
+class FakeCOMError(Exception):
+    def __init__(self, hresult):
+        self.com_error = mock.Mock(hresult=hresult)
+
+
+class RetryPolicyTestCase(test_base.OsWinBaseTestCase):
+    def setUp(self):
+        super(RetryPolicyTestCase, self).setUp()
+        retry.reset_stats()
+        self.addCleanup(retry.reset_stats)
+
+        self._mock_sleep = mock.Mock()
+        self._policy = retry.RetryPolicy(
+            'fake_policy', max_attempts=4, initial_delay=0.1, max_delay=0.3,
+            jitter=0, sleep=self._mock_sleep)
+
+    def test_get_error_code(self):
+        self.assertEqual(
+            constants.WMI_JOB_ERROR_INVALID_STATE,
+            retry.get_error_code(exceptions.WMIJobFailed(
+                'fake error',
+                error_code=constants.WMI_JOB_ERROR_INVALID_STATE)))
+        self.assertEqual(
+            baseutils.RPC_S_CALL_FAILED,
+            retry.get_error_code(FakeCOMError(baseutils.RPC_S_CALL_FAILED)))
+        self.assertEqual(32, retry.get_error_code(FakeWindowsError(32)))
+        self.assertIsNone(retry.get_error_code(Exception()))
+
+    def test_is_retryable(self):
+        policy = retry.RetryPolicy(
+            'fake_policy', exceptions=(exceptions.HyperVException, ),
+            fatal_error_codes=(constants.WMI_JOB_ERROR_ACCESS_DENIED, ))
+
+        self.assertTrue(policy.is_retryable(exceptions.HyperVException()))
+        self.assertTrue(policy.is_retryable(exceptions.WMIJobFailed(
+            'fake error', error_code=constants.WMI_JOB_ERROR_INVALID_STATE)))
+        self.assertFalse(policy.is_retryable(exceptions.WMIJobFailed(
+            'fake error', error_code=constants.WMI_JOB_ERROR_ACCESS_DENIED)))
+        self.assertFalse(policy.is_retryable(ValueError()))
+
+    def test_is_retryable_error_codes(self):
+        policy = retry.RetryPolicy('fake_policy', error_codes=(32, ))
+
+        self.assertTrue(policy.is_retryable(FakeWindowsError(32)))
+        self.assertFalse(policy.is_retryable(FakeWindowsError(5)))
+        self.assertFalse(policy.is_retryable(Exception()))
+
+    def test_get_delay(self):
+        self.assertEqual([0.1, 0.2, 0.3, 0.3],
+                         [self._policy.get_delay(retry_number)
+                          for retry_number in range(1, 5)])
+
+    @mock.patch('random.random', return_value=0.5)
+    def test_get_delay_jitter(self, mock_random):
+        self._policy.jitter = 0.5
+        self.assertAlmostEqual(0.075, self._policy.get_delay(1))
+
+    def test_call_recovered(self):
+        mock_func = mock.Mock(side_effect=[exceptions.HyperVException,
+                                           exceptions.HyperVException,
+                                           mock.sentinel.result])
+
+        result = self._policy.call(mock_func, mock.sentinel.arg)
+
+        self.assertEqual(mock.sentinel.result, result)
+        mock_func.assert_has_calls([mock.call(mock.sentinel.arg)] * 3)
+        self._mock_sleep.assert_has_calls([mock.call(0.1), mock.call(0.2)])
+        self.assertEqual({'fake_policy': {retry.CALLS: 1,
+                                          retry.RETRIES: 2,
+                                          retry.RECOVERED: 1}},
+                         retry.get_stats())
+
+    def test_call_exhausted(self):
+        mock_func = mock.Mock(side_effect=exceptions.HyperVException)
+
+        self.assertRaises(exceptions.HyperVException,
+                          self._policy.call, mock_func)
+
+        self.assertEqual(4, mock_func.call_count)
+        self.assertEqual(3, self._mock_sleep.call_count)
+        self.assertEqual({retry.CALLS: 1, retry.RETRIES: 3,
+                          retry.EXHAUSTED: 1},
+                         retry.get_stats()['fake_policy'])
+
+    def test_call_not_retryable(self):
+        self._policy.exceptions = (exceptions.HyperVException, )
+        mock_func = mock.Mock(side_effect=ValueError)
+
+        self.assertRaises(ValueError, self._policy.call, mock_func)
+
+        mock_func.assert_called_once_with()
+        self.assertFalse(self._mock_sleep.called)
+        self.assertEqual({retry.CALLS: 1, retry.NOT_RETRYABLE: 1},
+                         retry.get_stats()['fake_policy'])
+
+    @mock.patch('time.time', return_value=0)
+    def test_call_timeout(self, mock_time):
+        self._policy.timeout = 0.15
+        mock_func = mock.Mock(side_effect=exceptions.HyperVException)
+
+        self.assertRaises(exceptions.HyperVException,
+                          self._policy.call, mock_func)
+
+        # The second retry would have ended past the timeout.
+        self.assertEqual(2, mock_func.call_count)
+        self._mock_sleep.assert_called_once_with(0.1)
+        self.assertEqual(1, retry.get_stats()['fake_policy'][
+            retry.DEADLINE_EXCEEDED])
+
+    @mock.patch('time.time', return_value=0)
+    def test_deadline(self, mock_time):
+        mock_func = mock.Mock(side_effect=exceptions.HyperVException)
+
+        with retry.deadline(1):
+            with retry.deadline(0.15):
+                self.assertRaises(exceptions.HyperVException,
+                                  self._policy.call, mock_func)
+            self.assertEqual(1, retry._get_deadline())
+        self.assertIsNone(retry._get_deadline())
+
+        self._mock_sleep.assert_called_once_with(0.1)
+
+    @mock.patch.object(instrumentation, 'measure')
+    def test_decorator(self, mock_measure):
+        calls = []
+
+        @self._policy
+        def fake_operation(arg):
+            calls.append(arg)
+            if len(calls) < 2:
+                raise exceptions.HyperVException()
+            return mock.sentinel.result
+
+        self.assertEqual(mock.sentinel.result,
+                         fake_operation(mock.sentinel.arg))
+        self.assertEqual('fake_operation', fake_operation.__name__)
+        self.assertEqual([mock.sentinel.arg] * 2, calls)
+        mock_measure.assert_called_once_with(
+            instrumentation.RETRY_WAIT, 'fake_policy', 'fake_operation')
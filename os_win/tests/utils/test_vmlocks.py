@@ -0,0 +1,174 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import threading
+import time
+
+import mock
+
+from os_win import exceptions
+from os_win.tests import test_base
+from os_win.utils import instrumentation
+from os_win.utils import vmlocks
+
+_VM_ID = '0E3C4FD4-5C3E-4D23-A0C6-B0B6A0F3A7C1'
+_OTHER_VM_ID = '9B5F5E1E-8D40-4C8E-9C9B-2F0E5A7E3C11'
+
+
+class VMLocksTestCase(test_base.OsWinBaseTestCase):
+    def setUp(self):
+        super(VMLocksTestCase, self).setUp()
+        self._manager = vmlocks.VMLockManager()
+
+    def _check_get_vm_id(self, expected_vm_id, **properties):
+        wmi_object = mock.Mock(spec_set=['InstanceID', 'Name'],
+                               **properties)
+        self.assertEqual(expected_vm_id, vmlocks.get_vm_id(wmi_object))
+
+    def test_get_vm_id_from_resource(self):
+        self._check_get_vm_id(
+            _VM_ID,
+            InstanceID='Microsoft:%s\\83F8638B-8DCA-4152-9EDA-2CA8B33039B4'
+                       '\\0\\0\\D' % _VM_ID.lower(),
+            Name='Hard Drive')
+
+    def test_get_vm_id_from_vm(self):
+        self._check_get_vm_id(_VM_ID, InstanceID=None, Name=_VM_ID.lower())
+        # Non matching instance ids fall back to the VM name.
+        self._check_get_vm_id(_VM_ID, InstanceID='', Name=_VM_ID.lower())
+
+    def test_get_vm_id_unknown(self):
+        self._check_get_vm_id(None, InstanceID='Microsoft:Definition\\Default',
+                              Name='Default')
+        self._check_get_vm_id(None, InstanceID=None, Name='HOSTNAME')
+        self.assertIsNone(vmlocks.get_vm_id(mock.MagicMock()))
+
+    def _run_in_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        return thread
+
+    def _wait_for(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_lock_reentrant(self):
+        with self._manager.lock(_VM_ID):
+            with self._manager.lock([_VM_ID.lower(), None]):
+                self.assertTrue(self._manager.is_locked(_VM_ID))
+            self.assertTrue(self._manager.is_locked(_VM_ID))
+        self.assertFalse(self._manager.is_locked(_VM_ID))
+
+    def test_lock_upgrade(self):
+        with self._manager.lock(_VM_ID, shared=True):
+            self.assertRaises(exceptions.OSWinException,
+                              self._manager.acquire, _VM_ID)
+        self.assertFalse(self._manager.is_locked(_VM_ID))
+
+    def test_lock_out_of_order(self):
+        with self._manager.lock(_OTHER_VM_ID):
+            self.assertRaises(exceptions.OSWinException,
+                              self._manager.acquire, _VM_ID)
+            with self._manager.lock(_OTHER_VM_ID.lower()):
+                pass
+        self.assertEqual({}, self._manager._vm_locks)
+
+        with self._manager.lock(_VM_ID):
+            with self._manager.lock(_OTHER_VM_ID):
+                self.assertTrue(self._manager.is_locked(_OTHER_VM_ID))
+
+    def test_lock_ignored_none(self):
+        with self._manager.lock([None]):
+            self.assertEqual({}, self._manager._vm_locks)
+
+    def _hold_lock(self, vm_id, shared, acquired, release):
+        with self._manager.lock(vm_id, shared):
+            acquired.set()
+            release.wait(5)
+
+    def _start_holder(self, vm_id, shared=False):
+        acquired = threading.Event()
+        release = threading.Event()
+        self._run_in_thread(self._hold_lock, vm_id, shared, acquired,
+                            release)
+        # Cleanups run in reverse order, so the thread is released before
+        # being joined.
+        self.addCleanup(release.set)
+        self.assertTrue(acquired.wait(5))
+        return release
+
+    def test_shared_locks(self):
+        self._start_holder(_VM_ID, shared=True)
+
+        with self._manager.lock(_VM_ID, shared=True):
+            self.assertEqual(2, len(self._manager._vm_locks[_VM_ID]
+                                    .shared_owners))
+
+    def test_other_vm_not_blocked(self):
+        self._start_holder(_VM_ID)
+
+        with self._manager.lock(_OTHER_VM_ID):
+            self.assertTrue(self._manager.is_locked(_VM_ID))
+
+    def test_exclusive_lock_ordering(self):
+        release = self._start_holder(_VM_ID)
+        events = []
+
+        def operation(name, shared):
+            with self._manager.lock(_VM_ID, shared):
+                events.append(name)
+
+        vm_lock = self._manager._vm_locks[_VM_ID]
+        threads = []
+        for name, shared in (('write1', False), ('read1', True),
+                             ('read2', True), ('write2', False)):
+            threads.append(self._run_in_thread(operation, name, shared))
+            expected_waiters = len(threads)
+            self._wait_for(lambda: len(vm_lock.waiters) == expected_waiters)
+
+        self.assertEqual([], events)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual('write1', events[0])
+        self.assertEqual(set(['read1', 'read2']), set(events[1:3]))
+        self.assertEqual('write2', events[3])
+        self.assertFalse(self._manager.is_locked(_VM_ID))
+
+    @mock.patch.object(instrumentation, 'measure')
+    def test_lock_wait_instrumented(self, mock_measure):
+        with self._manager.lock(_VM_ID, shared=True):
+            pass
+
+        mock_measure.assert_called_once_with(
+            instrumentation.LOCK_WAIT, vmlocks.LOCK_CLASS, vmlocks.SHARED)
+
+    def test_lock_objects(self):
+        resource = mock.Mock(InstanceID='Microsoft:%s\\0' % _OTHER_VM_ID)
+        vm = mock.Mock(InstanceID=None, Name=_VM_ID)
+
+        with mock.patch.object(self._manager, 'acquire') as mock_acquire, \
+                mock.patch.object(self._manager, 'release'):
+            with self._manager.lock_objects([resource, vm, resource]):
+                pass
+
+        mock_acquire.assert_has_calls([mock.call(_VM_ID, False),
+                                       mock.call(_OTHER_VM_ID, False)])
+        self.assertEqual(2, mock_acquire.call_count)
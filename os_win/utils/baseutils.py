@@ -0,0 +1,684 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Base WMI utility class and the shared WMI connection pool.
+"""
+
+import collections
+import numbers
+import sys
+import threading
+import time
+
+if sys.platform == 'win32':
+    import pythoncom
+    import wmi
+
+import eventlet
+from eventlet import patcher
+from eventlet import tpool
+from oslo_log import log as logging
+
+from os_win._i18n import _, _LE, _LW
+from os_win.utils import instrumentation
+
+native_threading = patcher.original('threading')
+
+LOG = logging.getLogger(__name__)
+
+# HRESULT values signaling that the underlying DCOM channel is gone and
+# the connection has to be reestablished.
+RPC_S_SERVER_UNAVAILABLE = -2147023174
+RPC_S_CALL_FAILED = -2147023170
+RPC_S_CALL_FAILED_DNE = -2147023169
+RPC_E_DISCONNECTED = -2147417848
+WBEM_E_TRANSPORT_FAILURE = -2147217387
+
+_RPC_FAILURE_HRESULTS = (RPC_S_SERVER_UNAVAILABLE,
+                         RPC_S_CALL_FAILED,
+                         RPC_S_CALL_FAILED_DNE,
+                         RPC_E_DISCONNECTED,
+                         WBEM_E_TRANSPORT_FAILURE)
+# The requested WMI namespace does not exist.
+WBEM_E_INVALID_NAMESPACE = -2147217394
+
+
+def get_hresult(exc):
+    """Returns the HRESULT carried by a WMI / COM exception, if any."""
+    com_error = getattr(exc, 'com_error', exc)
+    hresult = getattr(com_error, 'hresult', None)
+    if isinstance(hresult, int):
+        return hresult
+
+
+def is_rpc_failure(exc):
+    return get_hresult(exc) in _RPC_FAILURE_HRESULTS
+
+
+class WMIConnectionPool(object):
+    """Registry of WMI namespace connections.
+
+    Connections are shared per (host, namespace, privileges) by the callers
+    running on the same native thread, as COM objects are bound to the
+    thread that created them. Greenthreads share the native thread, hence
+    its connections, which are dropped along with the thread. Connections
+    are established lazily, the first time they are actually used. Pooled
+    connections are health checked periodically and transparently
+    reestablished when a call fails because of an RPC error.
+
+    Connecting and health checking are done using per connection locks, so
+    that slow DCOM calls only delay the callers needing the same
+    connection.
+    """
+
+    _HEALTH_CHECK_QUERY = "SELECT Name FROM __Namespace"
+
+    def __init__(self, health_check_interval=60):
+        self._health_check_interval = health_check_interval
+        # Holds the connections of each native thread.
+        self._local = native_threading.local()
+        # Incremented when the pool is cleared, the connections of the
+        # previous generations being dropped by their threads.
+        self._generation = 0
+
+    @staticmethod
+    def _get_key(namespace, host, privileges):
+        namespace = namespace.replace('\\', '/').strip('/').lower()
+        privileges = tuple(sorted(privileges or []))
+        return (host.lower(), namespace, privileges)
+
+    def get_connection(self, namespace, host='.', privileges=None,
+                       connect=False):
+        """Returns a shared connection to the requested WMI namespace.
+
+        :param connect: bind the connection right away instead of doing it
+                        on first use, surfacing connection errors early.
+        """
+        key = self._get_key(namespace, host, privileges)
+        conn = WMIConnection(self, key)
+        if connect:
+            self.get_raw_connection(key)
+        return conn
+
+    def _get_thread_conns(self):
+        """Returns the connections of the current native thread.
+
+        :returns: a (conns, conn_locks) tuple. The first dict maps the
+                  connection keys to [raw_connection, last_checked] lists,
+                  the second one maps them to the locks serializing the
+                  connects and health checks.
+        """
+        local = self._local
+        if getattr(local, 'generation', None) != self._generation:
+            local.conns = {}
+            local.conn_locks = {}
+            local.generation = self._generation
+        return local.conns, local.conn_locks
+
+    def _needs_check(self, entry):
+        return (self._health_check_interval is not None and
+                time.time() - entry[1] >= self._health_check_interval)
+
+    def get_raw_connection(self, key):
+        """Returns the raw connection used by the current native thread."""
+        conns, conn_locks = self._get_thread_conns()
+        entry = conns.get(key)
+        if entry and not self._needs_check(entry):
+            return entry[0]
+        conn_lock = conn_locks.setdefault(key, threading.Lock())
+
+        with conn_lock:
+            # Another greenthread may have connected in the meantime.
+            entry = conns.get(key)
+            if entry and self._needs_check(entry):
+                if self._is_healthy(entry[0]):
+                    entry[1] = time.time()
+                else:
+                    entry = None
+
+            if not entry:
+                entry = [self._connect(*key), time.time()]
+                conns[key] = entry
+            return entry[0]
+
+    def _connect(self, host, namespace, privileges):
+        LOG.debug("Connecting to the '%(namespace)s' WMI namespace on host "
+                  "'%(host)s'.", {'namespace': namespace, 'host': host})
+        if privileges:
+            return wmi.WMI(computer=host, namespace=namespace,
+                           privileges=list(privileges))
+        return wmi.WMI(moniker='//%s/%s' % (host, namespace))
+
+    def _is_healthy(self, raw_conn):
+        try:
+            raw_conn.query(self._HEALTH_CHECK_QUERY)
+            return True
+        except Exception as exc:
+            LOG.warning(_LW("WMI connection health check failed: %s"), exc)
+            return False
+
+    def invalidate(self, key):
+        """Drops the connection used by the current native thread."""
+        conns, _conn_locks = self._get_thread_conns()
+        conns.pop(key, None)
+
+    def clear(self):
+        """Drops the connections of all the threads."""
+        self._generation += 1
+
+
+class WMIConnection(object):
+    """Lazily bound, self healing handle to a pooled WMI connection.
+
+    Attribute access is forwarded to the underlying WMI namespace object.
+    Calls failing due to RPC errors are retried once, over a new connection.
+    """
+
+    def __init__(self, pool, key):
+        self._pool = pool
+        self._key = key
+
+    def __getattr__(self, name):
+        attr = getattr(self._pool.get_raw_connection(self._key), name)
+        if callable(attr):
+            return _WMIConnectionCallable(self._pool, self._key, name, attr)
+        return attr
+
+    def __repr__(self):
+        return '<WMIConnection host=%r namespace=%r>' % self._key[:2]
+
+
+class _WMIConnectionCallable(object):
+    def __init__(self, pool, key, name, func):
+        self._pool = pool
+        self._key = key
+        self._name = name
+        self._func = func
+
+    def __getattr__(self, name):
+        # e.g. conn.Msvm_VirtualSystemSettingData.new()
+        return getattr(self._func, name)
+
+    def __call__(self, *args, **kwargs):
+        if not instrumentation.is_enabled():
+            return self._call(*args, **kwargs)
+
+        if self._name in ('query', '_raw_query'):
+            wql = args[0] if args else kwargs.get('wql', '')
+            category = instrumentation.QUERY
+            class_name = instrumentation.get_query_class(wql)
+        else:
+            # e.g. conn.Msvm_ComputerSystem(ElementName=vm_name)
+            category = instrumentation.ENUMERATION
+            class_name = self._name
+
+        with instrumentation.measure(category, class_name, self._name):
+            result = self._call(*args, **kwargs)
+        if self._name == '_raw_query':
+            # Raw objects are wrapped by the caller.
+            return result
+        return instrumentation.wrap(result, class_name)
+
+    def _call(self, *args, **kwargs):
+        try:
+            return self._func(*args, **kwargs)
+        except Exception as exc:
+            if not is_rpc_failure(exc):
+                raise
+            LOG.warning(_LW("WMI call %(name)s failed due to an RPC error. "
+                            "Reconnecting and retrying. Error: %(exc)s"),
+                        {'name': self._name, 'exc': exc})
+            self._pool.invalidate(self._key)
+            raw_conn = self._pool.get_raw_connection(self._key)
+            return getattr(raw_conn, self._name)(*args, **kwargs)
+
+
+_conn_pool = WMIConnectionPool()
+
+
+def get_connection_pool():
+    return _conn_pool
+
+
+def get_wmi_object(moniker):
+    """Retrieves a WMI object by its path, e.g. a job or a resource.
+
+    Unlike calling wmi.WMI(moniker=...) directly, the round trip is
+    instrumented.
+    """
+    class_name = instrumentation.get_path_class(moniker)
+    with instrumentation.measure(instrumentation.GET_OBJECT, class_name,
+                                 'get_object'):
+        wmi_object = wmi.WMI(moniker=moniker)
+    return instrumentation.wrap(wmi_object, class_name)
+
+
+def wait_for_native_event(event, timeout=None):
+    """Waits for an event set by a native thread, e.g. a WMI event watcher.
+
+    When eventlet monkey patching is used, the wait is performed by a
+    native thread pool worker, so that other greenthreads are not blocked.
+
+    :param event: a native threading.Event object.
+    :returns: True if the event was set, False if the wait timed out.
+    """
+    if patcher.is_monkey_patched('thread'):
+        return tpool.execute(event.wait, timeout)
+    return event.wait(timeout)
+
+
+class WMIEventWatcher(object):
+    """Handles a WMI event subscription using a native thread.
+
+    COM objects cannot be shared with other threads, for which reason the
+    watcher thread uses its own WMI connection instead of a pooled one.
+    If the subscription cannot be set up or fails later on, it's set up
+    again, waiting up to _MAX_RESUBSCRIBE_DELAY seconds between attempts.
+
+    :param event_query: the WQL event query.
+    :param callback: called from the watcher thread for each received
+                     event, or with None if no event was received within
+                     event_timeout_ms milliseconds.
+    :param state_callback: optional callable, called from the watcher
+                           thread with the new availability (True or
+                           False) each time the subscription is set up or
+                           lost.
+    :param description: describes the events, used in log messages.
+    """
+
+    _INITIAL_RESUBSCRIBE_DELAY = 1
+    _MAX_RESUBSCRIBE_DELAY = 60
+    # The amount of seconds start waits for the subscription to be set up.
+    _START_TIMEOUT = 10
+
+    def __init__(self, event_query, callback, host='.',
+                 namespace='root/virtualization/v2', fields=None,
+                 event_timeout_ms=2000, state_callback=None,
+                 description='WMI'):
+        self._event_query = event_query
+        self._callback = callback
+        self._host = host
+        self._namespace = namespace
+        self._fields = fields or []
+        self._event_timeout_ms = event_timeout_ms
+        self._state_callback = state_callback
+        self._description = description
+
+        self._available = False
+        self._stopped = native_threading.Event()
+        # Set once the first subscription attempt completes.
+        self._first_attempt_done = native_threading.Event()
+
+    @property
+    def available(self):
+        return self._available
+
+    def start(self, wait=True):
+        """Starts the watcher thread.
+
+        :param wait: wait for the subscription, making it available right
+                     away, unless setting it up fails or takes longer than
+                     _START_TIMEOUT seconds.
+        """
+        thread = native_threading.Thread(target=self._watch)
+        thread.daemon = True
+        thread.start()
+        if wait:
+            wait_for_native_event(self._first_attempt_done,
+                                  self._START_TIMEOUT)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _subscribe(self):
+        conn = wmi.WMI(moniker='//%s/%s' % (self._host, self._namespace))
+        return conn.watch_for(raw_wql=self._event_query,
+                              fields=self._fields)
+
+    def _set_available(self, available):
+        changed = available != self._available
+        self._available = available
+        self._first_attempt_done.set()
+        if changed and self._state_callback:
+            try:
+                self._state_callback(available)
+            except Exception:
+                LOG.exception(_LE("The %s event watcher state callback "
+                                  "failed."), self._description)
+
+    def _watch(self):
+        try:
+            pythoncom.CoInitialize()
+            try:
+                self._watch_subscriptions()
+            finally:
+                pythoncom.CoUninitialize()
+        finally:
+            # Unblocks start if the thread fails unexpectedly.
+            self._first_attempt_done.set()
+
+    def _watch_subscriptions(self):
+        delay = self._INITIAL_RESUBSCRIBE_DELAY
+        while not self._stopped.is_set():
+            try:
+                event_watcher = self._subscribe()
+            except Exception as exc:
+                LOG.warning(_LW("Could not subscribe to %(description)s "
+                                "events, retrying in %(delay)s seconds. "
+                                "Error: %(exc)s"),
+                            {'description': self._description,
+                             'delay': delay, 'exc': exc})
+                self._set_available(False)
+                self._stopped.wait(delay)
+                delay = min(delay * 2, self._MAX_RESUBSCRIBE_DELAY)
+                continue
+
+            delay = self._INITIAL_RESUBSCRIBE_DELAY
+            self._set_available(True)
+            try:
+                self._process_events(event_watcher)
+            except Exception as exc:
+                LOG.warning(_LW("The %(description)s event subscription "
+                                "failed, subscribing again. Error: "
+                                "%(exc)s"),
+                            {'description': self._description, 'exc': exc})
+            finally:
+                self._set_available(False)
+
+    def _process_events(self, event_watcher):
+        while not self._stopped.is_set():
+            try:
+                event = event_watcher(self._event_timeout_ms)
+            except wmi.x_wmi_timed_out:
+                event = None
+
+            try:
+                self._callback(event)
+            except Exception:
+                LOG.exception(_LE("Failed to process %s event."),
+                              self._description)
+
+
+class NotificationDispatcher(object):
+    """Runs calls requested by native threads, e.g. WMI event watchers.
+
+    When eventlet monkey patching is used, the calls are performed by a
+    greenthread, so that they may use green primitives, such as the green
+    threading.Event objects. A native thread is used otherwise.
+
+    The dispatcher waits for calls using a single tpool worker at a time,
+    which is released every _WAIT_TIMEOUT seconds.
+
+    :param description: describes the calls, used in log messages.
+    """
+
+    _WAIT_TIMEOUT = 1
+
+    def __init__(self, description='WMI'):
+        self._description = description
+        self._lock = native_threading.Lock()
+        self._calls = collections.deque()
+        self._calls_ready = native_threading.Event()
+        self._running = False
+        self._stopped = False
+
+    def start(self):
+        with self._lock:
+            self._stopped = False
+            if self._running:
+                return
+            self._running = True
+
+        if patcher.is_monkey_patched('thread'):
+            eventlet.spawn_n(self._run)
+        else:
+            thread = native_threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stops the dispatcher once the pending calls are performed."""
+        with self._lock:
+            self._stopped = True
+        self._calls_ready.set()
+
+    def dispatch(self, func, *args):
+        """Requests a call, which may be done from any thread."""
+        self._calls.append((func, args))
+        self._calls_ready.set()
+
+    def _run(self):
+        while True:
+            wait_for_native_event(self._calls_ready, self._WAIT_TIMEOUT)
+            self._calls_ready.clear()
+            while self._calls:
+                func, args = self._calls.popleft()
+                try:
+                    func(*args)
+                except Exception:
+                    LOG.exception(_LE("The %s notification dispatcher call "
+                                      "failed."), self._description)
+
+            with self._lock:
+                if self._stopped:
+                    self._running = False
+                    return
+
+
+# Maps the query shapes (class, selected properties, condition properties
+# and number of accepted values) to query templates.
+_query_templates = {}
+
+
+def escape_wql_value(value):
+    """Returns the WQL literal of the given value.
+
+    Strings are quoted, embedded quotes being doubled.
+    """
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, numbers.Number):
+        return str(value)
+    return "'%s'" % value.replace("'", "''")
+
+
+def _get_query_template(class_name, properties, condition_shapes):
+    key = (class_name, properties, condition_shapes)
+    template = _query_templates.get(key)
+    if template is None:
+        template = "SELECT %s FROM %s" % (', '.join(properties) or '*',
+                                          class_name)
+        clauses = []
+        for prop, values_count in condition_shapes:
+            if values_count is None:
+                clauses.append("%s = %%s" % prop)
+            else:
+                clauses.append("(%s)" % ' OR '.join(
+                    ["%s = %%s" % prop] * values_count))
+        if clauses:
+            template += " WHERE " + ' AND '.join(clauses)
+        _query_templates[key] = template
+    return template
+
+
+def build_query(class_name, properties=None, conditions=None, where=None):
+    """Builds a WQL query selecting only the given properties.
+
+    :param properties: the properties read by the caller. All the
+                       properties are selected if omitted. The key
+                       properties must be included if the object paths
+                       or the object methods are used.
+    :param conditions: dict mapping property names to the expected values.
+                       Non empty lists or tuples match any of the
+                       contained values.
+    :param where: additional raw WQL condition, e.g. using LIKE.
+
+    The query templates are cached, only the values being escaped and
+    filled in for subsequent queries having the same shape.
+    """
+    conditions = conditions or {}
+    condition_shapes = []
+    values = []
+    for prop in sorted(conditions):
+        value = conditions[prop]
+        if isinstance(value, (list, tuple)):
+            condition_shapes.append((prop, len(value)))
+            values.extend(value)
+        else:
+            condition_shapes.append((prop, None))
+            values.append(value)
+
+    template = _get_query_template(class_name, tuple(properties or ()),
+                                   tuple(condition_shapes))
+    query = template % tuple(escape_wql_value(value) for value in values)
+    if where:
+        query += " %s %s" % ('AND' if conditions else 'WHERE', where)
+    return query
+
+
+def _make_record(record_cls, values):
+    return record_cls(**values)
+
+
+class WMIRecord(object):
+    """Immutable copy of some of the properties of a WMI object.
+
+    Records do not hold any COM references, so they can be cached, pickled
+    and passed to other threads. Subclasses list the copied WMI properties
+    in __slots__. The object path is always copied, as the 'path' field.
+    """
+
+    __slots__ = ('path', )
+
+    def __init__(self, **values):
+        for field in self.get_fields():
+            object.__setattr__(self, field, values.get(field))
+
+    @classmethod
+    def get_fields(cls):
+        fields = []
+        for klass in reversed(cls.__mro__):
+            fields.extend(klass.__dict__.get('__slots__', ()))
+        return fields
+
+    @classmethod
+    def get_properties(cls):
+        """Returns the WMI properties which have to be selected."""
+        return [field for field in cls.get_fields() if field != 'path']
+
+    @classmethod
+    def from_wmi_object(cls, wmi_object):
+        values = dict((prop, getattr(wmi_object, prop))
+                      for prop in cls.get_properties())
+        values['path'] = wmi_object.path_()
+        return cls(**values)
+
+    def as_dict(self):
+        return dict((field, getattr(self, field))
+                    for field in self.get_fields())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(_("WMI records are immutable."))
+
+    def __delattr__(self, name):
+        raise AttributeError(_("WMI records are immutable."))
+
+    def __reduce__(self):
+        return (_make_record, (self.__class__, self.as_dict()))
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                self.as_dict() == other.as_dict())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % item for item in
+                                     sorted(self.as_dict().items())))
+
+
+class BaseUtils(object):
+    """Base class for the utils classes relying on WMI connections."""
+
+    _WMI_VIRT_NAMESPACE = 'root/virtualization/v2'
+    _WMI_CIMV2_NAMESPACE = 'root/cimv2'
+
+    _setting_data_templates = None
+
+    def _get_wmi_conn(self, namespace, host='.', privileges=None,
+                      connect=False):
+        return _conn_pool.get_connection(namespace, host=host,
+                                         privileges=privileges,
+                                         connect=connect)
+
+    def _iter_query(self, wql, conn=None):
+        """Yields the query results as they are received.
+
+        Unlike the connection's query method, this does not wait for the
+        whole result set to be retrieved.
+        """
+        conn = conn or self._conn
+        class_name = instrumentation.get_query_class(wql)
+        for ole_object in conn._raw_query(wql):
+            yield instrumentation.wrap(wmi._wmi_object(ole_object),
+                                       class_name)
+
+    def _query(self, class_name, properties=None, conditions=None,
+                where=None, conn=None):
+        """Runs a query built using build_query, returning a list."""
+        conn = conn or self._conn
+        return conn.query(build_query(class_name, properties, conditions,
+                                      where))
+
+    def _query_records(self, record_cls, class_name, where=None, conn=None,
+                       conditions=None):
+        """Retrieves WMIRecord objects using a projected query.
+
+        Only the properties declared by the record class are selected,
+        which must include the key properties so the object paths are
+        retrieved as well.
+        """
+        query = build_query(class_name, record_cls.get_properties(),
+                            conditions, where)
+        return [record_cls.from_wmi_object(wmi_object)
+                for wmi_object in self._iter_query(query, conn)]
+
+    def _get_default_setting_data(self, class_name, resource_sub_type=None):
+        """Returns a new copy of the default setting data instance.
+
+        The default instances are fetched only once, subsequent requests
+        being served by cloning the cached instance locally.
+        """
+        if self._setting_data_templates is None:
+            self._setting_data_templates = {}
+
+        key = (class_name, resource_sub_type)
+        template = self._setting_data_templates.get(key)
+        if template is None:
+            query = ("SELECT * FROM %s WHERE InstanceID LIKE '%%\\Default'"
+                     % class_name)
+            if resource_sub_type:
+                query += (" AND ResourceSubType = '%s'" %
+                          resource_sub_type)
+            template = self._conn.query(query)[0]
+            self._setting_data_templates[key] = template
+
+        return wmi._wmi_object(template.ole_object.Clone_())
@@ -23,6 +23,7 @@ from oslo_log import log as logging
 
 from os_win._i18n import _, _LE
 from os_win import exceptions
+from os_win.utils import baseutils
 from os_win.utils.compute import vmutils
 from os_win.utils import jobutils
 from os_win.utils.storage.initiator import iscsi_wmi_utils
@@ -30,7 +31,7 @@ from os_win.utils.storage.initiator import iscsi_wmi_utils
 LOG = logging.getLogger(__name__)
 
 
-class LiveMigrationUtils(object):
+class LiveMigrationUtils(baseutils.BaseUtils):
 
     def __init__(self):
         self._vmutils = vmutils.VMUtils()
@@ -39,13 +40,14 @@ class LiveMigrationUtils(object):
 
     def _get_conn_v2(self, host='localhost'):
         try:
-            return wmi.WMI(moniker='//%s/root/virtualization/v2' % host)
+            return self._get_wmi_conn(self._WMI_VIRT_NAMESPACE, host,
+                                      connect=True)
         except wmi.x_wmi as ex:
             LOG.exception(_LE('Get version 2 connection error'))
             if ex.com_error.hresult == -2147217394:
                 msg = (_('Live migration is not supported on target host "%s"')
                        % host)
-            elif ex.com_error.hresult == -2147023174:
+            elif ex.com_error.hresult == baseutils.RPC_S_SERVER_UNAVAILABLE:
                 msg = (_('Target live migration host "%s" is unreachable')
                        % host)
             else:
@@ -131,20 +133,23 @@ class LiveMigrationUtils(object):
         remote_iscsi_initiator = iscsi_wmi_utils.ISCSIInitiatorWMIUtils(
             dest_host)
 
-        disk_paths_remote = {}
+        dev_nums = {}
         for (rasd_rel_path, disk_path) in disk_paths.items():
             target = self._iscsi_initiator.get_target_from_disk_path(disk_path)
             if target:
                 (target_iqn, target_lun) = target
                 dev_num = remote_iscsi_initiator.get_device_number_for_target(
                     target_iqn, target_lun)
-                disk_path_remote = (
-                    vmutils_remote.get_mounted_disk_by_drive_number(dev_num))
-                disk_paths_remote[rasd_rel_path] = disk_path_remote
+                dev_nums[rasd_rel_path] = dev_num
             else:
                 LOG.debug("Could not retrieve iSCSI target "
                           "from disk path: %s", disk_path)
-        return disk_paths_remote
+
+        # The remote disks are retrieved using a single query.
+        remote_disks = vmutils_remote.get_mounted_disks_by_drive_numbers(
+            list(set(dev_nums.values())))
+        return dict((rasd_rel_path, remote_disks.get(dev_num))
+                    for rasd_rel_path, dev_num in dev_nums.items())
 
     def _get_disk_data(self, vm_name, vmutils_remote, disk_path_mapping):
         disk_paths = {}
@@ -13,16 +13,12 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import sys
+from os_win.utils import baseutils
 
-if sys.platform == 'win32':
-    import wmi
 
-
-class RDPConsoleUtils(object):
+class RDPConsoleUtils(baseutils.BaseUtils):
     def __init__(self):
-        if sys.platform == 'win32':
-            self._conn = wmi.WMI(moniker='//./root/virtualization/v2')
+        self._conn = self._get_wmi_conn(self._WMI_VIRT_NAMESPACE)
 
     def get_rdp_console_port(self):
         rdp_setting_data = self._conn.Msvm_TerminalServiceSettingData()[0]
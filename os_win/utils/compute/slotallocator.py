@@ -0,0 +1,166 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Allocation of disk controller slots, preventing concurrent attach
+operations from using the same slot.
+"""
+
+import threading
+import time
+
+from os_win._i18n import _
+from os_win import exceptions
+
+
+class ControllerSlotAllocator(object):
+    """Hands out controller slots, tracking them using per controller bitmaps.
+
+    The slots used by a controller are retrieved once, the first time slots
+    of that controller are requested. Reserved slots are considered taken
+    until they are either committed, once the disks are attached, or
+    released, if attaching the disks failed. Reservations which are neither
+    committed nor released expire after _RESERVATION_TIMEOUT seconds.
+
+    The used slots are retrieved again if a request cannot be satisfied,
+    as disks may have been detached by other means in the meantime, as well
+    as after failed attach operations and unexpected slot changes reported
+    through update_slot.
+    """
+
+    _RESERVATION_TIMEOUT = 300
+
+    def __init__(self, slots_count):
+        self._slots_count = slots_count
+        self._lock = threading.Lock()
+        # Maps controller paths to bitmaps of the used slots.
+        self._used_slots = {}
+        # Maps controller paths to dicts, mapping the reserved slots to the
+        # time at which the reservation expires.
+        self._reservations = {}
+
+    @staticmethod
+    def _get_key(controller_path):
+        return controller_path.lower()
+
+    def _get_reserved_slots_bitmap(self, key):
+        now = time.time()
+        reservations = self._reservations.get(key, {})
+        bitmap = 0
+        for slot, expires in list(reservations.items()):
+            if expires < now:
+                del reservations[slot]
+            else:
+                bitmap |= 1 << slot
+        return bitmap
+
+    def _get_free_slots(self, key, count):
+        taken = self._used_slots[key] | self._get_reserved_slots_bitmap(key)
+        free_slots = [slot for slot in range(self._slots_count)
+                      if not taken & (1 << slot)]
+        if len(free_slots) < count:
+            return None
+        return free_slots[:count]
+
+    def _load_used_slots(self, key, get_used_slots):
+        bitmap = 0
+        for slot in get_used_slots():
+            bitmap |= 1 << slot
+        self._used_slots[key] = bitmap
+
+    def reserve_slots(self, controller_path, count, get_used_slots):
+        """Reserves the requested number of free slots.
+
+        :param get_used_slots: callable returning the slots currently used
+                               by the controller.
+        :returns: the reserved slots, in ascending order.
+        :raises exceptions.HyperVException: if not enough slots are free.
+        """
+        key = self._get_key(controller_path)
+        with self._lock:
+            slots = None
+            if key in self._used_slots:
+                slots = self._get_free_slots(key, count)
+            if slots is None:
+                self._load_used_slots(key, get_used_slots)
+                slots = self._get_free_slots(key, count)
+            if slots is None:
+                raise exceptions.HyperVException(
+                    _("Exceeded the maximum number of slots"))
+
+            reservations = self._reservations.setdefault(key, {})
+            expires = time.time() + self._RESERVATION_TIMEOUT
+            for slot in slots:
+                reservations[slot] = expires
+            return slots
+
+    def commit_slots(self, controller_path, slots):
+        """Marks reserved slots as used, after attaching disks to them."""
+        key = self._get_key(controller_path)
+        with self._lock:
+            reservations = self._reservations.get(key, {})
+            for slot in slots:
+                reservations.pop(slot, None)
+                if key in self._used_slots:
+                    self._used_slots[key] |= 1 << slot
+
+    def release_reservations(self, controller_path, slots):
+        """Drops the reservations of slots which were not used.
+
+        Unlike release_slots, this leaves the known used slots untouched,
+        as the slots may have been taken by other means in the meantime.
+        """
+        key = self._get_key(controller_path)
+        with self._lock:
+            reservations = self._reservations.get(key, {})
+            for slot in slots:
+                reservations.pop(slot, None)
+
+    def release_slots(self, controller_path, slots):
+        """Frees reserved slots or slots used by detached disks."""
+        key = self._get_key(controller_path)
+        with self._lock:
+            reservations = self._reservations.get(key, {})
+            for slot in slots:
+                reservations.pop(slot, None)
+                if key in self._used_slots:
+                    self._used_slots[key] &= ~(1 << slot)
+
+    def update_slot(self, controller_path, slot, used):
+        """Checks a slot change, e.g. reported by a WMI event.
+
+        The used slots of the controller are retrieved again if the change
+        does not match the known state, as it was not performed through
+        this allocator or the event is outdated.
+        """
+        key = self._get_key(controller_path)
+        with self._lock:
+            used_slots = self._used_slots.get(key)
+            if used_slots is None:
+                return
+            if bool(used_slots & (1 << slot)) != used:
+                del self._used_slots[key]
+
+    def resync(self, controller_path=None):
+        """Drops the known used slots, retrieving them again when needed.
+
+        Reservations are preserved. If no controller is specified, this
+        applies to all the controllers.
+        """
+        with self._lock:
+            if controller_path:
+                self._used_slots.pop(self._get_key(controller_path), None)
+            else:
+                self._used_slots.clear()
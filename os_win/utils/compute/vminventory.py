@@ -0,0 +1,345 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-memory index of the VMs residing on a Hyper-V host.
+"""
+
+import collections
+import threading
+
+from eventlet import patcher
+from oslo_log import log as logging
+from oslo_utils import uuidutils
+
+from os_win import constants
+from os_win.utils import baseutils
+
+native_threading = patcher.original('threading')
+
+LOG = logging.getLogger(__name__)
+
+# Maps hosts to the VM inventories shared by all the VMUtils instances.
+_vm_inventories = {}
+_vm_inventories_lock = native_threading.Lock()
+
+# Queued when events may have been missed, the inventory having to be loaded
+# again.
+_RESET = object()
+
+
+def get_vm_inventory(host='.'):
+    """Returns the VM inventory of the given host, starting it if needed."""
+    with _vm_inventories_lock:
+        inventory = _vm_inventories.get(host)
+        if not inventory:
+            inventory = VMInventory(host)
+            inventory.start()
+            _vm_inventories[host] = inventory
+    return inventory
+
+
+class _VMEvent(baseutils.WMIRecord):
+    """VM event details, passed by the event thread to the inventory users."""
+
+    __slots__ = ('event_type', 'event_class', 'Name', 'ElementName',
+                 'EnabledState', 'VirtualSystemIdentifier',
+                 'VirtualSystemSubType', 'Notes')
+
+
+class VMInventory(baseutils.BaseUtils):
+    """Maps VM names to VM objects and VM details.
+
+    The inventory is loaded using two queries, the first time it is used.
+    A native thread keeps it up to date by subscribing to the VM
+    modification and deletion events. New VMs are added when looked up for
+    the first time, so lookups missing the inventory must be followed by a
+    query, passing the result to add_vm.
+
+    The events are queued by the native thread and applied by the inventory
+    users, which may be greenthreads, so that the inventory lock is never
+    taken by the native thread. Renamed VMs are retrieved again by their
+    WMI path, as the cached objects have a stale ElementName.
+
+    Events are received with a delay of up to _EVENT_POLL_INTERVAL seconds.
+    The inventory is not used at all while the event subscription is not
+    available, being loaded again once the subscription is set up again.
+    """
+
+    _COMPUTER_SYSTEM_CLASS = 'Msvm_ComputerSystem'
+    _VIRTUAL_SYSTEM_SETTING_DATA_CLASS = 'Msvm_VirtualSystemSettingData'
+    _VIRTUAL_SYSTEM_TYPE_REALIZED = 'Microsoft:Hyper-V:System:Realized'
+    _VIRTUAL_SYSTEM_SUBTYPE = 'VirtualSystemSubType'
+
+    _VM_EVENT_QUERY = ("SELECT * FROM __InstanceOperationEvent "
+                       "WITHIN %(interval)s "
+                       "WHERE TargetInstance ISA '%(cs_class)s' "
+                       "OR TargetInstance ISA '%(vssd_class)s'")
+    _EVENT_POLL_INTERVAL = 1
+    _EVENT_TIMEOUT_MS = 2000
+    # Past this, the queued events are dropped and the inventory is loaded
+    # again when used.
+    _MAX_PENDING_EVENTS = 1000
+
+    def __init__(self, host='.'):
+        self._host = host
+        self._conn = self._get_wmi_conn(self._WMI_VIRT_NAMESPACE, host)
+        self._loaded = False
+        # Green when eventlet monkey patching is used. Only taken by the
+        # inventory users.
+        self._lock = threading.RLock()
+        # Events queued by the event thread. Deque appends and pops are
+        # thread safe.
+        self._pending_events = collections.deque()
+        # Maps the VM names to dicts describing the VMs.
+        self._vms = {}
+        # Reverse indexes, mapping VM ids (GUIDs) and instance uuids to
+        # VM names.
+        self._vm_ids = {}
+        self._instance_uuids = {}
+        # VMs sharing a name are not indexed.
+        self._duplicate_names = set()
+
+        query = self._VM_EVENT_QUERY % {
+            'interval': self._EVENT_POLL_INTERVAL,
+            'cs_class': self._COMPUTER_SYSTEM_CLASS,
+            'vssd_class': self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS}
+        self._event_watcher = baseutils.WMIEventWatcher(
+            query, self._process_event, host=host,
+            namespace=self._WMI_VIRT_NAMESPACE,
+            event_timeout_ms=self._EVENT_TIMEOUT_MS,
+            state_callback=self._on_state_change,
+            description='WMI VM')
+
+    @property
+    def available(self):
+        return self._event_watcher.available
+
+    def start(self):
+        self._event_watcher.start()
+
+    def stop(self):
+        self._event_watcher.stop()
+
+    def _on_state_change(self, available):
+        # Events may have been missed while the subscription was not
+        # available, so the inventory is loaded again.
+        self._queue_event(_RESET)
+
+    def _queue_event(self, event):
+        if len(self._pending_events) >= self._MAX_PENDING_EVENTS:
+            self._pending_events.clear()
+            self._pending_events.append(_RESET)
+        self._pending_events.append(event)
+
+    def _process_event(self, event):
+        # Called by the event thread. The event properties are copied, as
+        # the WMI objects may not be used by other threads.
+        if not event:
+            return
+        event_class = event.path().Class
+        if event_class == self._COMPUTER_SYSTEM_CLASS:
+            self._queue_event(_VMEvent(
+                event_type=event.event_type, event_class=event_class,
+                Name=event.Name, ElementName=event.ElementName,
+                EnabledState=event.EnabledState))
+        elif (event.event_type == 'modification' and
+                event.VirtualSystemType ==
+                self._VIRTUAL_SYSTEM_TYPE_REALIZED):
+            self._queue_event(_VMEvent(
+                event_type=event.event_type, event_class=event_class,
+                VirtualSystemIdentifier=event.VirtualSystemIdentifier,
+                VirtualSystemSubType=getattr(
+                    event, self._VIRTUAL_SYSTEM_SUBTYPE, None),
+                Notes=event.Notes))
+
+    def _apply_pending_events(self):
+        while True:
+            try:
+                event = self._pending_events.popleft()
+            except IndexError:
+                return
+
+            if event is _RESET:
+                self._reset()
+            else:
+                self._apply_event(event)
+
+    def _apply_event(self, event):
+        if event.event_class == self._COMPUTER_SYSTEM_CLASS:
+            vm_name = self._vm_ids.get(event.Name.upper())
+            if not vm_name:
+                return
+            if event.event_type == 'deletion':
+                self._remove_vm(vm_name)
+            elif event.event_type == 'modification':
+                if event.ElementName != vm_name:
+                    # The VM was renamed.
+                    self._rename_vm(vm_name, event.ElementName)
+                vm_info = self._vms.get(event.ElementName)
+                if vm_info:
+                    vm_info['state'] = event.EnabledState
+        else:
+            vm_name = self._vm_ids.get(event.VirtualSystemIdentifier.upper())
+            if vm_name:
+                self._update_vm_settings(vm_name, event)
+
+    def _reset(self):
+        with self._lock:
+            self._loaded = False
+            self._vms.clear()
+            self._vm_ids.clear()
+            self._instance_uuids.clear()
+            self._duplicate_names.clear()
+
+    def _ensure_loaded(self):
+        with self._lock:
+            self._apply_pending_events()
+            if self._loaded:
+                return
+
+            vms = self._conn.Msvm_ComputerSystem(
+                Caption=constants.VM_CAPTION)
+            vmsettings = dict(
+                (vssd.VirtualSystemIdentifier.upper(), vssd)
+                for vssd in self._conn.Msvm_VirtualSystemSettingData(
+                    VirtualSystemType=self._VIRTUAL_SYSTEM_TYPE_REALIZED))
+            for vm in vms:
+                vssd = vmsettings.get(vm.Name.upper())
+                if vssd:
+                    self._add_vm(vm, vssd)
+            self._loaded = True
+
+    def _add_vm(self, vm, vssd):
+        vm_name = vm.ElementName
+        if vm_name in self._duplicate_names:
+            return
+        if vm_name in self._vms:
+            self._remove_vm(vm_name)
+            self._duplicate_names.add(vm_name)
+            return
+
+        self._vms[vm_name] = {'vm': vm,
+                              'path': vm.path_(),
+                              'id': vm.Name,
+                              'state': vm.EnabledState}
+        self._vm_ids[vm.Name.upper()] = vm_name
+        self._update_vm_settings(vm_name, vssd)
+
+    def _update_vm_settings(self, vm_name, vssd):
+        vm_info = self._vms[vm_name]
+        self._instance_uuids.pop(vm_info.get('instance_uuid'), None)
+
+        notes = [note for note in (vssd.Notes or []) if note]
+        instance_uuid = None
+        if notes and uuidutils.is_uuid_like(notes[0]):
+            instance_uuid = notes[0]
+            self._instance_uuids[instance_uuid] = vm_name
+
+        generation = constants.VM_GEN_1
+        if getattr(vssd, self._VIRTUAL_SYSTEM_SUBTYPE, None):
+            # expected format: 'Microsoft:Hyper-V:SubType:2'
+            generation = int(vssd.VirtualSystemSubType.split(':')[-1])
+
+        vm_info.update(notes=notes,
+                       instance_uuid=instance_uuid,
+                       generation=generation)
+
+    def _remove_vm(self, vm_name):
+        vm_info = self._vms.pop(vm_name, None)
+        if vm_info:
+            self._vm_ids.pop(vm_info['id'].upper(), None)
+            self._instance_uuids.pop(vm_info['instance_uuid'], None)
+
+    def _rename_vm(self, old_name, new_name):
+        vm_info = self._vms[old_name]
+        self._remove_vm(old_name)
+        if new_name in self._vms or new_name in self._duplicate_names:
+            self._remove_vm(new_name)
+            self._duplicate_names.add(new_name)
+            return
+
+        # The cached object has a stale ElementName, being retrieved again
+        # when requested.
+        vm_info['vm'] = None
+        self._vms[new_name] = vm_info
+        self._vm_ids[vm_info['id'].upper()] = new_name
+        if vm_info['instance_uuid']:
+            self._instance_uuids[vm_info['instance_uuid']] = new_name
+
+    def get_vm(self, vm_name):
+        """Returns the VM object, or None if the VM is not indexed."""
+        if not self.available:
+            return None
+        with self._lock:
+            self._ensure_loaded()
+            vm_info = self._vms.get(vm_name)
+            if not vm_info:
+                return None
+            vm = vm_info['vm']
+
+        if vm is None:
+            vm = baseutils.get_wmi_object(vm_info['path'])
+            with self._lock:
+                if self._vms.get(vm_name) is vm_info:
+                    vm_info['vm'] = vm
+        return vm
+
+    def get_vm_info(self, vm_name):
+        """Returns a dict describing the VM, or None if it's not indexed.
+
+        The dict contains the following keys: path, id, state (the last
+        known EnabledState), notes, instance_uuid and generation.
+        """
+        if not self.available:
+            return None
+        with self._lock:
+            self._ensure_loaded()
+            vm_info = self._vms.get(vm_name)
+            if vm_info:
+                vm_info = vm_info.copy()
+                vm_info.pop('vm')
+        return vm_info
+
+    def get_vm_name(self, instance_uuid):
+        """Returns the name of the VM having the given instance uuid."""
+        if not self.available:
+            return None
+        with self._lock:
+            self._ensure_loaded()
+            return self._instance_uuids.get(instance_uuid)
+
+    def add_vm(self, vm):
+        """Indexes a VM which could not be found in the inventory."""
+        if not self.available:
+            return
+        vmsettings = vm.associators(
+            wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)
+        vssd = [s for s in vmsettings if
+                s.VirtualSystemType == self._VIRTUAL_SYSTEM_TYPE_REALIZED][0]
+        with self._lock:
+            self._ensure_loaded()
+            if vm.ElementName not in self._vms:
+                self._add_vm(vm, vssd)
+
+    def remove_vm(self, vm_name):
+        """Drops the VM from the inventory.
+
+        Used when a VM is known to have been changed or destroyed, without
+        waiting for the according events.
+        """
+        with self._lock:
+            self._apply_pending_events()
+            self._remove_vm(vm_name)
@@ -0,0 +1,237 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Shared VM power state change listener.
+"""
+
+import time
+import uuid
+
+from eventlet import patcher
+from oslo_log import log as logging
+
+from os_win._i18n import _LE
+from os_win import constants
+from os_win.utils import baseutils
+
+native_threading = patcher.original('threading')
+
+LOG = logging.getLogger(__name__)
+
+# Maps hosts to the power state listeners shared by all the VMUtils
+# instances.
+_listeners = {}
+_listeners_lock = native_threading.Lock()
+
+
+def get_power_state_listener(vmutils, host='.'):
+    """Returns the power state listener of the given host, starting it."""
+    with _listeners_lock:
+        listener = _listeners.get(host)
+        if not listener:
+            listener = VMPowerStateListener(vmutils, host)
+            listener.start()
+            _listeners[host] = listener
+    return listener
+
+
+class VMPowerStateListener(baseutils.BaseUtils):
+    """Tracks the VM power states, notifying subscribers about changes.
+
+    The same WMI event subscriptions are used regardless of the number of
+    subscribers: one for the VM state changes and one for the created and
+    deleted VMs. The subscriptions are set up before loading the VM states
+    using one query, so that no change can be missed. The states are
+    loaded again if the subscriptions were lost in the meantime.
+
+    State changes are held for _COALESCE_INTERVAL seconds, only the latest
+    state being published. Transitions that end up in the previously
+    published state are not published at all, so a flapping VM does not
+    flood the subscribers. Created VMs are tracked without being
+    published, as they did not change state.
+
+    Subscribers are called using a single (vm_name, power_state) tuple
+    as argument, the power state being one of the
+    constants.HYPERV_VM_STATE_* values, so a queue's put method may be
+    used as subscriber. The events are received by native threads, the
+    notifications being handed over to a notification dispatcher.
+    """
+
+    _COMPUTER_SYSTEM_CLASS = 'Msvm_ComputerSystem'
+
+    _EVENT_QUERY = ("SELECT * FROM __InstanceModificationEvent "
+                    "WITHIN %(interval)s "
+                    "WHERE TargetInstance ISA '%(class)s' "
+                    "AND TargetInstance.Caption = '%(caption)s' "
+                    "AND TargetInstance.EnabledState != "
+                    "PreviousInstance.EnabledState")
+    _LIFECYCLE_EVENT_QUERY = ("SELECT * FROM __InstanceOperationEvent "
+                              "WITHIN %(interval)s "
+                              "WHERE (__CLASS = '__InstanceCreationEvent' "
+                              "OR __CLASS = '__InstanceDeletionEvent') "
+                              "AND TargetInstance ISA '%(class)s' "
+                              "AND TargetInstance.Caption = '%(caption)s'")
+    _EVENT_POLL_INTERVAL = 2
+    _EVENT_TIMEOUT_MS = 500
+    _COALESCE_INTERVAL = 1
+
+    def __init__(self, vmutils, host='.'):
+        self._vmutils = vmutils
+        self._host = host
+        self._conn = self._get_wmi_conn(self._WMI_VIRT_NAMESPACE, host)
+        self._lock = native_threading.Lock()
+        # Maps the VM names to the last published power state.
+        self._states = {}
+        # Set when events may have been missed, the states being loaded
+        # again when requested.
+        self._reload_needed = False
+        # Maps the VM names to (enabled_state, first_event_time) tuples,
+        # for state changes which were not published yet.
+        self._pending_changes = {}
+        # Maps subscription ids to the subscribed callables.
+        self._subscribers = {}
+        self._dispatcher = baseutils.NotificationDispatcher(
+            'VM power state')
+
+        query_args = {'interval': self._EVENT_POLL_INTERVAL,
+                      'class': self._COMPUTER_SYSTEM_CLASS,
+                      'caption': constants.VM_CAPTION}
+        self._event_watchers = [
+            baseutils.WMIEventWatcher(
+                query, callback, host=host,
+                namespace=self._WMI_VIRT_NAMESPACE,
+                fields=['ElementName', 'EnabledState'],
+                event_timeout_ms=self._EVENT_TIMEOUT_MS,
+                state_callback=self._on_state_change,
+                description='WMI VM power state')
+            for query, callback in (
+                (self._EVENT_QUERY % query_args, self._process_event),
+                (self._LIFECYCLE_EVENT_QUERY % query_args,
+                 self._process_lifecycle_event))]
+
+    @property
+    def available(self):
+        return all(watcher.available for watcher in self._event_watchers)
+
+    def start(self):
+        self._dispatcher.start()
+        for watcher in self._event_watchers:
+            watcher.start()
+        self._load_states()
+
+    def stop(self):
+        for watcher in self._event_watchers:
+            watcher.stop()
+        self._dispatcher.stop()
+
+    def _load_states(self):
+        self._reload_needed = False
+        vms = self._conn.Msvm_ComputerSystem(
+            ['ElementName', 'EnabledState'],
+            Caption=constants.VM_CAPTION)
+        with self._lock:
+            self._states = dict(
+                (vm.ElementName,
+                 self._vmutils.get_vm_power_state(vm.EnabledState))
+                for vm in vms)
+
+    def _on_state_change(self, available):
+        if available:
+            self._reload_needed = True
+
+    def _process_event(self, event):
+        if event:
+            self._add_pending_change(event.ElementName, event.EnabledState)
+        self._publish_pending_changes()
+
+    def _process_lifecycle_event(self, event):
+        if not event:
+            return
+
+        with self._lock:
+            self._pending_changes.pop(event.ElementName, None)
+            if event.event_type == 'deletion':
+                self._states.pop(event.ElementName, None)
+            else:
+                self._states[event.ElementName] = (
+                    self._vmutils.get_vm_power_state(event.EnabledState))
+
+    def _add_pending_change(self, vm_name, enabled_state):
+        with self._lock:
+            first_event_time = self._pending_changes.get(
+                vm_name, (None, time.time()))[1]
+            self._pending_changes[vm_name] = (enabled_state,
+                                              first_event_time)
+
+    def _publish_pending_changes(self):
+        now = time.time()
+        notifications = []
+        with self._lock:
+            for vm_name, (enabled_state, first_event_time) in list(
+                    self._pending_changes.items()):
+                if now - first_event_time < self._COALESCE_INTERVAL:
+                    continue
+
+                del self._pending_changes[vm_name]
+                power_state = self._vmutils.get_vm_power_state(enabled_state)
+                if self._states.get(vm_name) == power_state:
+                    continue
+                self._states[vm_name] = power_state
+                notifications.append((vm_name, power_state))
+
+        for vm_name, power_state in notifications:
+            self._dispatcher.dispatch(self._notify_subscribers,
+                                      vm_name, power_state)
+
+    def _notify_subscribers(self, vm_name, power_state):
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+
+        for subscriber in subscribers:
+            try:
+                subscriber((vm_name, power_state))
+            except Exception:
+                LOG.exception(_LE("VM power state subscriber %s failed."),
+                              subscriber)
+
+    def subscribe(self, subscriber):
+        """Registers a callable receiving (vm_name, power_state) tuples.
+
+        :returns: the subscription id, which may be used to unsubscribe.
+        """
+        subscription_id = uuid.uuid4().hex
+        with self._lock:
+            self._subscribers[subscription_id] = subscriber
+        return subscription_id
+
+    def unsubscribe(self, subscription_id):
+        with self._lock:
+            self._subscribers.pop(subscription_id, None)
+
+    def _reload_states_if_needed(self):
+        if self._reload_needed:
+            self._load_states()
+
+    def get_vm_power_state(self, vm_name):
+        """Returns the last known power state of the VM, or None."""
+        self._reload_states_if_needed()
+        return self._states.get(vm_name)
+
+    def get_vm_power_states(self):
+        """Returns a dict mapping the VM names to the last known states."""
+        self._reload_states_if_needed()
+        with self._lock:
+            return dict(self._states)
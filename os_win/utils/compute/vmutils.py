@@ -20,15 +20,17 @@ Based on the "root/virtualization/v2" namespace available starting with
 Hyper-V Server / Windows Server 2012.
 """
 
+import collections
+import contextlib
+import functools
 import re
-import sys
+import threading
+import time
 import uuid
 
-if sys.platform == 'win32':
-    import wmi
-
 from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_utils import excutils
 from oslo_utils import uuidutils
 import six
 from six.moves import range  # noqa
@@ -36,14 +38,85 @@ from six.moves import range  # noqa
 from os_win._i18n import _, _LW
 from os_win import constants
 from os_win import exceptions
+from os_win.utils import baseutils
+from os_win.utils.compute import slotallocator
+from os_win.utils.compute import vminventory
+from os_win.utils.compute import vmpowerstate
 from os_win.utils import jobutils
 from os_win.utils import pathutils
+from os_win.utils import vmlocks
 
 CONF = cfg.CONF
 LOG = logging.getLogger(__name__)
 
+# Maps hosts to the drive and disk image event watchers, keeping the shared
+# slot allocator and disk resource indexes in sync.
+_drive_event_watchers = {}
+_drive_event_watchers_lock = threading.Lock()
+# Maps hosts to the disk resource indexes shared by the VMUtils instances,
+# see VMUtils._get_mounted_disk_resources_from_paths.
+_disk_resource_indexes = collections.defaultdict(dict)
+# Maps hosts to counters, incremented when the disk resource indexes are
+# changed or invalidated.
+_disk_index_generations = collections.defaultdict(collections.Counter)
+
+
+class DiskResourceRecord(baseutils.WMIRecord):
+    """Detached disk resource, see baseutils.WMIRecord."""
+
+    __slots__ = ('InstanceID', 'ElementName', 'ResourceSubType',
+                 'HostResource', 'Parent', 'Address', 'AddressOnParent')
+
+
+class VMHandle(object):
+    """A resolved VM, which may be passed to VMUtils instead of the VM name.
+
+    Attribute access is forwarded to the underlying Msvm_ComputerSystem
+    object. The realized VM settings and the VM resources are retrieved
+    once, when first needed. VMUtils refreshes them when adding or removing
+    resources through the handle. Changes made by other means require
+    calling invalidate.
+    """
+
+    def __init__(self, vm, vmutils):
+        self._vm = vm
+        self._vmutils = vmutils
+        self._vmsettings = None
+        # Maps resource classes to the VM resources of that class.
+        self._resources = {}
+
+    def __getattr__(self, name):
+        return getattr(self._vm, name)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def vm(self):
+        return self._vm
+
+    @property
+    def name(self):
+        return self._vm.ElementName
+
+    @property
+    def vmsettings(self):
+        if self._vmsettings is None:
+            self._vmsettings = self._vmutils._get_vm_setting_data(self._vm)
+        return self._vmsettings
+
+    def get_resources(self, resource_class):
+        if resource_class not in self._resources:
+            self._resources[resource_class] = self.vmsettings.associators(
+                wmi_result_class=resource_class)
+        return self._resources[resource_class]
+
+    def invalidate(self):
+        self._vmsettings = None
+        self._resources = {}
+
 
-class VMUtils(object):
+class VMUtils(baseutils.BaseUtils):
 
     # These constants can be overridden by inherited classes
     _PHYS_DISK_RES_SUB_TYPE = 'Microsoft:Hyper-V:Physical Disk Drive'
@@ -70,6 +143,24 @@ class VMUtils(object):
 
     _VIRTUAL_SYSTEM_SUBTYPE = 'VirtualSystemSubType'
     _VIRTUAL_SYSTEM_TYPE_REALIZED = 'Microsoft:Hyper-V:System:Realized'
+    # Used to tell the VMs apart from the hosting computer system.
+
+    # Shared by all the instances, as the controller paths are unique.
+    _scsi_slot_allocator = slotallocator.ControllerSlotAllocator(
+        constants.SCSI_CONTROLLER_SLOTS_NUMBER)
+    # Used by enable_drive_events.
+    _DRIVE_EVENT_QUERY = ("SELECT * FROM __InstanceOperationEvent "
+                          "WITHIN %(interval)s "
+                          "WHERE (__CLASS = '__InstanceCreationEvent' "
+                          "OR __CLASS = '__InstanceDeletionEvent') "
+                          "AND TargetInstance ISA '%(class)s' "
+                          "AND (%(sub_type_conditions)s)")
+    # Disk image modifications are included, as the images may be replaced.
+    _DISK_IMAGE_EVENT_QUERY = ("SELECT * FROM __InstanceOperationEvent "
+                               "WITHIN %(interval)s "
+                               "WHERE TargetInstance ISA '%(class)s' "
+                               "AND (%(sub_type_conditions)s)")
+    _DRIVE_EVENT_POLL_INTERVAL = 2
     _VIRTUAL_SYSTEM_SUBTYPE_GEN2 = 'Microsoft:Hyper-V:SubType:2'
 
     _SNAPSHOT_FULL = 2
@@ -80,6 +171,19 @@ class VMUtils(object):
     _VM_ENABLED_STATE_PROP = "EnabledState"
 
     _SHUTDOWN_COMPONENT = "Msvm_ShutdownComponent"
+    _DISK_DRIVE_CLASS = 'Msvm_DiskDrive'
+
+    # Properties selected by projected queries. The key properties have to
+    # be selected in order to get the object paths.
+    _LOGICAL_DEVICE_KEY_PROPS = ['CreationClassName', 'DeviceID',
+                                 'SystemCreationClassName', 'SystemName']
+    _COMPUTER_SYSTEM_KEY_PROPS = ['CreationClassName', 'Name']
+    _DRIVE_RESOURCE_PROPS = ['InstanceID', 'Parent', 'AddressOnParent']
+    _SOFT_SHUTDOWN_REASON = 'Soft shutdown requested by OpenStack Nova.'
+    _SOFT_SHUTDOWN_POLL_INTERVAL = 2
+    # Invalid state for current operation (32775) typically means that
+    # the VM is already in the state requested.
+    _VM_STATE_CHANGE_SUCCESS_VALUES = [0, 32775]
     _VIRTUAL_SYSTEM_CURRENT_SETTINGS = 3
     _AUTOMATIC_STARTUP_ACTION_NONE = 2
 
@@ -91,19 +195,50 @@ class VMUtils(object):
                             constants.HYPERV_VM_STATE_SUSPENDED: 6}
 
     def __init__(self, host='.'):
+        self._host = host
         self._vs_man_svc_attr = None
-        self._jobutils = jobutils.JobUtils()
+        self._vm_inventory = None
+        # Maps is_physical to dicts, mapping lower case disk paths to the
+        # disk resources using them.
+        self._disk_resource_indexes = _disk_resource_indexes[host]
+        self._disk_index_generations = _disk_index_generations[host]
+        self._jobutils = jobutils.JobUtils(host)
         self._pathutils = pathutils.PathUtils()
+        self._vm_locks = vmlocks.get_lock_manager()
         self._enabled_states_map = {v: k for k, v in
                                     six.iteritems(self._vm_power_states_map)}
-        if sys.platform == 'win32':
-            self._init_hyperv_wmi_conn(host)
+        self._init_hyperv_wmi_conn(host)
 
         # Physical device names look like \\.\PHYSICALDRIVE1
         self._phys_dev_name_regex = re.compile(r'\\\\.*\\[\w]*([\d])')
 
     def _init_hyperv_wmi_conn(self, host):
-        self._conn = wmi.WMI(moniker='//%s/root/virtualization/v2' % host)
+        self._conn = self._get_wmi_conn(self._WMI_VIRT_NAMESPACE, host)
+
+    def enable_vm_inventory(self):
+        """Use the shared in-memory VM index when looking up VMs.
+
+        This avoids querying WMI each time a VM is looked up by name. The
+        index is kept up to date using WMI events.
+        """
+        self._vm_inventory = vminventory.get_vm_inventory(self._host)
+
+    def enable_drive_events(self):
+        """Track the drives and disk images of this host using WMI events.
+
+        Drives and disk images added or removed by other means are reported
+        by the events, keeping the shared slot allocator and disk resource
+        indexes in sync, so that disk lookups may be served by the indexes
+        alone.
+        """
+        self._start_drive_event_watchers()
+
+    def _get_vm_inventory_info(self, vm_name):
+        if not self._vm_inventory:
+            return None
+        # Ensures that the VM is indexed.
+        self._lookup_vm_check(vm_name)
+        return self._vm_inventory.get_vm_info(self._get_vm_name(vm_name))
 
     @property
     def _vs_man_svc(self):
@@ -113,23 +248,30 @@ class VMUtils(object):
         return self._vs_man_svc_attr
 
     def list_instance_notes(self):
-        instance_notes = []
-
-        for vs in self._conn.Msvm_VirtualSystemSettingData(
-                ['ElementName', 'Notes'],
-                VirtualSystemType=self._VIRTUAL_SYSTEM_TYPE_REALIZED):
+        return list(self.iter_instance_notes())
+
+    def iter_instance_notes(self):
+        """Yields (vm_name, notes) tuples as they are retrieved."""
+        query = ("SELECT ElementName, Notes FROM %(class_name)s "
+                 "WHERE VirtualSystemType = '%(vs_type)s'" %
+                 {'class_name': self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS,
+                  'vs_type': self._VIRTUAL_SYSTEM_TYPE_REALIZED})
+        for vs in self._iter_query(query):
             if vs.Notes is not None:
-                instance_notes.append(
-                    (vs.ElementName, [v for v in vs.Notes if v]))
-
-        return instance_notes
+                yield (vs.ElementName, [v for v in vs.Notes if v])
 
     def list_instances(self):
         """Return the names of all the instances known to Hyper-V."""
-        return [v.ElementName for v in
-                self._conn.Msvm_VirtualSystemSettingData(
-                    ['ElementName'],
-                    VirtualSystemType=self._VIRTUAL_SYSTEM_TYPE_REALIZED)]
+        return list(self.iter_instances())
+
+    def iter_instances(self):
+        """Yields the names of the instances as they are retrieved."""
+        query = ("SELECT ElementName FROM %(class_name)s "
+                 "WHERE VirtualSystemType = '%(vs_type)s'" %
+                 {'class_name': self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS,
+                  'vs_type': self._VIRTUAL_SYSTEM_TYPE_REALIZED})
+        for vs in self._iter_query(query):
+            yield vs.ElementName
 
     def get_vm_summary_info(self, vm_name):
         vm = self._lookup_vm_check(vm_name)
@@ -149,7 +291,42 @@ class VMUtils(object):
             raise exceptions.HyperVException(
                 _('Cannot get VM summary data for: %s') % vm_name)
 
-        si = summary_info[0]
+        return self._get_summary_info_dict(summary_info[0])
+
+    def get_vms_summary_info(self, vm_names=None):
+        """Returns the summary info of multiple VMs, using a single call.
+
+        :param vm_names: names of the VMs to be queried. All the VMs are
+                         queried if None. Missing VMs are ignored.
+        :returns: dict mapping the VM names to their summary info, having
+                  the same format as the get_vm_summary_info result.
+        """
+        vmsettings = self._conn.Msvm_VirtualSystemSettingData(
+            ['ElementName', 'InstanceID'],
+            VirtualSystemType=self._VIRTUAL_SYSTEM_TYPE_REALIZED)
+        if vm_names is not None:
+            vm_names = set(vm_names)
+            vmsettings = [v for v in vmsettings if v.ElementName in vm_names]
+        if not vmsettings:
+            return {}
+
+        settings_paths = [v.path_() for v in vmsettings]
+        (ret_val, summary_info) = self._vs_man_svc.GetSummaryInformation(
+            [constants.VM_SUMMARY_ELEMENT_NAME,
+             constants.VM_SUMMARY_NUM_PROCS,
+             constants.VM_SUMMARY_ENABLED_STATE,
+             constants.VM_SUMMARY_MEMORY_USAGE,
+             constants.VM_SUMMARY_UPTIME],
+            settings_paths)
+        if ret_val:
+            raise exceptions.HyperVException(
+                _('Cannot get VM summary data for: %s') %
+                ', '.join(v.ElementName for v in vmsettings))
+
+        return dict((si.ElementName, self._get_summary_info_dict(si))
+                    for si in summary_info)
+
+    def _get_summary_info_dict(self, si):
         memory_usage = None
         if si.MemoryUsage is not None:
             memory_usage = int(si.MemoryUsage)
@@ -175,15 +352,67 @@ class VMUtils(object):
         settings = self.get_vm_summary_info(vm_name)
         return settings['EnabledState']
 
-    def _lookup_vm_check(self, vm_name):
+    def _lookup_vm_check(self, vm_name, properties=None):
 
-        vm = self._lookup_vm(vm_name)
+        vm = self._lookup_vm(vm_name, properties)
         if not vm:
             raise exceptions.HyperVVMNotFoundException(vm_name=vm_name)
         return vm
 
-    def _lookup_vm(self, vm_name):
-        vms = self._conn.Msvm_ComputerSystem(ElementName=vm_name)
+    @contextlib.contextmanager
+    def lock_vm(self, vm_name, shared=False):
+        """Serializes the operations targeting the given VM.
+
+        Operations on other VMs are not blocked. The lock is reentrant, so
+        the locked operations may be called within the context. Other VMs
+        may not be locked within the context, the locks of multiple VMs
+        being acquired at once through a single lock_objects call.
+
+        :param shared: allows other shared lock holders to access the VM
+                       concurrently, e.g. for read only operations.
+        :returns: the VM object.
+        """
+        vm = self._lookup_vm_check(vm_name)
+        with self._vm_locks.lock_objects([vm], shared):
+            yield vm
+
+    def get_vm_handle(self, vm_name):
+        """Returns a VMHandle, which may be used instead of the VM name.
+
+        Using it avoids looking up the VM and its resources on each call.
+        """
+        vm = self._lookup_vm_check(vm_name)
+        if isinstance(vm, VMHandle):
+            return vm
+        return VMHandle(vm, self)
+
+    @staticmethod
+    def _get_vm_name(vm_name):
+        if isinstance(vm_name, VMHandle):
+            return vm_name.name
+        return vm_name
+
+    def _invalidate_vm_handle(self, vm):
+        if isinstance(vm, VMHandle):
+            vm.invalidate()
+
+    def _lookup_vm(self, vm_name, properties=None):
+        """Returns the VM object, or None if the VM does not exist.
+
+        :param properties: the VM properties read by the caller. If
+                           specified, only those properties are retrieved,
+                           unless the VM is already available.
+        """
+        if isinstance(vm_name, VMHandle):
+            return vm_name
+
+        if self._vm_inventory:
+            vm = self._vm_inventory.get_vm(vm_name)
+            if vm:
+                return vm
+
+        vms = self._query(self._COMPUTER_SYSTEM_CLASS, properties,
+                          {'ElementName': vm_name})
         n = len(vms)
         if n == 0:
             return None
@@ -191,16 +420,22 @@ class VMUtils(object):
             raise exceptions.HyperVException(
                 _('Duplicate VM name found: %s') % vm_name)
         else:
+            # Partially retrieved VMs are not indexed.
+            if self._vm_inventory and not properties:
+                self._vm_inventory.add_vm(vms[0])
             return vms[0]
 
     def vm_exists(self, vm_name):
-        return self._lookup_vm(vm_name) is not None
+        return self._lookup_vm(vm_name, ['Name']) is not None
 
     def get_vm_id(self, vm_name):
-        vm = self._lookup_vm_check(vm_name)
+        vm = self._lookup_vm_check(vm_name, ['Name'])
         return vm.Name
 
     def _get_vm_setting_data(self, vm):
+        if isinstance(vm, VMHandle):
+            return vm.vmsettings
+
         vmsettings = vm.associators(
             wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)
         # Avoid snapshots
@@ -211,7 +446,14 @@ class VMUtils(object):
                        dynamic_memory_ratio):
         mem_settings = vmsetting.associators(
             wmi_result_class=self._MEMORY_SETTING_DATA_CLASS)[0]
+        self._configure_memory_settings(mem_settings, memory_mb,
+                                        memory_per_numa_node,
+                                        dynamic_memory_ratio)
+        self._jobutils.modify_virt_resource(mem_settings)
 
+    def _configure_memory_settings(self, mem_settings, memory_mb,
+                                   memory_per_numa_node,
+                                   dynamic_memory_ratio):
         max_mem = int(memory_mb)
         mem_settings.Limit = max_mem
 
@@ -233,12 +475,17 @@ class VMUtils(object):
             # One memory block is 1 MB.
             mem_settings.MaxMemoryBlocksPerNumaNode = memory_per_numa_node
 
-        self._jobutils.modify_virt_resource(mem_settings)
-
     def _set_vm_vcpus(self, vmsetting, vcpus_num, vcpus_per_numa_node,
                       limit_cpu_features):
         procsetting = vmsetting.associators(
             wmi_result_class=self._PROCESSOR_SETTING_DATA_CLASS)[0]
+        self._configure_vcpus_settings(procsetting, vcpus_num,
+                                       vcpus_per_numa_node,
+                                       limit_cpu_features)
+        self._jobutils.modify_virt_resource(procsetting)
+
+    def _configure_vcpus_settings(self, procsetting, vcpus_num,
+                                  vcpus_per_numa_node, limit_cpu_features):
         vcpus = int(vcpus_num)
         procsetting.VirtualQuantity = vcpus
         procsetting.Reservation = vcpus
@@ -248,16 +495,14 @@ class VMUtils(object):
         if vcpus_per_numa_node:
             procsetting.MaxProcessorsPerNumaNode = vcpus_per_numa_node
 
-        self._jobutils.modify_virt_resource(procsetting)
-
     def update_vm(self, vm_name, memory_mb, memory_per_numa_node, vcpus_num,
                   vcpus_per_numa_node, limit_cpu_features, dynamic_mem_ratio):
-        vm = self._lookup_vm_check(vm_name)
-        vmsetting = self._get_vm_setting_data(vm)
-        self._set_vm_memory(vmsetting, memory_mb, memory_per_numa_node,
-                            dynamic_mem_ratio)
-        self._set_vm_vcpus(vmsetting, vcpus_num, vcpus_per_numa_node,
-                           limit_cpu_features)
+        with self.lock_vm(vm_name) as vm:
+            vmsetting = self._get_vm_setting_data(vm)
+            self._set_vm_memory(vmsetting, memory_mb, memory_per_numa_node,
+                                dynamic_mem_ratio)
+            self._set_vm_vcpus(vmsetting, vcpus_num, vcpus_per_numa_node,
+                               limit_cpu_features)
 
     def check_admin_permissions(self):
         if not self._conn.Msvm_VirtualSystemManagementService():
@@ -301,6 +546,164 @@ class VMUtils(object):
 
     def _create_vm_obj(self, vm_name, vnuma_enabled, vm_gen, notes,
                        instance_path):
+        vs_data = self._get_new_vm_setting_data(vm_name, vnuma_enabled,
+                                                vm_gen, notes, instance_path)
+
+        (job_path,
+         vm_path,
+         ret_val) = self._vs_man_svc.DefineSystem(
+            ResourceSettings=[], ReferenceConfiguration=None,
+            SystemSettings=vs_data.GetText_(1))
+        job = self._jobutils.check_ret_val(ret_val, job_path)
+        return self._get_defined_vm(vm_path, job)
+
+    def create_vm_from_spec(self, vm_spec):
+        """Creates a VM along with its resources using as few jobs as possible.
+
+        The memory, vCPUs, SCSI controllers and NICs are passed to the
+        DefineSystem call, while the drives and the disk images attached to
+        them are added in one batch each.
+
+        :param vm_spec: dict describing the VM, having the following keys:
+            - name, generation, instance_path, memory_mb, vcpus
+            - notes (optional)
+            - dynamic_memory_ratio (optional, defaults to 1)
+            - memory_per_numa_node, vcpus_per_numa_node (optional)
+            - limit_cpu_features (optional, defaults to False)
+            - scsi_controllers (optional): number of SCSI controllers.
+            - disks (optional): list of dicts having the 'path',
+              'ctrl_type' (constants.CTRL_TYPE_IDE or CTRL_TYPE_SCSI),
+              'ctrl_addr' (IDE controller address or SCSI controller
+              index, defaults to 0), 'drive_addr' (defaults to 0 for IDE
+              disks, chosen automatically for SCSI disks) and
+              'drive_type' (constants.DISK or constants.DVD, defaults
+              to DISK) keys.
+            - nics (optional): list of dicts having the 'name' and
+              'mac_address' keys.
+            - serial_ports (optional): dict mapping serial port numbers
+              to the pipe paths they should be connected to.
+            - boot_order (optional): list of BOOT_DEVICE_* constants for
+              generation 1 VMs, or list of disk paths for generation 2 VMs.
+        """
+        vm_name = vm_spec['name']
+        vm_gen = vm_spec['generation']
+        boot_order = vm_spec.get('boot_order')
+        dynamic_memory_ratio = vm_spec.get('dynamic_memory_ratio', 1)
+        LOG.debug('Creating VM %s from spec', vm_name)
+
+        # vNUMA and dynamic memory are mutually exclusive
+        vnuma_enabled = dynamic_memory_ratio <= 1
+        vs_data = self._get_new_vm_setting_data(
+            vm_name, vnuma_enabled, vm_gen, vm_spec.get('notes'),
+            vm_spec['instance_path'])
+        if boot_order and vm_gen == constants.VM_GEN_1:
+            vs_data.BootOrder = tuple(boot_order)
+
+        mem_settings = self._get_new_setting_data(
+            self._MEMORY_SETTING_DATA_CLASS)
+        self._configure_memory_settings(
+            mem_settings, vm_spec['memory_mb'],
+            vm_spec.get('memory_per_numa_node'), dynamic_memory_ratio)
+        procsetting = self._get_new_setting_data(
+            self._PROCESSOR_SETTING_DATA_CLASS)
+        self._configure_vcpus_settings(
+            procsetting, vm_spec['vcpus'],
+            vm_spec.get('vcpus_per_numa_node'),
+            vm_spec.get('limit_cpu_features', False))
+
+        resources = [mem_settings, procsetting]
+        for i in range(vm_spec.get('scsi_controllers', 0)):
+            resources.append(self._get_new_scsi_controller_setting_data())
+        for nic in vm_spec.get('nics', []):
+            resources.append(self._get_new_nic_setting_data(
+                nic['name'], nic['mac_address']))
+
+        (job_path,
+         vm_path,
+         ret_val) = self._vs_man_svc.DefineSystem(
+            ResourceSettings=[r.GetText_(1) for r in resources],
+            ReferenceConfiguration=None,
+            SystemSettings=vs_data.GetText_(1))
+        job = self._jobutils.check_ret_val(ret_val, job_path)
+        vm = self._get_defined_vm(vm_path, job)
+
+        disks = vm_spec.get('disks', [])
+        serial_ports = vm_spec.get('serial_ports')
+        if disks or serial_ports:
+            vmsettings = self._get_vm_setting_data(vm)
+        if disks:
+            self._add_vm_disks_from_spec(vm, vmsettings, disks)
+        if serial_ports:
+            self._set_vm_serial_ports_from_spec(vmsettings, serial_ports)
+
+        if boot_order and vm_gen == constants.VM_GEN_2:
+            self._set_boot_order_gen2(vm_name, boot_order)
+
+    def _add_vm_disks_from_spec(self, vm, vmsettings, disks):
+        rasds = vmsettings.associators(
+            wmi_result_class=self._RESOURCE_ALLOC_SETTING_DATA_CLASS)
+        ide_ctrls = dict((r.Address, r.path_()) for r in rasds
+                         if r.ResourceSubType == self._IDE_CTRL_RES_SUB_TYPE)
+        scsi_ctrls = [r.path_() for r in rasds
+                      if r.ResourceSubType == self._SCSI_CTRL_RES_SUB_TYPE]
+        # The VM was just created, so every SCSI slot is free.
+        next_scsi_slots = [0] * len(scsi_ctrls)
+
+        drives = []
+        for disk in disks:
+            ctrl_addr = disk.get('ctrl_addr', 0)
+            drive_addr = disk.get('drive_addr')
+            if disk['ctrl_type'] == constants.CTRL_TYPE_SCSI:
+                ctrller_path = scsi_ctrls[ctrl_addr]
+                if drive_addr is None:
+                    drive_addr = next_scsi_slots[ctrl_addr]
+                next_scsi_slots[ctrl_addr] = max(
+                    next_scsi_slots[ctrl_addr], drive_addr + 1)
+            else:
+                ctrller_path = ide_ctrls[str(ctrl_addr)]
+                drive_addr = drive_addr or 0
+
+            drive_type = disk.get('drive_type', constants.DISK)
+            # Validate the spec before adding any drive.
+            self._get_drive_res_sub_types(drive_type)
+            drives.append((disk['path'], ctrller_path, drive_addr,
+                           drive_type))
+
+        self._attach_drives(vm, drives)
+
+    def _set_vm_serial_ports_from_spec(self, vmsettings, serial_ports):
+        rasds = vmsettings.associators(
+            wmi_result_class=self._SERIAL_PORT_SETTING_DATA_CLASS)
+        vm_serial_ports = [r for r in rasds if
+                           r.ResourceSubType == self._SERIAL_PORT_RES_SUB_TYPE]
+        updated_ports = []
+        for port_number, pipe_path in serial_ports.items():
+            serial_port = vm_serial_ports[port_number - 1]
+            serial_port.Connection = [pipe_path]
+            updated_ports.append(serial_port)
+        self._jobutils.modify_multiple_virt_resources(updated_ports)
+
+    def create_vm_async(self, vm_name, vnuma_enabled, vm_gen, instance_path,
+                        notes=None):
+        """Defines a VM without waiting for the operation to finish.
+
+        :returns: a WMIJobHandle, having the new VM object as result.
+        """
+        LOG.debug('Creating VM %s', vm_name)
+        vs_data = self._get_new_vm_setting_data(vm_name, vnuma_enabled,
+                                                vm_gen, notes, instance_path)
+
+        (job_path,
+         vm_path,
+         ret_val) = self._vs_man_svc.DefineSystem(
+            ResourceSettings=[], ReferenceConfiguration=None,
+            SystemSettings=vs_data.GetText_(1))
+        return self._jobutils.check_ret_val_async(
+            ret_val, job_path,
+            result_func=lambda job: self._get_defined_vm(vm_path, job))
+
+    def _get_new_vm_setting_data(self, vm_name, vnuma_enabled, vm_gen, notes,
+                                 instance_path):
         vs_data = self._conn.Msvm_VirtualSystemSettingData.new()
         vs_data.ElementName = vm_name
         vs_data.Notes = notes
@@ -320,13 +723,9 @@ class VMUtils(object):
         vs_data.SnapshotDataRoot = instance_path
         vs_data.SuspendDataRoot = instance_path
         vs_data.SwapFileDataRoot = instance_path
+        return vs_data
 
-        (job_path,
-         vm_path,
-         ret_val) = self._vs_man_svc.DefineSystem(
-            ResourceSettings=[], ReferenceConfiguration=None,
-            SystemSettings=vs_data.GetText_(1))
-        job = self._jobutils.check_ret_val(ret_val, job_path)
+    def _get_defined_vm(self, vm_path, job):
         if not vm_path and job:
             vm_path = job.associators(self._AFFECTED_JOB_ELEMENT_CLASS)[0]
         return self._get_wmi_obj(vm_path)
@@ -340,20 +739,24 @@ class VMUtils(object):
         vm = self._lookup_vm_check(vm_name)
         return self._get_vm_scsi_controller(vm)
 
-    def _get_vm_scsi_controller(self, vm):
+    def _get_vm_resources(self, vm, resource_class):
+        if isinstance(vm, VMHandle):
+            return vm.get_resources(resource_class)
+
         vmsettings = vm.associators(
             wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)
-        rasds = vmsettings[0].associators(
-            wmi_result_class=self._RESOURCE_ALLOC_SETTING_DATA_CLASS)
+        return vmsettings[0].associators(wmi_result_class=resource_class)
+
+    def _get_vm_scsi_controller(self, vm):
+        rasds = self._get_vm_resources(
+            vm, self._RESOURCE_ALLOC_SETTING_DATA_CLASS)
         res = [r for r in rasds
                if r.ResourceSubType == self._SCSI_CTRL_RES_SUB_TYPE][0]
         return res.path_()
 
     def _get_vm_ide_controller(self, vm, ctrller_addr):
-        vmsettings = vm.associators(
-            wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)
-        rasds = vmsettings[0].associators(
-            wmi_result_class=self._RESOURCE_ALLOC_SETTING_DATA_CLASS)
+        rasds = self._get_vm_resources(
+            vm, self._RESOURCE_ALLOC_SETTING_DATA_CLASS)
         ide_ctrls = [r for r in rasds
                      if r.ResourceSubType == self._IDE_CTRL_RES_SUB_TYPE
                      and r.Address == str(ctrller_addr)]
@@ -364,121 +767,274 @@ class VMUtils(object):
         vm = self._lookup_vm_check(vm_name)
         return self._get_vm_ide_controller(vm, ctrller_addr)
 
-    def get_attached_disks(self, scsi_controller_path):
-        volumes = self._conn.query(
-            self._get_attached_disks_query_string(scsi_controller_path))
-        return volumes
+    def get_attached_disks(self, scsi_controller_path, detached=False):
+        """Returns the drives attached to the given controller.
+
+        :param detached: return DiskResourceRecord objects instead of WMI
+                         objects, retrieving only the needed properties.
+        """
+        conditions = self._get_attached_disks_conditions(
+            scsi_controller_path)
+        if detached:
+            return self._query_records(
+                DiskResourceRecord, self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                conditions=conditions)
+
+        return self._query(self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                           conditions=conditions)
 
-    def _get_attached_disks_query_string(self, scsi_controller_path):
+    def _get_attached_disks_conditions(self, scsi_controller_path):
         # DVD Drives can be attached to SCSI as well, if the VM Generation is 2
-        return ("SELECT * FROM Msvm_ResourceAllocationSettingData WHERE ("
-                "ResourceSubType='%(res_sub_type)s' OR "
-                "ResourceSubType='%(res_sub_type_virt)s' OR "
-                "ResourceSubType='%(res_sub_type_dvd)s') AND "
-                "Parent = '%(parent)s'" % {
-                    'res_sub_type': self._PHYS_DISK_RES_SUB_TYPE,
-                    'res_sub_type_virt': self._DISK_DRIVE_RES_SUB_TYPE,
-                    'res_sub_type_dvd': self._DVD_DRIVE_RES_SUB_TYPE,
-                    'parent': scsi_controller_path.replace("'", "''")})
+        return {'ResourceSubType': (self._PHYS_DISK_RES_SUB_TYPE,
+                                    self._DISK_DRIVE_RES_SUB_TYPE,
+                                    self._DVD_DRIVE_RES_SUB_TYPE),
+                'Parent': scsi_controller_path}
 
     def _get_new_setting_data(self, class_name):
-        obj = self._conn.query("SELECT * FROM %s WHERE InstanceID "
-                                "LIKE '%%\\Default'" % class_name)[0]
-        return obj
+        return self._get_default_setting_data(class_name)
 
     def _get_new_resource_setting_data(self, resource_sub_type,
                                        class_name=None):
         if class_name is None:
             class_name = self._RESOURCE_ALLOC_SETTING_DATA_CLASS
-        obj = self._conn.query("SELECT * FROM %(class_name)s "
-                                "WHERE ResourceSubType = "
-                                "'%(res_sub_type)s' AND "
-                                "InstanceID LIKE '%%\\Default'" %
-                                {"class_name": class_name,
-                                 "res_sub_type": resource_sub_type})[0]
-        return obj
+        return self._get_default_setting_data(class_name, resource_sub_type)
 
     def attach_scsi_drive(self, vm_name, path, drive_type=constants.DISK):
-        vm = self._lookup_vm_check(vm_name)
-        ctrller_path = self._get_vm_scsi_controller(vm)
-        drive_addr = self.get_free_controller_slot(ctrller_path)
-        self.attach_drive(vm_name, path, ctrller_path, drive_addr, drive_type)
+        self.attach_scsi_drives(vm_name, [path], drive_type)
+
+    def attach_scsi_drives(self, vm_name, paths, drive_type=constants.DISK):
+        """Attaches the given images to the VM's SCSI controller.
+
+        :returns: the controller slots used by the images, in order.
+        """
+        vm_handle = self.get_vm_handle(vm_name)
+        # The slots are reserved within the locked section, right before
+        # attaching the images, which releases them if attaching fails.
+        with self.lock_vm(vm_handle) as vm:
+            ctrller_path = self._get_vm_scsi_controller(vm)
+            drive_addrs = self._get_free_controller_slots(ctrller_path,
+                                                          len(paths))
+            self._attach_drives(
+                vm, [(path, ctrller_path, drive_addr, drive_type)
+                     for path, drive_addr in zip(paths, drive_addrs)])
+        return drive_addrs
 
     def attach_ide_drive(self, vm_name, path, ctrller_addr, drive_addr,
                          drive_type=constants.DISK):
-        vm = self._lookup_vm_check(vm_name)
+        vm = self.get_vm_handle(vm_name)
         ctrller_path = self._get_vm_ide_controller(vm, ctrller_addr)
-        self.attach_drive(vm_name, path, ctrller_path, drive_addr, drive_type)
+        self.attach_drive(vm, path, ctrller_path, drive_addr, drive_type)
 
     def attach_drive(self, vm_name, path, ctrller_path, drive_addr,
                      drive_type=constants.DISK):
         """Create a drive and attach it to the vm."""
 
-        vm = self._lookup_vm_check(vm_name)
+        with self.lock_vm(vm_name) as vm:
+            self._attach_drives(
+                vm, [(path, ctrller_path, drive_addr, drive_type)])
 
-        if drive_type == constants.DISK:
-            res_sub_type = self._DISK_DRIVE_RES_SUB_TYPE
-        elif drive_type == constants.DVD:
-            res_sub_type = self._DVD_DRIVE_RES_SUB_TYPE
+    def attach_drives(self, vm_name, drives):
+        """Attaches multiple images to the VM.
+
+        Regardless of the number of images, this requires two jobs: one
+        adding the drives and one adding the images to the new drives.
 
-        drive = self._get_new_resource_setting_data(res_sub_type)
+        :param drives: list of (path, ctrller_path, drive_addr, drive_type)
+                       tuples, having the same meaning as the arguments
+                       of attach_drive.
+        """
+        with self.lock_vm(vm_name) as vm:
+            self._attach_drives(vm, drives)
 
-        # Set the ctrller as parent.
-        drive.Parent = ctrller_path
-        drive.Address = drive_addr
-        drive.AddressOnParent = drive_addr
-        # Add the cloned disk drive object to the vm.
-        new_resources = self._jobutils.add_virt_resource(drive, vm)
-        drive_path = new_resources[0]
+    @contextlib.contextmanager
+    def _using_controller_slots(self, slots):
+        """Commits the reserved slots if attaching succeeds, else frees them.
 
+        :param slots: list of (controller_path, slot) tuples.
+        """
+        try:
+            yield
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                for controller_path, slot in slots:
+                    self._scsi_slot_allocator.release_reservations(
+                        controller_path, [slot])
+                    # The slot may have been taken by other means, which
+                    # is a common reason for failed attach operations.
+                    self._scsi_slot_allocator.resync(controller_path)
+        for controller_path, slot in slots:
+            self._scsi_slot_allocator.commit_slots(controller_path, [slot])
+
+    def _release_controller_slots(self, drives):
+        # Frees the slots used by the given detached drives.
+        for drive in drives:
+            if drive.Parent and drive.AddressOnParent is not None:
+                self._scsi_slot_allocator.release_slots(
+                    drive.Parent, [int(drive.AddressOnParent)])
+
+    def _attach_drives(self, vm, drives):
+        slots = [(ctrller_path, drive_addr)
+                 for (path, ctrller_path, drive_addr, drive_type) in drives]
+        try:
+            with self._using_controller_slots(slots):
+                disk_image_paths = self._add_drives(vm, drives)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # Some of the images may have been attached.
+                self._invalidate_disk_resource_index(is_physical=False)
+        self._index_disk_resources(disk_image_paths, is_physical=False)
+
+    def _get_drive_res_sub_types(self, drive_type):
+        """Returns the drive and image resource sub types."""
         if drive_type == constants.DISK:
-            res_sub_type = self._HARD_DISK_RES_SUB_TYPE
+            return (self._DISK_DRIVE_RES_SUB_TYPE,
+                    self._HARD_DISK_RES_SUB_TYPE)
         elif drive_type == constants.DVD:
-            res_sub_type = self._DVD_DISK_RES_SUB_TYPE
-
-        res = self._get_new_resource_setting_data(
-            res_sub_type, self._STORAGE_ALLOC_SETTING_DATA_CLASS)
-
-        res.Parent = drive_path
-        res.HostResource = [path]
-
-        # Add the new vhd object as a virtual hard disk to the vm.
-        self._jobutils.add_virt_resource(res, vm)
+            return (self._DVD_DRIVE_RES_SUB_TYPE,
+                    self._DVD_DISK_RES_SUB_TYPE)
+        raise exceptions.HyperVException(
+            _('Unsupported drive type: %s') % drive_type)
+
+    def _add_drives(self, vm, drives):
+        # Fails before adding any drive if a drive type is not supported.
+        res_sub_types = [self._get_drive_res_sub_types(drive_type)
+                         for (path, ctrller_path, drive_addr,
+                              drive_type) in drives]
+
+        new_drives = []
+        for (path, ctrller_path, drive_addr, drive_type), (
+                res_sub_type, _image_sub_type) in zip(drives, res_sub_types):
+            drive = self._get_new_resource_setting_data(res_sub_type)
+            drive.Parent = ctrller_path
+            drive.Address = drive_addr
+            drive.AddressOnParent = drive_addr
+            new_drives.append(drive)
+
+        drive_paths = self._jobutils.add_multiple_virt_resources(new_drives,
+                                                                 vm)
+
+        # The images reference the drives, so they can only be added after
+        # the drives are created.
+        disk_images = []
+        for (path, ctrller_path, drive_addr, drive_type), (
+                _drive_sub_type, res_sub_type), drive_path in zip(
+                    drives, res_sub_types, drive_paths):
+            res = self._get_new_resource_setting_data(
+                res_sub_type, self._STORAGE_ALLOC_SETTING_DATA_CLASS)
+            res.Parent = drive_path
+            res.HostResource = [path]
+            disk_images.append(res)
+
+        disk_image_paths = self._jobutils.add_multiple_virt_resources(
+            disk_images, vm)
+        self._invalidate_vm_handle(vm)
+        return disk_image_paths
 
     def create_scsi_controller(self, vm_name):
         """Create an iscsi controller ready to mount volumes."""
 
-        vm = self._lookup_vm_check(vm_name)
+        with self.lock_vm(vm_name) as vm:
+            scsicontrl = self._get_new_scsi_controller_setting_data()
+            self._jobutils.add_virt_resource(scsicontrl, vm)
+            self._invalidate_vm_handle(vm)
+
+    def _get_new_scsi_controller_setting_data(self):
         scsicontrl = self._get_new_resource_setting_data(
             self._SCSI_CTRL_RES_SUB_TYPE)
 
         scsicontrl.VirtualSystemIdentifiers = ['{' + str(uuid.uuid4()) + '}']
-        self._jobutils.add_virt_resource(scsicontrl, vm)
+        return scsicontrl
 
     def attach_volume_to_controller(self, vm_name, controller_path, address,
                                     mounted_disk_path, serial=None):
         """Attach a volume to a controller."""
 
-        vm = self._lookup_vm_check(vm_name)
-
-        diskdrive = self._get_new_resource_setting_data(
-            self._PHYS_DISK_RES_SUB_TYPE)
+        with self.lock_vm(vm_name) as vm:
+
+            diskdrive = self._get_new_resource_setting_data(
+                self._PHYS_DISK_RES_SUB_TYPE)
+
+            diskdrive.AddressOnParent = address
+            diskdrive.Parent = controller_path
+            diskdrive.HostResource = [mounted_disk_path]
+
+            try:
+                with self._using_controller_slots(
+                        [(controller_path, address)]):
+                    diskdrive_path = self._jobutils.add_virt_resource(
+                        diskdrive, vm)[0]
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._invalidate_disk_resource_index(is_physical=True)
+            self._invalidate_vm_handle(vm)
+
+            if serial:
+                # Apparently this can't be set when the resource is added.
+                diskdrive = baseutils.get_wmi_object(diskdrive_path)
+                diskdrive.ElementName = serial
+                self._jobutils.modify_virt_resource(diskdrive)
+            self._index_disk_resources([diskdrive_path], is_physical=True)
+
+    def attach_volumes_to_controller(self, vm_name, controller_path,
+                                     volumes):
+        """Attaches multiple volumes to a controller using a single job.
+
+        :param volumes: list of (address, mounted_disk_path, serial)
+                        tuples. The serial may be None.
+        """
+        with self.lock_vm(vm_name) as vm:
+
+            diskdrives = []
+            for (address, mounted_disk_path, serial) in volumes:
+                diskdrive = self._get_new_resource_setting_data(
+                    self._PHYS_DISK_RES_SUB_TYPE)
+
+                diskdrive.AddressOnParent = address
+                diskdrive.Parent = controller_path
+                diskdrive.HostResource = [mounted_disk_path]
+                diskdrives.append(diskdrive)
+
+            slots = [(controller_path, address) for (address, _path,
+                                                     _serial) in volumes]
+            try:
+                with self._using_controller_slots(slots):
+                    diskdrive_paths = (
+                        self._jobutils.add_multiple_virt_resources(
+                            diskdrives, vm))
+            except Exception:
+                with excutils.save_and_reraise_exception():
+                    self._invalidate_disk_resource_index(is_physical=True)
+            self._invalidate_vm_handle(vm)
+
+            # Apparently the serials can't be set when the resources are added.
+            updated_diskdrives = []
+            for (address, mounted_disk_path,
+                 serial), diskdrive_path in zip(volumes, diskdrive_paths):
+                if serial:
+                    diskdrive = baseutils.get_wmi_object(diskdrive_path)
+                    diskdrive.ElementName = serial
+                    updated_diskdrives.append(diskdrive)
+            if updated_diskdrives:
+                self._jobutils.modify_multiple_virt_resources(
+                    updated_diskdrives)
+            self._index_disk_resources(diskdrive_paths, is_physical=True)
 
-        diskdrive.AddressOnParent = address
-        diskdrive.Parent = controller_path
-        diskdrive.HostResource = [mounted_disk_path]
+    def get_vm_physical_disk_mapping(self, vm_name):
+        physical_disks = self.get_vm_disks(vm_name)[1]
+        return self._get_physical_disk_mapping(physical_disks)
 
-        diskdrive_path = self._jobutils.add_virt_resource(diskdrive, vm)[0]
+    def get_vms_physical_disk_mapping(self):
+        """Returns the physical disk mappings of all the VMs.
 
-        if serial:
-            # Apparently this can't be set when the resource is added.
-            diskdrive = wmi.WMI(moniker=diskdrive_path)
-            diskdrive.ElementName = serial
-            self._jobutils.modify_virt_resource(diskdrive)
+        :returns: dict mapping the VM names to dicts having the same format
+                  as the get_vm_physical_disk_mapping result.
+        """
+        return dict((vm_name, self._get_physical_disk_mapping(volumes))
+                    for vm_name, (disks, volumes) in
+                    self.get_vms_disks().items())
 
-    def get_vm_physical_disk_mapping(self, vm_name):
+    def _get_physical_disk_mapping(self, physical_disks):
         mapping = {}
-        physical_disks = self.get_vm_disks(vm_name)[1]
         for diskdrive in physical_disks:
             mapping[diskdrive.ElementName] = dict(
                 resource_path=diskdrive.Path_(),
@@ -489,37 +1045,48 @@ class VMUtils(object):
         return disk_resource.AddressOnParent
 
     def set_disk_host_res(self, disk_res_path, mounted_disk_path):
-        diskdrive = wmi.WMI(moniker=disk_res_path)
+        diskdrive = baseutils.get_wmi_object(disk_res_path)
+        old_host_resource = list(diskdrive.HostResource or [])
         diskdrive.HostResource = [mounted_disk_path]
         self._jobutils.modify_virt_resource(diskdrive)
+        self._drop_indexed_disk_resources(old_host_resource,
+                                          is_physical=True)
+        self._index_disk_resources([disk_res_path], is_physical=True)
 
     def set_disk_host_resource(self, vm_name, controller_path, address,
                                mounted_disk_path):
         # TODO(lpetrut): remove this method after the patch fixing
         # swapped disks after host reboot merges in Nova.
         disk_found = False
-        vm = self._lookup_vm_check(vm_name)
-        (disk_resources, volume_resources) = self._get_vm_disks(vm)
-        for disk_resource in disk_resources + volume_resources:
-            if (disk_resource.Parent == controller_path and
-                    self._get_disk_resource_address(disk_resource) ==
-                    str(address)):
-                if (disk_resource.HostResource and
-                        disk_resource.HostResource[0] != mounted_disk_path):
-                    LOG.debug('Updating disk host resource "%(old)s" to '
-                                '"%(new)s"' %
-                              {'old': disk_resource.HostResource[0],
-                               'new': mounted_disk_path})
-                    disk_resource.HostResource = [mounted_disk_path]
-                    self._jobutils.modify_virt_resource(disk_resource)
-                disk_found = True
-                break
-        if not disk_found:
-            LOG.warning(_LW('Disk not found on controller '
-                            '"%(controller_path)s" with '
-                            'address "%(address)s"'),
-                        {'controller_path': controller_path,
-                         'address': address})
+        with self.lock_vm(vm_name) as vm:
+            (disk_resources, volume_resources) = self._get_vm_disks(vm)
+            for disk_resource in disk_resources + volume_resources:
+                if (disk_resource.Parent == controller_path and
+                        self._get_disk_resource_address(disk_resource) ==
+                        str(address)):
+                    old_host_resource = (disk_resource.HostResource and
+                                         disk_resource.HostResource[0])
+                    if (old_host_resource and
+                            old_host_resource != mounted_disk_path):
+                        LOG.debug('Updating disk host resource "%(old)s" to '
+                                    '"%(new)s"' %
+                                  {'old': disk_resource.HostResource[0],
+                                   'new': mounted_disk_path})
+                        disk_resource.HostResource = [mounted_disk_path]
+                        self._jobutils.modify_virt_resource(disk_resource)
+                        is_physical = disk_resource in volume_resources
+                        self._drop_indexed_disk_resources(
+                            [old_host_resource], is_physical)
+                        self._index_disk_resources([disk_resource.path_()],
+                                                   is_physical)
+                    disk_found = True
+                    break
+            if not disk_found:
+                LOG.warning(_LW('Disk not found on controller '
+                                '"%(controller_path)s" with '
+                                'address "%(address)s"'),
+                            {'controller_path': controller_path,
+                             'address': address})
 
     def _get_nic_data_by_name(self, name):
         return self._conn.Msvm_SyntheticEthernetPortSettingData(
@@ -528,6 +1095,14 @@ class VMUtils(object):
     def create_nic(self, vm_name, nic_name, mac_address):
         """Create a (synthetic) nic and attach it to the vm."""
         # Create a new nic
+        new_nic_data = self._get_new_nic_setting_data(nic_name, mac_address)
+
+        # Add the new nic to the vm
+        with self.lock_vm(vm_name) as vm:
+            self._jobutils.add_virt_resource(new_nic_data, vm)
+            self._invalidate_vm_handle(vm)
+
+    def _get_new_nic_setting_data(self, nic_name, mac_address):
         new_nic_data = self._get_new_setting_data(
             self._SYNTHETIC_ETHERNET_PORT_SETTING_DATA_CLASS)
 
@@ -536,11 +1111,7 @@ class VMUtils(object):
         new_nic_data.Address = mac_address.replace(':', '')
         new_nic_data.StaticMacAddress = 'True'
         new_nic_data.VirtualSystemIdentifiers = ['{' + str(uuid.uuid4()) + '}']
-
-        # Add the new nic to the vm
-        vm = self._lookup_vm_check(vm_name)
-
-        self._jobutils.add_virt_resource(new_nic_data, vm)
+        return new_nic_data
 
     def destroy_nic(self, vm_name, nic_name):
         """Destroys the NIC with the given nic_name from the given VM.
@@ -548,36 +1119,177 @@ class VMUtils(object):
         :param vm_name: The name of the VM which has the NIC to be destroyed.
         :param nic_name: The NIC's ElementName.
         """
-        # TODO(claudiub): remove vm_name argument, no longer used.
-        nic_data = self._get_nic_data_by_name(nic_name)
-        self._jobutils.remove_virt_resource(nic_data)
+        with self.lock_vm(vm_name):
+            nic_data = self._get_nic_data_by_name(nic_name)
+            self._jobutils.remove_virt_resource(nic_data)
 
     def soft_shutdown_vm(self, vm_name):
-        vm = self._lookup_vm_check(vm_name)
-        shutdown_component = vm.associators(
-            wmi_result_class=self._SHUTDOWN_COMPONENT)
+        with self.lock_vm(vm_name) as vm:
+            shutdown_component = vm.associators(
+                wmi_result_class=self._SHUTDOWN_COMPONENT)
 
-        if not shutdown_component:
-            # If no shutdown_component is found, it means the VM is already
-            # in a shutdown state.
-            return
+            if not shutdown_component:
+                # If no shutdown_component is found, it means the VM is already
+                # in a shutdown state.
+                return
 
-        reason = 'Soft shutdown requested by OpenStack Nova.'
-        (ret_val, ) = shutdown_component[0].InitiateShutdown(Force=False,
-                                                             Reason=reason)
+            self._initiate_shutdown(shutdown_component[0])
+
+    def _initiate_shutdown(self, shutdown_component):
+        (ret_val, ) = shutdown_component.InitiateShutdown(
+            Force=False, Reason=self._SOFT_SHUTDOWN_REASON)
         self._jobutils.check_ret_val(ret_val, None)
 
     def set_vm_state(self, vm_name, req_state):
         """Set the desired state of the VM."""
-        vm = self._lookup_vm_check(vm_name)
-        (job_path,
-         ret_val) = vm.RequestStateChange(self._vm_power_states_map[req_state])
-        # Invalid state for current operation (32775) typically means that
-        # the VM is already in the state requested
-        self._jobutils.check_ret_val(ret_val, job_path, [0, 32775])
-        LOG.debug("Successfully changed vm state of %(vm_name)s "
-                  "to %(req_state)s",
-                  {'vm_name': vm_name, 'req_state': req_state})
+        with self.lock_vm(vm_name) as vm:
+            (job_path, ret_val) = vm.RequestStateChange(
+                self._vm_power_states_map[req_state])
+            self._jobutils.check_ret_val(ret_val, job_path,
+                                         self._VM_STATE_CHANGE_SUCCESS_VALUES)
+            LOG.debug("Successfully changed vm state of %(vm_name)s "
+                      "to %(req_state)s",
+                      {'vm_name': vm_name, 'req_state': req_state})
+
+    def set_vms_state(self, vm_names, req_state, max_concurrency=None,
+                      soft_shutdown_timeout=None):
+        """Sets the desired state of multiple VMs.
+
+        The state change jobs run in parallel, the VMs being retrieved
+        using a single query. Each VM is locked only while its state change
+        is being requested.
+
+        :param max_concurrency: maximum number of state change jobs running
+                                at the same time. Unlimited if None. Once
+                                reached, the next job is started as soon
+                                as any of the running jobs finishes.
+        :param soft_shutdown_timeout: when disabling the VMs, the guests may
+                                      be asked to shut down first. VMs still
+                                      running after this amount of seconds
+                                      are turned off.
+        :returns: dict mapping the VM names to None if the state change
+                  succeeded, or to the raised exception otherwise.
+        """
+        results = {}
+        vms = self._get_vms_by_names(vm_names, results)
+
+        if (soft_shutdown_timeout is not None and
+                req_state == constants.HYPERV_VM_STATE_DISABLED):
+            vms = self._soft_shutdown_vms(vms, soft_shutdown_timeout,
+                                          results)
+
+        # (vm_name, job_handle) tuples.
+        pending_jobs = []
+        for vm_name, vm in vms.items():
+            if max_concurrency and len(pending_jobs) >= max_concurrency:
+                # Waits for whichever job finishes first.
+                finished_jobs = self._jobutils.wait_for_any(
+                    [job_handle for (_vm_name, job_handle)
+                     in pending_jobs])
+                for pending_job in [job for job in pending_jobs
+                                    if job[1] in finished_jobs]:
+                    pending_jobs.remove(pending_job)
+                    self._wait_for_vm_state_job(pending_job, results)
+
+            try:
+                with self._vm_locks.lock_objects([vm]):
+                    (job_path, ret_val) = vm.RequestStateChange(
+                        self._vm_power_states_map[req_state])
+                    job_handle = self._jobutils.check_ret_val_async(
+                        ret_val, job_path,
+                        self._VM_STATE_CHANGE_SUCCESS_VALUES)
+                pending_jobs.append((vm_name, job_handle))
+            except Exception as exc:
+                results[vm_name] = exc
+
+        for pending_job in pending_jobs:
+            self._wait_for_vm_state_job(pending_job, results)
+
+        failed_vms = [vm_name for vm_name, exc in results.items() if exc]
+        LOG.debug("Changed the state of %(count)d VMs to %(req_state)s. "
+                  "Failed VMs: %(failed_vms)s",
+                  {'count': len(results) - len(failed_vms),
+                   'req_state': req_state,
+                   'failed_vms': failed_vms})
+        return results
+
+    def _get_vms_by_names(self, vm_names, results):
+        vms = {}
+        vm_names = set(vm_names)
+        for vm in self._conn.Msvm_ComputerSystem(
+                ['ElementName'] + self._COMPUTER_SYSTEM_KEY_PROPS,
+                Caption=constants.VM_CAPTION):
+            vm_name = vm.ElementName
+            if vm_name not in vm_names:
+                continue
+            if vm_name in vms:
+                results[vm_name] = exceptions.HyperVException(
+                    _('Duplicate VM name found: %s') % vm_name)
+            elif vm_name not in results:
+                vms[vm_name] = vm
+
+        for vm_name in vm_names:
+            if vm_name in results:
+                vms.pop(vm_name, None)
+            elif vm_name not in vms:
+                results[vm_name] = exceptions.HyperVVMNotFoundException(
+                    vm_name=vm_name)
+        return vms
+
+    def _wait_for_vm_state_job(self, pending_job, results):
+        vm_name, job_handle = pending_job
+        try:
+            job_handle.result()
+            results[vm_name] = None
+        except Exception as exc:
+            results[vm_name] = exc
+
+    def _soft_shutdown_vms(self, vms, timeout, results):
+        """Shuts down the guests, returning the VMs that are still running.
+
+        All the shutdown components are retrieved using a single query,
+        the VM states being polled using a single query as well. Each VM
+        is locked only while its shutdown is being requested.
+        """
+        deadline = time.time() + timeout
+        vm_ids = dict((vm.Name.upper(), vm_name)
+                      for vm_name, vm in vms.items())
+        shutting_down = {}
+        for shutdown_component in self._query(
+                self._SHUTDOWN_COMPONENT, self._LOGICAL_DEVICE_KEY_PROPS):
+            vm_name = vm_ids.get(shutdown_component.SystemName.upper())
+            if not vm_name:
+                continue
+            try:
+                with self._vm_locks.lock_objects([vms[vm_name]]):
+                    self._initiate_shutdown(shutdown_component)
+                shutting_down[vm_name] = vms[vm_name]
+            except Exception as exc:
+                LOG.debug("Soft shutdown failed for VM %(vm_name)s, it "
+                          "will be turned off. Error: %(exc)s",
+                          {'vm_name': vm_name, 'exc': exc})
+
+        disabled_state = self._vm_power_states_map[
+            constants.HYPERV_VM_STATE_DISABLED]
+        while shutting_down:
+            for vm in self._conn.Msvm_ComputerSystem(
+                    ['ElementName', 'EnabledState'],
+                    Caption=constants.VM_CAPTION):
+                if (vm.ElementName in shutting_down and
+                        vm.EnabledState == disabled_state):
+                    del shutting_down[vm.ElementName]
+                    results[vm.ElementName] = None
+
+            remaining = deadline - time.time()
+            if not shutting_down or remaining <= 0:
+                break
+            time.sleep(min(self._SOFT_SHUTDOWN_POLL_INTERVAL, remaining))
+
+        # VMs which did not shut down in time and VMs lacking a shutdown
+        # component (which is usually the case for VMs which are not
+        # running) are turned off.
+        return dict((vm_name, vm) for vm_name, vm in vms.items()
+                    if vm_name not in results)
 
     def _get_disk_resource_disk_path(self, disk_resource):
         return disk_resource.HostResource
@@ -585,7 +1297,19 @@ class VMUtils(object):
     def get_vm_storage_paths(self, vm_name):
         vm = self._lookup_vm_check(vm_name)
         (disk_resources, volume_resources) = self._get_vm_disks(vm)
+        return self._get_storage_paths(disk_resources, volume_resources)
+
+    def get_vms_storage_paths(self):
+        """Returns the storage paths of all the VMs.
 
+        :returns: dict mapping the VM names to (disk_files, volume_drives)
+                  tuples, as returned by get_vm_storage_paths.
+        """
+        return dict((vm_name, self._get_storage_paths(disks, volumes))
+                    for vm_name, (disks, volumes) in
+                    self.get_vms_disks().items())
+
+    def _get_storage_paths(self, disk_resources, volume_resources):
         volume_drives = []
         for volume_resource in volume_resources:
             drive_path = volume_resource.HostResource[0]
@@ -598,15 +1322,46 @@ class VMUtils(object):
 
         return (disk_files, volume_drives)
 
-    def get_vm_disks(self, vm_name):
+    def get_vm_disks(self, vm_name, detached=False):
+        """Returns a (disk_resources, volume_resources) tuple.
+
+        :param detached: return DiskResourceRecord objects instead of WMI
+                         objects. The resources are retrieved using projected
+                         queries filtered by VM id, instead of walking the VM
+                         associators.
+        """
         vm = self._lookup_vm_check(vm_name)
+        if detached:
+            return self._get_vm_disk_records(vm)
         return self._get_vm_disks(vm)
 
+    def _get_vm_disk_records(self, vm):
+        # The resource instance ids start with the VM id.
+        vm_filter = "InstanceID LIKE 'Microsoft:%s\\%%'" % vm.Name
+        disk_resources = self._query_records(
+            DiskResourceRecord, self._STORAGE_ALLOC_SETTING_DATA_CLASS,
+            vm_filter,
+            conditions={'ResourceSubType': (self._HARD_DISK_RES_SUB_TYPE,
+                                            self._DVD_DISK_RES_SUB_TYPE)})
+        volume_resources = self._query_records(
+            DiskResourceRecord, self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+            vm_filter,
+            conditions={'ResourceSubType': self._PHYS_DISK_RES_SUB_TYPE})
+        return (disk_resources, volume_resources)
+
     def _get_vm_disks(self, vm):
-        vmsettings = vm.associators(
-            wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)
-        rasds = vmsettings[0].associators(
-            wmi_result_class=self._STORAGE_ALLOC_SETTING_DATA_CLASS)
+        if isinstance(vm, VMHandle):
+            vmsettings = vm
+            get_resources = vm.get_resources
+        else:
+            vmsettings = vm.associators(
+                wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)[0]
+
+            def get_resources(resource_class):
+                return vmsettings.associators(
+                    wmi_result_class=resource_class)
+
+        rasds = get_resources(self._STORAGE_ALLOC_SETTING_DATA_CLASS)
         disk_resources = [r for r in rasds if
                           r.ResourceSubType in
                           [self._HARD_DISK_RES_SUB_TYPE,
@@ -614,38 +1369,86 @@ class VMUtils(object):
 
         if (self._RESOURCE_ALLOC_SETTING_DATA_CLASS !=
                 self._STORAGE_ALLOC_SETTING_DATA_CLASS):
-            rasds = vmsettings[0].associators(
-                wmi_result_class=self._RESOURCE_ALLOC_SETTING_DATA_CLASS)
+            rasds = get_resources(self._RESOURCE_ALLOC_SETTING_DATA_CLASS)
 
         volume_resources = [r for r in rasds if
                             r.ResourceSubType == self._PHYS_DISK_RES_SUB_TYPE]
 
         return (disk_resources, volume_resources)
 
+    def get_vms_disks(self):
+        """Returns the disk resources of all the VMs.
+
+        A single query is used per resource class, grouping the resources
+        by the VM they belong to. VMs sharing the same name are omitted.
+
+        :returns: dict mapping the VM names to (disk_resources,
+                  volume_resources) tuples, as returned by get_vm_disks.
+        """
+        vms = self._conn.Msvm_ComputerSystem(
+            ['ElementName', 'Name'], Caption=constants.VM_CAPTION)
+        # Maps the VM ids to the VM names.
+        vm_names = {}
+        seen_names = set()
+        duplicate_names = set()
+        for vm in vms:
+            if vm.ElementName in seen_names:
+                duplicate_names.add(vm.ElementName)
+            seen_names.add(vm.ElementName)
+            vm_names[vm.Name.upper()] = vm.ElementName
+
+        vms_disks = dict((vm_name, ([], [])) for vm_name in
+                         seen_names - duplicate_names)
+
+        disk_resources = self._get_disk_resources(is_physical=False)
+        volume_resources = self._get_disk_resources(is_physical=True)
+        for resources, resource_sub_types, idx in (
+                (disk_resources, [self._HARD_DISK_RES_SUB_TYPE,
+                                  self._DVD_DISK_RES_SUB_TYPE], 0),
+                (volume_resources, [self._PHYS_DISK_RES_SUB_TYPE], 1)):
+            for resource in resources:
+                if resource.ResourceSubType not in resource_sub_types:
+                    continue
+                vm_name = vm_names.get(self._get_resource_vm_id(resource))
+                if vm_name in vms_disks:
+                    vms_disks[vm_name][idx].append(resource)
+        return vms_disks
+
+    def _get_resource_vm_id(self, resource):
+        # The resource instance ids have the following format:
+        # Microsoft:<VM id>\<resource id>[\...]
+        return resource.InstanceID.split('\\')[0].split(':')[-1].upper()
+
     def destroy_vm(self, vm_name):
-        vm = self._lookup_vm_check(vm_name)
+        with self.lock_vm(vm_name) as vm:
 
-        # Remove the VM. It does not destroy any associated virtual disk.
-        (job_path, ret_val) = self._vs_man_svc.DestroySystem(vm.path_())
-        self._jobutils.check_ret_val(ret_val, job_path)
+            # Remove the VM. It does not destroy any associated virtual disk.
+            (job_path, ret_val) = self._vs_man_svc.DestroySystem(vm.path_())
+            self._jobutils.check_ret_val(ret_val, job_path)
+            self._invalidate_disk_resource_index(is_physical=True)
+            self._invalidate_disk_resource_index(is_physical=False)
+
+            if self._vm_inventory:
+                # Don't wait for the deletion event.
+                self._vm_inventory.remove_vm(self._get_vm_name(vm_name))
 
     def _get_wmi_obj(self, path):
-        return wmi.WMI(moniker=path.replace('\\', '/'))
+        return baseutils.get_wmi_object(path.replace('\\', '/'))
 
     def take_vm_snapshot(self, vm_name):
-        vm = self._lookup_vm_check(vm_name)
-        vs_snap_svc = self._conn.Msvm_VirtualSystemSnapshotService()[0]
+        with self.lock_vm(vm_name) as vm:
+            vs_snap_svc = self._conn.Msvm_VirtualSystemSnapshotService()[0]
 
-        (job_path, snp_setting_data, ret_val) = vs_snap_svc.CreateSnapshot(
-            AffectedSystem=vm.path_(),
-            SnapshotType=self._SNAPSHOT_FULL)
-        self._jobutils.check_ret_val(ret_val, job_path)
+            (job_path, snp_setting_data, ret_val) = vs_snap_svc.CreateSnapshot(
+                AffectedSystem=vm.path_(),
+                SnapshotType=self._SNAPSHOT_FULL)
+            self._jobutils.check_ret_val(ret_val, job_path)
 
-        job = self._get_wmi_obj(job_path)
-        snp_setting_data = job.associators(
-            wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)[0]
+            job = self._get_wmi_obj(job_path)
+            snp_setting_data = job.associators(
+                wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)[0]
 
-        return snp_setting_data.path_()
+            return snp_setting_data.path_()
 
     def remove_vm_snapshot(self, snapshot_path):
         vs_snap_svc = self._conn.Msvm_VirtualSystemSnapshotService()[0]
@@ -681,12 +1484,17 @@ class VMUtils(object):
 
     def get_vm_dvd_disk_paths(self, vm_name):
         vm = self._lookup_vm_check(vm_name)
+        sasds = self._get_vm_resources(
+            vm, self._STORAGE_ALLOC_SETTING_DATA_CLASS)
+        return self._get_dvd_disk_paths(sasds)
 
-        settings = vm.associators(
-            wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)[0]
-        sasds = settings.associators(
-            wmi_result_class=self._STORAGE_ALLOC_SETTING_DATA_CLASS)
+    def get_vms_dvd_disk_paths(self):
+        """Returns a dict mapping the VM names to their DVD disk paths."""
+        return dict((vm_name, self._get_dvd_disk_paths(disks))
+                    for vm_name, (disks, volumes) in
+                    self.get_vms_disks().items())
 
+    def _get_dvd_disk_paths(self, sasds):
         dvd_paths = [sasd.HostResource[0] for sasd in sasds
                      if sasd.ResourceSubType == self._DVD_DISK_RES_SUB_TYPE]
 
@@ -697,42 +1505,195 @@ class VMUtils(object):
                                                                   is_physical)
         return disk_resource is not None
 
+    def are_disks_attached(self, disk_paths, is_physical=True):
+        """Returns a dict mapping the given disk paths to booleans."""
+        disk_resources = self._get_mounted_disk_resources_from_paths(
+            disk_paths, is_physical)
+        return dict((disk_path, disk_path.lower() in disk_resources)
+                    for disk_path in disk_paths)
+
     def detach_vm_disk(self, vm_name, disk_path, is_physical=True):
         # TODO(claudiub): remove vm_name argument, no longer used.
         disk_resource = self._get_mounted_disk_resource_from_path(disk_path,
                                                                   is_physical)
 
         if disk_resource:
-            parent = self._conn.query("SELECT * FROM "
-                                      "Msvm_ResourceAllocationSettingData "
-                                      "WHERE __PATH = '%s'" %
-                                      disk_resource.Parent)[0]
+            parent = self._query(
+                self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                self._DRIVE_RESOURCE_PROPS,
+                {'__PATH': disk_resource.Parent})[0]
 
             self._jobutils.remove_virt_resource(disk_resource)
+            self._drop_indexed_disk_resources([disk_path], is_physical)
             if not is_physical:
                 self._jobutils.remove_virt_resource(parent)
+                self._release_controller_slots([parent])
+            else:
+                self._release_controller_slots([disk_resource])
 
-    def _get_mounted_disk_resource_from_path(self, disk_path, is_physical):
-        if is_physical:
-            class_name = self._RESOURCE_ALLOC_SETTING_DATA_CLASS
-        else:
-            class_name = self._STORAGE_ALLOC_SETTING_DATA_CLASS
+    def detach_vm_disks(self, disk_paths, is_physical=True):
+        """Detaches multiple disks.
+
+        Passthrough disks are removed using a single job for each VM using
+        them. Images are removed along with their drives, which requires an
+        additional job.
+        """
+        disk_resources = list(self._get_mounted_disk_resources_from_paths(
+            disk_paths, is_physical).values())
+        if not disk_resources:
+            return
+
+        # RemoveResourceSettings only handles the resources of a single VM.
+        vm_disk_resources = collections.defaultdict(list)
+        for disk_resource in disk_resources:
+            vm_disk_resources[vmlocks.get_vm_id(disk_resource)].append(
+                disk_resource)
 
-        query = ("SELECT * FROM %(class_name)s WHERE ("
-                 "ResourceSubType='%(res_sub_type)s' OR "
-                 "ResourceSubType='%(res_sub_type_virt)s' OR "
-                 "ResourceSubType='%(res_sub_type_dvd)s')" % {
-                     'class_name': class_name,
-                     'res_sub_type': self._PHYS_DISK_RES_SUB_TYPE,
-                     'res_sub_type_virt': self._HARD_DISK_RES_SUB_TYPE,
-                     'res_sub_type_dvd': self._DVD_DISK_RES_SUB_TYPE})
+        try:
+            for vm_id in sorted(vm_disk_resources, key=str):
+                self._remove_disk_resources(vm_disk_resources[vm_id],
+                                            is_physical)
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                # Some of the disks may have been detached.
+                self._invalidate_disk_resource_index(is_physical)
+        self._drop_indexed_disk_resources(disk_paths, is_physical)
+
+    def _remove_disk_resources(self, disk_resources, is_physical):
+        # The disk resources must belong to the same VM.
+        parents = []
+        if not is_physical:
+            parents = self._query(
+                self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                self._DRIVE_RESOURCE_PROPS,
+                {'__PATH': [disk_resource.Parent
+                            for disk_resource in disk_resources]})
+
+        self._jobutils.remove_multiple_virt_resources(disk_resources)
+        if parents:
+            self._jobutils.remove_multiple_virt_resources(parents)
+            self._release_controller_slots(parents)
+        elif is_physical:
+            self._release_controller_slots(disk_resources)
+
+    def _get_mounted_disk_resources_from_paths(self, disk_paths,
+                                               is_physical):
+        """Returns a dict mapping the requested disk paths to resources.
+
+        The keys are lower case. Paths not attached to any VM are omitted.
+
+        The disk resources are indexed by path, the index being loaded using
+        a single query and shared by the VMUtils instances of the same host.
+        The returned resources are shared as well, so they must not be
+        modified. The index entries are updated when disks are attached or
+        detached. While the drive and disk image events are available (see
+        enable_drive_events), the entries affected by disks changed by other
+        means are updated as well, the lookups being served by the index
+        alone. Otherwise, indexed resources are retrieved again by their
+        WMI path, ensuring that they are still attached, and the index is
+        reloaded if any of the requested paths is missing from it.
+        """
+        disk_paths = set(path.lower() for path in disk_paths)
+        if self._drive_events_available():
+            index = self._disk_resource_indexes.get(is_physical)
+            if index is None:
+                index = self._load_disk_resource_index(is_physical)
+            return dict((path, index[path]) for path in disk_paths
+                        if path in index)
+
+        index = self._disk_resource_indexes.get(is_physical)
+        reloaded = index is None
+        if reloaded:
+            index = self._load_disk_resource_index(is_physical)
+
+        disk_resources = {}
+        for path in disk_paths:
+            disk_resource = index.get(path)
+            if disk_resource is not None and not reloaded:
+                disk_resource = self._refresh_disk_resource(
+                    disk_resource, path, is_physical)
+            if disk_resource is None and not reloaded:
+                index = self._load_disk_resource_index(is_physical)
+                reloaded = True
+                disk_resource = index.get(path)
+
+            if disk_resource is not None:
+                disk_resources[path] = disk_resource
+        return disk_resources
 
-        disk_resources = self._conn.query(query)
+    def _get_mounted_disk_resource_from_path(self, disk_path, is_physical):
+        disk_resources = self._get_mounted_disk_resources_from_paths(
+            [disk_path], is_physical)
+        return disk_resources.get(disk_path.lower())
+
+    def _load_disk_resource_index(self, is_physical):
+        generation = self._disk_index_generations[is_physical]
+        index = {}
+        for disk_resource in self._get_disk_resources(is_physical):
+            if disk_resource.HostResource:
+                index[disk_resource.HostResource[0].lower()] = disk_resource
+        # The index is not kept if it was invalidated during the query, as
+        # it may be stale.
+        if self._disk_index_generations[is_physical] == generation:
+            self._disk_resource_indexes[is_physical] = index
+        return index
+
+    def _invalidate_disk_resource_index(self, is_physical):
+        self._disk_index_generations[is_physical] += 1
+        self._disk_resource_indexes.pop(is_physical, None)
+
+    def _refresh_disk_resource(self, disk_resource, disk_path, is_physical):
+        """Retrieves the indexed resource again.
+
+        Returns None if the resource was removed or no longer uses the
+        given path.
+        """
+        disk_resources = self._query(
+            self._get_disk_resource_class(is_physical),
+            conditions={'__PATH': disk_resource.path_()})
+        if (disk_resources and disk_resources[0].HostResource and
+                disk_resources[0].HostResource[0].lower() == disk_path):
+            self._disk_resource_indexes[is_physical][disk_path] = (
+                disk_resources[0])
+            return disk_resources[0]
+
+        self._disk_resource_indexes[is_physical].pop(disk_path, None)
+
+    def _drop_indexed_disk_resources(self, disk_paths, is_physical):
+        # An index being loaded in the meantime may include the resources.
+        self._disk_index_generations[is_physical] += 1
+        index = self._disk_resource_indexes.get(is_physical, {})
+        for disk_path in disk_paths:
+            index.pop(disk_path.lower(), None)
+
+    def _index_disk_resources(self, resource_paths, is_physical):
+        """Adds the given attached disk resources to the loaded index."""
+        # An index being loaded in the meantime may miss the resources.
+        self._disk_index_generations[is_physical] += 1
+        index = self._disk_resource_indexes.get(is_physical)
+        if index is None or not resource_paths:
+            return
 
+        disk_resources = self._query(
+            self._get_disk_resource_class(is_physical),
+            conditions={'__PATH': list(resource_paths)})
         for disk_resource in disk_resources:
             if disk_resource.HostResource:
-                if disk_resource.HostResource[0].lower() == disk_path.lower():
-                    return disk_resource
+                index[disk_resource.HostResource[0].lower()] = disk_resource
+
+    def _get_disk_resource_class(self, is_physical):
+        if is_physical:
+            return self._RESOURCE_ALLOC_SETTING_DATA_CLASS
+        return self._STORAGE_ALLOC_SETTING_DATA_CLASS
+
+    def _get_disk_resources(self, is_physical):
+        class_name = self._get_disk_resource_class(is_physical)
+
+        return self._query(
+            class_name,
+            conditions={'ResourceSubType': (self._PHYS_DISK_RES_SUB_TYPE,
+                                            self._HARD_DISK_RES_SUB_TYPE,
+                                            self._DVD_DISK_RES_SUB_TYPE)})
 
     def get_device_number_from_device_name(self, device_name):
         matches = self._phys_dev_name_regex.findall(device_name)
@@ -743,22 +1704,39 @@ class VMUtils(object):
             raise exceptions.HyperVException(err_msg % device_name)
 
     def get_mounted_disk_by_drive_number(self, device_number):
-        mounted_disks = self._conn.query("SELECT * FROM Msvm_DiskDrive "
-                                         "WHERE DriveNumber=" +
-                                         str(device_number))
+        mounted_disks = self._query(
+            self._DISK_DRIVE_CLASS, self._LOGICAL_DEVICE_KEY_PROPS,
+            {'DriveNumber': int(device_number)})
         if len(mounted_disks):
             return mounted_disks[0].path_()
 
+    def get_mounted_disks_by_drive_numbers(self, device_numbers):
+        """Retrieves the paths of multiple mounted disks using one query.
+
+        :returns: a dict mapping the device numbers to the mounted disk
+                  paths. Device numbers without a mounted disk are omitted.
+        """
+        if not device_numbers:
+            return {}
+
+        mounted_disks = self._query(
+            self._DISK_DRIVE_CLASS,
+            self._LOGICAL_DEVICE_KEY_PROPS + ['DriveNumber'],
+            {'DriveNumber': [int(device_number)
+                             for device_number in device_numbers]})
+        disk_paths = dict((int(mounted_disk.DriveNumber),
+                           mounted_disk.path_())
+                          for mounted_disk in mounted_disks)
+        return dict((device_number, disk_paths[int(device_number)])
+                    for device_number in device_numbers
+                    if int(device_number) in disk_paths)
+
     def get_controller_volume_paths(self, controller_path):
-        disks = self._conn.query("SELECT * FROM %(class_name)s "
-                                 "WHERE ResourceSubType = '%(res_sub_type)s' "
-                                 "AND Parent='%(parent)s'" %
-                                 {"class_name":
-                                  self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
-                                  "res_sub_type":
-                                  self._PHYS_DISK_RES_SUB_TYPE,
-                                  "parent":
-                                  controller_path})
+        disks = self._query(
+            self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+            ['InstanceID', 'HostResource'],
+            {'ResourceSubType': self._PHYS_DISK_RES_SUB_TYPE,
+             'Parent': controller_path})
         disk_data = {}
         for disk in disks:
             if disk.HostResource:
@@ -766,24 +1744,146 @@ class VMUtils(object):
         return disk_data
 
     def get_free_controller_slot(self, scsi_controller_path):
-        attached_disks = self.get_attached_disks(scsi_controller_path)
-        used_slots = [int(disk.AddressOnParent) for disk in attached_disks]
+        """Returns a free slot, reserving it until a disk is attached to it.
 
-        for slot in range(constants.SCSI_CONTROLLER_SLOTS_NUMBER):
-            if slot not in used_slots:
-                return slot
-        raise exceptions.HyperVException(
-            _("Exceeded the maximum number of slots"))
+        Concurrent requests get different slots. The reservation is dropped
+        if attaching the disk fails.
+        """
+        return self._get_free_controller_slots(scsi_controller_path, 1)[0]
+
+    def _get_free_controller_slots(self, scsi_controller_path, count):
+        return self._scsi_slot_allocator.reserve_slots(
+            scsi_controller_path, count,
+            functools.partial(self._get_used_controller_slots,
+                              scsi_controller_path))
+
+    def _get_used_controller_slots(self, scsi_controller_path):
+        attached_disks = self.get_attached_disks(scsi_controller_path,
+                                                 detached=True)
+        return [int(disk.AddressOnParent) for disk in attached_disks]
+
+    def release_controller_slots(self, scsi_controller_path, slots):
+        """Frees slots which were reserved but were not used."""
+        self._scsi_slot_allocator.release_reservations(scsi_controller_path,
+                                                       slots)
+
+    def _get_event_query(self, query, class_name, sub_types):
+        sub_type_conditions = ' OR '.join(
+            "TargetInstance.ResourceSubType = '%s'" % sub_type
+            for sub_type in sub_types)
+        return query % {'interval': self._DRIVE_EVENT_POLL_INTERVAL,
+                        'class': class_name,
+                        'sub_type_conditions': sub_type_conditions}
+
+    def _start_drive_event_watchers(self):
+        with _drive_event_watchers_lock:
+            if self._host in _drive_event_watchers:
+                return
+
+            drive_query = self._get_event_query(
+                self._DRIVE_EVENT_QUERY,
+                self._RESOURCE_ALLOC_SETTING_DATA_CLASS,
+                (self._DISK_DRIVE_RES_SUB_TYPE,
+                 self._DVD_DRIVE_RES_SUB_TYPE,
+                 self._PHYS_DISK_RES_SUB_TYPE))
+            disk_image_query = self._get_event_query(
+                self._DISK_IMAGE_EVENT_QUERY,
+                self._STORAGE_ALLOC_SETTING_DATA_CLASS,
+                (self._HARD_DISK_RES_SUB_TYPE,
+                 self._DVD_DISK_RES_SUB_TYPE))
+            watchers = [
+                baseutils.WMIEventWatcher(
+                    drive_query, self._process_drive_event, host=self._host,
+                    namespace=self._WMI_VIRT_NAMESPACE,
+                    fields=['Parent', 'AddressOnParent', 'ResourceSubType',
+                            'HostResource'],
+                    state_callback=self._on_drive_events_state_change,
+                    description='WMI drive'),
+                baseutils.WMIEventWatcher(
+                    disk_image_query, self._process_disk_image_event,
+                    host=self._host, namespace=self._WMI_VIRT_NAMESPACE,
+                    fields=['HostResource'],
+                    state_callback=self._on_disk_image_events_state_change,
+                    description='WMI disk image')]
+            _drive_event_watchers[self._host] = watchers
+
+        # Setting up the subscriptions may take a while, so this is done
+        # without holding the lock. The disk lookups do not rely on the
+        # events until the subscriptions are available.
+        for watcher in watchers:
+            watcher.start()
+
+    def _drive_events_available(self):
+        watchers = _drive_event_watchers.get(self._host)
+        return bool(watchers) and all(watcher.available
+                                      for watcher in watchers)
+
+    def _process_drive_event(self, event):
+        if not event:
+            return
+        # Passthrough disks are drives as well.
+        if event.ResourceSubType == self._PHYS_DISK_RES_SUB_TYPE:
+            self._update_indexed_disk_resource(event, is_physical=True)
+        if not event.Parent or event.AddressOnParent is None:
+            return
+        self._scsi_slot_allocator.update_slot(
+            event.Parent, int(event.AddressOnParent),
+            used=event.event_type == 'creation')
+
+    def _on_drive_events_state_change(self, available):
+        # Drive events may have been missed.
+        self._invalidate_disk_resource_index(is_physical=True)
+        self._scsi_slot_allocator.resync()
+
+    def _process_disk_image_event(self, event):
+        if event:
+            self._update_indexed_disk_resource(event, is_physical=False)
+
+    def _update_indexed_disk_resource(self, event, is_physical):
+        """Updates the index entry affected by a disk resource event.
+
+        COM objects cannot be passed to other threads, so the index is
+        invalidated instead of indexing a resource received by the event
+        watcher thread, unless the resource was already indexed when
+        attaching it.
+        """
+        disk_path = self._get_host_resource_path(event)
+        if event.event_type == 'deletion':
+            if disk_path:
+                self._drop_indexed_disk_resources([disk_path], is_physical)
+            return
+
+        if event.event_type == 'modification':
+            previous = getattr(event, 'previous', None)
+            if previous is None:
+                self._invalidate_disk_resource_index(is_physical)
+                return
+            previous_path = self._get_host_resource_path(previous)
+            if previous_path == disk_path:
+                return
+            if previous_path:
+                self._drop_indexed_disk_resources([previous_path],
+                                                  is_physical)
+
+        index = self._disk_resource_indexes.get(is_physical)
+        if disk_path and (index is None or disk_path not in index):
+            self._invalidate_disk_resource_index(is_physical)
+
+    @staticmethod
+    def _get_host_resource_path(disk_resource):
+        host_resource = disk_resource.HostResource
+        return host_resource[0].lower() if host_resource else None
+
+    def _on_disk_image_events_state_change(self, available):
+        self._invalidate_disk_resource_index(is_physical=False)
 
     def get_vm_serial_port_connection(self, vm_name, update_connection=None):
         # TODO(lpetrut): Remove this method after the patch implementing
         # serial console access support merges in Nova.
         vm = self._lookup_vm_check(vm_name)
 
-        vmsettings = vm.associators(
-            wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)
-        rasds = vmsettings[0].associators(
-            wmi_result_class=self._SERIAL_PORT_SETTING_DATA_CLASS)
+        rasds = self._get_vm_resources(
+            vm, self._SERIAL_PORT_SETTING_DATA_CLASS)
         serial_port = (
             [r for r in rasds if
              r.ResourceSubType == self._SERIAL_PORT_RES_SUB_TYPE][0])
@@ -791,15 +1891,14 @@ class VMUtils(object):
         if update_connection:
             serial_port.Connection = [update_connection]
             self._jobutils.modify_virt_resource(serial_port)
+            self._invalidate_vm_handle(vm)
 
         if len(serial_port.Connection) > 0:
             return serial_port.Connection[0]
 
     def _get_vm_serial_ports(self, vm):
-        vmsettings = vm.associators(
-            wmi_result_class=self._VIRTUAL_SYSTEM_SETTING_DATA_CLASS)
-        rasds = vmsettings[0].associators(
-            wmi_result_class=self._SERIAL_PORT_SETTING_DATA_CLASS)
+        rasds = self._get_vm_resources(
+            vm, self._SERIAL_PORT_SETTING_DATA_CLASS)
         serial_ports = (
             [r for r in rasds if
              r.ResourceSubType == self._SERIAL_PORT_RES_SUB_TYPE]
@@ -813,6 +1912,7 @@ class VMUtils(object):
         serial_port.Connection = [pipe_path]
 
         self._modify_virt_resource(serial_port, vm.path_())
+        self._invalidate_vm_handle(vm)
 
     def get_vm_serial_port_connections(self, vm_name):
         vm = self._lookup_vm_check(vm_name)
@@ -824,12 +1924,19 @@ class VMUtils(object):
 
     def get_active_instances(self):
         """Return the names of all the active instances known to Hyper-V."""
-        vm_names = self.list_instances()
-        vms = [self._lookup_vm(vm_name) for vm_name in vm_names]
-        active_vm_names = [v.ElementName for v in vms
-            if v.EnabledState == constants.HYPERV_VM_STATE_ENABLED]
-
-        return active_vm_names
+        return list(self.iter_active_instances())
+
+    def iter_active_instances(self):
+        """Yields the names of the active instances as they are retrieved."""
+        query = ("SELECT ElementName FROM %(class_name)s "
+                 "WHERE Caption = '%(caption)s' AND "
+                 "EnabledState = %(enabled_state)s" %
+                 {'class_name': self._COMPUTER_SYSTEM_CLASS,
+                  'caption': constants.VM_CAPTION,
+                  'enabled_state': self._vm_power_states_map[
+                      constants.HYPERV_VM_STATE_ENABLED]})
+        for vm in self._iter_query(query):
+            yield vm.ElementName
 
     def get_vm_power_state_change_listener(self, timeframe, filtered_states):
         field = self._VM_ENABLED_STATE_PROP
@@ -840,6 +1947,15 @@ class VMUtils(object):
         return self._conn.Msvm_ComputerSystem.watch_for(raw_wql=query,
                                                         fields=[field])
 
+    def get_vm_power_state_listener_service(self):
+        """Returns the VM power state listener shared on this host.
+
+        Unlike get_vm_power_state_change_listener, this uses a single WMI
+        event subscription for all the consumers, providing the current
+        VM power states as well. See vmpowerstate.VMPowerStateListener.
+        """
+        return vmpowerstate.get_power_state_listener(self, self._host)
+
     def _get_event_wql_query(self, cls, field,
                              timeframe, filtered_states=None):
         """Return a WQL query used for polling WMI events.
@@ -868,6 +1984,10 @@ class VMUtils(object):
         return query
 
     def _get_instance_notes(self, vm_name):
+        vm_info = self._get_vm_inventory_info(vm_name)
+        if vm_info:
+            return vm_info['notes']
+
         vm = self._lookup_vm_check(vm_name)
         vmsettings = self._get_vm_setting_data(vm)
         return [note for note in vmsettings.Notes if note]
@@ -877,11 +1997,29 @@ class VMUtils(object):
         if instance_notes and uuidutils.is_uuid_like(instance_notes[0]):
             return instance_notes[0]
 
+    def get_vm_name_by_instance_uuid(self, instance_uuid):
+        """Returns the name of the VM having the given instance uuid.
+
+        Returns None if no such VM exists.
+        """
+        if self._vm_inventory:
+            vm_name = self._vm_inventory.get_vm_name(instance_uuid)
+            if vm_name:
+                return vm_name
+
+        for vm_name, notes in self.iter_instance_notes():
+            if notes and notes[0] == instance_uuid:
+                return vm_name
+
     def get_vm_power_state(self, vm_enabled_state):
         return self._enabled_states_map.get(vm_enabled_state,
                                             constants.HYPERV_VM_STATE_OTHER)
 
     def get_vm_generation(self, vm_name):
+        vm_info = self._get_vm_inventory_info(vm_name)
+        if vm_info:
+            return vm_info['generation']
+
         vm = self._lookup_vm_check(vm_name)
         vssd = self._get_vm_setting_data(vm)
         if hasattr(vssd, self._VIRTUAL_SYSTEM_SUBTYPE):
@@ -923,6 +2061,10 @@ class VMUtils(object):
 
         disk_resource = self._get_mounted_disk_resource_from_path(
             disk_path, is_physical=False)
+        # The indexed resources are shared, so a fresh copy is modified.
+        disk_resource = self._query(
+            self._STORAGE_ALLOC_SETTING_DATA_CLASS,
+            conditions={'__PATH': disk_resource.path_()})[0]
 
         if max_iops is not None:
             disk_resource.IOPSLimit = max_iops
@@ -945,7 +2087,7 @@ class VMUtils(object):
             bssd = drive.associators(
                 wmi_association_class=self._LOGICAL_IDENTITY_CLASS)[0]
         else:
-            rasd = wmi.WMI(moniker=drive.Parent)
+            rasd = baseutils.get_wmi_object(drive.Parent)
             bssd = rasd.associators(
                 wmi_association_class=self._LOGICAL_IDENTITY_CLASS)[0]
         return bssd
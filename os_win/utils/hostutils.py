@@ -15,21 +15,18 @@
 
 import ctypes
 import socket
-import sys
-
-if sys.platform == 'win32':
-    import wmi
 
 from oslo_log import log as logging
 
 from os_win._i18n import _, _LW
 from os_win import constants
 from os_win import exceptions
+from os_win.utils import baseutils
 
 LOG = logging.getLogger(__name__)
 
 
-class HostUtils(object):
+class HostUtils(baseutils.BaseUtils):
 
     _windows_version = None
 
@@ -48,18 +45,27 @@ class HostUtils(object):
 
     def __init__(self):
         self._virt_v2 = None
-        if sys.platform == 'win32':
-            self._conn_cimv2 = wmi.WMI(privileges=["Shutdown"])
-            self._init_wmi_virt_conn()
+        # Set when the virtualization namespace is missing, in which case
+        # connecting is not attempted again.
+        self._virt_namespace_missing = False
+        self._conn_cimv2 = self._get_wmi_conn(self._WMI_CIMV2_NAMESPACE,
+                                              privileges=["Shutdown"])
 
     def _init_wmi_virt_conn(self):
         try:
-            self._virt_v2 = wmi.WMI(moniker='//./root/virtualization/v2')
-        except Exception:
-            pass
+            self._virt_v2 = self._get_wmi_conn(self._WMI_VIRT_NAMESPACE,
+                                               connect=True)
+        except Exception as exc:
+            if (baseutils.get_hresult(exc) ==
+                    baseutils.WBEM_E_INVALID_NAMESPACE):
+                self._virt_namespace_missing = True
 
     @property
     def _conn_virt(self):
+        if not self._virt_v2 and not self._virt_namespace_missing:
+            # The virtualization namespace may be missing, for which reason
+            # the connection is checked when first requested.
+            self._init_wmi_virt_conn()
         if self._virt_v2:
             return self._virt_v2
         raise exceptions.HyperVException(
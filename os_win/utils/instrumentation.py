@@ -0,0 +1,346 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Opt-in instrumentation of the WMI calls.
+
+When enabled, the queries, class enumerations, associator walks, method
+invocations and job waits performed through the pooled WMI connections are
+counted and timed, being aggregated by category, WMI class and method into
+latency histograms. The time spent waiting for VM locks and the retry
+backoff delays are recorded as well.
+"""
+
+import bisect
+import collections
+import contextlib
+import re
+import sys
+import threading
+import time
+
+from oslo_log import log as logging
+from oslo_service import loopingcall
+import six
+
+LOG = logging.getLogger(__name__)
+
+QUERY = 'query'
+ENUMERATION = 'enumeration'
+ASSOCIATORS = 'associators'
+METHOD = 'method'
+JOB_WAIT = 'job_wait'
+GET_OBJECT = 'get_object'
+LOCK_WAIT = 'lock_wait'
+RETRY_WAIT = 'retry_wait'
+
+# Histogram bucket upper bounds, in seconds.
+_BUCKET_BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+_QUERY_CLASS_REGEX = re.compile(r'\sFROM\s+(\w+)', re.IGNORECASE)
+# e.g. //HOST/root/virtualization/v2:Msvm_ConcreteJob.InstanceID="..."
+_PATH_CLASS_REGEX = re.compile(r'(\w+)\.\w+=')
+
+_enabled = False
+_stats_lock = threading.Lock()
+# The number of active call trackers, across all the threads. The
+# instrumentation is active while there is at least one.
+_active_tracker_count = 0
+# Maps (category, class_name, method) tuples to histograms.
+_stats = {}
+_local = threading.local()
+
+
+class Histogram(object):
+    """Latency histogram, using fixed buckets."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        # The last bucket holds the values exceeding the last bound.
+        self.buckets = [0] * (len(_BUCKET_BOUNDS) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.buckets[bisect.bisect_left(_BUCKET_BOUNDS, value)] += 1
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0
+
+    def as_dict(self):
+        bounds = [str(bound) for bound in _BUCKET_BOUNDS] + ['inf']
+        return {'count': self.count,
+                'total': self.total,
+                'average': self.average,
+                'min': self.min,
+                'max': self.max,
+                'buckets': collections.OrderedDict(zip(bounds,
+                                                       self.buckets))}
+
+
+class CallTracker(object):
+    """Counts the WMI calls performed by each public utils method."""
+
+    def __init__(self):
+        # Maps 'UtilsClass.method' to dicts, mapping the WMI call
+        # categories to call counts.
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def add(self, public_call, category):
+        self.counts[public_call][category] += 1
+
+    def get_counts(self):
+        return dict((public_call, dict(counts))
+                    for public_call, counts in self.counts.items())
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled or _active_tracker_count > 0
+
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
+
+
+def get_stats():
+    """Returns a dict mapping (category, class_name, method) tuples to
+    dicts describing the call latency histograms.
+    """
+    with _stats_lock:
+        return dict((key, histogram.as_dict())
+                    for key, histogram in _stats.items())
+
+
+def get_query_class(wql):
+    if not isinstance(wql, six.string_types):
+        return None
+    match = _QUERY_CLASS_REGEX.search(wql)
+    return match.group(1) if match else None
+
+
+def get_path_class(path):
+    if not isinstance(path, six.string_types):
+        return None
+    match = _PATH_CLASS_REGEX.search(path)
+    return match.group(1) if match else None
+
+
+def _get_active_trackers():
+    return getattr(_local, 'trackers', None)
+
+
+def _get_public_call():
+    # The outermost public utils method from the current call stack.
+    public_call = '<unknown>'
+    frame = sys._getframe(2)
+    while frame:
+        code = frame.f_code
+        if (not code.co_name.startswith('_') and
+                frame.f_globals.get('__name__', '').startswith(
+                    'os_win.utils') and
+                'self' in frame.f_locals):
+            public_call = '%s.%s' % (type(frame.f_locals['self']).__name__,
+                                     code.co_name)
+        frame = frame.f_back
+    return public_call
+
+
+def record(category, class_name, method, duration):
+    key = (category, class_name, method)
+    with _stats_lock:
+        histogram = _stats.get(key)
+        if histogram is None:
+            histogram = _stats[key] = Histogram()
+        histogram.add(duration)
+
+    trackers = _get_active_trackers()
+    if trackers:
+        public_call = _get_public_call()
+        for tracker in trackers:
+            tracker.add(public_call, category)
+
+
+@contextlib.contextmanager
+def measure(category, class_name, method):
+    """Times the wrapped block, if the instrumentation is enabled."""
+    if not is_enabled():
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(category, class_name, method, time.time() - start)
+
+
+@contextlib.contextmanager
+def track_calls():
+    """Counts the WMI calls performed by each public utils method.
+
+    Only the calls performed by the current thread within the context are
+    counted, the instrumentation being active while there are trackers in
+    use. The counts are logged when leaving the context.
+    """
+    global _active_tracker_count
+
+    tracker = CallTracker()
+    if _get_active_trackers() is None:
+        _local.trackers = []
+    _local.trackers.append(tracker)
+    with _stats_lock:
+        _active_tracker_count += 1
+    try:
+        yield tracker
+    finally:
+        with _stats_lock:
+            _active_tracker_count -= 1
+        _local.trackers.remove(tracker)
+        LOG.debug("WMI calls per public method: %s", tracker.get_counts())
+
+
+def format_stats():
+    lines = []
+    for (category, class_name, method), histogram in sorted(
+            get_stats().items(),
+            key=lambda item: [str(part) for part in item[0]]):
+        lines.append(
+            "%(category)s %(class_name)s.%(method)s: count=%(count)d "
+            "avg=%(average).4fs min=%(min).4fs max=%(max).4fs" % dict(
+                histogram, category=category, class_name=class_name,
+                method=method))
+    return '\n'.join(lines)
+
+
+def log_stats():
+    LOG.info("WMI call statistics:\n%s", format_stats())
+
+
+def start_periodic_dump(interval=60):
+    """Periodically logs the collected statistics.
+
+    :returns: the looping call, which may be used to stop the dumps.
+    """
+    timer = loopingcall.FixedIntervalLoopingCall(log_stats)
+    timer.start(interval=interval, initial_delay=interval)
+    return timer
+
+
+def wrap(obj, class_name=None):
+    """Wraps WMI objects so that associator walks and method invocations
+    are instrumented. Lists of objects are wrapped element wise.
+
+    Objects are only wrapped while the instrumentation is enabled, so it
+    has no overhead otherwise. The calls performed through objects
+    retrieved beforehand, e.g. cached by the utils classes, are not
+    measured.
+    """
+    if obj is None or not is_enabled():
+        return obj
+    if isinstance(obj, list):
+        return [wrap(item, class_name) for item in obj]
+    if isinstance(obj, InstrumentedWMIObject):
+        return obj
+    return InstrumentedWMIObject(obj, class_name)
+
+
+class InstrumentedWMIObject(object):
+    """Proxy forwarding everything to a WMI object.
+
+    The names ending with an underscore are WMI library helpers (e.g.
+    path_), which are not considered WMI method invocations. Neither are
+    the helpers of the wmi module objects, e.g. path and set.
+    """
+
+    _NON_METHOD_ATTRIBUTES = ('ole_object', 'path', 'set', 'keys',
+                              'derivation', 'qualifiers')
+
+    def __init__(self, wmi_object, class_name=None):
+        object.__setattr__(self, '_wmi_object', wmi_object)
+        object.__setattr__(self, '_class_name', class_name)
+
+    def __getattr__(self, name):
+        attr = getattr(self._wmi_object, name)
+        if name in ('associators', 'references'):
+            return self._get_associators_walker(name, attr)
+        if (callable(attr) and not name.endswith('_') and
+                name not in self._NON_METHOD_ATTRIBUTES):
+            return self._get_instrumented_method(name, attr)
+        return attr
+
+    def _get_associators_walker(self, name, func):
+        def walk(*args, **kwargs):
+            result_class = kwargs.get('wmi_result_class')
+            with measure(ASSOCIATORS, self._class_name,
+                         '%s:%s' % (name, result_class)):
+                results = func(*args, **kwargs)
+            return wrap(results, result_class)
+        return walk
+
+    def _get_instrumented_method(self, name, func):
+        def call(*args, **kwargs):
+            with measure(METHOD, self._class_name, name):
+                return func(*args, **kwargs)
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self._wmi_object, name, value)
+
+    # Mocked WMI call results are not always lists, the proxy forwarding
+    # item access and iteration as well.
+    def __getitem__(self, index):
+        return wrap(self._wmi_object[index], self._class_name)
+
+    def __iter__(self):
+        return iter(wrap(list(self._wmi_object), self._class_name))
+
+    def __len__(self):
+        return len(self._wmi_object)
+
+    def __bool__(self):
+        return bool(self._wmi_object)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, InstrumentedWMIObject):
+            other = other._wmi_object
+        return self._wmi_object == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._wmi_object)
+
+    def __repr__(self):
+        return repr(self._wmi_object)
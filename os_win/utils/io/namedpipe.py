@@ -13,7 +13,6 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import errno
 import os
 
 from eventlet import patcher
@@ -23,17 +22,27 @@ from os_win._i18n import _
 from os_win import constants
 from os_win import exceptions
 from os_win.utils.io import ioutils
+from os_win.utils import retry
 
 threading = patcher.original('threading')
 time = patcher.original('time')
 
 LOG = logging.getLogger(__name__)
 
+ERROR_ACCESS_DENIED = 5
+ERROR_SHARING_VIOLATION = 32
+
 
 class NamedPipeHandler(object):
     """Handles asyncronous I/O operations on a specified named pipe."""
 
-    _MAX_LOG_ROTATE_RETRIES = 5
+    _MAX_LOG_ROTATE_RETRIES = 20
+    _LOG_ROTATE_RETRY_TIMEOUT = 5
+    _LOG_ROTATE_RETRY_POLICY = retry.RetryPolicy(
+        'log_rotate', max_attempts=_MAX_LOG_ROTATE_RETRIES + 1,
+        timeout=_LOG_ROTATE_RETRY_TIMEOUT,
+        error_codes=(ERROR_ACCESS_DENIED, ERROR_SHARING_VIOLATION),
+        sleep=time.sleep)
 
     def __init__(self, pipe_name, input_queue=None, output_queue=None,
                  connect_event=None, log_file=None):
@@ -208,14 +217,4 @@ class NamedPipeHandler(object):
     def _retry_if_file_in_use(self, f, *args, **kwargs):
         # The log files might be in use if the console log is requested
         # while a log rotation is attempted.
-        retry_count = 0
-        while True:
-            try:
-                return f(*args, **kwargs)
-            except WindowsError as err:
-                if (err.errno == errno.EACCES and
-                        retry_count < self._MAX_LOG_ROTATE_RETRIES):
-                    retry_count += 1
-                    time.sleep(1)
-                else:
-                    raise
+        return self._LOG_ROTATE_RETRY_POLICY.call(f, *args, **kwargs)
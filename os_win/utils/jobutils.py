@@ -18,30 +18,248 @@
 Base Utility class for operations on Hyper-V.
 """
 
-import sys
+import re
+import threading
 import time
 
-if sys.platform == 'win32':
-    import wmi
-
+from eventlet import patcher
 from oslo_log import log as logging
-from oslo_service import loopingcall
 
 from os_win._i18n import _
 from os_win import constants
 from os_win import exceptions
+from os_win.utils import baseutils
+from os_win.utils import instrumentation
+from os_win.utils import retry
+from os_win.utils import vmlocks
+
+native_threading = patcher.original('threading')
 
 LOG = logging.getLogger(__name__)
 
+# Maps hosts to the job watchers shared by all the JobUtils instances.
+_job_watchers = {}
+_job_watchers_lock = native_threading.Lock()
+
+
+class _JobWatcher(object):
+    """Tracks job state changes using a single WMI event subscription.
 
-class JobUtils(object):
+    The subscription is only set up while there are job waiters, being
+    dropped after _IDLE_TIMEOUT seconds without waiters. Events are
+    received by a native thread, the waiters being woken up by a
+    notification dispatcher, so that they may block on green events when
+    eventlet monkey patching is used. Waiters are woken up as well when the
+    subscription is set up or lost, so that they may switch between waiting
+    for events and polling.
+    """
 
-    _WMI_NAMESPACE = '//%s/root/virtualization/v2'
+    _JOB_EVENT_QUERY = ("SELECT * FROM __InstanceModificationEvent "
+                        "WITHIN %(interval)s "
+                        "WHERE TargetInstance ISA 'CIM_ConcreteJob' "
+                        "AND TargetInstance.JobState != "
+                        "PreviousInstance.JobState")
+    _JOB_EVENT_POLL_INTERVAL = 1
+    _IDLE_TIMEOUT = 60
+
+    def __init__(self, host='.'):
+        self._host = host
+        self._lock = native_threading.Lock()
+        # Maps the upper case InstanceID of the awaited jobs to sets of
+        # waiter events, set once the jobs leave the running state.
+        self._waiters = {}
+        self._event_watcher = None
+        self._idle_since = None
+        self._dispatcher = baseutils.NotificationDispatcher('WMI job')
+
+    @property
+    def available(self):
+        event_watcher = self._event_watcher
+        return bool(event_watcher and event_watcher.available)
+
+    def stop(self):
+        with self._lock:
+            self._stop_event_watcher()
+
+    def _start_event_watcher(self):
+        self._event_watcher = baseutils.WMIEventWatcher(
+            self._JOB_EVENT_QUERY % {
+                'interval': self._JOB_EVENT_POLL_INTERVAL},
+            self._process_event, host=self._host, fields=['JobState'],
+            state_callback=self._on_state_change,
+            description='WMI job')
+        self._dispatcher.start()
+        # The waiters poll the job states until the subscription is set up.
+        self._event_watcher.start(wait=False)
+
+    def _stop_event_watcher(self):
+        if self._event_watcher:
+            self._event_watcher.stop()
+            self._event_watcher = None
+            self._dispatcher.stop()
+
+    def _stop_if_idle(self):
+        with self._lock:
+            if (not self._waiters and self._idle_since is not None and
+                    time.time() - self._idle_since >= self._IDLE_TIMEOUT):
+                self._idle_since = None
+                self._stop_event_watcher()
+
+    def _wake_up(self, waiters):
+        for waiter in waiters:
+            self._dispatcher.dispatch(waiter.set)
+
+    def _process_event(self, event):
+        if not event:
+            self._stop_if_idle()
+            return
+        if event.JobState == constants.WMI_JOB_STATE_RUNNING:
+            return
+        with self._lock:
+            waiters = list(self._waiters.get(event.InstanceID.upper(), ()))
+        self._wake_up(waiters)
+
+    def _on_state_change(self, available):
+        with self._lock:
+            waiters = set()
+            for job_waiters in self._waiters.values():
+                waiters.update(job_waiters)
+        self._wake_up(waiters)
+
+    def add_waiter(self, job_ids):
+        """Registers a waiter of the given jobs.
+
+        :returns: an event, set when any of the jobs leaves the running
+                  state. It's also set when the subscription is set up or
+                  lost, so the job states have to be checked each time.
+                  It's green when eventlet monkey patching is used.
+        """
+        waiter = threading.Event()
+        with self._lock:
+            for job_id in job_ids:
+                self._waiters.setdefault(job_id.upper(), set()).add(waiter)
+            self._idle_since = None
+            if not self._event_watcher:
+                self._start_event_watcher()
+        return waiter
+
+    def remove_waiter(self, job_ids, waiter):
+        with self._lock:
+            for job_id in job_ids:
+                job_waiters = self._waiters.get(job_id.upper())
+                if job_waiters is None:
+                    continue
+                job_waiters.discard(waiter)
+                if not job_waiters:
+                    del self._waiters[job_id.upper()]
+            if not self._waiters:
+                self._idle_since = time.time()
+
+
+class WMIJobHandle(object):
+    """Handle of a WMI job which is not waited for when started.
+
+    :param jobutils: the JobUtils instance used for waiting on the job.
+    :param job_path: the WMI job path, None if the operation completed
+                     synchronously.
+    :param result_func: optional callable receiving the finished job (None
+                        for synchronous operations), returning the
+                        operation result.
+    """
+
+    def __init__(self, jobutils, job_path=None, result_func=None):
+        self._jobutils = jobutils
+        self._job_path = job_path
+        self._result_func = result_func
+        self._finished = False
+        self._result = None
+        self._exc = None
+
+    @property
+    def job_path(self):
+        return self._job_path
+
+    def _get_job(self):
+        return baseutils.get_wmi_object(self._job_path.replace('\\', '/'))
+
+    def done(self):
+        if self._finished or not self._job_path:
+            return True
+        return self._get_job().JobState != constants.WMI_JOB_STATE_RUNNING
+
+    @property
+    def progress(self):
+        """Returns the job completion percentage."""
+        if self._finished or not self._job_path:
+            return 100
+        return self._get_job().PercentComplete
+
+    def cancel(self):
+        """Requests the job to be stopped.
+
+        :returns: True if the cancel request was issued.
+        """
+        if self._finished or not self._job_path:
+            return False
+        job = self._get_job()
+        if not job.Cancellable or self._jobutils._is_job_completed(job):
+            return False
+        job.RequestStateChange(self._jobutils._KILL_JOB_STATE_CHANGE_REQUEST)
+        return True
+
+    def result(self, timeout=None):
+        """Waits for the job to finish, returning the operation result.
+
+        :raises WMIJobTimeoutException: if the job did not finish in the
+                                        specified amount of seconds.
+        :raises HyperVException: if the job failed.
+        """
+        if not self._finished:
+            try:
+                job = None
+                if self._job_path:
+                    job = self._jobutils._wait_for_job(self._job_path,
+                                                       timeout=timeout)
+                if self._result_func:
+                    self._result = self._result_func(job)
+            except exceptions.WMIJobTimeoutException:
+                raise
+            except Exception as exc:
+                self._exc = exc
+            self._finished = True
+
+        if self._exc:
+            raise self._exc
+        return self._result
+
+
+class JobUtils(baseutils.BaseUtils):
 
     _CONCRETE_JOB_CLASS = "Msvm_ConcreteJob"
 
     _KILL_JOB_STATE_CHANGE_REQUEST = 5
 
+    # Job state polling intervals, used when job events are not available.
+    _JOB_POLL_INITIAL_INTERVAL = 0.05
+    _JOB_POLL_MAX_INTERVAL = 1
+    _JOB_POLL_BACKOFF_FACTOR = 2
+    # Events may get lost, so the job is still checked from time to time.
+    _JOB_EVENT_RECHECK_INTERVAL = 5
+
+    _use_job_events = True
+
+    # Changing the VM resources can fail transiently, especially while
+    # setting up the VM's serial port connection. Retrying the operation
+    # for a few seconds will yield success, unless the request itself is
+    # invalid.
+    _VIRT_RESOURCE_RETRY_POLICY = retry.RetryPolicy(
+        'virt_resource', max_attempts=20, timeout=5,
+        exceptions=(exceptions.HyperVException, ),
+        fatal_error_codes=(constants.WMI_JOB_ERROR_ACCESS_DENIED,
+                           constants.WMI_JOB_ERROR_NOT_SUPPORTED,
+                           constants.WMI_JOB_ERROR_INVALID_PARAMETER,
+                           constants.WMI_JOB_ERROR_INCORRECT_DATA_TYPE))
+
     _completed_job_states = [constants.JOB_STATE_COMPLETED,
                              constants.JOB_STATE_TERMINATED,
                              constants.JOB_STATE_KILLED,
@@ -49,11 +267,9 @@ class JobUtils(object):
 
     def __init__(self, host='.'):
         self._vs_man_svc_attr = None
-        if sys.platform == 'win32':
-            self._init_hyperv_wmi_conn(host)
-
-    def _init_hyperv_wmi_conn(self, host):
-        self._conn = wmi.WMI(moniker=self._WMI_NAMESPACE % host)
+        self._host = host
+        self._conn = self._get_wmi_conn(self._WMI_VIRT_NAMESPACE, host)
+        self._vm_locks = vmlocks.get_lock_manager()
 
     @property
     def _vs_man_svc(self):
@@ -67,18 +283,147 @@ class JobUtils(object):
                        constants.WMI_JOB_STATE_RUNNING]:
             return self._wait_for_job(job_path)
         elif ret_val not in success_values:
-            raise exceptions.HyperVException(
-                _('Operation failed with return value: %s') % ret_val)
-
-    def _wait_for_job(self, job_path):
-        """Poll WMI job state and wait for completion."""
+            raise exceptions.WMIJobFailed(
+                _('Operation failed with return value: %s') % ret_val,
+                error_code=ret_val)
+
+    def _get_job_watcher(self):
+        if not self._use_job_events:
+            return None
+
+        with _job_watchers_lock:
+            watcher = _job_watchers.get(self._host)
+            if not watcher:
+                watcher = _JobWatcher(self._host)
+                _job_watchers[self._host] = watcher
+        return watcher
+
+    def _wait_for_job_states(self, job_ids, wait_func, timeout=None):
+        """Calls wait_func until it returns a result other than None.
+
+        Between calls, the job state events are awaited when available.
+        Otherwise, the job states are polled using an exponential backoff.
+
+        :returns: the wait_func result, or None if the timeout expired.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        watcher = None
+        if job_ids and all(job_ids):
+            watcher = self._get_job_watcher()
+        # Registering the waiter before checking the job states ensures
+        # that no state change can be missed.
+        waiter = watcher.add_waiter(job_ids) if watcher else None
+
+        try:
+            poll_interval = self._JOB_POLL_INITIAL_INTERVAL
+            while True:
+                result = wait_func()
+                if result is not None:
+                    return result
+
+                wait_time = self._JOB_EVENT_RECHECK_INTERVAL
+                if not (watcher and watcher.available):
+                    wait_time = poll_interval
+                    poll_interval = min(
+                        poll_interval * self._JOB_POLL_BACKOFF_FACTOR,
+                        self._JOB_POLL_MAX_INTERVAL)
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    wait_time = min(wait_time, remaining)
+
+                if waiter:
+                    waiter.wait(wait_time)
+                    # The job states are checked next, so the waiter may
+                    # be reused.
+                    waiter.clear()
+                else:
+                    time.sleep(wait_time)
+        finally:
+            if waiter:
+                watcher.remove_waiter(job_ids, waiter)
+
+    def _get_job_id(self, job_path):
+        match = re.search(r'InstanceID="([^"]+)"', job_path)
+        return match.group(1) if match else None
+
+    def check_ret_val_async(self, ret_val, job_path, success_values=[0],
+                            result_func=None):
+        """Returns a WMIJobHandle instead of waiting for the job."""
+        if ret_val in [constants.WMI_JOB_STATUS_STARTED,
+                       constants.WMI_JOB_STATE_RUNNING]:
+            return WMIJobHandle(self, job_path, result_func)
+        elif ret_val not in success_values:
+            raise exceptions.WMIJobFailed(
+                _('Operation failed with return value: %s') % ret_val,
+                error_code=ret_val)
+        return WMIJobHandle(self, result_func=result_func)
+
+    def wait_for_jobs(self, job_handles, timeout=None):
+        """Waits for multiple jobs, returning their results.
+
+        The jobs are running in parallel, so waiting for them sequentially
+        takes roughly as long as the slowest job.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        results = []
+        for job_handle in job_handles:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.time())
+            results.append(job_handle.result(timeout=remaining))
+        return results
+
+    def wait_for_any(self, job_handles, timeout=None):
+        """Waits until at least one of the jobs finishes.
+
+        Job state events are used when available, the job states being
+        polled otherwise.
+
+        :returns: the finished job handles, which may be waited for without
+                  blocking. The list is empty if the timeout expired.
+        """
+        job_ids = [self._get_job_id(job_handle.job_path)
+                   for job_handle in job_handles if job_handle.job_path]
+
+        def get_finished_jobs():
+            return [job_handle for job_handle in job_handles
+                    if job_handle.done()] or None
+
+        return self._wait_for_job_states(job_ids, get_finished_jobs,
+                                         timeout) or []
+
+    def _wait_for_job(self, job_path, timeout=None):
+        match = re.search(r':(\w+)\.', job_path)
+        job_class = match.group(1) if match else None
+        with instrumentation.measure(instrumentation.JOB_WAIT, job_class,
+                                     'wait'):
+            return self._do_wait_for_job(job_path, timeout)
+
+    def _do_wait_for_job(self, job_path, timeout=None):
+        """Wait for the WMI job to complete.
+
+        Job state changes are received through a WMI event subscription,
+        the job state being polled with an exponential backoff only when
+        events are not available.
+
+        :param timeout: optional amount of seconds after which
+                        WMIJobTimeoutException is raised.
+        """
 
         job_wmi_path = job_path.replace('\\', '/')
-        job = wmi.WMI(moniker=job_wmi_path)
 
-        while job.JobState == constants.WMI_JOB_STATE_RUNNING:
-            time.sleep(0.1)
-            job = wmi.WMI(moniker=job_wmi_path)
+        def get_finished_job():
+            job = baseutils.get_wmi_object(job_wmi_path)
+            if job.JobState != constants.WMI_JOB_STATE_RUNNING:
+                return job
+
+        job = self._wait_for_job_states([self._get_job_id(job_path)],
+                                        get_finished_job, timeout)
+        if job is None:
+            raise exceptions.WMIJobTimeoutException(job_path=job_path,
+                                                    timeout=timeout)
 
         if job.JobState == constants.JOB_STATE_KILLED:
             LOG.debug("WMI job killed with status %s.", job.JobState)
@@ -87,29 +432,25 @@ class JobUtils(object):
         if job.JobState != constants.WMI_JOB_STATE_COMPLETED:
             job_state = job.JobState
             if job.path().Class == "Msvm_ConcreteJob":
-                err_sum_desc = job.ErrorSummaryDescription
-                err_desc = job.ErrorDescription
-                err_code = job.ErrorCode
-                data = {'job_state': job_state,
-                        'err_sum_desc': err_sum_desc,
-                        'err_desc': err_desc,
-                        'err_code': err_code}
-                raise exceptions.HyperVException(
-                    _("WMI job failed with status %(job_state)d. "
-                      "Error details: %(err_sum_desc)s - %(err_desc)s - "
-                      "Error code: %(err_code)d") % data)
+                raise exceptions.WMIJobFailed(
+                    job_state=job_state,
+                    error_code=job.ErrorCode,
+                    error_summ_desc=job.ErrorSummaryDescription,
+                    error_desc=job.ErrorDescription)
             else:
                 (error, ret_val) = job.GetError()
                 if not ret_val and error:
                     data = {'job_state': job_state,
                             'error': error}
-                    raise exceptions.HyperVException(
+                    raise exceptions.WMIJobFailed(
                         _("WMI job failed with status %(job_state)d. "
-                          "Error details: %(error)s") % data)
+                          "Error details: %(error)s") % data,
+                        job_state=job_state)
                 else:
-                    raise exceptions.HyperVException(
+                    raise exceptions.WMIJobFailed(
                         _("WMI job failed with status %d. No error "
-                          "description available") % job_state)
+                          "description available") % job_state,
+                        job_state=job_state)
         desc = job.Description
         elap = job.ElapsedTime
         LOG.debug("WMI job succeeded: %(desc)s, Elapsed=%(elap)s",
@@ -129,42 +470,81 @@ class JobUtils(object):
         return job.JobState in self._completed_job_states
 
     def add_virt_resource(self, virt_resource, parent):
-        (job_path, new_resources,
-         ret_val) = self._vs_man_svc.AddResourceSettings(
-            parent.path_(), [virt_resource.GetText_(1)])
-        self.check_ret_val(ret_val, job_path)
+        return self.add_multiple_virt_resources([virt_resource], parent)
+
+    def add_multiple_virt_resources(self, virt_resources, parent):
+        """Adds the given resources using a single job.
+
+        :returns: the paths of the added resources, in the same order.
+        """
+        with self._vm_locks.lock_objects([parent]):
+            (job_path, new_resources,
+             ret_val) = self._vs_man_svc.AddResourceSettings(
+                parent.path_(), [r.GetText_(1) for r in virt_resources])
+            self.check_ret_val(ret_val, job_path)
         return new_resources
 
-    # modify_virt_resource can fail, especially while setting up the VM's
-    # serial port connection. Retrying the operation will yield success.
-    @loopingcall.RetryDecorator(max_retry_count=5, max_sleep_time=1,
-                                exceptions=(exceptions.HyperVException, ))
+    def add_virt_resource_async(self, virt_resource, parent):
+        """Adds the resource, returning a WMIJobHandle.
+
+        The handle's result is the list of added resource paths. The VM
+        lock is only held while starting the job.
+        """
+        with self._vm_locks.lock_objects([parent]):
+            (job_path, new_resources,
+             ret_val) = self._vs_man_svc.AddResourceSettings(
+                parent.path_(), [virt_resource.GetText_(1)])
+        return self.check_ret_val_async(
+            ret_val, job_path, result_func=lambda job: new_resources)
+
     def modify_virt_resource(self, virt_resource):
-        (job_path, out_set_data,
-         ret_val) = self._vs_man_svc.ModifyResourceSettings(
-            ResourceSettings=[virt_resource.GetText_(1)])
-        self.check_ret_val(ret_val, job_path)
+        self.modify_multiple_virt_resources([virt_resource])
+
+    @_VIRT_RESOURCE_RETRY_POLICY
+    def modify_multiple_virt_resources(self, virt_resources):
+        with self._vm_locks.lock_objects(virt_resources):
+            (job_path, out_set_data,
+             ret_val) = self._vs_man_svc.ModifyResourceSettings(
+                ResourceSettings=[r.GetText_(1) for r in virt_resources])
+            self.check_ret_val(ret_val, job_path)
+
+    def modify_virt_resource_async(self, virt_resource):
+        """Modifies the resource, returning a WMIJobHandle.
+
+        Unlike modify_virt_resource, failed operations are not retried.
+        The VM lock is only held while starting the job.
+        """
+        with self._vm_locks.lock_objects([virt_resource]):
+            (job_path, out_set_data,
+             ret_val) = self._vs_man_svc.ModifyResourceSettings(
+                ResourceSettings=[virt_resource.GetText_(1)])
+        return self.check_ret_val_async(ret_val, job_path)
 
     def remove_virt_resource(self, virt_resource):
-        (job, ret_val) = self._vs_man_svc.RemoveResourceSettings(
-            ResourceSettings=[virt_resource.path_()])
-        self.check_ret_val(ret_val, job)
+        self.remove_multiple_virt_resources([virt_resource])
+
+    def remove_multiple_virt_resources(self, virt_resources):
+        with self._vm_locks.lock_objects(virt_resources):
+            (job, ret_val) = self._vs_man_svc.RemoveResourceSettings(
+                ResourceSettings=[r.path_() for r in virt_resources])
+            self.check_ret_val(ret_val, job)
 
     def add_virt_feature(self, virt_feature, parent):
         self.add_multiple_virt_features([virt_feature], parent)
 
-    @loopingcall.RetryDecorator(max_retry_count=5, max_sleep_time=1,
-                                exceptions=(exceptions.HyperVException, ))
+    @_VIRT_RESOURCE_RETRY_POLICY
     def add_multiple_virt_features(self, virt_features, parent):
-        (job_path, out_set_data,
-         ret_val) = self._vs_man_svc.AddFeatureSettings(
-            parent.path_(), [f.GetText_(1) for f in virt_features])
-        self.check_ret_val(ret_val, job_path)
+        with self._vm_locks.lock_objects([parent]):
+            (job_path, out_set_data,
+             ret_val) = self._vs_man_svc.AddFeatureSettings(
+                parent.path_(), [f.GetText_(1) for f in virt_features])
+            self.check_ret_val(ret_val, job_path)
 
     def remove_virt_feature(self, virt_feature):
         self.remove_multiple_virt_features([virt_feature])
 
     def remove_multiple_virt_features(self, virt_features):
-        (job_path, ret_val) = self._vs_man_svc.RemoveFeatureSettings(
-            FeatureSettings=[f.path_() for f in virt_features])
-        self.check_ret_val(ret_val, job_path)
+        with self._vm_locks.lock_objects(virt_features):
+            (job_path, ret_val) = self._vs_man_svc.RemoveFeatureSettings(
+                FeatureSettings=[f.path_() for f in virt_features])
+            self.check_ret_val(ret_val, job_path)
@@ -20,20 +20,19 @@ Hyper-V Server / Windows Server 2012.
 """
 
 from eventlet import greenthread
-import sys
-
-if sys.platform == 'win32':
-    import wmi
 
 from os_win._i18n import _
 from os_win import exceptions
+from os_win.utils import baseutils
 from os_win.utils import jobutils
 
 
-class NetworkUtils(object):
+class NetworkUtils(baseutils.BaseUtils):
 
     _EXTERNAL_PORT = 'Msvm_ExternalEthernetPort'
     _ETHERNET_SWITCH_PORT = 'Msvm_EthernetSwitchPort'
+    _SYNTHETIC_ETHERNET_PORT_SETTING_DATA = (
+        'Msvm_SyntheticEthernetPortSettingData')
     _PORT_ALLOC_SET_DATA = 'Msvm_EthernetPortAllocationSettingData'
     _PORT_VLAN_SET_DATA = 'Msvm_EthernetSwitchPortVlanSettingData'
     _PORT_SECURITY_SET_DATA = 'Msvm_EthernetSwitchPortSecuritySettingData'
@@ -78,8 +77,7 @@ class NetworkUtils(object):
 
     def __init__(self):
         self._jobutils = jobutils.JobUtils()
-        if sys.platform == 'win32':
-            self._conn = wmi.WMI(moniker='//./root/virtualization/v2')
+        self._conn = self._get_wmi_conn(self._WMI_VIRT_NAMESPACE)
 
     def get_external_vswitch(self, vswitch_name):
         if vswitch_name:
@@ -120,18 +118,22 @@ class NetworkUtils(object):
         return False
 
     def get_switch_ports(self, vswitch_name):
+        return set(self.iter_switch_ports(vswitch_name))
+
+    def iter_switch_ports(self, vswitch_name):
+        """Yields the vswitch port names as they are retrieved."""
         vswitch = self._get_vswitch(vswitch_name)
-        vswitch_ports = vswitch.associators(
-            wmi_result_class=self._ETHERNET_SWITCH_PORT)
-        return set(p.Name for p in vswitch_ports)
+        query = baseutils.build_query(self._ETHERNET_SWITCH_PORT, ['Name'],
+                                      {'SystemName': vswitch.Name})
+        for switch_port in self._iter_query(query):
+            yield switch_port.Name
 
     def get_port_by_id(self, port_id, vswitch_name):
         vswitch = self._get_vswitch(vswitch_name)
-        switch_ports = vswitch.associators(
-            wmi_result_class=self._ETHERNET_SWITCH_PORT)
-        for switch_port in switch_ports:
-            if (switch_port.ElementName == port_id):
-                return switch_port
+        switch_ports = self._query(
+            self._ETHERNET_SWITCH_PORT,
+            conditions={'SystemName': vswitch.Name, 'ElementName': port_id})
+        return self._get_first_item(switch_ports)
 
     def vnic_port_exists(self, port_id):
         try:
@@ -141,10 +143,17 @@ class NetworkUtils(object):
         return True
 
     def get_vnic_ids(self):
-        return set(
-            p.ElementName
-            for p in self._conn.Msvm_SyntheticEthernetPortSettingData()
-            if p.ElementName is not None)
+        return set(self.iter_vnic_ids())
+
+    def iter_vnic_ids(self):
+        """Yields the vNIC ids as they are retrieved, without duplicates."""
+        seen_ids = set()
+        for vnic in self._iter_query(baseutils.build_query(
+                self._SYNTHETIC_ETHERNET_PORT_SETTING_DATA, ['ElementName'])):
+            if vnic.ElementName is not None and (
+                    vnic.ElementName not in seen_ids):
+                seen_ids.add(vnic.ElementName)
+                yield vnic.ElementName
 
     def _get_vnic_settings(self, vnic_name):
         vnic_settings = self._conn.Msvm_SyntheticEthernetPortSettingData(
@@ -229,11 +238,9 @@ class NetworkUtils(object):
             switch_port_name, create)
 
     def _get_setting_data(self, class_name, element_name, create=True):
-        element_name = element_name.replace("'", '"')
-        q = self._conn.query("SELECT * FROM %(class_name)s WHERE "
-                             "ElementName = '%(element_name)s'" %
-                             {"class_name": class_name,
-                              "element_name": element_name})
+        # The returned objects may be modified, so all the properties
+        # are retrieved.
+        q = self._query(class_name, conditions={'ElementName': element_name})
         data = self._get_first_item(q)
         found = data is not None
         if not data and create:
@@ -241,10 +248,6 @@ class NetworkUtils(object):
             data.ElementName = element_name
         return data, found
 
-    def _get_default_setting_data(self, class_name):
-        return self._conn.query("SELECT * FROM %s WHERE InstanceID "
-                                "LIKE '%%\\Default'" % class_name)[0]
-
     def _get_first_item(self, obj):
         if obj:
             return obj[0]
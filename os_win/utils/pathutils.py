@@ -17,7 +17,6 @@ import ctypes
 import os
 import shutil
 import sys
-import time
 
 if sys.platform == 'win32':
     from ctypes import wintypes
@@ -28,6 +27,7 @@ import six
 
 from os_win._i18n import _
 from os_win import exceptions
+from os_win.utils import retry
 from os_win.utils.storage import smbutils
 from os_win.utils import win32utils
 
@@ -104,18 +104,12 @@ class PathUtils(smbutils.SMBUtils):
             if os.path.isfile(src):
                 self.rename(src, os.path.join(dest_dir, fname))
 
+    # The retries will be removed once support for Windows Server 2008R2
+    # is stopped
+    @retry.RetryPolicy('rmtree', max_attempts=10, timeout=5,
+                       error_codes=(ERROR_DIR_IS_NOT_EMPTY, ))
     def rmtree(self, path):
-        # This will be removed once support for Windows Server 2008R2 is
-        # stopped
-        for i in range(5):
-            try:
-                shutil.rmtree(path)
-                return
-            except WindowsError as e:
-                if e.winerror == ERROR_DIR_IS_NOT_EMPTY:
-                    time.sleep(1)
-                else:
-                    raise e
+        shutil.rmtree(path)
 
     def check_create_dir(self, path):
         if not self.exists(path):
@@ -0,0 +1,222 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Retry policies for the operations which may fail transiently.
+
+Failed attempts are retried using exponential backoff with jitter, so that
+operations succeeding after a few milliseconds are not delayed by whole
+seconds, while concurrent callers do not retry in lockstep. Errors are
+classified as retryable based on their type and error code (WMI job error
+code, HRESULT or Win32 error code). Retries stop once the policy timeout
+or the caller's deadline would be exceeded.
+"""
+
+import collections
+import contextlib
+import functools
+import random
+import threading
+import time
+
+from oslo_log import log as logging
+
+from os_win.utils import baseutils
+from os_win.utils import instrumentation
+
+LOG = logging.getLogger(__name__)
+
+CALLS = 'calls'
+RETRIES = 'retries'
+RECOVERED = 'recovered'
+NOT_RETRYABLE = 'not_retryable'
+EXHAUSTED = 'exhausted'
+DEADLINE_EXCEEDED = 'deadline_exceeded'
+
+_stats_lock = threading.Lock()
+# Maps policy names to counters.
+_stats = collections.defaultdict(collections.Counter)
+_local = threading.local()
+
+
+def get_error_code(exc):
+    """Returns the error code carried by the given exception, if any.
+
+    os-win exceptions expose the WMI job or Win32 error codes, WMI / COM
+    errors carry a HRESULT while WindowsError exceptions carry the Win32
+    error code.
+    """
+    error_code = getattr(exc, 'error_code', None)
+    if error_code is None:
+        error_code = baseutils.get_hresult(exc)
+    if error_code is None:
+        error_code = getattr(exc, 'winerror', None)
+    return error_code
+
+
+def get_stats():
+    """Returns a dict mapping policy names to retry counters."""
+    with _stats_lock:
+        return dict((name, dict(counters))
+                    for name, counters in _stats.items())
+
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def _get_deadline():
+    return getattr(_local, 'deadline', None)
+
+
+@contextlib.contextmanager
+def deadline(timeout):
+    """Bounds the retries performed by the current thread within the context.
+
+    Attempts are not interrupted, but no retry is scheduled past the
+    deadline. Nested deadlines may only shorten the outer ones.
+    """
+    previous_deadline = _get_deadline()
+    new_deadline = time.time() + timeout
+    if previous_deadline is not None:
+        new_deadline = min(previous_deadline, new_deadline)
+
+    _local.deadline = new_deadline
+    try:
+        yield
+    finally:
+        _local.deadline = previous_deadline
+
+
+class RetryPolicy(object):
+    """Retries failed calls using exponential backoff with jitter.
+
+    The policy may be used as a decorator or through the call method. The
+    attributes may be changed in order to tune existing policies.
+
+    :param name: identifies the policy in logs and statistics.
+    :param max_attempts: the maximum number of attempts, including the
+                         first one.
+    :param initial_delay: the delay preceding the first retry, in seconds.
+                          It's multiplied by the backoff factor for each
+                          subsequent retry, up to max_delay.
+    :param jitter: the ratio by which delays are randomly shortened.
+    :param timeout: the overall time budget, including the attempts, after
+                    which the operation is not retried anymore.
+    :param exceptions: the retryable exception types.
+    :param error_codes: if set, only the errors having one of those codes
+                        are retried.
+    :param fatal_error_codes: codes of the errors which are never retried.
+    :param sleep: the function used for sleeping, defaults to time.sleep.
+    """
+
+    def __init__(self, name, max_attempts=5, initial_delay=0.05,
+                 max_delay=1, backoff_factor=2, jitter=0.5, timeout=None,
+                 exceptions=(Exception, ), error_codes=None,
+                 fatal_error_codes=(), sleep=None):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.timeout = timeout
+        self.exceptions = exceptions
+        self.error_codes = error_codes
+        self.fatal_error_codes = fatal_error_codes
+        self.sleep = sleep
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return wrapper
+
+    def is_retryable(self, exc):
+        if not isinstance(exc, self.exceptions):
+            return False
+
+        error_code = get_error_code(exc)
+        if error_code in self.fatal_error_codes:
+            return False
+        if self.error_codes is not None:
+            return error_code in self.error_codes
+        return True
+
+    def get_delay(self, retry_number):
+        """Returns the delay preceding the given retry, counting from 1."""
+        delay = min(self.max_delay,
+                    self.initial_delay *
+                    self.backoff_factor ** (retry_number - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def _get_deadline(self, start_time):
+        deadlines = [_get_deadline()]
+        if self.timeout is not None:
+            deadlines.append(start_time + self.timeout)
+        deadlines = [value for value in deadlines if value is not None]
+        return min(deadlines) if deadlines else None
+
+    def _count(self, *counters):
+        with _stats_lock:
+            _stats[self.name].update(counters)
+
+    def _get_outcome(self, exc, attempt, delay, deadline):
+        if not self.is_retryable(exc):
+            return NOT_RETRYABLE
+        if attempt >= self.max_attempts:
+            return EXHAUSTED
+        if deadline is not None and time.time() + delay > deadline:
+            return DEADLINE_EXCEEDED
+        return RETRIES
+
+    def call(self, func, *args, **kwargs):
+        call_deadline = self._get_deadline(time.time())
+        func_name = getattr(func, '__name__', str(func))
+
+        attempt = 1
+        while True:
+            try:
+                result = func(*args, **kwargs)
+                break
+            except Exception as exc:
+                delay = self.get_delay(attempt)
+                outcome = self._get_outcome(exc, attempt, delay,
+                                            call_deadline)
+                if outcome != RETRIES:
+                    self._count(CALLS, outcome)
+                    raise
+
+                LOG.debug("%(func_name)s failed (attempt %(attempt)d of "
+                          "%(max_attempts)d), retrying in %(delay).3f "
+                          "seconds. Error: %(exc)s",
+                          {'func_name': func_name,
+                           'attempt': attempt,
+                           'max_attempts': self.max_attempts,
+                           'delay': delay,
+                           'exc': exc})
+
+            self._count(RETRIES)
+            with instrumentation.measure(instrumentation.RETRY_WAIT,
+                                         self.name, func_name):
+                (self.sleep or time.sleep)(delay)
+            attempt += 1
+
+        if attempt > 1:
+            self._count(CALLS, RECOVERED)
+        else:
+            self._count(CALLS)
+        return result
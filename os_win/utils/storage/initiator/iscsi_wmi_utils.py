@@ -40,12 +40,13 @@ CONF = cfg.CONF
 class ISCSIInitiatorWMIUtils(base_iscsi_utils.BaseISCSIInitiatorUtils):
     _CHAP_AUTH_TYPE = 'ONEWAYCHAP'
 
+    _WMI_STORAGE_NAMESPACE = 'root/microsoft/windows/storage'
+
     def __init__(self, host='.'):
         super(ISCSIInitiatorWMIUtils, self).__init__(host)
 
-        storage_namespace = '//%s/root/microsoft/windows/storage' % host
-        if sys.platform == 'win32':
-            self._conn_storage = wmi.WMI(moniker=storage_namespace)
+        self._conn_storage = self._get_wmi_conn(self._WMI_STORAGE_NAMESPACE,
+                                                host)
 
     def _login_target_portal(self, target_portal):
         (target_address,
@@ -0,0 +1,227 @@
+# Copyright 2016 Cloudbase Solutions Srl
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Per VM serialization of the operations modifying VMs.
+
+Hyper-V rejects operations targeting a VM which is being modified by a
+concurrent operation (e.g. with 32775, invalid state). Operations on the
+same VM are ordered using per VM locks, while operations on different VMs
+proceed in parallel.
+"""
+
+import collections
+import contextlib
+import re
+import threading
+
+import six
+from six.moves import _thread
+
+from os_win._i18n import _
+from os_win import exceptions
+from os_win.utils import instrumentation
+
+# Resource instance ids look like Microsoft:<VM id>\<resource id>[\...]
+_INSTANCE_ID_REGEX = re.compile(
+    r'^Microsoft:([0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-'
+    r'[0-9a-f]{12})(\\|$)', re.IGNORECASE)
+_VM_ID_REGEX = re.compile(
+    r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$',
+    re.IGNORECASE)
+
+LOCK_CLASS = 'VM'
+EXCLUSIVE = 'exclusive'
+SHARED = 'shared'
+
+
+def get_vm_id(wmi_object):
+    """Returns the id of the VM owning the given object, or None.
+
+    The object may be a VM or a VM resource or feature setting data.
+    """
+    instance_id = getattr(wmi_object, 'InstanceID', None)
+    if isinstance(instance_id, six.string_types):
+        match = _INSTANCE_ID_REGEX.match(instance_id)
+        if match:
+            return match.group(1).upper()
+
+    name = getattr(wmi_object, 'Name', None)
+    if isinstance(name, six.string_types) and _VM_ID_REGEX.match(name):
+        return name.upper()
+    return None
+
+
+class _Waiter(object):
+    def __init__(self, shared):
+        self.shared = shared
+
+
+class _VMLock(object):
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        self.exclusive_owner = None
+        self.exclusive_count = 0
+        # Maps thread idents to the number of shared acquisitions.
+        self.shared_owners = collections.Counter()
+        self.waiters = collections.deque()
+
+    def is_idle(self):
+        return not (self.exclusive_owner or self.shared_owners or
+                    self.waiters)
+
+    def is_owner(self, ident):
+        return self.exclusive_owner == ident or ident in self.shared_owners
+
+    def can_acquire(self, waiter):
+        if self.exclusive_owner:
+            return False
+        if not waiter.shared:
+            return not self.shared_owners and self.waiters[0] is waiter
+        # Shared requests may only overtake other shared requests.
+        for other in self.waiters:
+            if other is waiter:
+                return True
+            if not other.shared:
+                return False
+
+
+class VMLockManager(object):
+    """Hands out per VM reader/writer locks, keyed by VM id.
+
+    Waiting requests are granted in order, shared requests being granted
+    together unless queued behind an exclusive request. Locks are reentrant
+    for the thread (or green thread) holding them, so locked operations may
+    call each other. Upgrading a shared lock to an exclusive one is not
+    allowed, as it may deadlock. For the same reason, while holding VM
+    locks, the locks of other VMs may only be acquired in VM id order.
+    The locks of multiple VMs should be acquired at once, using a single
+    lock or lock_objects call.
+
+    The lock wait time is instrumented, using the LOCK_WAIT category.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Maps VM ids to _VMLock objects, which are dropped once unused.
+        self._vm_locks = {}
+
+    def acquire(self, vm_id, shared=False):
+        vm_id = vm_id.upper()
+        ident = _thread.get_ident()
+        with self._lock:
+            vm_lock = self._vm_locks.get(vm_id)
+            if vm_lock is None:
+                vm_lock = self._vm_locks[vm_id] = _VMLock(self._lock)
+
+            if vm_lock.exclusive_owner == ident:
+                vm_lock.exclusive_count += 1
+                return
+            if ident in vm_lock.shared_owners:
+                if not shared:
+                    raise exceptions.OSWinException(
+                        _("Cannot upgrade the shared lock of VM %s.") %
+                        vm_id)
+                vm_lock.shared_owners[ident] += 1
+                return
+
+            out_of_order = [other_id for other_id, other_lock
+                            in self._vm_locks.items()
+                            if other_id > vm_id and
+                            other_lock.is_owner(ident)]
+            if out_of_order:
+                if vm_lock.is_idle():
+                    del self._vm_locks[vm_id]
+                raise exceptions.OSWinException(
+                    _("Cannot lock VM %(vm_id)s while holding the lock of "
+                      "VM %(other_vm_id)s. The locks of multiple VMs must "
+                      "be acquired at once.") %
+                    {'vm_id': vm_id, 'other_vm_id': out_of_order[0]})
+
+            waiter = _Waiter(shared)
+            vm_lock.waiters.append(waiter)
+            with instrumentation.measure(instrumentation.LOCK_WAIT,
+                                         LOCK_CLASS,
+                                         SHARED if shared else EXCLUSIVE):
+                while not vm_lock.can_acquire(waiter):
+                    vm_lock.condition.wait()
+            vm_lock.waiters.remove(waiter)
+
+            if shared:
+                vm_lock.shared_owners[ident] += 1
+                # Other shared requests may be granted as well.
+                vm_lock.condition.notify_all()
+            else:
+                vm_lock.exclusive_owner = ident
+                vm_lock.exclusive_count = 1
+
+    def release(self, vm_id):
+        vm_id = vm_id.upper()
+        ident = _thread.get_ident()
+        with self._lock:
+            vm_lock = self._vm_locks[vm_id]
+            if vm_lock.exclusive_owner == ident:
+                vm_lock.exclusive_count -= 1
+                if not vm_lock.exclusive_count:
+                    vm_lock.exclusive_owner = None
+            else:
+                vm_lock.shared_owners[ident] -= 1
+                if not vm_lock.shared_owners[ident]:
+                    del vm_lock.shared_owners[ident]
+
+            if vm_lock.is_idle():
+                del self._vm_locks[vm_id]
+            else:
+                vm_lock.condition.notify_all()
+
+    @contextlib.contextmanager
+    def lock(self, vm_ids, shared=False):
+        """Holds the locks of one or more VMs within the context.
+
+        :param vm_ids: a VM id or a list of VM ids. None values are
+                       ignored. Multiple locks are acquired in a consistent
+                       order, preventing deadlocks.
+        :param shared: acquire shared (reader) locks instead of exclusive
+                       ones.
+        """
+        if vm_ids is None or isinstance(vm_ids, six.string_types):
+            vm_ids = [vm_ids]
+        vm_ids = sorted(set(vm_id.upper() for vm_id in vm_ids if vm_id))
+
+        acquired = []
+        try:
+            for vm_id in vm_ids:
+                self.acquire(vm_id, shared)
+                acquired.append(vm_id)
+            yield
+        finally:
+            for vm_id in reversed(acquired):
+                self.release(vm_id)
+
+    def lock_objects(self, wmi_objects, shared=False):
+        """Locks the VMs owning the given VMs, resources or features."""
+        return self.lock([get_vm_id(wmi_object)
+                          for wmi_object in wmi_objects], shared)
+
+    def is_locked(self, vm_id):
+        with self._lock:
+            return vm_id.upper() in self._vm_locks
+
+
+_lock_manager = VMLockManager()
+
+
+def get_lock_manager():
+    return _lock_manager
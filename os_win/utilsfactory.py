@@ -13,6 +13,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import importutils
@@ -27,6 +29,14 @@ hyper_opts = [
     cfg.BoolOpt('force_volumeutils_v1',
                 default=False,
                 help='Force V1 volume utility class'),
+    cfg.BoolOpt('share_utils_instances',
+                default=False,
+                help='Return shared per host utils class instances instead '
+                     'of creating a new instance on each request.'),
+    cfg.BoolOpt('use_vm_inventory',
+                default=False,
+                help='Look up VMs using an in-memory index kept up to date '
+                     'by WMI events, instead of querying WMI each time.'),
 ]
 
 CONF = cfg.CONF
@@ -34,8 +44,19 @@ CONF.register_opts(hyper_opts, 'hyperv')
 
 LOG = logging.getLogger(__name__)
 
+# HostUtils binds its WMI connections lazily, so this does not touch WMI
+# at import time.
 utils = hostutils.HostUtils()
 
+# Maps (class type, host) tuples to the resolved utils classes. The classes
+# are picked based on the local Windows version, as they always were, but
+# are cached per host so that a class resolved for one host is never
+# assumed to be valid for another one.
+_utils_classes = {}
+# Maps (class type, host) tuples to shared utils instances.
+_utils_instances = {}
+_cache_lock = threading.Lock()
+
 utils_map = {
     'hostutils': {
         'HostUtils': {
@@ -108,69 +129,109 @@ utils_map = {
 }
 
 
-def _get_class(class_type):
+def _get_windows_version():
+    windows_version = utils.get_windows_version()
+    build = list(map(int, windows_version.split('.')))
+    return float("%i.%i" % (build[0], build[1]))
+
+
+def _get_class(class_type, host=None):
     if class_type not in utils_map:
         raise exceptions.HyperVException(_('Class type %s does '
                                            'not exist') % class_type)
 
-    windows_version = utils.get_windows_version()
-    build = list(map(int, windows_version.split('.')))
-    windows_version = float("%i.%i" % (build[0], build[1]))
+    key = (class_type, host or '.')
+    utils_class = _utils_classes.get(key)
+    if utils_class:
+        return utils_class
+
+    windows_version = _get_windows_version()
 
     existing_classes = utils_map.get(class_type)
     for class_variant in existing_classes.keys():
-        utils_class = existing_classes.get(class_variant)
-        if (utils_class['min_version'] <= windows_version and
-                (utils_class['max_version'] is None or
-                 windows_version < utils_class['max_version'])):
-            return importutils.import_object(utils_class['path'])
+        class_info = existing_classes.get(class_variant)
+        if (class_info['min_version'] <= windows_version and
+                (class_info['max_version'] is None or
+                 windows_version < class_info['max_version'])):
+            utils_class = importutils.import_class(class_info['path'])
+            _utils_classes[key] = utils_class
+            return utils_class
 
     raise exceptions.HyperVException(_('Could not find any %(class)s class for'
         'this Windows version: %(win_version)s')
         % {'class': class_type, 'win_version': windows_version})
 
 
+def _get_instance(class_type, utils_class, host=None):
+    args = (host, ) if host else ()
+    if not CONF.hyperv.share_utils_instances:
+        return utils_class(*args)
+
+    key = (class_type, host or '.')
+    with _cache_lock:
+        instance = _utils_instances.get(key)
+        if not instance:
+            instance = utils_class(*args)
+            _utils_instances[key] = instance
+        return instance
+
+
+def _get_utils(class_type, host=None):
+    return _get_instance(class_type, _get_class(class_type, host), host)
+
+
+def reset_cache():
+    """Drops the resolved utils classes and the shared utils instances."""
+    with _cache_lock:
+        _utils_classes.clear()
+        _utils_instances.clear()
+
+
 def get_vmutils(host='.'):
-    return _get_class(class_type='vmutils')
+    vmutils = _get_utils(class_type='vmutils', host=host)
+    if CONF.hyperv.use_vm_inventory:
+        vmutils.enable_vm_inventory()
+    return vmutils
 
 
 def get_vhdutils():
-    return _get_class(class_type='vhdutils')
+    return _get_utils(class_type='vhdutils')
 
 
 def get_networkutils():
-    return _get_class(class_type='networkutils')
+    return _get_utils(class_type='networkutils')
 
 
 def get_hostutils():
-    return _get_class(class_type='hostutils')
+    return _get_utils(class_type='hostutils')
 
 
 def get_pathutils():
-    return _get_class(class_type='pathutils')
+    return _get_utils(class_type='pathutils')
 
 
 def get_iscsi_initiator_utils(use_iscsi_cli=False):
     use_iscsi_cli = use_iscsi_cli or CONF.hyperv.force_volumeutils_v1
     if use_iscsi_cli:
-        return iscsi_cli_utils.ISCSIInitiatorCLIUtils()
-    return _get_class(class_type='iscsi_initiator_utils')
+        return _get_instance('iscsi_initiator_cli_utils',
+                             iscsi_cli_utils.ISCSIInitiatorCLIUtils)
+    return _get_utils(class_type='iscsi_initiator_utils')
 
 
 def get_livemigrationutils():
-    return _get_class(class_type='livemigrationutils')
+    return _get_utils(class_type='livemigrationutils')
 
 
 def get_smbutils():
-    return _get_class(class_type='smbutils')
+    return _get_utils(class_type='smbutils')
 
 
 def get_rdpconsoleutils():
-    return _get_class(class_type='rdpconsoleutils')
+    return _get_utils(class_type='rdpconsoleutils')
 
 
 def get_iscsi_target_utils():
-    return _get_class(class_type='iscsi_target_utils')
+    return _get_utils(class_type='iscsi_target_utils')
 
 
 def get_named_pipe_handler(*args, **kwargs):
@@ -178,4 +239,4 @@ def get_named_pipe_handler(*args, **kwargs):
 
 
 def get_fc_utils():
-    return _get_class(class_type='fc_utils')
+    return _get_utils(class_type='fc_utils')